@@ -0,0 +1,189 @@
+import math
+import numpy
+import Kittens.utils
+
+from SubtilePool import SubtilePool,BlockOpts
+
+_verbosity = Kittens.utils.verbosity(name="activeset");
+dprint = _verbosity.dprint;
+dprintf = _verbosity.dprintf;
+
+def _gather_values (x,shape,index,outshape):
+  """Gathers the slots given by index (a tuple of index arrays) from every array of the given shape in a nested
+  structure, and reshapes them to outshape. Scalars and other arrays are returned as is.""";
+  if isinstance(x,dict):
+    return dict([ (key,_gather_values(value,shape,index,outshape)) for key,value in x.iteritems() ]);
+  elif isinstance(x,(list,tuple)):
+    return type(x)([ _gather_values(value,shape,index,outshape) for value in x ]);
+  elif isinstance(x,numpy.ndarray) and x.shape == shape:
+    return x[index].reshape(outshape);
+  else:
+    return x;
+
+def _copy_values (x):
+  """Copies every array in a nested structure""";
+  if isinstance(x,dict):
+    return dict([ (key,_copy_values(value)) for key,value in x.iteritems() ]);
+  elif isinstance(x,(list,tuple)):
+    return type(x)(map(_copy_values,x));
+  elif isinstance(x,numpy.ndarray):
+    return x.copy();
+  else:
+    return x;
+
+def _scatter_values (x,y,shape,index,select):
+  """Inverse of _gather_values(): returns a copy of x in which the slots given by index are replaced by the
+  corresponding values of y, for those slots where the flat boolean array 'select' is True. Dict entries missing
+  from x or y are taken to be False (as is the case for gain flags).""";
+  if isinstance(y,dict):
+    keys = set(y.iterkeys())|set(x.iterkeys());
+    return dict([ (key,_scatter_values(x.get(key,False),y.get(key,False),shape,index,select)) for key in keys ]);
+  elif isinstance(y,(list,tuple)):
+    return type(y)([ _scatter_values(a,b,shape,index,select) for a,b in zip(x,y) ]);
+  if numpy.ndim(x) == 0 and numpy.ndim(y) == 0 and x == y:
+    return x;
+  out = numpy.empty(shape,numpy.result_type(x,y));
+  out[...] = x;
+  y = numpy.asarray(y);
+  out[tuple([ i[select] for i in index ])] = y.ravel()[select] if y.ndim else y;
+  return out;
+
+
+class ActiveSet (object):
+  """Iterates a solver over its active set of solution slots only.
+
+  Once a slot (subtile) has converged, its gains are frozen, and it is dropped from the problem. The data of the
+  remaining active subtiles is gathered into a compact problem of shape (N*M1,M2,...), where N is the
+  number of active subtiles and M1,M2,... is the subtile size, and a solver of the same class is run on that.
+  Results are scattered back into the parent solver, and the converged_mask/num_converged/delta_sq bookkeeping of
+  the parent is updated, with frozen slots counted as converged. To the rest of StefCal, ActiveSet.iterate() looks
+  exactly like solver.iterate().
+
+  Gathering the data is a full pass over the active subset, so iterations start on the full problem (i.e. on
+  the solver itself), and a compact problem is only (re)built when the active set has shrunk to below a fraction
+  (rebuild_fraction) of the current one. In between, slots that have converged are still computed, but their results
+  are discarded.
+
+  Subtiles are independent unless a smoothing kernel is in use, so in that case create() returns None.
+  """;
+
+  # the compact problem is rebuilt when the active set drops below this fraction of its size
+  rebuild_fraction = 0.5;
+
+  @staticmethod
+  def create (solver,lhs,rhs,bitflags,weight=None,nproc=0):
+    """Returns an ActiveSet for the given solver, or None if this is not possible.
+    If nproc>1, the compact problem is solved via a SubtilePool.""";
+    if solver.opts.smoothing:
+      dprint(1,"%s: smoothing kernel in use, active set mode disabled"%solver.opts.label);
+      return None;
+    return ActiveSet(solver,lhs,rhs,bitflags,weight,nproc);
+
+  def __init__ (self,solver,lhs,rhs,bitflags,weight=None,nproc=0):
+    self.solver = solver;
+    self.nproc = nproc;
+    # only the solvable interferometers are needed
+    keys = set();
+    for p,q in solver._solve_ifrs:
+      keys.update([(p,q),(q,p)]);
+    subset = lambda x:x and dict([ (pq,value) for pq,value in x.iteritems() if pq in keys ]);
+    self._data = subset(lhs),subset(rhs),subset(bitflags),subset(weight);
+    self._opts = BlockOpts(solver.opts);
+    # frozen slots (of shape subshape)
+    self.frozen = numpy.zeros(solver.subshape,bool);
+    self._compact = self._iterator = None;
+    self._compact_index = None;
+    self.num_iter = self.num_slot_iter = 0;
+
+  def _gather_data (self,x):
+    """Gathers the subtiles in self._compact_index from an array of shape datashape (or one broadcastable to it)""";
+    if numpy.isscalar(x) or x.size == 1:
+      return x;
+    solver = self.solver;
+    x = numpy.broadcast_to(x,tuple(solver.datashape)).reshape(
+          sum([ [k,m] for k,m in zip(solver.subshape,solver.subtiling) ],[]));
+    index = sum([ [i,slice(None)] for i in self._compact_index ],[]);
+    # the advanced indices are separated by slices, so the gathered axis comes first, giving shape N,M1,M2,...
+    return x[tuple(index)].reshape(self._compact.datashape);
+
+  def _rebuild (self,active):
+    """Builds compact problem for the given active set. If all slots are active, the "compact" problem is
+    the full problem, i.e. the solver itself""";
+    solver = self.solver;
+    self._close_iterator();
+    self._compact_index = numpy.nonzero(active);
+    nslots = len(self._compact_index[0]);
+    if nslots == active.size:
+      self._compact = solver;
+      self._compact_data = self._data;
+    else:
+      subtiling = list(solver.subtiling);
+      datashape = [nslots*subtiling[0]]+subtiling[1:];
+      self._compact = solver.__class__(datashape,datashape,subtiling,solver._solve_ifrs,opts=self._opts,
+                                       verbose=_verbosity.verbose);
+      gather = lambda x:x and dict([ (pq,map(self._gather_data,value) if isinstance(value,(list,tuple))
+                                              else self._gather_data(value))
+                                     for pq,value in x.iteritems() ]);
+      self._compact_data = map(gather,self._data);
+    self._iterator = SubtilePool.create(self._compact,self.nproc,*self._compact_data) or self._compact;
+    dprint(2,"%s: active set is %d/%d slots"%(solver.opts.label,nslots,active.size));
+
+  def iterate (self,lhs,rhs,bitflags,bounds=None,verbose=0,niter=0,weight=None):
+    """Same as solver.iterate(), but works on the active set only. Note that lhs, rhs, bitflags and weight must be the
+    same as the ones given to the constructor (the compact problem is built from those, so they are ignored here).""";
+    solver = self.solver;
+    active = ~self.frozen;
+    nactive = active.sum();
+    if not nactive:
+      # nothing left to do, report what we had
+      return (solver.num_converged >= solver.convergence_target),solver.delta_max,solver.delta_sq,0;
+    if self._compact is None or nactive < len(self._compact_index[0])*self.rebuild_fraction:
+      self._rebuild(active);
+    compact = self._compact;
+    subshape = tuple(solver.subshape);
+    if getattr(solver,'delta_sq',None) is None:
+      solver.delta_sq = numpy.zeros(subshape);
+    if compact is solver:
+      # full problem: the solver overwrites its own gains, so keep a copy of the current ones (iterate() may
+      # also modify them in place when flagging)
+      gain0,gainflags0,delta_sq0 = _copy_values(solver.gain),_copy_values(solver.gainflags),solver.delta_sq;
+    else:
+      # load current gains and gain flags into compact solver
+      gain0,gainflags0,delta_sq0 = solver.gain,solver.gainflags,solver.delta_sq;
+      compact.set_values(_gather_values(gain0,subshape,self._compact_index,compact.subshape));
+      compact.gainflags = _gather_values(gainflags0,subshape,self._compact_index,compact.subshape);
+    converged,maxdiff,deltas,nflag = self._iterator.iterate(*self._compact_data[:3],
+                                          bounds=bounds,verbose=verbose,niter=niter,weight=self._compact_data[3]);
+    # slots of the compact problem that are still active
+    select = active[self._compact_index];
+    self.num_iter += 1;
+    self.num_slot_iter += len(select);
+    # scatter results back into solver, keeping frozen slots as they were
+    scatter = lambda x,y:_scatter_values(x,y,subshape,self._compact_index,select);
+    gain,gainflags,delta_sq = scatter(gain0,compact.gain),scatter(gainflags0,compact.gainflags),scatter(delta_sq0,compact.delta_sq);
+    solver.set_values(gain);
+    solver.gainflags = gainflags;
+    solver.delta_sq = delta_sq;
+    solver.converged_mask = self.frozen|(delta_sq <= solver.opts.epsilon**2);
+    solver.gainnorm = compact.gainnorm;
+    solver.num_converged = solver.converged_mask.sum() - solver.padded_slots;
+    solver.delta_max = math.sqrt(delta_sq.max());
+    # freeze newly converged slots
+    self.frozen |= solver.converged_mask;
+    solver.opts.save_intermediate_values(niter);
+    dprint(3,"iter %d: %d active slots, %d now frozen"%(niter+1,select.sum(),self.frozen.sum()));
+    return (solver.num_converged >= solver.convergence_target),solver.delta_max,solver.delta_sq,nflag;
+
+  def _close_iterator (self):
+    if self._iterator is not None and self._iterator is not self._compact:
+      self._iterator.close();
+    self._compact = self._iterator = None;
+
+  def close (self):
+    """Releases the compact problem""";
+    self._close_iterator();
+    self._compact_index = None;
+    self._data = self._compact_data = None;
+    dprint(2,"%s: %d iterations over %d/%d slot-iterations (%.1f%%) of full problem"%(self.solver.opts.label,
+            self.num_iter,self.num_slot_iter,self.num_iter*self.frozen.size,
+            self.num_slot_iter*100./max(self.num_iter*self.frozen.size,1)));
@@ -0,0 +1,85 @@
+import collections
+import threading
+import numpy
+import Kittens.utils
+
+_verbosity = Kittens.utils.verbosity(name="applycache");
+dprint = _verbosity.dprint;
+dprintf = _verbosity.dprintf;
+
+def _nbytes (x):
+  """Returns total size of arrays in a (nested) list of visibilities""";
+  if isinstance(x,(list,tuple)):
+    return sum(map(_nbytes,x));
+  return x.nbytes if isinstance(x,numpy.ndarray) else 0;
+
+
+class ApplyCache (object):
+  """Memoizes the results of applying gain terms to visibilities.
+
+  Each result is identified by a tag (see below) and a baseline. A tag identifies a set of visibilities: inputs
+  such as the data or model of a tile are given tags by the caller (e.g. "data"), and the result of applying a gain
+  term to a set of visibilities is tagged as (operation,label,generation,regularize,input tag), where 'generation' is
+  the solver's generation counter, which is incremented whenever its gains change. Results of a chain of gain terms are
+  thus found again as long as none of the terms in the chain have changed, and never become stale, so no explicit
+  invalidation is needed within a tile. Generations start over with each tile, so the cache must be cleared
+  between tiles (StefCal does this at the start and the end of each tile).
+
+  Memory use is bounded by maxbytes, with least-recently-used entries evicted first. Cached results are shared
+  with the caller, so they must not be modified in place. The cache may be used from several threads at once (the
+  results themselves are computed outside the lock, so two threads may occasionally compute the same one).
+  """;
+
+  def __init__ (self,maxbytes=0):
+    self.maxbytes = maxbytes;
+    self._entries = collections.OrderedDict();
+    self.nbytes = 0;
+    self.hits = self.misses = self.evictions = 0;
+    self._lock = threading.Lock();
+
+  @staticmethod
+  def tag (op,solver,label,input_tag,regularize=0):
+    """Returns tag for the result of applying a gain term (with the given solver and label) to the input visibilities
+    identified by input_tag""";
+    return op,label,solver.generation,regularize,input_tag;
+
+  def apply (self,solver,label,vis,input_tag,pq):
+    """Returns solver.apply(vis,pq), cached""";
+    return self._get(self.tag("apply",solver,label,input_tag),pq,lambda:solver.apply(vis,pq));
+
+  def apply_inverse (self,solver,label,vis,input_tag,pq,regularize=0):
+    """Returns solver.apply_inverse(vis,pq,regularize=regularize), cached""";
+    return self._get(self.tag("apply_inverse",solver,label,input_tag,regularize),pq,
+                     lambda:solver.apply_inverse(vis,pq,regularize=regularize));
+
+  def _get (self,tag,pq,compute):
+    key = tag,pq;
+    with self._lock:
+      value = self._entries.pop(key,None);
+      if value is not None:
+        # re-insert at the end, so that the least recently used entries stay at the front
+        self._entries[key] = value;
+        self.hits += 1;
+        return value;
+      self.misses += 1;
+    value = compute();
+    if self.maxbytes > 0:
+      with self._lock:
+        if key in self._entries:
+          return self._entries[key];
+        self._entries[key] = value;
+        self.nbytes += _nbytes(value);
+        while self.nbytes > self.maxbytes and len(self._entries) > 1:
+          key0,value0 = self._entries.popitem(last=False);
+          self.nbytes -= _nbytes(value0);
+          self.evictions += 1;
+    return value;
+
+  def clear (self):
+    """Empties the cache, and reports the hit rate""";
+    if self.hits or self.misses:
+      dprint(1,"apply cache: %d hits, %d misses (%.1f%%), %d evictions, %.1f Mb in use"%(self.hits,self.misses,
+              self.hits*100./(self.hits+self.misses),self.evictions,self.nbytes/float(2**20)));
+    self._entries.clear();
+    self.nbytes = 0;
+    self.hits = self.misses = self.evictions = 0;
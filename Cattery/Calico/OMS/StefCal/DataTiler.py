@@ -1,8 +1,24 @@
 import numpy
 import operator
+import itertools
 from MatrixOps import *
 from Timba.Meq import meq
 
+def _subtile_runs (start,stop,nt):
+  """Splits the index range start:stop of an axis that is covered by subtiles of length nt into a run of whole
+  subtiles, and partial subtiles at either end. Returns list of (output slice,subtile slice,whole) tuples, with
+  output slices relative to start""";
+  i0 = min(-(-start//nt)*nt,stop);    # start of first whole subtile
+  i1 = max(stop//nt*nt,i0);           # end of last whole subtile
+  runs = [];
+  if start < i0:
+    runs.append((slice(0,i0-start),slice(start//nt,start//nt+1),False));
+  if i0 < i1:
+    runs.append((slice(i0-start,i1-start),slice(i0//nt,i1//nt),True));
+  if i1 < stop:
+    runs.append((slice(i1-start,stop-start),slice(i1//nt,i1//nt+1),False));
+  return runs;
+
 
 class DataTiler (object):
   """Support class to handle subtiling of data, i.e. covering every axis of length N with K subtiles of length M=N/K.
@@ -48,7 +64,9 @@ class DataTiler (object):
     if max(subtiling) == 1 and not force_subtiling:
       self.tiled_shape = self.datashape;
       self.tile_data = lambda x, dtype=None: x.astype(dtype) if ( not numpy.isscalar(x) and dtype and dtype != x.dtype ) else x
-      self.untile_data = self.tile_tiling = self.reduce_tiles = identity_function;
+      self.untile_data = self.tile_tiling = identity_function;
+      self.reduce_tiles = lambda x,method='sum',dtype=None: x.astype(dtype,copy=False) \
+                            if ( dtype and not numpy.isscalar(x) ) else x;
       self.expand_tiling = self._expand_trivial_subshape;
       self.subtiled_axes = ();
       self.tiling_slice = ();
@@ -90,29 +108,67 @@ class DataTiler (object):
     """Converts something of shape subshape into a subtiled_shape"""
     return x[self.tiling_slice] if not (numpy.isscalar(x) or x.size == 1) else x;
     
-  def reduce_tiles (self,x,method='sum'):
-    """reduces something of shape tiled_shape into a subshape by collapsing the M-axes""";
+  def reduce_tiles (self,x,method='sum',dtype=None):
+    """reduces something of shape tiled_shape into a subshape by collapsing the M-axes.
+    If dtype is given, the reduction is done (and the result returned) in that type, e.g. to accumulate
+    single-precision data in double precision""";
     try:
       if not (numpy.isscalar(x) or x.size == 1):
         for ax in self.subtiled_axes:
-          x = getattr(x,method)(ax);
+          x = getattr(x,method)(ax,dtype=dtype) if dtype else getattr(x,method)(ax);
       return x;
     except:
       print 'reduce_tiles exception, axes:',self.subtiled_axes,', arg:',getattr(x,'shape',());
       raise;
     
-  def expand_subshape (self,x,datashape=None,data_subset=None):
-    """expands subshape to original data shape"""
+  def reduce_stack (self,x,naxes=1,method='sum'):
+    """Same as reduce_tiles(tile_data(x)), but for a stack of arrays, i.e. for x of shape S+datashape, where S
+    is given by the first naxes axes of x. Returns array of shape S+subshape""";
+    if not self.subtiled_axes:
+      return x;
+    x = x.reshape(x.shape[:naxes]+tuple(self.tiled_shape));
+    for ax in self.subtiled_axes:
+      x = getattr(x,method)(naxes+ax);
+    return x;
+
+  def expand_subshape (self,x,datashape=None,data_subset=None,out=None):
+    """expands subshape to original data shape, and returns the given subset (a tuple of slices) of that.
+    Only the subset is filled in, directly from x, without a tiled or full-size temporary. If out is given,
+    the result is written into it, else a new vells (or, for non-float data, a new array) is allocated.""";
     if numpy.isscalar(x):
+      if out is not None:
+        out[...] = x;
+        return out;
       return x;
-    a = numpy.empty(self.tiled_shape,dtype=x.dtype);
-    a[...] = self.tile_subshape(x);
-    if x.dtype == bool:
-      b = numpy.zeros(datashape or self.datashape,bool);
-    else:
-      b = meq.complex_vells(datashape or self.datashape);
-    b[...] = self.untile_data(a);
-    return b[data_subset or ()];
+    shape = datashape or self.datashape;
+    subset = tuple(data_subset or ()) + (slice(None),)*(len(shape)-len(data_subset or ()));
+    ranges = [ slc.indices(n) for slc,n in zip(subset,shape) ];
+    if any([ step != 1 for start,stop,step in ranges ]):
+      raise ValueError,"expand_subshape: data subset %s must be contiguous"%(subset,);
+    ranges = [ (start,max(start,stop),step) for start,stop,step in ranges ];
+    if out is None:
+      outshape = tuple([ stop-start for start,stop,step in ranges ]);
+      if numpy.issubdtype(x.dtype,numpy.inexact):
+        out = meq.complex_vells(outshape);
+      else:
+        out = numpy.empty(outshape,x.dtype);
+    # fill in each combination of runs of whole and partial subtiles separately. For whole subtiles, the output axis
+    # is split into (subtile,offset) axes, and the corresponding value of x is broadcast along the offset axis
+    for runs in itertools.product(*[ _subtile_runs(start,stop,nt) for (start,stop,step),nt in zip(ranges,self.subtiling) ]):
+      target = out[tuple([ oslc for oslc,xslc,whole in runs ])].view();
+      tshape = [];
+      index = [];
+      for (oslc,xslc,whole),n,nt in zip(runs,target.shape,self.subtiling):
+        if whole:
+          tshape += [n//nt,nt];
+          index += [slice(None),numpy.newaxis];
+        else:
+          tshape.append(n);
+          index.append(slice(None));
+      # setting the shape attribute raises an error rather than silently copying, so this always writes into out
+      target.shape = tshape;
+      target[...] = x[tuple([ xslc for oslc,xslc,whole in runs ])][tuple(index)];
+    return out;
     
   def _expand_trivial_subshape (self,x,datashape=None,data_subset=None):
     a = meq.complex_vells(x.shape);
@@ -50,6 +50,8 @@ class Gain2x2 (DataTiler):
     self._zero  = numpy.zeros(self.subshape, dtype=self._dtype)
     self._unity = numpy.ones(self.subshape, dtype=self._dtype)
     self._nullflag =  numpy.zeros(self.subshape,dtype=bool);
+    # sums over baselines and tiles are accumulated in double precision, even if data and gains are single precision
+    self._reduce_acc = lambda x:self.reduce_tiles(x,dtype=numpy.complex128);
     self.gainflags = {};
     # init_value=1: init each parm with a unity Jones term
     # if init_value is a dict, use it to initialize each array with a different value
@@ -78,10 +80,13 @@ class Gain2x2 (DataTiler):
 ##      self.gain = dict([ (p,(default,self._zero,self._zero,default)) for p in self._antennas ]);
     # setup convergence targets
     self.convergence_target = round(self.real_slots*opts.convergence_quota);
+    # generation counter, incremented whenever the gains (may) change
+    self.generation = 0;
     self._reset();
     dprint(1,"convergence target %d of %d real slots"%(self.convergence_target,self.real_slots));
 
   def _reset (self):
+    self.generation += 1;
     self._apply_cache = {};
     self._apply_inverse_cache = {};
     self._residual_cache = {};
@@ -117,6 +122,17 @@ class Gain2x2 (DataTiler):
     else:
       return None;
 
+  def _get_Matrix (self,p,q,data,conj=False):
+    """Like _get_matrix() (or _get_conj_matrix(), if conj=True), but returns a new Matrix2x2 object""";
+    if (p,q) in data:
+      mat = Matrix2x2.from_list(data[p,q],transform=self.tile_data,dtype=self._dtype);
+    elif (q,p) in data:
+      mat = Matrix2x2.from_list(data[q,p],transform=self.tile_data,dtype=self._dtype);
+      conj = not conj;
+    else:
+      return None;
+    return mat.iconj() if conj else mat;
+
   def iterate (self,lhs,rhs,bitflags,bounds=None,verbose=0,niter=0,weight=None):
     self._reset();
     # G updates from step 0 and 1 go here
@@ -125,28 +141,32 @@ class Gain2x2 (DataTiler):
     nflag = 0;
     flags_per_antenna = {};
     gaindiff2 = {};
+    # work buffers for V, DV, V^H and V^H.V, plus scratch space for the multiplications. These are reused
+    # across all baselines (Matrix2x2.multiply() reallocates them if the shape changes)
+    vbuf = dvbuf = vhbuf = vhvbuf = scratch = None;
     for step,(gain0,gain1) in enumerate([(self.gain,gain0dict),(gain0dict,gain1dict)]):
       active_gain = gain0.copy() if self.opts.omega is not None else gain0;
+      # cache of tiled Matrix2x2 versions of the active gains
+      gmats = {};
       # loop over all antennas
       for p in self._antennas:
         pmask = self.gainflags.get(p,False);
         g0p = gain0[p];
         # build up sums
-        sum_dv = NULL_MATRIX();
-        sum_vhv = NULL_MATRIX();
+        sum_dv = sum_vhv = None;
         for q in self._antennas:
           if (p,q) in self._solve_ifrs or (q,p) in self._solve_ifrs:
-            # get D/D^H and M/M^H, depending on p<q or p>q
-            m = self._get_conj_matrix(p,q,lhs);
-            d = self._get_matrix(p,q,rhs);
+            # get D/D^H and M/M^H, depending on p<q or p>q. These are new copies, so we can modify them in place
+            m = self._get_Matrix(p,q,lhs,conj=True);
+            d = self._get_Matrix(p,q,rhs);
             if m is None or d is None:
               continue;
             if weight is not None:
               ww = weight.get((p,q),weight.get((q,p),None));
               if is_null(ww):
                 continue;
-              m = matrix_scale(m,ww);
-              d = matrix_scale(d,ww);
+              m.iscale(ww);
+              d.iscale(ww);
             # get applicable flags -- these are same shape as gains
             pqmask = pmask|self.gainflags.get(q,False);
             # get bitflag mask -- same shape as the data
@@ -154,60 +174,52 @@ class Gain2x2 (DataTiler):
             # zero flagged elements in data, model
             if numpy.any(bfmask):
               bfmask = self.tile_data(bfmask);
-              # copy matrices, unless we applied weight above, in which case we already have the copy
-              if weight is None:
-                d = matrix_copy(d);
-                m = matrix_copy(m);
-              for idm,dm in enumerate((d,m)):
-                for x in dm:
-                  if not is_null(x):
-#                    print ('m' if idm else 'd'),p,q,x.shape,bfmask.shape
-                    x[bfmask] = 0;
+              for dm in d,m:
+                if dm.shape:
+                  dm.data[bfmask] = 0;
             # get the current gain
-            g = map(self.tile_subshape,active_gain[q]);
-#            print p,q,niter,step,": M",[ is_null(x) for x in m ],"D",[ is_null(x) for x in d ],"G",[ is_null(x) for x in g ];
+            g = gmats.get(q);
+            if g is None:
+              g = gmats[q] = Matrix2x2.from_list(active_gain[q],transform=self.tile_subshape,dtype=self._dtype);
             # multiply and accumulate
-            v = matrix_multiply(g,m);
-            dv  = matrix_multiply(d,v);
-            vhv = matrix_multiply(matrix_conj(v),v);
-#            print "V",[ is_null(x) for x in v ],"DV",[ is_null(x) for x in dv ],"VHV",[ is_null(x) for x in vhv ];
-#            print m[1],d[1],v[1];
+            v   = vbuf   = Matrix2x2.multiply(g,m,out=vbuf,scratch=scratch);
+            scratch = self._scratch_for(v,scratch);
+            dv  = dvbuf  = Matrix2x2.multiply(d,v,out=dvbuf,scratch=scratch);
+            vh  = vhbuf  = self._copy_into(v,vhbuf).iconj();
+            vhv = vhvbuf = Matrix2x2.multiply(vh,v,out=vhvbuf,scratch=scratch);
             if (p,q) in verbose_baselines:
               print "%s%s"%(p,q),"D",[ g[verbose_element] for g in d[0],d[3] ],"M",[ g[verbose_element] for g in m[0],m[3] ];
               print "%s%s"%(p,q),"Gq",[ g[verbose_element] for g in gain0[q][0],gain0[q][3] ],"V",[ g[verbose_element] for g in v[0],v[3] ];
               print "%s%s"%(p,q),"DV",[ g[verbose_element] for g in dv[0],dv[3] ],"VHV",[ g[verbose_element] for g in vhv[0],vhv[3] ];
-            # reduce tiles back to gain shape
-            dv1 = map(self.reduce_tiles,dv);
-            vhv1 = map(self.reduce_tiles,vhv);
+            # reduce tiles back to gain shape (all four elements at once). Note that this may return the
+            # work buffers themselves (if there is no subtiling), so they must be added to the sums before the next q
+            dv1 = dv.reduce(self._reduce_acc);
+            vhv1 = vhv.reduce(self._reduce_acc);
             # mask out flagged elements
             if numpy.any(pqmask):
               for mat in dv1,vhv1:
-                for x in mat:
-                  if not is_null(x):
-                    x[pqmask] = 0;
+                mat.data[pqmask] = 0;
             # add
-            matrix_add1(sum_dv,dv1);
-            matrix_add1(sum_vhv,vhv1);
-        if all([is_null(x) for x in sum_vhv]):
+            if sum_dv is None:
+              sum_dv,sum_vhv = dv1.copy(),vhv1.copy();
+            else:
+              sum_dv.iadd(dv1);
+              sum_vhv.iadd(vhv1);
+        if sum_vhv is None or sum_vhv.null == 15:
           gain1[p] = g0p;
           continue;
 #        print p,q,niter,step,": SDV",[ is_null(x) for x in sum_dv ],"SVHV",[ is_null(x) for x in sum_vhv ];
         if self.opts.real_only:
-          dv  = [ x.real if not is_null(x) else x for x in sum_dv ];
-          vhv = [ x.real if not is_null(x) else x for x in sum_vhv ];
-        # smooth with gaussian, if enabled
+          dv  = [ x.real if not is_null(x) else x for x in sum_dv.as_list() ];
+          vhv = [ x.real if not is_null(x) else x for x in sum_vhv.as_list() ];
+        # smooth with gaussian, if enabled (null elements are zero, and stay zero)
         if self.opts.smoothing:
-          sum_vhv = [ x if is_null(x) else 
-                        scipy.ndimage.filters.gaussian_filter(x.real,self.opts.smoothing,mode='constant')
-                        +1j*scipy.ndimage.filters.gaussian_filter(x.imag,self.opts.smoothing,mode='constant') 
-                      for x in sum_vhv ];
-          sum_dv = [ x if is_null(x) else
-                        scipy.ndimage.filters.gaussian_filter(x.real,self.opts.smoothing,mode='constant')
-                        +1j*scipy.ndimage.filters.gaussian_filter(x.imag,self.opts.smoothing,mode='constant') 
-                     for x in sum_dv ];
+          sigma = list(self.opts.smoothing)+[0];
+          for mat in sum_vhv,sum_dv:
+            mat.data = scipy.ndimage.filters.gaussian_filter(mat.data.real,sigma,mode='constant') \
+                        +1j*scipy.ndimage.filters.gaussian_filter(mat.data.imag,sigma,mode='constant');
         # invert and do update
-        inv_vhv = matrix_invert(sum_vhv);
-        g1p = gain1[p] = matrix_multiply(sum_dv,inv_vhv);
+        g1p = gain1[p] = sum_dv.imul(sum_vhv.iinvert()).astype(self._dtype).as_list();
 #        print p,q,niter,step,": IVHV",[ is_null(x) for x in inv_vhv ],"G1P",[ is_null(x) for x in g1p ];
         
         if p in verbose_stations:
@@ -260,6 +272,7 @@ class Gain2x2 (DataTiler):
         # feed forward G', if enabled
         if self.opts.feed_forward:
           active_gain[p] = g1p;
+          gmats.pop(p,None);
 
     if flags_per_antenna:
       dprint(3,"new gain-flags: "," ".join(["%s:%d"%x for x in sorted(flags_per_antenna.iteritems())]));
@@ -277,6 +290,22 @@ class Gain2x2 (DataTiler):
     self.opts.save_intermediate_values(niter);
     return (self.num_converged >= self.convergence_target),self.delta_max,self.delta_sq,nflag;
     
+  @staticmethod
+  def _copy_into (mat,buf):
+    """Copies Matrix2x2 mat into buf, reallocating buf if needed. Returns buf""";
+    if buf is None or buf.data.shape != mat.data.shape or buf.data.dtype != mat.data.dtype:
+      return mat.copy();
+    buf.data[...] = mat.data;
+    buf.null = mat.null;
+    return buf;
+
+  @staticmethod
+  def _scratch_for (mat,scratch):
+    """Returns scratch array suitable for multiplications of the same shape as mat""";
+    if scratch is None or scratch.shape[:-1] != mat.shape or scratch.dtype != mat.data.dtype:
+      return numpy.empty(mat.shape+(3,),mat.data.dtype);
+    return scratch;
+
   def get_converged_mask (self):
     """Returns mask (of shape datashape) showing which t/f slots have been converged""";
     cmask = numpy.zeros(self.datashape,bool);
@@ -310,33 +339,33 @@ class Gain2x2 (DataTiler):
       outflags[p] = fl;
     return outflags;
 
+  # the following return (and cache) tiled Matrix2x2 versions of G, G^H, G^{-1} and G^{-H}
   def _G (self,p):
     g = self._gmat.get(p);
     if g is None:
-      g = self._gmat[p] = map(self.tile_subshape,self.gain[p]);
+      g = self._gmat[p] = Matrix2x2.from_list(self.gain[p],transform=self.tile_subshape,dtype=self._dtype);
     return g;
 
   def _Gconj (self,p):
     g = self._gconj.get(p);
     if g is None:
-      g = self._gconj[p] = matrix_conj(self._G(p));
+      g = self._gconj[p] = self._G(p).copy().iconj();
     return g;
 
   def _Ginv (self,p,reg=0):
     gi = self._ginv.get((p,reg));
     if gi is None:
-      a,b,c,d = self._G(p);
-      gi = self._ginv[p,reg] = matrix_maskinf(matrix_invert((a+reg,b,c,d+reg)));
+      gi = self._ginv[p,reg] = self._G(p).copy().iinvert(reg).imaskinf();
       if p in verbose_stations_corr:
-        print p,"G",[ g[verbose_element] for g in a,b,c,d ];
-        print p,"Ginv",[ g[verbose_element] for g in gi ];
+        print p,"G",[ g[verbose_element] for g in self._G(p).as_list() ];
+        print p,"Ginv",[ g[verbose_element] for g in gi.as_list() ];
 #      print "Inverting",p;
     return gi;
 
   def _Ginvconj (self,p,reg=0):
     gi = self._ginvconj.get((p,reg));
     if gi is None:
-      gi = self._ginvconj[p,reg] = matrix_conj(self._Ginv(p,reg));
+      gi = self._ginvconj[p,reg] = self._Ginv(p,reg).copy().iconj();
     return gi;
 
   def get_last_timeslot (self):
@@ -388,8 +417,7 @@ class Gain2x2 (DataTiler):
     tiler = tiler or self;
     appl = self._apply_cache.get(pq) if cache else None;
     if appl is None:
-      lhs = self._get_matrix(p,q,lhs);
-      appl = map(tiler.untile_data,matrix_multiply(self._G(p),matrix_multiply(lhs,self._Gconj(q))));
+      appl = self._get_Matrix(p,q,lhs).imul(self._Gconj(q)).ilmul(self._G(p)).as_list(tiler.untile_data);
       if cache:
         self._apply_cache[pq] = appl;
     return appl;
@@ -401,8 +429,8 @@ class Gain2x2 (DataTiler):
     tiler = tiler or self;
     appl = self._apply_inverse_cache.get(pq) if cache else None;
     if appl is None:
-      appl = map(tiler.untile_data,matrix_multiply(self._Ginv(p,regularize),
-        matrix_multiply(map(tiler.tile_data,rhs[pq]),self._Ginvconj(q,regularize))));
+      appl = Matrix2x2.from_list(rhs[pq],transform=tiler.tile_data,dtype=self._dtype);
+      appl = appl.imul(self._Ginvconj(q,regularize)).ilmul(self._Ginv(p,regularize)).as_list(tiler.untile_data);
       if cache:
         self._apply_inverse_cache[pq] = appl;
       if pq in verbose_baselines_corr:
@@ -0,0 +1,251 @@
+import numpy
+import math
+import scipy.ndimage.filters
+import Kittens.utils
+
+from MatrixOps import *
+
+_verbosity = Kittens.utils.verbosity(name="gain2x2v");
+dprint = _verbosity.dprint;
+dprintf = _verbosity.dprintf;
+
+from Gain2x2 import Gain2x2
+
+square = lambda x:(x*numpy.conj(x)).real;
+
+def _invert_2x2 (x):
+  """Inverts a stack of 2x2 matrices (last two axes). Singular matrices produce INF/NANs, these are
+  dealt with by the caller, as in MatrixOps.matrix_invert()""";
+  a,b,c,d = x[...,0,0],x[...,0,1],x[...,1,0],x[...,1,1];
+  det = a*d-b*c;
+  out = numpy.empty_like(x);
+  out[...,0,0] = d/det;
+  out[...,0,1] = -b/det;
+  out[...,1,0] = -c/det;
+  out[...,1,1] = a/det;
+  return out;
+
+class Gain2x2v (Gain2x2):
+  """Support class to handle a set of subtiled gains in the form of 2x2 G matrices.
+  Version 2x2v: iterate() works on dense stacked arrays covering all baselines at once, instead of looping over
+  antenna pairs in Python. Data, model and gains are kept in arrays of shape
+
+      tiled_shape + (Nant,Nant,2,2)        # data and model, one 2x2 matrix per p,q pair
+      subshape    + (Nant,2,2)             # gains, one 2x2 matrix per antenna
+
+  i.e. with the matrix axes trailing, so that the DataTiler methods (tile_subshape, reduce_tiles) apply unchanged
+  to the leading time/freq axes, and numpy.matmul/einsum operate on the trailing 2x2 axes.
+
+  If feed-forward is enabled, antennas are updated one at a time (as Gain2x2 does), but the sum over q for each
+  antenna is still done in a single batched operation. Otherwise all antennas are updated at once, except in the
+  second step of an iteration with bounds: Gain2x2 flags the out-of-bounds gains of each antenna as soon as it has
+  been updated, so that they drop out of the sums of the antennas after it, and this is done here too.
+
+  The dense data and model arrays are built on the first iterate() call, and reused for as long as the same
+  lhs, rhs, bitflags and weight dicts are passed in. Since their contents may change in place between solutions,
+  release_data() must be called at the start (and end) of each solution.
+
+  Everything except iterate() is inherited from Gain2x2, so solutions are stored in the same form (a dict of p->4-list),
+  and tables are interchangeable between the two classes.
+  """;
+
+  def __init__ (self,*args,**kw):
+    Gain2x2.__init__(self,*args,**kw);
+    _verbosity.set_verbose(kw.get('verbose',0));
+    _verbosity.enable_timestamps(True,modulo=6000);
+    self._antlist = sorted(self._antennas);
+    self._antindex = dict([ (p,i) for i,p in enumerate(self._antlist) ]);
+    # (lhs,rhs,bitflags,weight),(D,Mh,valid) of the last iterate() call
+    self._dense_cache = None;
+
+  def release_data (self):
+    """Drops the dense data and model arrays kept by iterate()""";
+    self._dense_cache = None;
+
+  def _dense_gains (self,gain):
+    """Converts a dict of p->4-list of gains into a dense array of shape subshape+(Nant,2,2)""";
+    G = numpy.zeros(tuple(self.subshape)+(len(self._antlist),2,2),self._dtype);
+    for ip,p in enumerate(self._antlist):
+      for x,(i,j) in zip(gain[p],IJ2x2):
+        if not is_null(x):
+          G[...,ip,i,j] = x;
+    return G;
+
+  def _dense_data (self,lhs,rhs,bitflags,weight):
+    """Converts data and model dicts into dense arrays of shape tiled_shape+(Nant,Nant,2,2).
+    Returns D,Mh,valid, where D[...,p,q,:,:] is D_pq, Mh[...,p,q,:,:] is M_pq^H, and valid is a boolean
+    Nant x Nant array telling us which p,q pairs contribute to the sums""";
+    nant = len(self._antlist);
+    shape = tuple(self.tiled_shape)+(nant,nant,2,2);
+    D  = numpy.zeros(shape,self._dtype);
+    Mh = numpy.zeros(shape,self._dtype);
+    valid = numpy.zeros((nant,nant),bool);
+    for pq in self._solve_ifrs:
+      p,q = pq;
+      ip,iq = self._antindex[p],self._antindex[q];
+      # each unordered pair is filled in in both orientations, so process it once
+      if valid[ip,iq]:
+        continue;
+      # find which orientation the data comes in (this is what _get_matrix() does)
+      key = pq if pq in rhs else ((q,p) if (q,p) in rhs else None);
+      if key is None or key not in lhs:
+        continue;
+      if weight is not None:
+        ww = weight.get(pq,weight.get((q,p),None));
+        if is_null(ww):
+          continue;
+      else:
+        ww = None;
+      # note that Gain2x2 only applies bitflags stored under the (p,q) key to the (p,q) equations,
+      # and not to their (q,p) conjugates. Mirror this here, so that solutions are identical
+      bfmask = dict([ (k,self.tile_data(bitflags[k]!=0)) for k in (pq,(q,p))
+                      if not is_null(bitflags.get(k,0)) and numpy.any(bitflags[k]) ]);
+      ia,ib = (ip,iq) if key == pq else (iq,ip);
+      for (i,j),d,m in zip(IJ2x2,rhs[key],lhs[key]):
+        if ww is not None:
+          d = 0 if is_null(d) else d*ww;
+          m = 0 if is_null(m) else m*ww;
+        if not is_null(d):
+          d = self.tile_data(d);
+          D[...,ia,ib,i,j] = d;
+          D[...,ib,ia,j,i] = numpy.conj(d);
+        if not is_null(m):
+          m = self.tile_data(m);
+          Mh[...,ia,ib,j,i] = numpy.conj(m);
+          Mh[...,ib,ia,i,j] = m;
+      for (a,b),fmask in bfmask.iteritems():
+        a,b = self._antindex[a],self._antindex[b];
+        D[...,a,b,:,:][fmask] = 0;
+        Mh[...,a,b,:,:][fmask] = 0;
+      valid[ip,iq] = valid[iq,ip] = True;
+    return D,Mh,valid;
+
+  def _get_dense_data (self,lhs,rhs,bitflags,weight):
+    """Returns _dense_data(), reusing the arrays of the previous call if it was given the same dicts""";
+    # an empty bitflags dict is as good as another
+    key = lhs,rhs,bitflags or None,weight;
+    cache = self._dense_cache;
+    if cache is None or any([ x is not y for x,y in zip(key,cache[0]) ]):
+      cache = self._dense_cache = key,self._dense_data(lhs,rhs,bitflags,weight);
+    return cache[1];
+
+  def _dense_gainflags (self):
+    """Returns gain flags as a boolean array of shape subshape+(Nant,)""";
+    GF = numpy.zeros(tuple(self.subshape)+(len(self._antlist),),bool);
+    for p,gf in self.gainflags.iteritems():
+      ip = self._antindex.get(p);
+      if ip is not None:
+        GF[...,ip] = gf;
+    return GF;
+
+  def _tile_stack (self,x,ntrail):
+    """Like tile_subshape(), but for arrays with ntrail extra trailing axes""";
+    if not self.tiling_slice:
+      return x;
+    return x[tuple(self.tiling_slice)+(slice(None),)*ntrail];
+
+  def _smooth (self,x):
+    sigma = list(self.opts.smoothing)+[0]*(x.ndim-len(self.subshape));
+    return scipy.ndimage.filters.gaussian_filter(x.real,sigma,mode='constant') + \
+            1j*scipy.ndimage.filters.gaussian_filter(x.imag,sigma,mode='constant');
+
+  def iterate (self,lhs,rhs,bitflags,bounds=None,verbose=0,niter=0,weight=None):
+    self._reset();
+    D,Mh,valid = self._get_dense_data(lhs,rhs,bitflags,weight);
+    # antennas with no contributing baselines keep their previous gains
+    has_data = valid.any(1);
+    # antenna groups processed together: all at once, or one at a time (in the same order as Gain2x2 goes through
+    # them) if feed-forward is on, or when flagging by bounds (see class docstring)
+    per_antenna = [ slice(self._antindex[p],self._antindex[p]+1) for p in self._antennas ];
+    G = self._dense_gains(self.gain);
+    GF = self._dense_gainflags();
+    nflag = 0;
+    flags_per_antenna = {};
+    gaindiff2 = 0;
+    for step in 0,1:
+      G0 = G;
+      G1 = numpy.empty_like(G0);
+      active = G0.copy() if self.opts.feed_forward else G0;
+      groups = per_antenna if self.opts.feed_forward or (step and bounds) else [ slice(None) ];
+      if step:
+        gd2 = numpy.zeros(GF.shape);
+      for slc in groups:
+        # V[...,p,q] = G_q*M_pq^H
+        V = numpy.matmul(self._tile_stack(active,3)[...,numpy.newaxis,:,:,:],Mh[...,slc,:,:,:]);
+        # zero out contributions from flagged gains (this is equivalent to Gain2x2 masking DV and VHV)
+        pqmask = GF[...,slc,numpy.newaxis] | GF[...,numpy.newaxis,:];
+        if pqmask.any():
+          V *= ~self._tile_stack(pqmask,2)[...,numpy.newaxis,numpy.newaxis];
+        # sum over q, and reduce tiles back to gain shape (accumulating in double precision)
+        sum_dv  = self._reduce_acc(numpy.einsum('...pqij,...pqjk->...pik',D[...,slc,:,:,:],V,dtype=numpy.complex128));
+        sum_vhv = self._reduce_acc(numpy.einsum('...pqji,...pqjk->...pik',numpy.conj(V),V,dtype=numpy.complex128));
+        V = None;
+        # smooth with gaussian, if enabled
+        if self.opts.smoothing:
+          sum_dv  = self._smooth(sum_dv);
+          sum_vhv = self._smooth(sum_vhv);
+        g0 = G0[...,slc,:,:];
+        # invert and do update
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+          g1 = numpy.matmul(sum_dv,_invert_2x2(sum_vhv));
+        # take mean with previous value
+        if self.opts.average == 1 or (self.opts.average == 2 and step):
+          if self.opts.omega == 0.5:
+            g1 += g0;
+            g1 *= 0.5;
+          else:
+            g1 *= self.opts.omega;
+            g1 += g0*(1-self.opts.omega);
+        # mask out infs/nans, flagged gains and antennas without data
+        mask = ~numpy.isfinite(g1);
+        mask |= GF[...,slc,numpy.newaxis,numpy.newaxis];
+        mask |= ~has_data[slc,numpy.newaxis,numpy.newaxis];
+        g1[mask] = g0[mask];
+        if step:
+          gd2[...,slc] = square(g1-g0).sum(-1).sum(-1);
+          # flag out-of-bounds gains
+          if bounds:
+            lower,upper = bounds;
+            absg = abs(g1[...,(0,1),(0,1)]);
+            flag = (absg<(lower or 0)).any(-1);
+            if upper:
+              flag |= (absg>upper).any(-1);
+            if flag.any():
+              GF[...,slc] |= flag;
+              gd2[...,slc][flag] = 0;
+              for k,p in enumerate(self._antlist[slc]):
+                fl = flag[...,k];
+                nfl = fl.sum();
+                if nfl:
+                  flags_per_antenna[p] = nfl;
+                  nflag += nfl;
+                  if p in self.gainflags:
+                    self.gainflags[p] |= fl;
+                  else:
+                    self.gainflags[p] = fl;
+              # reset flagged gains to unity -- as Gain2x2 does, this sets all four elements to 1
+              g1[flag] = 1;
+        G1[...,slc,:,:] = g1;
+        # feed forward G', if enabled
+        if self.opts.feed_forward:
+          active[...,slc,:,:] = g1;
+      if step:
+        gaindiff2 = gd2.sum(-1);
+      G = G1;
+
+    if flags_per_antenna:
+      dprint(3,"new gain-flags: "," ".join(["%s:%d"%x for x in sorted(flags_per_antenna.iteritems())]));
+
+    deltanorm_sq = gaindiff2;
+    gainnorm_sq  = square(G).sum(-1).sum(-1).sum(-1);
+    self.gainnorm = numpy.sqrt(gainnorm_sq).max();
+    # find how many have converged
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+      self.delta_sq = deltanorm_sq/gainnorm_sq;
+    self.delta_sq[gainnorm_sq==0] = 0;
+    self.converged_mask = self.delta_sq <= self.opts.epsilon**2;
+    self.num_converged = self.converged_mask.sum() - self.padded_slots;
+    self.delta_max = math.sqrt(self.delta_sq.max());
+    self.gain = dict([ (p,[ G[...,ip,i,j].copy() for i,j in IJ2x2 ]) for ip,p in enumerate(self._antlist) ]);
+    self.opts.save_intermediate_values(niter);
+    return (self.num_converged >= self.convergence_target),self.delta_max,self.delta_sq,nflag;
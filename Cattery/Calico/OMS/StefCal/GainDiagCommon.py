@@ -60,7 +60,12 @@ class GainDiagCommon (GainDiag):
     self._antennas = set();
     for ifr in self._solve_ifrs:
       self._antennas.update(ifr);
-    self._unity = numpy.ones(self.subshape,dtype=complex if not opts.real_only else float);
+    self._float = opts.use_float;
+    self._dtype = numpy.float64 if opts.real_only else (numpy.complex64 if self._float else numpy.complex128);
+    self._unity = numpy.ones(self.subshape,dtype=self._dtype);
+    # sums over baselines and tiles are accumulated in double precision, even if data and gains are single precision
+    self._acc_dtype = numpy.result_type(self._dtype,numpy.float64);
+    self._weight_dtype = numpy.float32 if self._float else numpy.float64;
     # init_value=1: init each parm with the _unity array
     # subsequent steps create new arrays, so sufficient to use the same initial value object for all antennas
     if init_value == 1:
@@ -82,17 +87,20 @@ class GainDiagCommon (GainDiag):
             g[slc] = value[slc];
     # else assume scalar init value, and use it to initialize default array
     else:
-      default = numpy.empty(self.subshape,dtype=complex);
+      default = numpy.empty(self.subshape,dtype=numpy.complex64 if self._float else complex);
       default[...] = init_value;
       self.gain = [ default, default ];
     # setup gain flags
     self.gainflags = False
     # setup convergence targets
     self.convergence_target = round(self.real_slots*opts.convergence_quota);
+    # generation counter, incremented whenever the gains (may) change
+    self.generation = 0;
     self._reset();
     dprint(1,"convergence target %d of %d real slots"%(self.convergence_target,self.real_slots));
 
   def _reset (self):
+    self.generation += 1;
     self._residual_cache = {};
     self._residual_inverse_cache = {};
     self._apply_cache = {};
@@ -100,6 +108,7 @@ class GainDiagCommon (GainDiag):
     self._gpgq = {};
     self._gpgq_inv = {};
     self._gp_inv = {};
+    self._gpgq_matrix = {};
 
   def get_values (self):
     return  [ g.copy() for g in self.gain ];
@@ -138,17 +147,19 @@ class GainDiagCommon (GainDiag):
             # get bitflag mask -- same shape as the data
             bfmask = bitflags.get(pq,0)!=0;
             # apply bitflag mask to make zero model/data
+            # (weights are cast to the precision of the data, so as not to promote single-precision data)
+            ww = numpy.asarray(ww,self._weight_dtype);
             m,d = m*ww,d*ww;
             if numpy.any(bfmask):
               m[bfmask] = 0;
               d[bfmask] = 0;
             # compute update
-            mh = self.tile_data(m)*self.tile_subshape(g0[j]);
-            dmh = self.tile_data(d)*mh;
+            mh = self.tile_data(m,dtype=self._dtype)*self.tile_subshape(g0[j]);
+            dmh = self.tile_data(d,dtype=self._dtype)*mh;
             mh2 = abs(mh)**2;
             # average over tiles
-            dmh = self.reduce_tiles(dmh);
-            mh2 = self.reduce_tiles(mh2);
+            dmh = self.reduce_tiles(dmh,dtype=self._acc_dtype);
+            mh2 = self.reduce_tiles(mh2,dtype=numpy.float64);
             # mask out flagged gain elements
             if not is_null(pqmask):
               dmh[pqmask] = 0;
@@ -174,7 +185,7 @@ class GainDiagCommon (GainDiag):
         else:
           # null sumsq in some slot means null model, so keep the gain constant there
           # (this is ok -- null model means simply that the slot was flagged)
-          gnew = g1[i] = sum_reim/sum_sq;
+          gnew = g1[i] = (sum_reim/sum_sq).astype(self._dtype);
           mask = sum_sq==0;
           gnew[mask] = gold[mask];
         # inf/nan gains means something else is very wrong, better print a diagnostic
@@ -60,7 +60,12 @@ class GainDiagPhase (DataTiler):
     for ifr in self._solve_ifrs:
       self._antennas.update(ifr);
       self._parms.update([(p,i) for p in ifr for i in range(2)]);
-    self._unity = numpy.ones(self.subshape,dtype=complex if not opts.real_only else float);
+    self._float = opts.use_float;
+    self._dtype = numpy.float64 if opts.real_only else (numpy.complex64 if self._float else numpy.complex128);
+    self._unity = numpy.ones(self.subshape,dtype=self._dtype);
+    # sums over baselines and tiles are accumulated in double precision, even if data and gains are single precision
+    self._acc_dtype = numpy.result_type(self._dtype,numpy.float64);
+    self._weight_dtype = numpy.float32 if self._float else numpy.float64;
     # init_value=1: init each parm with the _unity array
     # subsequent steps create new arrays, so sufficient to use the same initial value object for all antennas
     if init_value == 1:
@@ -81,17 +86,20 @@ class GainDiagPhase (DataTiler):
             g[slc] = value[slc];
     # else assume scalar init value, and use it to initialize default array
     else:
-      default = numpy.empty(self.subshape,dtype=complex);
+      default = numpy.empty(self.subshape,dtype=numpy.complex64 if self._float else complex);
       default[...] = init_value;
       self.gain = dict([ (pp,default) for pp in parms ]);
     # setup gain flags
     self.gainflags = {}
     # setup convergence targets
     self.convergence_target = round(self.real_slots*opts.convergence_quota);
+    # generation counter, incremented whenever the gains (may) change
+    self.generation = 0;
     self._reset();
     dprint(1,"convergence target %d of %d real slots"%(self.convergence_target,self.real_slots));
 
   def _reset (self):
+    self.generation += 1;
     self._residual_cache = {};
     self._residual_inverse_cache = {};
     self._apply_cache = {};
@@ -99,6 +107,7 @@ class GainDiagPhase (DataTiler):
     self._gpgq = {};
     self._gpgq_inv = {};
     self._gp_inv = {};
+    self._gpgq_matrix = {};
 
   def get_values (self):
     return self.gain.copy();
@@ -141,20 +150,22 @@ class GainDiagPhase (DataTiler):
             # get bitflag mask -- same shape as the data
             bfmask = bitflags.get(pq,0)!=0;
             # apply bitflag mask to make zero model/data
+            # (weights are cast to the precision of the data, so as not to promote single-precision data)
+            ww = numpy.asarray(ww,self._weight_dtype);
             m,d = m*ww,d*ww;
             if numpy.any(bfmask):
               m[bfmask] = 0;
               d[bfmask] = 0;
             # compute update
-            mh = self.tile_data(m)*self.tile_subshape(g0[q,j]);
-            dmh = self.tile_data(d)*mh;
+            mh = self.tile_data(m,dtype=self._dtype)*self.tile_subshape(g0[q,j]);
+            dmh = self.tile_data(d,dtype=self._dtype)*mh;
             mh2 = abs(mh)**2;
             if (p,q) in verbose_baselines and i==j:
               print "S%d %s%s:%s%s"%(step,p,q,i,j),"D",d[verbose_element],"MH",m[verbose_element], \
                   "Gq",g0[q,j][verbose_element],"V",mh[verbose_element],"DV",dmh[verbose_element],"VHV",mh2[verbose_element];
             # average over tiles
-            dmh = self.reduce_tiles(dmh);
-            mh2 = self.reduce_tiles(mh2);
+            dmh = self.reduce_tiles(dmh,dtype=self._acc_dtype);
+            mh2 = self.reduce_tiles(mh2,dtype=numpy.float64);
             # mask out flagged gain elements
             if not is_null(pqmask):
               dmh[pqmask] = 0;
@@ -183,7 +194,7 @@ class GainDiagPhase (DataTiler):
         else:
           # null sumsq in some slot means null model, so keep the gain constant there
           # (this is ok -- null model means simply that the slot was flagged)
-          gnew = g1[p,i] = sum_reim/sum_sq;
+          gnew = g1[p,i] = (sum_reim/sum_sq).astype(self._dtype);
           # reset amplitude to 1
           absval = abs(gnew);
           absnull = absval==0;
@@ -311,6 +322,20 @@ class GainDiagPhase (DataTiler):
       g = self._gpgq_inv[pq,i,j] = self.tile_subshape(gpgqi[0]*numpy.conj(gpgqi[1]));
     return g;
 
+  def gpgq_matrix (self,pq,inverse=False,regularize=0):
+    """Returns Matrix2x2 of Gp_i*conj(Gq_j) (or of its inverse) for all four i,j, tiled into subtile shape.
+    Applying the gains is then a single element-by-element multiplication.
+    Computes it on-demand, if not already cached""";
+    key = pq,inverse,regularize;
+    g = self._gpgq_matrix.get(key);
+    if g is None:
+      if inverse:
+        elems = [ self.gpgq_inv(pq,i,j,regularize=regularize) for i,j in IJ2x2 ];
+      else:
+        elems = [ self.gpgq(pq,i,j) for i,j in IJ2x2 ];
+      g = self._gpgq_matrix[key] = Matrix2x2.from_list(elems,dtype=None);
+    return g;
+
   def get_last_timeslot (self):
     """Returns dict of p->g, where p is a parm ID, and g is the gain solution for the last timeslot.
     This can be used to initialize new gain objects (for init_value)"""
@@ -362,8 +387,8 @@ class GainDiagPhase (DataTiler):
     appl = self._apply_cache.get(pq) if cache else None;
     if appl is None:
 #      print [ (getattr(tiler.untile_data(tiler.tile_data(d)),'shape',()),getattr(self.gpgq(pq,i,j),'shape',())) for d,(i,j) in zip(lhs,IJ2x2) ];
-      appl = [ 0 if is_null(d) else tiler.untile_data(tiler.tile_data(d)*self.gpgq(pq,i,j))
-                                   for d,(i,j) in zip(lhs,IJ2x2) ];
+      appl = Matrix2x2.from_list(lhs,transform=tiler.tile_data,dtype=None);
+      appl = appl.imul_elementwise(self.gpgq_matrix(pq)).as_list(tiler.untile_data);
       if cache:
         self._apply_cache[pq] = appl;
       if pq in verbose_baselines_corr:
@@ -377,9 +402,8 @@ class GainDiagPhase (DataTiler):
     tiler = tiler or self;
     appl = self._apply_inverse_cache.get(pq) if cache else None;
     if appl is None:
-      mod = rhs[pq];
-      appl = [ 0 if is_null(m) else tiler.untile_data(tiler.tile_data(m)*
-                  self.gpgq_inv(pq,i,j,regularize=regularize)) for m,(i,j) in zip(mod,IJ2x2) ];
+      appl = Matrix2x2.from_list(rhs[pq],transform=tiler.tile_data,dtype=None);
+      appl = appl.imul_elementwise(self.gpgq_matrix(pq,True,regularize)).as_list(tiler.untile_data);
       if cache:
         self._apply_inverse_cache[pq] = appl;
     return appl;
@@ -8,10 +8,15 @@ import cPickle
 import numpy
 import traceback
 
+import GainTable
+
 MODE_SOLVE_SAVE = "solve-save";
 MODE_SOLVE_NOSAVE = "solve-nosave"
 MODE_SOLVE_APPLY = "apply"
 
+TABLE_PICKLE = "pickle";
+TABLE_BINARY = "binary";
+
 TIMEMED = "time"; 
 FREQMED = "freq";
 TOTMED  = "overall";
@@ -66,7 +71,7 @@ class GainOpts (object):
               TDLOption("flag_ampl_low","Lower threshold (0 disables)",[0,.5],more=float,default=0,namespace=self),
               TDLOption("flag_ampl_high","Upper threshold (0 disables)",[0,1.5],more=float,default=0,namespace=self),
             toggle='flag_ampl',namespace=self),
-          TDLOption("implementation","Jones matrix type",["GainDiag","Gain2x2","Gain2x2a","GainDiagCommon","GainDiagPhase" ] ,namespace=self),
+          TDLOption("implementation","Jones matrix type",["GainDiag","Gain2x2","Gain2x2a","Gain2x2v","GainDiagCommon","GainDiagPhase" ] ,namespace=self),
           TDLOption("mode","Solution mode",
             {MODE_SOLVE_SAVE:"solve and save",MODE_SOLVE_NOSAVE:"solve, do not save",MODE_SOLVE_APPLY:"load and apply"},
             default=MODE_SOLVE_SAVE,namespace=self),
@@ -91,6 +96,8 @@ class GainOpts (object):
               TDLOption("ff","Enable feed-forward averaging",True,namespace=self),
               TDLOption("table","Filename for solution table",["%s.cp"%name],more=str,namespace=self),
               TDLOption("intermediate_table","Filename for intermediate values table",[None,"intermediate-%s.cp"%name],more=str,namespace=self),
+              TDLOption("table_format","Format of solution tables",
+                {TABLE_PICKLE:"pickle",TABLE_BINARY:"binary (memory-mapped, written tile by tile)"},default=TABLE_PICKLE,namespace=self),
             )
         ] + post_opts;
       self._menuopt = TDLMenu("Use '%s' %s"%(label,desc),toggle='enabled',namespace=self,*menuopts)
@@ -98,6 +105,10 @@ class GainOpts (object):
       self.tdl_options = [ self._menuopt ];
     # other stuff
     self.tiler = self.vis_tiler = None;
+    # WarmStart object used to predict initial values from previous tiles, if enabled (see StefCalNode)
+    self.warm_start = None;
+    # number of iterations done on the current tile
+    self.num_iter = 0;
       
   def update_state (self,node,mystate=None,verbose=None,option_suffix=None):
     """Called from StefCal node to update state record""";
@@ -138,6 +149,7 @@ class GainOpts (object):
             ('bounds',[]),
             ('table','%s.cp'%self.name),
             ('intermediate_table',None),
+            ('table_format',TABLE_PICKLE),
             ('implementation','GainDiag'),
           ]:
       # for each OPTION, init node state field NAME_OPTION,
@@ -188,6 +200,7 @@ class GainOpts (object):
     kw['%s_feed_forward'%name] = self.ff;
     kw['%s_table'%name]      = self.table;
     kw['%s_intermediate_table'%name] = self.intermediate_table;
+    kw['%s_table_format'%name] = self.table_format;
     kw['%s_solve'%name]      = (self.mode != MODE_SOLVE_APPLY);
     kw['%s_save'%name]       = (self.mode == MODE_SOLVE_SAVE);
     kw['%s_implementation'%name] = self.implementation;
@@ -212,6 +225,8 @@ class GainOpts (object):
     """Loads initial values from table (if available)"""
     self.init_value = default;
     self.has_init_value = False;
+    if self.warm_start:
+      self.warm_start.reset();
     if not self.enable:
       return;
     if not os.path.exists(self.table):
@@ -220,7 +235,7 @@ class GainOpts (object):
     try:
       struct = GainOpts._incoming_tables.get(self.table);
       if not struct:
-        struct = GainOpts._incoming_tables[self.table] = cPickle.load(file(self.table));
+        struct = GainOpts._incoming_tables[self.table] = GainTable.load_table(self.table);
       if not isinstance(struct,dict) or struct.get('version',0) < 2:
         dprint(0,"error loading %s solutions: %s format or version not known"%(self.label,self.table));
         return;
@@ -238,31 +253,119 @@ class GainOpts (object):
       traceback.print_exc();
       dprint(0,"error loading %s solutions from"%self.label,self.table);
 
+  # binary tables that were opened for resuming, as filename -> GainTable (or None if not binary)
+  _resume_tables = {};
+
+  def load_tile_solutions (self,domain):
+    """Loads solutions for the given domain into the solver, if the (binary) solutions table already contains them
+    (i.e. if they were written by a previous run that was interrupted). Returns True if solutions were loaded.""";
+    if not self.enable or self.table_format != TABLE_BINARY:
+      return False;
+    try:
+      if self.table not in GainOpts._resume_tables:
+        GainOpts._resume_tables[self.table] = \
+          GainTable.GainTable(self.table) if GainTable.is_binary_table(self.table) else None;
+      table = GainOpts._resume_tables[self.table];
+      if table is None or not table.has_domain(self.label,domain):
+        return False;
+      gains = table.get(self.label,domain);
+      if gains['implementation'] != self.implementation:
+        dprint(0,"%s solutions in %s are for class %s, expected %s"%(self.label,self.table,gains['implementation'],self.implementation));
+        return False;
+      # copy the solutions out of the memory map, since the solver owns them from now on
+      def copy (x):
+        if isinstance(x,dict):
+          return dict([ (key,copy(value)) for key,value in x.iteritems() ]);
+        elif isinstance(x,(list,tuple)):
+          return type(x)(map(copy,x));
+        elif isinstance(x,numpy.ndarray):
+          return numpy.array(x);
+        return x;
+      self.solver.set_values(copy(gains['solutions']));
+      return True;
+    except:
+      traceback.print_exc();
+      dprint(0,"error loading %s solutions from"%self.label,self.table);
+      return False;
+
   _outgoing_tables = {};
-        
-  def save_values (self):
+  # formats of outgoing tables
+  _outgoing_formats = {};
+  # open writers for binary intermediate tables, these are appended to as solutions come in
+  _intermediate_writers = {};
+  # background writer for binary solution tables, started on first use
+  _streamer = None;
+
+  def save_values (self,domain=None,append=False):
+    """Saves current solutions. For binary tables, these are queued up for writing in the background, and
+    appended to the table as a record for the given domain. If this is the first write to the table since
+    close_tables(), append=False starts a new table, while append=True adds to the existing one.
+    Pickled tables are kept in memory, and written out by flush_tables()""";
     if self.save:
-      GainOpts._outgoing_tables.setdefault(self.table,{})[self.label] = \
-        dict(solutions=self.solver.gain,implementation=self.implementation);
+      if self.table_format == TABLE_BINARY:
+        if GainOpts._streamer is None:
+          GainOpts._streamer = GainTable.TableStreamer();
+        GainOpts._streamer.write(self.table,self.label,self.solver.gain,self.implementation,
+                                 domain=domain,append=append);
+      else:
+        GainOpts._outgoing_tables.setdefault(self.table,{})[self.label] = \
+          dict(solutions=self.solver.gain,implementation=self.implementation);
+        GainOpts._outgoing_formats[self.table] = self.table_format;
 
   def save_intermediate_values (self,niter):
     if self.intermediate_table:
-      GainOpts._outgoing_tables.setdefault(self.intermediate_table,{})[self.label,niter] = \
-        dict(solutions=self.solver.gain,implementation=self.implementation);
+      if self.table_format == TABLE_BINARY:
+        writer = GainOpts._intermediate_writers.get(self.intermediate_table);
+        if writer is None:
+          writer = GainOpts._intermediate_writers[self.intermediate_table] = \
+            GainTable.GainTableWriter(self.intermediate_table);
+        writer.write((self.label,niter),self.solver.gain,self.implementation);
+      else:
+        GainOpts._outgoing_tables.setdefault(self.intermediate_table,{})[self.label,niter] = \
+          dict(solutions=self.solver.gain,implementation=self.implementation);
 
   @staticmethod 
   def flush_tables ():
     GainOpts._incoming_tables = {};
     for table,initval in GainOpts._outgoing_tables.iteritems():
       if initval:
-        struct = dict(description="stefcal gain solutions table",version=2,gains=initval);
         try:
-          cPickle.dump(struct,file(table,'w'),2);
+          if GainOpts._outgoing_formats.get(table) == TABLE_BINARY:
+            writer = GainTable.GainTableWriter(table);
+            for key,gains in initval.iteritems():
+              writer.write(key,gains['solutions'],gains['implementation']);
+            writer.close();
+          else:
+            struct = dict(description="stefcal gain solutions table",version=2,gains=initval);
+            cPickle.dump(struct,file(table,'w'),2);
           dprint(1,"saved %d gain set(s) to %s"%(len(initval),table));
         except:
           traceback.print_exc();
           dprint(0,"error saving gains to",table);
+    for table,writer in GainOpts._intermediate_writers.iteritems():
+      try:
+        writer.close();
+        dprint(1,"saved %d intermediate gain set(s) to %s"%(writer.num_records,table));
+      except:
+        traceback.print_exc();
+        dprint(0,"error saving gains to",table);
     GainOpts._outgoing_tables = {};
+    GainOpts._outgoing_formats = {};
+    GainOpts._intermediate_writers = {};
+
+  @staticmethod
+  def close_tables ():
+    """Flushes all tables, and waits for the background writer to finish with the binary ones""";
+    GainOpts.flush_tables();
+    GainOpts._resume_tables = {};
+    if GainOpts._streamer is not None:
+      try:
+        for table,nrec in GainOpts._streamer.close().iteritems():
+          dprint(1,"saved %d gain set(s) to %s"%(nrec,table));
+      except:
+        traceback.print_exc();
+        dprint(0,"error saving gains");
+      GainOpts._streamer = None;
 
   @staticmethod
 #  @profile
@@ -296,17 +399,24 @@ class GainOpts (object):
 
     return expanded_datashape;
 
-  def init_solver (self,datashape,expanded_datashape,solvable_ifrs,downsample_subtiling):
-    """Initializes gain solver object""";
+  def init_solver (self,datashape,expanded_datashape,solvable_ifrs,downsample_subtiling,domain=None):
+    """Initializes gain solver object. If a domain is given and warm start is enabled, initial values are
+    extrapolated from the solutions of previous tiles, if possible""";
     if not self.enable:
       return;
+    self.num_iter = 0;
+    init_value = self.warm_start and domain and self.warm_start.predict(domain,expanded_datashape,self.subtiling);
+    if init_value is None:
+      init_value = self.init_value;
     dprintf(0,"stefcal %s solve=%d %s, using %d solvable inteferometers\n",
       self.label,self.solve,self.impl_class.__name__,
       len(solvable_ifrs));
     dprint(0,"  solution intervals:",self.subtiling,"smoothing kernel:",self.smoothing);
     if self.bounds:
       dprint(0,"  gains will be flagged on amplitudes outside of",self.bounds);
-    if self.has_init_value:
+    if init_value is not self.init_value:
+      dprint(1,"  initial values extrapolated from previous tiles");
+    elif self.has_init_value:
       initval = self.init_value.values()[0][0];
       dprint(1,"  initial values loaded, first number is",initval.flat[0] if hasattr(initval,'flat') else initval);
     else:
@@ -315,10 +425,21 @@ class GainOpts (object):
     self.solver = self.impl_class(datashape,expanded_datashape,
         self.subtiling,solvable_ifrs,opts=self,
         force_subtiling=bool(downsample_subtiling),
-        init_value=self.init_value,
+        init_value=init_value,
         verbose=_verbosity.verbose);
+    self._datashapes = datashape,expanded_datashape;
     dprint(1,"  subshape",self.solver.subshape,"tiled",self.solver.tiled_shape);
 
-  def update_initval (self):
-    self.init_value = self.solver.get_last_timeslot();
+  def update_initval (self,use_previous=True,domain=None,solved=True,loaded=False):
+    """Called at the end of a tile. If use_previous is True, the last timeslot of the solutions becomes the
+    initial value for the next tile. If warm start is enabled and a domain is given, the solutions are added to its
+    history if the tile was solved, or if its solutions were loaded from a table (loaded=True), and if solved is True,
+    its prediction for this tile is scored against them. Unsolved tiles (e.g. with no valid data) are not added, since
+    their "solutions" are merely the initial values, i.e. the warm start prediction itself""";
+    if use_previous:
+      self.init_value = self.solver.get_last_timeslot();
+    if self.warm_start and domain and (solved or loaded):
+      datashape,expanded_datashape = self._datashapes;
+      self.warm_start.record(self.solver.gain,domain,expanded_datashape,self.subtiling,datashape,
+                             niter=self.num_iter if solved else None);
         
\ No newline at end of file
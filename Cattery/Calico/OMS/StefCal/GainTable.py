@@ -0,0 +1,328 @@
+"""Binary gain solutions tables.
+
+A binary table is a single file made up of a 16-byte file header, followed by any number of records:
+
+    file header:    "SCGTABLE" magic, uint32 format version, uint32 reserved
+    record header:  "SCGR" magic, uint32 length of metadata, uint64 length of data
+    metadata:       pickled dict(key=...,implementation=...,solutions=...,domain=...)
+    data:           raw array data, each array aligned to ALIGNMENT bytes
+
+Each record holds one set of solutions, i.e. one entry of the 'gains' dict of a version-2 pickled table,
+with 'key' being the gain label (or a label,niter tuple for intermediate tables). 'domain' optionally identifies the
+tile (domain) that the solutions were obtained for. In the 'solutions' structure
+of the metadata, arrays are replaced by {ARRAY_TAG:(dtype,shape,offset)} entries, where offset is relative to the start
+of the record data. Arrays are mapped from the file when a table is loaded, so only those parts of a table that are
+actually used get read in.
+
+New records are simply appended to the end of a file. If several records have the same key, the last one is used
+(unless a specific domain is asked for). A TableStreamer can be used to append records in a background thread as
+solutions become available. If a writer is interrupted mid-record, the partial record at the end of the file is
+ignored by readers, and cut off when the table is next opened for appending.
+""";
+
+import os
+import os.path
+import struct
+import cPickle
+import threading
+import Queue
+import atexit
+import traceback
+import numpy
+import Kittens.utils
+
+_verbosity = Kittens.utils.verbosity(name="gaintable");
+dprint = _verbosity.dprint;
+dprintf = _verbosity.dprintf;
+
+FILE_MAGIC = "SCGTABLE";
+RECORD_MAGIC = "SCGR";
+FORMAT_VERSION = 1;
+ALIGNMENT = 64;
+ARRAY_TAG = "__array__";
+
+_file_header = struct.Struct("<8sII");
+_record_header = struct.Struct("<4sIQ");
+
+def _padding (offset):
+  return (ALIGNMENT - offset%ALIGNMENT)%ALIGNMENT;
+
+def is_binary_table (filename):
+  """Returns True if filename is a binary gain table""";
+  try:
+    ff = open(filename,"rb");
+    try:
+      return ff.read(len(FILE_MAGIC)) == FILE_MAGIC;
+    finally:
+      ff.close();
+  except IOError:
+    return False;
+
+
+def _scan_records (ff,filename):
+  """Reads the headers of a binary table from open file ff. Returns version,list of (metadata,data offset) for each
+  record,offset of the end of the last complete record. A partial record at the end of the file (as left behind by a
+  writer that was interrupted mid-write) is ignored, and the returned end offset excludes it.""";
+  header = ff.read(_file_header.size);
+  if len(header) < _file_header.size:
+    raise IOError,"%s: not a binary gain table"%filename;
+  magic,version,dum = _file_header.unpack(header);
+  if magic != FILE_MAGIC:
+    raise IOError,"%s: not a binary gain table"%filename;
+  if version > FORMAT_VERSION:
+    raise IOError,"%s: gain table format version %d not supported"%(filename,version);
+  filesize = os.fstat(ff.fileno()).st_size;
+  records = [];
+  end_offset = ff.tell();
+  while True:
+    offset = end_offset;
+    ff.seek(offset);
+    header = ff.read(_record_header.size);
+    if len(header) < _record_header.size:
+      break;
+    magic,metalen,datalen = _record_header.unpack(header);
+    if magic != RECORD_MAGIC:
+      raise IOError,"%s: corrupt record at offset %d"%(filename,offset);
+    data_offset = offset + _record_header.size + metalen;
+    data_offset += _padding(data_offset);
+    if data_offset + datalen > filesize:
+      break;
+    try:
+      meta = cPickle.loads(ff.read(metalen));
+    except Exception:
+      # only the last record can have been left incomplete
+      if data_offset + datalen < filesize:
+        raise IOError,"%s: corrupt record at offset %d"%(filename,offset);
+      break;
+    records.append((meta,data_offset));
+    end_offset = data_offset + datalen;
+  if end_offset < filesize:
+    dprint(1,"%s: ignoring incomplete record at offset %d"%(filename,end_offset));
+  return version,records,end_offset;
+
+
+class GainTable (object):
+  """Reads a binary gain table. Solutions are returned as memory-mapped arrays.""";
+  def __init__ (self,filename):
+    self.filename = filename;
+    # index is a dict of key -> (metadata,data offset)
+    self.index = {};
+    self.keys = [];
+    # domain_index is a dict of key,domain -> (metadata,data offset), for records that have a domain
+    self.domain_index = {};
+    ff = open(filename,"rb");
+    try:
+      self.version,records,self.end_offset = _scan_records(ff,filename);
+    finally:
+      ff.close();
+    for meta,data_offset in records:
+      if meta['key'] not in self.index:
+        self.keys.append(meta['key']);
+      self.index[meta['key']] = meta,data_offset;
+      if meta.get('domain') is not None:
+        self.domain_index[meta['key'],meta['domain']] = meta,data_offset;
+    self._mmap = None;
+
+  def _map (self):
+    if self._mmap is None:
+      self._mmap = numpy.memmap(self.filename,dtype=numpy.uint8,mode='r');
+    return self._mmap;
+
+  def has_domain (self,key,domain):
+    """Returns True if the table has solutions for the given key and domain""";
+    return (key,domain) in self.domain_index;
+
+  def get (self,key,domain=None):
+    """Returns entry for key, as a dict(solutions=...,implementation=...). If domain is given,
+    returns the entry for that domain, else the last one written.""";
+    meta,data_offset = self.index[key] if domain is None else self.domain_index[key,domain];
+    buf = self._map();
+    def unpack (x):
+      if isinstance(x,dict):
+        if len(x) == 1 and ARRAY_TAG in x:
+          dtype,shape,offset = x[ARRAY_TAG];
+          return numpy.ndarray(shape,numpy.dtype(dtype),buf,data_offset+offset);
+        return dict([ (key,unpack(value)) for key,value in x.iteritems() ]);
+      elif isinstance(x,(list,tuple)):
+        return type(x)(map(unpack,x));
+      else:
+        return x;
+    return dict(solutions=unpack(meta['solutions']),implementation=meta['implementation']);
+
+  def as_struct (self):
+    """Returns contents in the same form as a version-2 pickled table""";
+    return dict(description="stefcal gain solutions table",version=2,
+                gains=dict([ (key,self.get(key)) for key in self.keys ]));
+
+
+class GainTableWriter (object):
+  """Writes records to a binary gain table. If append=True and the file exists, records are appended to it,
+  otherwise a new file is started. New files are written under a temporary name and renamed into place, so that
+  any readers that still have the old file mapped are not affected. This is done when the writer is closed, or, if
+  streaming=True, straight away (so that each record is on disk as soon as it has been written).""";
+  def __init__ (self,filename,append=False,streaming=False):
+    self.filename = filename;
+    if append and is_binary_table(filename):
+      self._tmpname = None;
+      self._file = open(filename,"r+b");
+      # drop any incomplete record left at the end by an interrupted writer, so that new records follow
+      # the last complete one
+      end_offset = _scan_records(self._file,filename)[2];
+      self._file.truncate(end_offset);
+      self._file.seek(end_offset);
+    else:
+      self._tmpname = "%s.tmp%d"%(filename,os.getpid());
+      self._file = open(self._tmpname,"wb");
+      self._file.write(_file_header.pack(FILE_MAGIC,FORMAT_VERSION,0));
+      if streaming:
+        self._file.flush();
+        os.rename(self._tmpname,filename);
+        self._tmpname = None;
+    self.num_records = 0;
+
+  def write (self,key,solutions,implementation,domain=None):
+    """Appends a set of solutions to the table""";
+    arrays = [];
+    size = [0];
+    def pack (x):
+      if isinstance(x,dict):
+        return dict([ (k,pack(value)) for k,value in x.iteritems() ]);
+      elif isinstance(x,(list,tuple)):
+        return type(x)(map(pack,x));
+      elif isinstance(x,numpy.ndarray) and x.ndim:
+        size[0] += _padding(size[0]);
+        arrays.append((size[0],x));
+        ref = { ARRAY_TAG:(x.dtype.str,x.shape,size[0]) };
+        size[0] += x.nbytes;
+        return ref;
+      else:
+        return x;
+    meta = cPickle.dumps(dict(key=key,implementation=implementation,solutions=pack(solutions),domain=domain),2);
+    ff = self._file;
+    offset = ff.tell();
+    ff.write(_record_header.pack(RECORD_MAGIC,len(meta),size[0]));
+    ff.write(meta);
+    data_offset = offset + _record_header.size + len(meta);
+    data_offset += _padding(data_offset);
+    for array_offset,x in arrays:
+      ff.seek(data_offset+array_offset);
+      numpy.ascontiguousarray(x).tofile(ff);
+    # seeking past the end does not extend the file, so if there is nothing left to write (no arrays, or an empty
+    # last array), pad it out to the end of the record, else readers take the record to be incomplete
+    end_offset = data_offset+size[0];
+    ff.seek(0,2);
+    if ff.tell() < end_offset:
+      ff.write("\0"*(end_offset-ff.tell()));
+    ff.seek(end_offset);
+    ff.flush();
+    self.num_records += 1;
+
+  def close (self):
+    if self._file:
+      self._file.close();
+      self._file = None;
+      if self._tmpname:
+        os.rename(self._tmpname,self.filename);
+
+
+def _copy_arrays (x):
+  """Returns a copy of a structure of dicts, lists and tuples, with copies of any arrays in it""";
+  if isinstance(x,dict):
+    return dict([ (key,_copy_arrays(value)) for key,value in x.iteritems() ]);
+  elif isinstance(x,(list,tuple)):
+    return type(x)(map(_copy_arrays,x));
+  elif isinstance(x,numpy.ndarray):
+    return x.copy();
+  else:
+    return x;
+
+
+class TableStreamer (object):
+  """Appends records to binary gain tables in a background thread. At most maxsize records are queued up (write()
+  blocks when the queue is full), so memory use stays bounded. Each table is opened with a streaming
+  GainTableWriter on its first write(), so records reach the disk in the order they are written.""";
+  def __init__ (self,maxsize=4):
+    self._queue = Queue.Queue(maxsize);
+    self._writers = {};
+    self._thread = threading.Thread(target=self._run,name="gaintable-streamer");
+    self._thread.daemon = True;
+    self._thread.start();
+    atexit.register(self.close);
+
+  def write (self,filename,key,solutions,implementation,domain=None,append=False):
+    """Queues a set of solutions for writing. If this is the first write to the given file, append determines
+    whether a new file is started. The solutions arrays are copied, since the caller may well reuse them
+    (e.g. for the next tile) before the record has been written.""";
+    if self._thread is None:
+      raise RuntimeError,"TableStreamer has been closed";
+    self._queue.put((filename,key,_copy_arrays(solutions),implementation,domain,append));
+
+  def _run (self):
+    while True:
+      item = self._queue.get();
+      try:
+        if item is None:
+          break;
+        filename,key,solutions,implementation,domain,append = item;
+        try:
+          writer = self._writers.get(filename);
+          if writer is None:
+            writer = self._writers[filename] = GainTableWriter(filename,append=append,streaming=True);
+          writer.write(key,solutions,implementation,domain=domain);
+        except:
+          traceback.print_exc();
+          dprint(0,"error writing %s solutions to %s"%(key,filename));
+      finally:
+        self._queue.task_done();
+
+  def sync (self):
+    """Waits for all queued records to be written""";
+    self._queue.join();
+
+  def close (self):
+    """Writes out all queued records, closes the tables and stops the thread. Returns dict of filename -> number
+    of records written.""";
+    if self._thread is None:
+      return {};
+    self._queue.put(None);
+    self._thread.join();
+    self._thread = None;
+    nrec = {};
+    for filename,writer in self._writers.iteritems():
+      writer.close();
+      nrec[filename] = writer.num_records;
+    self._writers = {};
+    return nrec;
+
+
+def load_table (filename):
+  """Loads a gain table in either the binary or the pickle format, and returns its contents in the form
+  of a version-2 pickled table, i.e. dict(description=...,version=2,gains={key:dict(solutions=...,implementation=...)})""";
+  if is_binary_table(filename):
+    return GainTable(filename).as_struct();
+  return cPickle.load(open(filename,"rb"));
+
+def convert_table (infile,outfile):
+  """Converts a version-2 pickled gain table into the binary format. Returns number of records written""";
+  struct = cPickle.load(open(infile,"rb"));
+  if not isinstance(struct,dict) or struct.get('version',0) < 2:
+    raise TypeError,"%s: format or version not known"%infile;
+  writer = GainTableWriter(outfile);
+  for key,gains in sorted(struct['gains'].iteritems()):
+    writer.write(key,gains['solutions'],gains['implementation']);
+  writer.close();
+  return writer.num_records;
+
+
+if __name__ == "__main__":
+  import sys
+  from optparse import OptionParser
+
+  parser = OptionParser(usage="""%prog: [options] <input table> <output table>""",
+      description="Converts a (version 2) pickled StefCal gain table into the binary gain table format.");
+  (options,args) = parser.parse_args();
+  if len(args) != 2:
+    parser.error("incorrect number of arguments");
+  infile,outfile = args;
+  nrec = convert_table(infile,outfile);
+  print "Wrote %d gain set(s) to %s"%(nrec,outfile);
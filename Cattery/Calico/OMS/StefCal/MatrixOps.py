@@ -94,6 +94,193 @@ def matrix_maskinf (A):
       a[mask] = defval;
   return A
   
+class Matrix2x2 (object):
+  """A 2x2 matrix (or an array of them) stored as a single contiguous array of shape (...,4), in the same
+  element order as the flat 4-lists above.
+
+  The 'null' attribute is a bitmask: bit i is set if element i is known to be identically zero. Null elements
+  are stored as zeroes, so whole-matrix operations can ignore the mask, while multiplication uses it to skip
+  products of null blocks (this is what is_null() does for the 4-list representation, but without per-element
+  checks).
+
+  Operations named i* work in place and return self, so they can be chained.
+  """;
+  __slots__ = ('data','null');
+
+  def __init__ (self,data,null=0):
+    self.data = data;
+    self.null = null;
+
+  @staticmethod
+  def from_list (A,transform=None,dtype=complex,shape=None):
+    """Makes a matrix from a flat 4-list. Null elements are flagged in the null mask.
+    If transform is given, it is applied to every non-null element first (e.g. tile_data).
+    If dtype is None, it is determined from the elements""";
+    null = 0;
+    elems = [];
+    for i,x in enumerate(A):
+      if is_null(x):
+        null |= (1<<i);
+        elems.append(None);
+      else:
+        elems.append(transform(x) if transform else x);
+    nonnull = [ x for x in elems if x is not None ] or [0];
+    if shape is None:
+      shape = numpy.broadcast(*nonnull).shape;
+    if dtype is None:
+      dtype = numpy.result_type(*nonnull);
+    data = numpy.zeros(tuple(shape)+(4,),dtype);
+    for i,x in enumerate(elems):
+      if x is not None:
+        data[...,i] = x;
+    return Matrix2x2(data,null);
+
+  def as_list (self,transform=None):
+    """Converts to a flat 4-list of views into the data array (nulls are returned as 0).
+    If transform is given, it is applied to every non-null element (e.g. untile_data)""";
+    return [ 0 if self.null&(1<<i) else (transform(self.data[...,i]) if transform else self.data[...,i])
+             for i in range(4) ];
+
+  @property
+  def shape (self):
+    return self.data.shape[:-1];
+
+  def copy (self):
+    return Matrix2x2(self.data.copy(),self.null);
+
+  def astype (self,dtype):
+    """Returns matrix converted to the given dtype (self, if already of that dtype)""";
+    return self if self.data.dtype == dtype else Matrix2x2(self.data.astype(dtype),self.null);
+
+  def reduce (self,reduce_func):
+    """Applies a reduction function (e.g. DataTiler.reduce_tiles) to all four elements at once""";
+    return Matrix2x2(reduce_func(self.data),self.null);
+
+  def __getitem__ (self,i):
+    return 0 if self.null&(1<<i) else self.data[...,i];
+
+  @staticmethod
+  def multiply (A,B,out=None,scratch=None):
+    """Computes A*B. If out is given, the product is written into it. out may be the same object as A
+    or B, since rows (or columns) are computed into scratch arrays before being written back.
+    scratch may be given as an array of shape (...,3) to avoid allocating temporaries""";
+    shape = numpy.broadcast(A.data[...,0],B.data[...,0]).shape;
+    dtype = numpy.result_type(A.data,B.data);
+    if out is None or out.shape != shape or out.data.dtype != dtype or (out is A and out is B):
+      out = Matrix2x2(numpy.empty(shape+(4,),dtype),0);
+    if scratch is None or scratch.shape[:-1] != shape or scratch.dtype != dtype:
+      scratch = numpy.empty(shape+(3,),dtype);
+    a,b,c = A.data,B.data,out.data;
+    anull,bnull = A.null,B.null;
+    cnull = 0;
+    # if out is the same as A, we compute row by row (row i of A is not needed after row i of C is computed);
+    # otherwise column by column (for out same as B). A row/column of C goes into scratch[...,0:2] first.
+    byrow = out is not B;
+    tmp = scratch[...,2];
+    for outer in 0,1:
+      results = [];
+      for inner in 0,1:
+        i,j = (outer,inner) if byrow else (inner,outer);
+        acc = scratch[...,inner];
+        nterms = 0;
+        for k in 0,1:
+          ia,ib = i*2+k,k*2+j;
+          if anull&(1<<ia) or bnull&(1<<ib):
+            continue;
+          if nterms:
+            numpy.multiply(a[...,ia],b[...,ib],out=tmp);
+            acc += tmp;
+          else:
+            numpy.multiply(a[...,ia],b[...,ib],out=acc);
+          nterms += 1;
+        results.append((i*2+j,nterms));
+      for inner,(ic,nterms) in enumerate(results):
+        if nterms:
+          c[...,ic] = scratch[...,inner];
+        else:
+          c[...,ic] = 0;
+          cnull |= (1<<ic);
+    out.null = cnull;
+    return out;
+
+  def imul (self,B,scratch=None):
+    """In-place self = self*B""";
+    return Matrix2x2.multiply(self,B,out=self,scratch=scratch);
+
+  def ilmul (self,A,scratch=None):
+    """In-place self = A*self""";
+    return Matrix2x2.multiply(A,self,out=self,scratch=scratch);
+
+  def imul_elementwise (self,B):
+    """In-place element-by-element (not matrix) multiplication by B. The data array is reallocated if
+    the product needs a wider dtype""";
+    if numpy.result_type(self.data,B.data) != self.data.dtype:
+      self.data = self.data*B.data;
+    else:
+      self.data *= B.data;
+    self.null |= B.null;
+    return self;
+
+  def iconj (self):
+    """In-place conjugate-transpose (same as matrix_conj() does for a 4-list)""";
+    numpy.conj(self.data,out=self.data);
+    tmp = self.data[...,1].copy();
+    self.data[...,1] = self.data[...,2];
+    self.data[...,2] = tmp;
+    n = self.null;
+    self.null = (n&9) | ((n&2)<<1) | ((n&4)>>1);
+    return self;
+
+  def iadd (self,B):
+    """In-place self = self+B""";
+    self.data += B.data;
+    self.null &= B.null;
+    return self;
+
+  def isub (self,B):
+    """In-place self = self-B""";
+    self.data -= B.data;
+    self.null &= B.null;
+    return self;
+
+  def iscale (self,c):
+    """In-place multiplication by a scalar (or by an array broadcastable to the matrix shape)""";
+    if is_null(c):
+      self.data[...] = 0;
+      self.null = 15;
+    else:
+      self.data *= numpy.asarray(c)[...,numpy.newaxis];
+    return self;
+
+  def iinvert (self,reg=0):
+    """In-place inversion (same as matrix_invert())""";
+    x = self.data;
+    if reg:
+      x[...,0] += reg;
+      x[...,3] += reg;
+      self.null &= ~9;
+    if (self.null&6) == 6:
+      # diagonal matrix
+      numpy.divide(1,x[...,0],out=x[...,0]);
+      numpy.divide(1,x[...,3],out=x[...,3]);
+    else:
+      det = x[...,0]*x[...,3]-x[...,1]*x[...,2];
+      a = x[...,0].copy();
+      numpy.divide(x[...,3],det,out=x[...,0]);
+      numpy.divide(a,det,out=x[...,3]);
+      x[...,1] /= det;
+      x[...,2] /= det;
+      numpy.negative(x[...,1:3],out=x[...,1:3]);
+    return self;
+
+  def imaskinf (self):
+    """In-place replacement of non-finite matrices with the unity matrix (as matrix_maskinf() does)""";
+    mask = ~numpy.isfinite(self.data).all(-1);
+    if mask.any():
+      self.data[mask] = (1,0,0,1);
+      self.null &= ~9;
+    return self;
+
 def array_to_vells (x,vellshape=None,expanded_slice=None):
   if expanded_slice is not None:
     a = meq.complex_vells(vellshape);
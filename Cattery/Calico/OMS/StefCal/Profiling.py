@@ -0,0 +1,150 @@
+"""Per-stage profiling of StefCal.
+
+A StageProfiler records wall time, CPU time and memory use for each stage of a tile (ingest, noise, solve, output,
+etc., as marked by StefCalNode.end_stage()), and accumulates the same for sub-stages measured within them, such as
+the iterate() and chi-square calls of each gain term. When a tile is done, one record per stage is
+written to a profile file, as JSON lines, or as CSV if the filename ends in ".csv". Records from different tiles and runs
+can be appended to the same file, and aggregated later.
+
+Each record has the following fields:
+
+    tile:       request ID of the tile
+    dataset:    dataset ID
+    domain:     time0,time1,timestep,numtime,freq0,freq1,freqstep,numfreq of the tile
+    stage:      name of stage (e.g. "solve") or sub-stage (e.g. "iterate")
+    term:       gain term label, for sub-stages that are measured per gain term (e.g. "G"), else empty
+    wall:       wall time, in seconds
+    cpu:        CPU time (user+system, of this process only), in seconds. Empty for sub-stages measured in other
+                threads than the main one (e.g. diffgain threads), since process CPU time then includes the
+                other threads as well
+    calls:      number of calls, e.g. the number of iterations for "iterate"
+    rss_mb:     resident memory at the end of the stage (or at the end of the last call), in Mb
+    peak_rss_mb: peak resident memory of the process so far, as of the end of the stage (or of the last call), in Mb.
+                This is not the peak within the stage: a stage only raised the peak if its value is above that of
+                the stage before it
+""";
+
+import os
+import time
+import json
+import csv
+import resource
+import threading
+
+FIELDS = [ "tile","dataset","domain","stage","term","wall","cpu","calls","rss_mb","peak_rss_mb" ];
+
+_pagesize = resource.getpagesize();
+
+# the thread that imported this module, i.e. the one that runs the node
+_main_thread = threading.current_thread();
+
+def _cpu_time ():
+  """Returns user+system CPU time of this process""";
+  t = os.times();
+  return t[0]+t[1];
+
+def _rss_mb ():
+  """Returns current resident memory in Mb, or None if not available""";
+  try:
+    return int(open("/proc/self/statm").read().split()[1])*_pagesize/float(2**20);
+  except (IOError,IndexError,ValueError):
+    return None;
+
+def _peak_rss_mb ():
+  """Returns peak resident memory of the process so far in Mb""";
+  # note that Linux reports ru_maxrss in kb
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.;
+
+
+class _Measurement (object):
+  """Context manager returned by StageProfiler.measure()""";
+  __slots__ = ('acc','t0','c0');
+  def __init__ (self,acc):
+    self.acc = acc;
+
+  def __enter__ (self):
+    # CPU time is process-wide, so it is meaningless for measurements made in concurrent threads
+    main = threading.current_thread() is _main_thread;
+    self.t0,self.c0 = time.time(),(_cpu_time() if main else None);
+    return self;
+
+  def __exit__ (self,*exc):
+    acc = self.acc;
+    acc[0] += time.time() - self.t0;
+    if self.c0 is None or acc[1] is None:
+      acc[1] = None;
+    else:
+      acc[1] += _cpu_time() - self.c0;
+    acc[2] += 1;
+    acc[3] = _rss_mb();
+    acc[4] = _peak_rss_mb();
+    return False;
+
+
+class StageProfiler (object):
+  """Records per-stage timings and memory use of tiles. If filename is given, records are
+  appended to that file at the end of each tile""";
+  def __init__ (self,filename=None):
+    self.filename = filename or None;
+    self.csv = bool(self.filename) and self.filename.lower().endswith(".csv");
+    self.start_tile();
+
+  def start_tile (self,tile=None,dataset=None,domain=None):
+    """Starts profiling a new tile""";
+    self._tile = dict(tile=str(tile) if tile is not None else "",dataset=str(dataset) if dataset is not None else "",
+                      domain=list(domain) if domain is not None else []);
+    self._stages = [];
+    # dict of (stage,term) -> [wall,cpu,calls,rss,peak rss] for sub-stages, and the order in which they were first seen
+    self._substages = {};
+    self._substage_order = [];
+    self._t0,self._c0 = time.time(),_cpu_time();
+
+  def end_stage (self,stage):
+    """Ends the current stage of the tile, i.e. records everything since the end of the previous stage (or since
+    the start of the tile) as the given stage""";
+    t,c = time.time(),_cpu_time();
+    self._stages.append((stage,"",t-self._t0,c-self._c0,1,_rss_mb(),_peak_rss_mb()));
+    self._t0,self._c0 = t,c;
+
+  def measure (self,stage,term=None):
+    """Returns a context manager that adds the time spent in its body to the given sub-stage. E.g.
+
+        with profiler.measure("iterate",label):
+          solver.iterate(...)
+    """;
+    key = stage,term or "";
+    acc = self._substages.get(key);
+    if acc is None:
+      acc = self._substages[key] = [0.,0.,0,None,None];
+      self._substage_order.append(key);
+    return _Measurement(acc);
+
+  @property
+  def stage_timings (self):
+    """Returns list of (stage,wall time) of stages that have ended so far""";
+    return [ (stage,wall) for stage,term,wall,cpu,calls,rss,peak in self._stages ];
+
+  def records (self):
+    """Returns list of records for the current tile, as dicts""";
+    stages = self._stages + [ key+tuple(self._substages[key]) for key in self._substage_order ];
+    return [ dict(self._tile,stage=stage,term=term,wall=wall,cpu=cpu,calls=calls,rss_mb=rss,peak_rss_mb=peak)
+             for stage,term,wall,cpu,calls,rss,peak in stages ];
+
+  def end_tile (self):
+    """Ends the tile, and writes its records to the profile file, if one is set. Returns the records.""";
+    records = self.records();
+    if self.filename:
+      if self.csv:
+        new = not os.path.exists(self.filename) or not os.path.getsize(self.filename);
+        ff = open(self.filename,"ab");
+        writer = csv.DictWriter(ff,FIELDS);
+        if new:
+          writer.writerow(dict(zip(FIELDS,FIELDS)));
+        for rec in records:
+          writer.writerow(dict(rec,domain=":".join(map(str,rec['domain']))));
+      else:
+        ff = open(self.filename,"a");
+        for rec in records:
+          ff.write(json.dumps(rec,sort_keys=True,default=float)+"\n");
+      ff.close();
+    return records;
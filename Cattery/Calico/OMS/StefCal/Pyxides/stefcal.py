@@ -251,6 +251,11 @@ def _cmp_antenna (sa,sb):
 
 import cPickle
 
+def _load_gain_table (filename):
+  """Loads a gain solutions table, in either the pickle or the binary format"""
+  from Calico.OMS.StefCal import GainTable
+  return GainTable.load_table(filename);
+
 define("FEED_TYPE","rl","feed type for plot labels: rl or xy")
 
 define("DIFFGAIN_PLOT_DIR_Template","$OUTFILE.diffgain${SUFFIX}.plots","directory for diffgain plots")
@@ -272,7 +277,7 @@ def make_diffgain_plots (filename="$STEFCAL_DIFFGAIN_SAVE",prefix="dE",dir="$DIF
     dir = ".";
 
   info("loading diffgain solutions from $filename");
-  DG0 = cPickle.load(file(filename))
+  DG0 = _load_gain_table(filename)
 
   DG = DG0['gains']
   srcnames = sorted(DG.keys())
@@ -656,7 +661,7 @@ def make_gain_plots (filename="$STEFCAL_GAIN_SAVE",prefix="G",ylim=None,ylim_off
   _GAIN_PREFIX = prefix;
 
   info("loading gain solutions from $filename");
-  G0 = cPickle.load(file(filename))
+  G0 = _load_gain_table(filename)
 
   G = G0['gains'][prefix]['solutions'];
   solkeys = G.keys()
@@ -11,11 +11,17 @@ import time
 import cPickle
 import os.path
 import traceback
-import gc
+import threading
+from multiprocessing.pool import ThreadPool
 import scipy.ndimage.measurements
 
 from MatrixOps import *
 import DataTiler
+from SubtilePool import SubtilePool,get_pool
+from ActiveSet import ActiveSet
+from Profiling import StageProfiler
+from ApplyCache import ApplyCache
+from WarmStart import WarmStart
 
 _verbosity = Kittens.utils.verbosity(name="stefcal");
 dprint = _verbosity.dprint;
@@ -137,6 +143,11 @@ class StefCalNode (pynode.PyNode):
     pynode.PyNode.__init__(self,*args);
     self._dataset_id = None;
     self.ifr_gain = {};
+    # scratch arrays of compute_noise() and compute_chisq(), reused across calls. These are per-thread, since
+    # diffgains may be solved in parallel threads
+    self._scratch = threading.local();
+    # serializes state updates from parallel threads
+    self._state_lock = threading.Lock();
 
   def update_state (self,mystate):
     """Standard function to update our state""";
@@ -154,6 +165,11 @@ class StefCalNode (pynode.PyNode):
     mystate('use_polarizations_for_noise',False);
     # compute noise estimates per-channel
     mystate('noise_per_chan',True);
+    # number of baselines processed at a time when computing noise and chi-square
+    mystate('stats_chunk',256);
+    # memory budget (in Mb) for the scratch arrays used when computing noise and chi-square (per thread). For large
+    # tiles, fewer than stats_chunk baselines are processed at a time to stay within it
+    mystate('stats_chunk_mb',256);
     # verbosity level
     mystate('verbose',0);
     # verbosity level
@@ -202,6 +218,10 @@ class StefCalNode (pynode.PyNode):
     mystate('init_from_table',True);
     # use previous tile (timeslot) as starting guess -- if table not available
     mystate('init_from_previous',True);
+    # if >0, starting guesses for gain terms being solved for are extrapolated from the solutions of (up to)
+    # this many previous tiles, using a polynomial in time of the given order
+    mystate('warm_start_tiles',0);
+    mystate('warm_start_order',1);
     # rescale data to model
     mystate('rescale',True);
     # use this value as starting guess -- if previous two not available
@@ -238,6 +258,21 @@ class StefCalNode (pynode.PyNode):
     mystate('dump_domain',[]);
     # print the per-baseline variance of incoming data
     mystate('print_variance',False);
+    # if >1, blocks of subtiles are solved in parallel by a pool of this many processes
+    mystate('solver_processes',0);
+    # if True, converged solution slots are frozen, and subsequent iterations only go over the remaining active ones
+    mystate('active_set',False);
+    # if >1, diffgain terms are solved concurrently by a pool of this many threads (see solve_diffgains_parallel()),
+    # rather than one after another
+    mystate('diffgain_threads',0);
+    # if set, per-stage profiling records are appended to this file after each tile (as CSV if the name ends in .csv,
+    # else as JSON lines)
+    mystate('profile_file','');
+    # memory budget (in Mb) for caching the results of applying gain terms within a tile, 0 to disable
+    mystate('apply_cache_mb',512);
+    # if True, tiles that already have solutions in the (binary) solution tables are not re-solved, rather
+    # the solutions are loaded and applied, and new solutions are appended to the tables. This resumes a run that was interrupted.
+    mystate('resume_from_table',False);
     # lis of all ifrs, as p,q pairs
     self._ifrs = [ tuple(x.split(':')) for x in self.ifrs ];
     # make list of ifrs sorted by baselines
@@ -248,6 +283,11 @@ class StefCalNode (pynode.PyNode):
     # other init
     _verbosity.set_verbose(self.verbose);
     _verbosity.enable_timestamps(True,modulo=6000);
+    self._profiler = StageProfiler(self.profile_file);
+    self._apply_cache = ApplyCache(self.apply_cache_mb*2**20);
+    for opt in self.gainopts+self.dgopts:
+      opt.warm_start = self.warm_start_tiles and opt.solve and \
+                       WarmStart(opt.label,self.warm_start_tiles,self.warm_start_order) or None;
     # initial value from which to start iterating
     self._init_value_gain = self._init_value_bgain = self.init_value;
     self._init_value_dg = {};
@@ -260,6 +300,12 @@ class StefCalNode (pynode.PyNode):
     dataset_id,domain_id = meq.split_request_id(request.request_id);
     # get domain ID from request
     time0,time1,timestep,numtime,freq0,freq1,freqstep,numfreq = request.cells.domain.domain_id;
+    domain = (time0,time1,timestep,numtime,freq0,freq1,freqstep,numfreq);
+    # per-stage timings for this tile, see end_stage()
+    self._profiler.start_tile(request.request_id,dataset_id,domain);
+    # the apply cache is normally cleared at the end of the tile, but not if that tile raised an error. Its
+    # entries would then be found again by this tile, since solver generations start over each tile
+    self._apply_cache.clear();
     # child 0 is data
     # child 1 is direction-independent model
     # children 2 and on are models subject to dE terms
@@ -270,6 +316,8 @@ class StefCalNode (pynode.PyNode):
     # if new dataset ID, do setup for start of new dataset
     if dataset_id != self._dataset_id:
       self._dataset_id = dataset_id;
+      # make sure tables of the previous dataset have been written out
+      GainOpts.close_tables();
  
       # try to load gain solutions if available
       for opt in self.gainopts + self.dgopts:
@@ -344,125 +392,124 @@ class StefCalNode (pynode.PyNode):
       # setup antenna names
       if nifrs != len(self.ifrs):
         raise TypeError,"first dimension of data and model must match the number of interferometers in the ifrs field";
-      # setup list of data, values and parameter names
-      nvells = -1;
-      for pq in self._ifrs:
-        # get IFR gain for this p,q
-        ifrgain = self.ifr_gain.get(pq,[1,1,1,1]);
-#        print pq,"IFR gain is",ifrgain;
+      # first pass: find the matrix elements that we will be using. We only look at the vellsets here, the
+      # data is copied in the second pass, once all buffers have been allocated. 
+      inputs = [];          # list of (pq,num,nvells) for valid elements
+      ifr_row = {};         # row of each valid p,q in the input buffers
+      corr_col = {};        # column of each valid matrix element in the input buffers
+      datashape = None;
+      for ipq,pq in enumerate(self._ifrs):
         # now loop over the 4 matrix elements
-        for num,(i,j) in enumerate(IJ2x2):
-          # increment vells count upfront (this is why we start at -1)
-          nvells += 1;
-          # get data
+        for num in range(4):
+          nvells = ipq*4+num;
           d = getattr(datares.vellsets[nvells],'value',0);
-          # apply ifr gains if we have them
-          if not is_null(d):
-            # convert if needed
-            if self.use_float_di:
-              d = d.astype(numpy.complex64)  # make copy by default
-            if d.flags['WRITEABLE']:
-              d *= ifrgain[num]
-            else:
-              d = d*ifrgain[num]
-          # get model
           m = getattr(modelres.vellsets[nvells],'value',0);
-          if hasattr(datares.vellsets[nvells],'flags'):
-            flags = (datares.vellsets[nvells].flags != 0);
-          else:
-            flags = None;
           # does this need to be skipped? only process data otherwise
           if not ( is_null(d) if self.polarized else (is_null(m) or is_null(d)) ):
-            # if this is the first datum, then check shape, and prepare subtilings etc.
-            # for the first valid result, setup shapes and stuff
-            if not model0:
-              def get_dtype (dd):
-                if dd:
-                  return numpy.complex64 if self.use_float_dd else numpy.complex128
-                else:
-                  return numpy.complex64 if self.use_float_di else numpy.complex128
-              # this is the basic time-frequency shape
-              self._datashape = datashape = tuple(d.shape);
-              self._datasize = reduce(operator.mul,datashape);
-              # figure out subtiling
-              self._expanded_datashape = expanded_datashape = GainOpts.resolve_tilings(datashape,*(self.gainopts+self.dgopts));
-              # if tiling does not tile the data shape perfectly, we'll need to expand the input arrays
-              # Define pad_array() as a function for this: it will set to be identity if no expansion is needed
-              if datashape != expanded_datashape:
-                self._expanded_dataslice = expanded_dataslice = tuple([ slice(0,nd) for nd in datashape ]);
-                def pad_array (x,initval=0,dd=False):
-                  if is_null(x):
-                    return 0;
-                  x1 = numpy.empty(expanded_datashape, dtype=bool if type(initval) is bool else get_dtype(dd))
-                  x1[...] = initval;
-                  x1[expanded_dataslice] = x;
-                  return x1;
-                self._expanded_size = reduce(operator.mul,expanded_datashape);
-                self._expansion_ratio = self._expanded_size/float(self._datasize);
-                self._expansion_mask = numpy.zeros(expanded_datashape,bool);
-                self._expansion_mask[expanded_dataslice] = True;
-                dprint(1,"input arrays will be expanded to shape",expanded_datashape,"ratio %.2f"%self._expansion_ratio);
-              else:
-                self._expanded_size = self._datasize;
-                self._expansion_ratio = 1;
-                self._expanded_dataslice = expanded_dataslice = None;
-                self._expansion_mask = numpy.ones(datashape,bool);
-                def pad_array (x,initval=0,dd=False):
-                  if is_null(x):
-                    return x
-                  elif type(initval) is bool:
-                    return x
-                  else:
-                    return x.astype(get_dtype(dd))  # copy=True implicitly
-              # this counts how many valid visibilities we have per each antenna, per each time/freq slot
-              vis_per_antenna = dict([(p,numpy.zeros(expanded_datashape,dtype=int)) for p in antennas ]);
-            # now check inputs and add them to data and model dicts
-            if d.shape != datashape:
-              raise TypeError,"data shape mismatch at %s:%s:%s:%s, %s vs %s" % (pq[0], pq[1],
-                self.corr_names[i], self.corr_names[j], d.shape, datashape )
-            if not is_null(m) and m.shape != datashape:
-              raise TypeError,"model shape mismatch at %s:%s:%s:%s, %s vs %s" % (pq[0], pq[1],
-                self.corr_names[i], self.corr_names[j], m.shape, datashape )
-            # add to data/model matrices, applying the padding function defined above
-            m0 = model0.setdefault(pq,[0,0,0,0])[num] = pad_array(m);
-            d0 = data.setdefault(pq,[0,0,0,0])[num] = pad_array(d);
-            # apply flags
-            if flags is not None:
-              flags = pad_array(flags,True);
-              if not is_null(m0):
-                m0[flags] = 0;
-              if not is_null(d0):
-                d0[flags] = 0;
-              invalid = (d0==0)&(m0==0);
-              self.add_flags(bitflags,pq,invalid*FPRIOR);
-            # if there are at least some valid points on this baseline, add it to solvable antennas
-            if (bitflags.get(pq) is None) or not bitflags[pq].all():
-              if pq in self._solvable_ifrs:
-                solvable_antennas.update(pq);
-  #              print pq,validmask[pq];
-            # get models for dE-subjected terms
-            if num_diffgains:
-              for k in range(num_diffgains):
-                m1 = children[2+k].vellsets[nvells].value
-                m1 = pad_array(m1,dd=True);
-                if flags is not None and not is_null(m1):
-                  m1[flags] = 0;
-                dgmodel[k].setdefault(pq,[0,0,0,0])[num] = m1;
-        # ok, done looping over the 2x2 visibility matrix elements. 
-        # If we have found anything valid at all, finalize flagmasks etc.
-        if pq in model0:
-          # look at bitflags to see how many valid correlations we have, and zero the flagged ones
-          fmask = bitflags.get(pq);
-          if fmask is not None:
-            fmask = fmask!=0;
-            valid = self._expanded_size - fmask.sum();
-            if valid > 0:
-              dprint(4,"%s-%s"%pq,"has %d of %d unflagged correlation matrices"%(valid,self._datasize));
-              for dataset in [data,model0] + dgmodel:
-                for x in dataset.get(pq,[]):
-                  if not is_null(x):
-                    x[fmask] = 0;
-              validmask = (~fmask).astype(int);
+            if datashape is None:
+              datashape = tuple(d.shape);
+            inputs.append((pq,num,nvells));
+            ifr_row.setdefault(pq,len(ifr_row));
+            corr_col.setdefault(num,None);
+      # for the first valid result, setup shapes and stuff
+      if inputs:
+        # this is the basic time-frequency shape
+        self._datashape = datashape;
+        self._datasize = reduce(operator.mul,datashape);
+        # figure out subtiling
+        self._expanded_datashape = expanded_datashape = GainOpts.resolve_tilings(datashape,*(self.gainopts+self.dgopts));
+        # if tiling does not tile the data shape perfectly, we'll need to expand the input arrays
+        if datashape != expanded_datashape:
+          self._expanded_dataslice = expanded_dataslice = tuple([ slice(0,nd) for nd in datashape ]);
+          self._expanded_size = reduce(operator.mul,expanded_datashape);
+          self._expansion_ratio = self._expanded_size/float(self._datasize);
+          self._expansion_mask = numpy.zeros(expanded_datashape,bool);
+          self._expansion_mask[expanded_dataslice] = True;
+          dprint(1,"input arrays will be expanded to shape",expanded_datashape,"ratio %.2f"%self._expansion_ratio);
+        else:
+          self._expanded_size = self._datasize;
+          self._expansion_ratio = 1;
+          self._expanded_dataslice = expanded_dataslice = None;
+          self._expansion_mask = numpy.ones(datashape,bool);
+        # input slice of the expanded arrays
+        inslice = expanded_dataslice or Ellipsis;
+        # allocate one contiguous buffer of shape (nifr,ncorr)+expanded_datashape per input. The expanded
+        # region is left at zero.
+        for col,num in enumerate(sorted(corr_col.keys())):
+          corr_col[num] = col;
+        bufshape = (len(ifr_row),len(corr_col))+tuple(expanded_datashape);
+        di_dtype = numpy.complex64 if self.use_float_di else numpy.complex128;
+        dd_dtype = numpy.complex64 if self.use_float_dd else numpy.complex128;
+        databuf = numpy.zeros(bufshape,di_dtype);
+        modelbuf = numpy.zeros(bufshape,di_dtype);
+        dgbuf = [ numpy.zeros(bufshape,dd_dtype) for k in range(num_diffgains) ];
+        flagbuf = numpy.zeros(bufshape[:1]+bufshape[2:],int);
+        dprint(1,"allocated %d %s input buffers of %.2f Mb"%(num_diffgains+2,"x".join(map(str,bufshape)),
+                  databuf.nbytes/float(2**20)));
+      # second pass: copy data into buffers, and apply flags and IFR gains in place. The data and model dicts
+      # refer to slices of the buffers
+      for pq,num,nvells in inputs:
+        row,col = ifr_row[pq],corr_col[num];
+        d = datares.vellsets[nvells].value;
+        m = getattr(modelres.vellsets[nvells],'value',0);
+        # now check inputs and add them to data and model dicts
+        if d.shape != datashape:
+          i,j = IJ2x2[num];
+          raise TypeError,"data shape mismatch at %s:%s:%s:%s, %s vs %s" % (pq[0], pq[1],
+            self.corr_names[i], self.corr_names[j], d.shape, datashape )
+        if not is_null(m) and m.shape != datashape:
+          i,j = IJ2x2[num];
+          raise TypeError,"model shape mismatch at %s:%s:%s:%s, %s vs %s" % (pq[0], pq[1],
+            self.corr_names[i], self.corr_names[j], m.shape, datashape )
+        d0 = data.setdefault(pq,[0,0,0,0])[num] = databuf[row,col];
+        d0[inslice] = d;
+        # apply ifr gains if we have them
+        ifrgain = self.ifr_gain.get(pq,[1,1,1,1])[num];
+        if ifrgain != 1:
+          d0 *= ifrgain;
+        if is_null(m):
+          m0 = model0.setdefault(pq,[0,0,0,0])[num] = 0;
+        else:
+          m0 = model0.setdefault(pq,[0,0,0,0])[num] = modelbuf[row,col];
+          m0[inslice] = m;
+        # get models for dE-subjected terms
+        m1 = [];
+        for k in range(num_diffgains):
+          x = children[2+k].vellsets[nvells].value;
+          if not is_null(x):
+            dgbuf[k][row,col][inslice] = x;
+            x = dgbuf[k][row,col];
+          dgmodel[k].setdefault(pq,[0,0,0,0])[num] = x;
+          m1.append(x);
+        # apply flags
+        if hasattr(datares.vellsets[nvells],'flags'):
+          flags = (datares.vellsets[nvells].flags != 0);
+          for x in [d0,m0] + m1:
+            if not is_null(x):
+              x[inslice][flags] = 0;
+          invalid = (d0==0)&(m0==0);
+          fmask = bitflags[pq] = flagbuf[row];
+          fmask[invalid] |= FPRIOR;
+        # if there are at least some valid points on this baseline, add it to solvable antennas
+        if (bitflags.get(pq) is None) or not bitflags[pq].all():
+          if pq in self._solvable_ifrs:
+            solvable_antennas.update(pq);
+      inputs = None;
+      # ok, done with the inputs. If we have found anything valid at all, finalize flagmasks etc.
+      if model0:
+        # zero the flagged correlations, in all buffers at once
+        fmask = flagbuf!=0;
+        for buf in [databuf,modelbuf] + dgbuf:
+          numpy.copyto(buf,0,where=fmask[:,numpy.newaxis,...]);
+        nvalid = self._expanded_size - fmask.reshape((len(fmask),-1)).sum(1);
+        # this counts how many valid visibilities we have per each antenna, per each time/freq slot
+        vis_per_antenna = dict([(p,numpy.zeros(expanded_datashape,dtype=int)) for p in antennas ]);
+        for pq,row in ifr_row.iteritems():
+          # look at bitflags to see how many valid correlations we have
+          if pq in bitflags:
+            if nvalid[row] > 0:
+              dprint(4,"%s-%s"%pq,"has %d of %d unflagged correlation matrices"%(nvalid[row],self._datasize));
+              validmask = ~fmask[row];
               vis_per_antenna[pq[0]] += validmask;
               vis_per_antenna[pq[1]] += validmask;
             else:
@@ -474,17 +521,16 @@ class StefCalNode (pynode.PyNode):
             dprint(4,"%s-%s"%pq,"has no flagged correlation matrices, all data is valid");
             vis_per_antenna[pq[0]] += 1;
             vis_per_antenna[pq[1]] += 1;
+        fmask = None;
     else:
       # in principle could also handle [N], but let's not bother for now
       raise TypeError,"data and model must be of rank Nx2x2";
 
     # hang onto datares record since we'll be putting the results into it
-    # release modelres and all the other child results (they're already held in model and dgmodel)
-    # use resize to explicitly release the memory since we KNOW nobody else is using it
-    dprint(1,"constructed internal arrays, trying to release array memory");
+    # release modelres and all the other child results (they're already copied into the input buffers)
+    dprint(1,"constructed internal arrays");
     modelres = children = None
-    gc.collect()
-    dprint(1,"released memory");
+    self.end_stage("ingest");
     
     valid_ifrs = data.keys();
     solvable_ifrs = set(self._solvable_ifrs)&set(valid_ifrs);
@@ -527,24 +573,32 @@ class StefCalNode (pynode.PyNode):
         orig_sampled_bitflags = bitflags.copy();
         orig_sampled_model0 = model0.copy();
         orig_sampled_dgmodel = [ dg.copy() for dg in dgmodel ];
-        # resample
+        # resample. This is done on the input buffers, i.e. for all baselines at once
         downsample_factor = reduce(operator.mul,downsample_subtiling);
         dprint(1,"resampling data by a factor of %d=%s"%(downsample_factor,"x".join(map(str,downsample_subtiling))));
+        # resample flags, and compute number of valid slots per resampled interval, and a norm based on this
+        # (baselines without flags have all slots valid, so get a norm of 1/downsample_factor)
+        nv = downsample_factor - downsampler.reduce_stack(flagbuf!=0,1);
+        flagbuf = FPRIOR*(nv==0);
+        with numpy.errstate(divide='ignore'):
+          norm = numpy.where(flagbuf,0,1./nv)[:,numpy.newaxis,...];
+        nv = None;
+        # resample data
+        databuf,modelbuf = [ downsampler.reduce_stack(buf,2) for buf in (databuf,modelbuf) ];
+        dgbuf = [ downsampler.reduce_stack(buf,2) for buf in dgbuf ];
+        for buf in [databuf,modelbuf] + dgbuf:
+          buf *= norm;
+        norm = None;
+        # point data and model dicts at the resampled buffers
         for pq in data.keys():
-          flags = bitflags.get(pq);
-          # resample flags, and compute number of valid slots per resampled interval, and a norm based on this
-          if flags is not None and not numpy.isscalar(flags):
-            nv = downsample_factor - downsampler.reduce_tiles(downsampler.tile_data(flags!=0));
-            fl = bitflags[pq] = FPRIOR*(nv==0);
-            norm = numpy.where(fl,0,1./nv);
-          else:
-            norm = 1./downsample_factor;
-          # resample data
-          for vissets in [data,model0] + dgmodel:
+          row = ifr_row[pq];
+          if pq in bitflags:
+            bitflags[pq] = flagbuf[row];
+          for vissets,buf in zip([data,model0] + dgmodel,[databuf,modelbuf] + dgbuf):
             dd = vissets.get(pq);
             if dd is not None:
-              vissets[pq] = [ downsampler.reduce_tiles(downsampler.tile_data(d))*norm if 
-                              d is not None and not numpy.isscalar(d) else d for d in dd ];
+              vissets[pq] = [ buf[row,corr_col[num]] if d is not None and not numpy.isscalar(d) else d
+                              for num,d in enumerate(dd) ];
         # change other settings
         orig_sampled_expanded_datashape = expanded_datashape;
         orig_sampled_datashape = datashape;
@@ -556,39 +610,49 @@ class StefCalNode (pynode.PyNode):
         self._datasize /= downsample_factor;
         self._expanded_size /= downsample_factor;
     
+    self.end_stage("downsample");
+
 ## -------------------- rescale data to model if asked to
     if self.rescale and self.rescale != "no":
       scale = {};
-      finite = {};
-      # compute scales as s(p) = ||sum_q Mpq||/||sum_q Dpq||
-      for p in antennas:
-        dsum = msum = 0;
-        for q in antennas:
-          d = m = None;
-          if (p,q) in data:
-            d,m = data.get((p,q)),model0.get((p,q));
-          elif (q,p) in data:
-            d,m = data.get((q,p)),model0.get((q,p));
-          if d is None or m is None:
-            continue;
-          dsum += sum([x*numpy.conj(x) for x in d]);
-          msum += sum([x*numpy.conj(x) for x in m]);
-        if self.rescale == "scalar":
-          dsum = dsum.sum() if dsum is not 0 else 0+0j;
-          msum = msum.sum() if msum is not 0 else 0+0j;
-          if dsum:
-            scale[p] = numpy.power(msum.real/dsum.real,0.25),True;
+      # compute scales as s(p) = ||sum_q Mpq||/||sum_q Dpq||. This is done on the input buffers: the
+      # per-baseline powers are summed over correlations, then summed per antenna using an antenna->baseline
+      # incidence matrix
+      antlist = sorted(antennas);
+      antindex = dict([ (p,i) for i,p in enumerate(antlist) ]);
+      rows = numpy.array([ ifr_row[pq] for pq in data.iterkeys() ],int);
+      ant_p = numpy.array([ antindex[p] for p,q in data.iterkeys() ],int);
+      ant_q = numpy.array([ antindex[q] for p,q in data.iterkeys() ],int);
+      incidence = numpy.zeros((len(antlist),len(rows)));
+      incidence[ant_p,numpy.arange(len(rows))] = 1;
+      incidence[ant_q,numpy.arange(len(rows))] = 1;
+      shape = databuf.shape[2:];
+      def antenna_power (buf):
+        pw = 0;
+        for col in range(buf.shape[1]):
+          x = buf[rows,col];
+          pw = pw + (x.real**2 + x.imag**2);
+        return numpy.dot(incidence,pw.reshape((len(rows),-1))).reshape((len(antlist),)+shape);
+      dsum,msum = antenna_power(databuf),antenna_power(modelbuf);
+      if self.rescale == "scalar":
+        dsum = dsum.reshape((len(antlist),-1)).sum(1);
+        msum = msum.reshape((len(antlist),-1)).sum(1);
+        for p,i in antindex.iteritems():
+          if dsum[i]:
+            scale[p] = numpy.power(msum[i]/dsum[i],0.25),True;
           else:
             dprint(2,"no valid data (and thus no scale) for",p);
-        else:
-          if dsum is not 0:
-            s = numpy.power(msum.real/dsum.real,0.25);
-            f = numpy.isfinite(s);
-          if dsum is 0 or (~f).all():
+      else:
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+          s = numpy.power(msum/dsum,0.25);
+        f = numpy.isfinite(s);
+        s[~f] = 0;
+        for p,i in antindex.iteritems():
+          if not f[i].any():
             dprint(2,"no valid data (and thus no scale) for",p);
           else:
-            s[~f] = 0;
-            scale[p] = s,f;
+            scale[p] = s[i],f[i];
+      dsum = msum = None;
       # apply scales
       if scale:
         if self.rescale == "scalar":
@@ -597,16 +661,23 @@ class StefCalNode (pynode.PyNode):
           dprint(1,"min/max scaling factors are",min([s[f].min() for s,f in scale.itervalues()]),
                                                 max([s[f].max() for s,f in scale.itervalues()]));
           dprint(2,"per-antenna data scaling factors are ",", ".join(["%s %.3g"%(p,s.max()) for p,(s,f) in scale.iteritems() ]));
+        # per-baseline factors s(p)*s(q), for baselines where both antennas have a scale
+        has_scale = numpy.array([ p in scale for p in antlist ]);
+        ant_scale = numpy.ones((len(antlist),)+(shape if self.rescale != "scalar" else (1,)*len(shape)));
+        for p,(s,f) in scale.iteritems():
+          ant_scale[antindex[p]] = s;
+        bl_scale = numpy.ones((len(databuf),)+ant_scale.shape[1:]);
+        sel = has_scale[ant_p]&has_scale[ant_q];
+        bl_scale[rows[sel]] = ant_scale[ant_p[sel]]*ant_scale[ant_q[sel]];
+        databuf *= bl_scale[:,numpy.newaxis,...];
+        bl_scale = ant_scale = None;
       else:
         dprint(1,"rescaling not done, as none of the antennas appear to have any valid data");
-      for (p,q),dd in data.iteritems():
-        s1,f = scale.get(p,(None,None));
-        s2,f = scale.get(q,(None,None));
-        if s1 is not None and s2 is not None:
-          matrix_scale1(dd,s1*s2);
           
 ## -------------------- compute the noise estimate, and weights based on this
+    self.end_stage("rescale");
     noise,weight = self.compute_noise(data,bitflags);
+    self.end_stage("noise");
     nw = nm = nnw = 0;
     # print and total up stats, check for funny situations
     for pq,bl in self.ifr_by_baseline:
@@ -675,7 +746,15 @@ class StefCalNode (pynode.PyNode):
       dprintf(0,"Solvable: %d of %d inteferometers (%d have valid data), with %d solvable antennas\n",
         len(self._solvable_ifrs),len(self.ifrs),len(solvable_ifrs),len(solvable_antennas));
     for opt in self.gainopts+self.dgopts:
-      opt.init_solver(datashape,expanded_datashape,solvable_ifrs,downsample_subtiling);
+      opt.init_solver(datashape,expanded_datashape,solvable_ifrs,downsample_subtiling,domain=domain);
+
+    # if resuming, and this tile was solved by a previous run, load its solutions and don't solve again
+    loaded = False;
+    if self.resume_from_table and not skip_solve:
+      solvable = [ opt for opt in self.gainopts+self.dgopts if opt.enable and opt.solve ];
+      if all([ opt.load_tile_solutions(domain) for opt in solvable ]):
+        dprint(0,"solutions for this tile loaded from table, skipping solve");
+        skip_solve = loaded = True;
 
     if self.print_variance:
       print_variance(variance);
@@ -712,6 +791,8 @@ class StefCalNode (pynode.PyNode):
     self.check_finiteness(model,"model",bitflags);
 #    cPickle.dump(model,file("dump-model.cp","w"),2);
 
+    self.end_stage("setup");
+
 ## -------------------- start of major loop
     initdata,initmodel,initweight = data,model,weight;
     if not skip_solve:
@@ -746,6 +827,9 @@ class StefCalNode (pynode.PyNode):
         # at beginning of loop, model: contains M = M0+dE1.M1+dE1^H+... with the latest dE values
         # reset data and weight to initial values
         data,weight = initdata,initweight;
+        # tags identifying the current data and model in the apply cache. The model only changes between major loops
+        # if there are diffgains
+        data_tag,model_tag = "data",("model",nmajor if num_diffgains else 0);
         flagged = False;  # will be True if new flags arise in DI terms
         pq0 = sorted(solvable_ifrs)[0]
         dprintf(2,"%s data type of data is %s\n",pq0,data[pq0][0].dtype)
@@ -764,7 +848,9 @@ class StefCalNode (pynode.PyNode):
           # modify model, if in second loop, or gain is already initialized
           if nmajor or opt.has_init_value:
             dprint(1,"applying %s %s to model"%(("current" if nmajor else "prior"),opt.label));
-            model = dict([ (pq,opt.solver.apply(model,pq,cache=True)) for pq in solvable_ifrs ]);
+            model = dict([ (pq,self._apply_cache.apply(opt.solver,opt.label,model,model_tag,pq))
+                           for pq in solvable_ifrs ]);
+            model_tag = ApplyCache.tag("apply",opt.solver,opt.label,model_tag);
           dimodels.append(model);
 
         ## loop over all DI terms (unless we're in the last major cycle, in which case only do the first one)
@@ -778,15 +864,17 @@ class StefCalNode (pynode.PyNode):
           if opt.solve and (nmajor >= opt.nmajor_start) and not (last_loop and di_solved):
             # recompute noise, unless this is the outer term, since it will have been rescaled
             if i:
-              newnoise,weight = self.compute_noise(data,bitflags);
+              with self._profiler.measure("noise"):
+                newnoise,weight = self.compute_noise(data,bitflags);
             ## iterate to convergence
             flagged |= self.run_gain_solution(opt,model,data,weight,bitflags,flag_null_gains=True,looptype=looptype);
             di_solved = True;
           ## apply correction to data
           dprint(1,"applying %s-inverse to data"%opt.label);
-          data = dict([ (pq,opt.solver.apply_inverse(data,pq,
-              regularize=self.regularization_factor if self.regularize_intermediate or last_loop else 0))
-              for pq in solvable_ifrs ]);
+          regularize = self.regularization_factor if self.regularize_intermediate or last_loop else 0;
+          data = dict([ (pq,self._apply_cache.apply_inverse(opt.solver,opt.label,data,data_tag,pq,regularize=regularize))
+                        for pq in solvable_ifrs ]);
+          data_tag = ApplyCache.tag("apply_inverse",opt.solver,opt.label,data_tag,regularize);
           dprint(1,"done");
           ## check for NANs in the data
           self.check_finiteness(data,"corrected data",bitflags);
@@ -804,53 +892,60 @@ class StefCalNode (pynode.PyNode):
                 #for m in visset.get(pq,()):
                   #if not is_null(m):
                     #m[fm] = 0;
-          # subtract model from corrected data to make residuals
+          # subtract model from corrected data to make residuals. Corrected data may be shared with the apply
+          # cache, so copy it first
+          if data is not initdata:
+            data = dict([ (pq,matrix_copy(data[pq])) for pq in solvable_ifrs ]);
           for pq in solvable_ifrs:
             for n,(dd,mm) in enumerate(zip(data[pq],model[pq])):
               dd -= mm;
           # recompute noise on residuals -- this will have been rescaled by the DI solutions      
-          noise,resweight = self.compute_noise(data,bitflags);
+          with self._profiler.measure("noise"):
+            noise,resweight = self.compute_noise(data,bitflags);
           # reset current model to a _copy_ of model0 -- each DG term will be added to it (in place) at the end of
           # each DG loop iteration
           for pq in solvable_ifrs:
             model[pq] = matrix_copy(model0[pq]);
-          # now loop over all diffgains and iterate each set once
-          for idg,dgopt in enumerate(self.dgopts):
-            # we want to solve for dE1 minimizing D=G.(M0+dE1.M1.dE1^H+dE2.M2.dE2^H+...).G^H
-            # which is the same as G^{-1}.D.G^{-H} = M0 + dE1.M1.dE1^H + dE2.M2.dE2^H + ...
-            # which is the same as D_corr - (M0 + dE1.M1.dE1^H + dE2.M2.dE2^H + ...) + dE1.M1.dE1^H = dE1.M1.dE1^H
-            # which is the same as D_corr - full_model_old                           + model1_old   = model1
-            # at this point, data is D_corr - full_model_old
-            # so, add model1_old to data, and fit model1 to it
-            # dgmodel_corr always contains the modelN_old values
-            report_prec = False
-            for pq in solvable_ifrs:
-              if not report_prec:
-                dprintf(2,"%s %s data type of dgmodel is %s\n",dgopt.label,pq,dgmodel[idg][pq][0].dtype)
-              corr = dgopt.solver.apply(dgmodel[idg],pq);
-              ##dgm: corr = dgmodel_corr[idg][pq];
-              if not report_prec:
-                dprintf(2,"%s %s data type of corrected is %s\n",dgopt.label,pq,corr[0].dtype)
-                report_prec = True
-              for (c,dd) in zip(corr,data[pq]):
-                dd += c;
-            if ( idg == self.dump_diffgain or self.dump_diffgain == -1 ) and \
-              ( domain_id == self.dump_domain or self.dump_domain == -1 ):
-              dump_data_model(dgmodel[idg],data,solvable_ifrs,"dump_E%d-%d.txt"%(idg,nmajor));
-            # iterate this diffgain solution
-            self.check_finiteness(data,"data after DG%d added in"%idg,bitflags);
-            flagged = self.run_gain_solution(dgopt,dgmodel[idg],data,weight,bitflags,flag_null_gains=False,looptype=looptype);
-            # now, add to model1 to model, and subtract back from data if needed
-            for pq in solvable_ifrs:
-              corr = dgopt.solver.apply(dgmodel[idg],pq);
-              #dgm: corr = dgmodel_corr[idg][pq] = dgopt.solver.apply(dgmodel[idg],pq,cache=True);
-              for i,(c,mm,dd) in enumerate(zip(corr,model[pq],data[pq])):
-                if is_null(mm):
-                  model[i] = c;
-                else:
-                  mm += c;
-                if idg<num_diffgains-1:
-                  dd -= c;
+          # solve for all diffgains at once, or loop over all diffgains and iterate each set once
+          if self.diffgain_threads > 1 and num_diffgains > 1:
+            flagged = self.solve_diffgains_parallel(data,model,dgmodel,weight,bitflags,solvable_ifrs,looptype);
+          else:
+            for idg,dgopt in enumerate(self.dgopts):
+              # we want to solve for dE1 minimizing D=G.(M0+dE1.M1.dE1^H+dE2.M2.dE2^H+...).G^H
+              # which is the same as G^{-1}.D.G^{-H} = M0 + dE1.M1.dE1^H + dE2.M2.dE2^H + ...
+              # which is the same as D_corr - (M0 + dE1.M1.dE1^H + dE2.M2.dE2^H + ...) + dE1.M1.dE1^H = dE1.M1.dE1^H
+              # which is the same as D_corr - full_model_old                           + model1_old   = model1
+              # at this point, data is D_corr - full_model_old
+              # so, add model1_old to data, and fit model1 to it
+              # dgmodel_corr always contains the modelN_old values
+              report_prec = False
+              for pq in solvable_ifrs:
+                if not report_prec:
+                  dprintf(2,"%s %s data type of dgmodel is %s\n",dgopt.label,pq,dgmodel[idg][pq][0].dtype)
+                corr = self._apply_cache.apply(dgopt.solver,dgopt.label,dgmodel[idg],("dgmodel",idg),pq);
+                ##dgm: corr = dgmodel_corr[idg][pq];
+                if not report_prec:
+                  dprintf(2,"%s %s data type of corrected is %s\n",dgopt.label,pq,corr[0].dtype)
+                  report_prec = True
+                for (c,dd) in zip(corr,data[pq]):
+                  dd += c;
+              if ( idg == self.dump_diffgain or self.dump_diffgain == -1 ) and \
+                ( domain_id == self.dump_domain or self.dump_domain == -1 ):
+                dump_data_model(dgmodel[idg],data,solvable_ifrs,"dump_E%d-%d.txt"%(idg,nmajor));
+              # iterate this diffgain solution
+              self.check_finiteness(data,"data after DG%d added in"%idg,bitflags);
+              flagged = self.run_gain_solution(dgopt,dgmodel[idg],data,weight,bitflags,flag_null_gains=False,looptype=looptype);
+              # now, add to model1 to model, and subtract back from data if needed
+              for pq in solvable_ifrs:
+                corr = self._apply_cache.apply(dgopt.solver,dgopt.label,dgmodel[idg],("dgmodel",idg),pq);
+                #dgm: corr = dgmodel_corr[idg][pq] = dgopt.solver.apply(dgmodel[idg],pq,cache=True);
+                for i,(c,mm,dd) in enumerate(zip(corr,model[pq],data[pq])):
+                  if is_null(mm):
+                    model[i] = c;
+                  else:
+                    mm += c;
+                  if idg<num_diffgains-1:
+                    dd -= c;
           # at end of loop over diffgains:
           # model already contains an up-to-date model with dEs applied
           
@@ -878,7 +973,7 @@ class StefCalNode (pynode.PyNode):
       data.update(data1);
       dprint(1,"saving solutions");        
       for opt in self.gainopts+self.dgopts:
-        opt.save_values();
+        opt.save_values(domain=domain,append=self.resume_from_table);
       GainOpts.flush_tables();
     # endif not skip_solve
     else:
@@ -892,15 +987,20 @@ class StefCalNode (pynode.PyNode):
 #    dprint(0,"***DEBUG*** data",pq00,data[pq00][0][DEBUG_SLICE])
 #    dprint(0,"***DEBUG*** model",pq00,model[pq00][0][DEBUG_SLICE])
     
+    self._apply_cache.clear();
+    # release the scratch arrays of compute_noise() and compute_chisq(), rather than keep them around between tiles
+    # (those of diffgain threads go away with the threads)
+    self._scratch.__dict__.clear();
+    self.end_stage("solve");
+
     # corrdata will contain the corrected data (with all DI terms applied)
     # data will contain the original data
     # model already contains an up-to-date model with dEs applied
     corrdata,data = data,initdata;
     
-    # remember init value for next tile
-    if self.init_from_previous:
-      for opt in self.gainopts+self.dgopts:
-        opt.update_initval();
+    # remember init value for next tile, and pass solutions on to warm start
+    for opt in self.gainopts+self.dgopts:
+      opt.update_initval(use_previous=self.init_from_previous,domain=domain,solved=not skip_solve,loaded=loaded);
     
     dprint(1,"checking flagging");  
     # check for excessive flagging
@@ -1024,7 +1124,8 @@ class StefCalNode (pynode.PyNode):
         continue;
       else:
         if self.residuals:
-          out = [ d-m for d,m in zip(dd,mm) ];
+          # residuals are formed one element at a time as the output is filled, so only one is held at a time
+          out = ( d-m for d,m in zip(dd,mm) );
 #          out = mm  ### write model!
 #          if pq == pq00:
 #            dprint(0,"***DEBUG*** residuals:",pq00,out[0][DEBUG_SLICE])
@@ -1049,15 +1150,19 @@ class StefCalNode (pynode.PyNode):
           if not flagmask.any():
             flagmask = None;
         for n,x in enumerate(out):
-          if self.downsample_output and downsampler and not numpy.isscalar(x):
-            x = downsampler.expand_subshape(x);
           vs = datares.vellsets[nvells];
           val = getattr(vs,'value',None);
           if val is not None:
-            vs.value = val = val.copy()
+            # the output is written straight into a new value array (all of which is overwritten, so there's no need
+            # to copy the old one), and downsampled values are expanded directly into it
+            newval = numpy.empty_like(val);
             try:
-              val[...] = x[expanded_dataslice] if expanded_dataslice \
-                and not is_null(x) else x;
+              if self.downsample_output and downsampler and not numpy.isscalar(x):
+                downsampler.expand_subshape(x,data_subset=expanded_dataslice,out=newval);
+              else:
+                newval[...] = x[expanded_dataslice] if expanded_dataslice \
+                  and not is_null(x) else x;
+              vs.value = newval;
             except:
               print x,getattr(x,'shape',None);
           if not is_null(flagmask) and self.output_flag_bit:
@@ -1078,6 +1183,9 @@ class StefCalNode (pynode.PyNode):
               fl[newflags if expanded_dataslice is None else newflags[expanded_dataslice]] |=  self.output_flag_bit;
           # compute stats
           nvells += 1;
+        # release this baseline's working arrays, they're no longer needed
+        corrdata.pop(pq,None);
+        model.pop(pq,None);
     dprint(1,"computing result: done");
 
     # if last domain, then write ifr gains to file
@@ -1111,69 +1219,108 @@ class StefCalNode (pynode.PyNode):
           traceback.print_exc();
           dprint(0,"error saving ifr gains to",self.ifr_gain_table);
 
+    self.end_stage("output");
     dt = time.time()-timestamp0;
     m,s = divmod(dt,60);
     dprint(0,"%s elapsed time %dm%0.2fs"%(
               request.request_id,m,s));
+    try:
+      self._profiler.end_tile();
+    except:
+      traceback.print_exc();
+      dprint(0,"error writing profiling records to",self.profile_file);
+    dprint(1,"  time per stage:",", ".join([ "%s %.2fs"%x for x in self._profiler.stage_timings ]));
 
     return datares;
 
+  def end_stage (self,stage):
+    """Records the time spent in the given stage of get_result(), i.e. since the end of the previous stage""";
+    self._profiler.end_stage(stage);
+
+  def _scratch_array (self,name,shape,dtype):
+    """Returns a scratch array of the given shape and dtype. The array from the previous call with the same name
+    is reused if it fits, so the contents are undefined.""";
+    scratch = self._scratch.__dict__;
+    arr = scratch.get(name);
+    if arr is None or arr.shape != shape or arr.dtype != dtype:
+      arr = scratch[name] = numpy.empty(shape,dtype);
+    return arr;
+
+  def _stats_chunk (self,shape,bytes_per_slot):
+    """Returns the number of baselines that compute_noise() and compute_chisq() process at a time: at most
+    stats_chunk, and few enough that their scratch arrays (of bytes_per_slot bytes per time/freq slot of each
+    baseline, for the given data shape) stay within stats_chunk_mb""";
+    nbl = int(self.stats_chunk_mb*2**20/(numpy.prod(shape)*bytes_per_slot));
+    return max(1,min(self.stats_chunk,nbl));
+
+  def _stack_flags (self,keys,bitflags,shape):
+    """Stacks flags of the given baselines into a scratch boolean array of shape (len(keys),)+shape""";
+    fmask = self._scratch_array("flags",(len(keys),)+shape,bool);
+    for i,pq in enumerate(keys):
+      flag = bitflags.get(pq);
+      if is_null(flag):
+        fmask[i] = False;
+      else:
+        numpy.not_equal(flag,0,out=fmask[i]);
+    return fmask;
+
   def compute_noise (self,data,bitflags):
     """Computes delta-std and weights of data""";
     noise = {};
     weight = {};
-    sumweight = 0;
-    nweight = 0;
-    # make null-flag array
-    dfshape = list(self._expanded_datashape);
-    dfshape[0] -= 1;
-    alltrue = numpy.ones(dfshape,bool);
-    allfalse = numpy.zeros(dfshape,bool);
-    # loop over data
-    for pq,dd in data.iteritems():
-      flag = bitflags.get(pq);
-      if not is_null(flag):
-        flag = (flag!=0);
-        dflag = flag[1:,...]|flag[:-1,...];
-        dvalid = ~dflag;
-      else:
-        dflag,dvalid = allfalse,alltrue;
-      # number of valid slots (per channel, or in total)
-      num_valid = dvalid.sum(0) if self.noise_per_chan else dvalid.sum();
-      vv2 = [];
-      for d in dd:
-        if is_null(d):
-          vv2.append(0);
-        else:
-          # take forward difference, null at flagged points
-          delta = d[1:,...]-d[:-1,...];
-          delta[dflag] = 0;
-          # take squared real and imaginary parts of this
-          # sum them, since taking the difference reduces the noise by sqrt(2); so the
-          # squared-mean-diff is a factor of 2 higher
-          if self.noise_per_chan:
-            v2 = (numpy.square(delta.real).sum(0) + numpy.square(delta.imag).sum(0))/num_valid;
-            v2[num_valid==0] = 0;
-            vv2.append(v2[numpy.newaxis,:]);
+    shape = tuple(self._expanded_datashape);
+    keys = data.keys();
+    dtype = numpy.result_type(*[ d for dd in data.itervalues() for d in dd if not is_null(d) ] or [complex]);
+    # process baselines in chunks, so that scratch arrays stay bounded in size: per slot, these are
+    # 4 differences, plus flags and difference flags
+    nchunk = self._stats_chunk(shape,4*numpy.dtype(dtype).itemsize+2);
+    for i0 in range(0,len(keys),nchunk):
+      chunk = keys[i0:i0+nchunk];
+      nbl = len(chunk);
+      # forward differences of all baselines and correlations, stacked into one array
+      delta = self._scratch_array("delta",(nbl,4,shape[0]-1)+shape[1:],dtype);
+      present = numpy.zeros((nbl,4),bool);
+      for i,pq in enumerate(chunk):
+        for j,d in enumerate(data[pq]):
+          if is_null(d):
+            delta[i,j] = 0;
           else:
-            v2 = (numpy.square(delta.real).sum() + numpy.square(delta.imag).sum())/num_valid if num_valid else 0;
-            vv2.append(v2);
+            numpy.subtract(d[1:,...],d[:-1,...],out=delta[i,j]);
+            present[i,j] = True;
+      # null the differences at flagged points
+      fmask = self._stack_flags(chunk,bitflags,shape);
+      dflag = self._scratch_array("dflags",(nbl,shape[0]-1)+shape[1:],bool);
+      numpy.logical_or(fmask[:,1:,...],fmask[:,:-1,...],out=dflag);
+      numpy.copyto(delta,0,where=dflag[:,numpy.newaxis,...]);
+      # number of valid slots (per channel, or in total)
+      num_valid = (~dflag).reshape((nbl,shape[0]-1,-1)).sum(1);
+      if not self.noise_per_chan:
+        num_valid = num_valid.sum(1)[:,numpy.newaxis];
+      # take squared real and imaginary parts of this, and sum them, since taking the difference reduces the noise
+      # by sqrt(2); so the squared-mean-diff is a factor of 2 higher
+      dv = delta.view(delta.real.dtype);
+      numpy.square(dv,out=dv);
+      v2 = dv.reshape((nbl,4,shape[0]-1,-1,2)).sum(4,dtype=numpy.float64).sum(2);
+      if not self.noise_per_chan:
+        v2 = v2.sum(2)[...,numpy.newaxis];
+      valid = num_valid!=0;
+      v2 = numpy.where(valid[:,numpy.newaxis,:],v2/numpy.maximum(num_valid,1)[:,numpy.newaxis,:],0);
+      # an estimate is null if the correlation is missing, or if it came out as a single zero
+      nonnull = present&((v2.shape[2]>1)|(v2[...,0]!=0));
       # convert to weight
       # if XY/YX is well-defined, use it, else use the XX/YY estimates
-      if self.use_polarizations_for_noise and not is_null(vv2[1]) and not is_null(vv2[2]):
-        n = noise[pq] = numpy.sqrt((vv2[1]+vv2[2])/2);
-        w = weight[pq] = 1/n;
-        w[n==0] = 0; 
-      elif not is_null(vv2[0]) and not is_null(vv2[3]):
-        n = noise[pq] = numpy.sqrt((vv2[0]+vv2[3])/2);
-        w = weight[pq] = 1/n;
-        if numpy.isscalar(n):
-          if n == 0:
-            w = 0;
-        else:
-          w[n==0] = 0; 
+      usepol = nonnull[:,1]&nonnull[:,2] if self.use_polarizations_for_noise else numpy.zeros(nbl,bool);
+      usediag = ~usepol&nonnull[:,0]&nonnull[:,3];
+      n = numpy.sqrt(numpy.where(usepol[:,numpy.newaxis],v2[:,1]+v2[:,2],v2[:,0]+v2[:,3])/2);
+      w = numpy.where(n!=0,1/numpy.where(n!=0,n,1),0);
+      if self.noise_per_chan:
+        n = n.reshape((nbl,1)+shape[1:]);
+        w = w.reshape((nbl,1)+shape[1:]);
       else:
-        n,w = 0,0;
+        n,w = n[:,0],w[:,0];
+      for i in numpy.nonzero(usepol|usediag)[0]:
+        noise[chunk[i]] = n[i];
+        weight[chunk[i]] = w[i];
     ## normalize weights ## NB why? what was I thinking?
     #if nweight:
       #meanweight = sumweight/nweight;
@@ -1184,45 +1331,66 @@ class StefCalNode (pynode.PyNode):
       dprint(4,"noise estimates by baseline:");
       npq = sorted([ (n,pq) for pq,n in noise.iteritems() ],cmp=lambda x,y:cmp(numpy.mean(x[0]),numpy.mean(y[0])));
       for n,pq in npq:
-        dprint(4,"  %s-%s"%pq," ".join(["%.2g"%float(x) for x in n.ravel()[:20]]));
+        dprint(4,"  %s-%s"%pq," ".join(["%.2g"%float(x) for x in numpy.ravel(n)[:20]]));
         
     return noise,weight;
 
   def compute_chisq (self,model,data,gain,weight=None,bitflags={}):
+    shape = tuple(self._expanded_datashape);
     # per-slot normalized and unnormalized chisq
-    chisq0 = numpy.zeros(self._expanded_datashape);
-    chisq1 = numpy.zeros(self._expanded_datashape);
+    chisq0 = numpy.zeros(shape);
+    chisq1 = numpy.zeros(shape);
     # nterms: per-slot number of terms in chi-sq sum
-    nterms = numpy.zeros(self._expanded_datashape,int);
-    # loop over all IFRS
-    for pq in self._solvable_ifrs:
-      if pq not in data:
-        continue;
-      res = gain.residual(model,data,pq);
-      w = weight.get(pq,1)**2 if weight else 1;
-#      fmask = reduce(operator.or_,[(d==0)&(m==0) for (d,m) in zip(data[pq],model[pq])]);
-      fmask = bitflags.get(pq);
-      fmask = fmask is not None and (fmask!=0);
-      # n0 is the nominal number of t/f slots for which we expect to have a residual
-      n0 = self._datasize - ((fmask&self._expansion_mask).sum() if not is_null(fmask) else 0);
-      for ir,r in enumerate(res):
-        if not is_null(r):
-          # fin is a mask of finite residuals, in unflagged slots
-          # in principle all unflagged residuals ought to be finite, but I'm covering
-          # my ass here in case of some pathologies/bugs
-          fin = numpy.isfinite(r);
-          if not is_null(fmask):
-            fin &= ~fmask;
-          # n is the number of slots for which we have a finite, unflagged residual
-          n = fin.sum();
-          if n < n0:
-            dprintf(4,"%s element %d: %d/%d slots are unexpectedly INF/NAN, omitting from chisq sum\n",pq,ir,n0-n,n0);
-          # add residual to chisq sum
-          if n:
-            rsq = (r*numpy.conj(r)).real;
-            chisq0[fin] += (rsq*w)[fin];
-            chisq1[fin] += (rsq)[fin];
-            nterms[fin] += 2;  # each slot contributes two terms (real and imag)
+    nterms = numpy.zeros(shape,int);
+    # loop over all IFRS, in chunks, so that scratch arrays stay bounded in size
+    keys = [ pq for pq in self._solvable_ifrs if pq in data ];
+    # per slot, the scratch arrays hold 4 (complex) residuals, their squares and finiteness flags, and a weight
+    nchunk = self._stats_chunk(shape,4*(16+8+1)+8);
+    for i0 in range(0,len(keys),nchunk):
+      chunk = keys[i0:i0+nchunk];
+      nbl = len(chunk);
+      # stack residuals and (squared) weights of all baselines
+      res = [ gain.residual(model,data,pq) for pq in chunk ];
+      dtype = numpy.result_type(*[ r for rr in res for r in rr if not is_null(r) ] or [complex]);
+      resbuf = self._scratch_array("residuals",(nbl,4)+shape,dtype);
+      wbuf = self._scratch_array("weights",(nbl,)+shape,float);
+      present = numpy.zeros((nbl,4),bool);
+      for i,(pq,rr) in enumerate(zip(chunk,res)):
+        for j,r in enumerate(rr):
+          if is_null(r):
+            resbuf[i,j] = 0;
+          else:
+            resbuf[i,j] = r;
+            present[i,j] = True;
+        wbuf[i] = weight.get(pq,1)**2 if weight else 1;
+      res = None;
+      # fin is a mask of finite residuals, in unflagged slots
+      # in principle all unflagged residuals ought to be finite, but I'm covering
+      # my ass here in case of some pathologies/bugs
+      fin = numpy.isfinite(resbuf,out=self._scratch_array("finite",resbuf.shape,bool));
+      fmask = self._stack_flags(chunk,bitflags,shape);
+      fin &= ~fmask[:,numpy.newaxis,...];
+      fin &= present.reshape((nbl,4)+(1,)*len(shape));
+      if _verbosity.verbose>3:
+        for i,pq in enumerate(chunk):
+          # n0 is the nominal number of t/f slots for which we expect to have a residual
+          n0 = self._datasize - (fmask[i]&self._expansion_mask).sum();
+          for ir in numpy.nonzero(present[i])[0]:
+            # n is the number of slots for which we have a finite, unflagged residual
+            n = fin[i,ir].sum();
+            if n < n0:
+              dprintf(4,"%s element %d: %d/%d slots are unexpectedly INF/NAN, omitting from chisq sum\n",pq,ir,n0-n,n0);
+      # each slot contributes two terms (real and imag)
+      nterms += 2*fin.reshape((-1,)+shape).sum(0);
+      # squared residuals, nulled where not finite or flagged
+      rv = resbuf.view(resbuf.real.dtype);
+      numpy.square(rv,out=rv);
+      rsq = numpy.add(rv[...,0::2],rv[...,1::2],out=self._scratch_array("rsq",resbuf.shape,float));
+      numpy.copyto(rsq,0,where=numpy.logical_not(fin,out=fin));
+      rsq = rsq.sum(1);
+      # add residuals to chisq sums
+      chisq1 += rsq.sum(0);
+      chisq0 += numpy.einsum('i...,i...->...',rsq,wbuf);
     # ok chisq0 and chisq1 contain the per-slot chi-squares. Take their mean
     tot_terms = nterms.sum();
     if tot_terms:
@@ -1260,6 +1428,67 @@ class StefCalNode (pynode.PyNode):
     else:
       bitflags[pq] = fmask;
 
+  def solve_diffgains_parallel (self,data,model,dgmodel,weight,bitflags,solvable_ifrs,looptype=0):
+    """Solves for all diffgain terms concurrently, SAGE-style, using a pool of self.diffgain_threads threads.
+
+    On entry, data contains the residuals R = D_corr - full_model_old, and model contains a copy of M0. Each term k is
+    fitted to its own "hidden data" model_k_old + R/K (where K is the number of terms), i.e. the residuals are shared out
+    equally between the directions, and all terms start from the solutions of the other directions from the previous
+    major loop, rather than from the ones already updated in this loop, as in the serial case. (Giving each term all of
+    R would make every direction try to absorb the same residuals, and the merged model overshoot.) The residuals are
+    shared (read-only) by all threads, while each direction gets its own data buffer and a private copy of the flags.
+    In the merge step, the new model_k are added into model, and new flags are merged back into bitflags.
+    Returns True if anything was flagged.""";
+    num_diffgains = len(self.dgopts);
+    beta = 1./num_diffgains;
+    def solve_direction (idg):
+      dgopt = self.dgopts[idg];
+      t0 = time.time();
+      niter0 = dgopt.num_iter;
+      with self._profiler.measure("diffgain",dgopt.label):
+        dgdata = {};
+        for pq in solvable_ifrs:
+          corr = self._apply_cache.apply(dgopt.solver,dgopt.label,dgmodel[idg],("dgmodel",idg),pq);
+          dgdata[pq] = [ dd*beta+c for dd,c in zip(data[pq],corr) ];
+        dgflags = dict([ (pq,numpy.array(bf)) for pq,bf in bitflags.iteritems() ]);
+        self.check_finiteness(dgdata,"data after DG%d added in"%idg,dgflags);
+        flagged = self.run_gain_solution(dgopt,dgmodel[idg],dgdata,weight,dgflags,flag_null_gains=False,looptype=looptype);
+      return flagged,dgflags,time.time()-t0,dgopt.num_iter-niter0;
+    nthreads = min(self.diffgain_threads,num_diffgains);
+    dprint(1,"solving for %d diffgain terms using %d threads"%(num_diffgains,nthreads));
+    # the directions share one pool of solver processes, which is started here rather than by whichever
+    # thread gets there first
+    if self.solver_processes > 1:
+      get_pool(self.solver_processes);
+    t0 = time.time();
+    pool = ThreadPool(nthreads);
+    try:
+      results = pool.map(solve_direction,range(num_diffgains));
+    finally:
+      pool.close();
+      pool.join();
+    walltime = time.time() - t0;
+    # merge step: add new models into model, and merge flags
+    flagged = False;
+    for idg,(dgopt,(dgflagged,dgflags,dgtime,dgniter)) in enumerate(zip(self.dgopts,results)):
+      dprint(1,"%s: solved in %.2fs (wall), %d iterations"%(dgopt.label,dgtime,dgniter));
+      if dgflagged:
+        flagged = True;
+        for pq,fmask in dgflags.iteritems():
+          self.add_flags(bitflags,pq,fmask);
+      for pq in solvable_ifrs:
+        corr = self._apply_cache.apply(dgopt.solver,dgopt.label,dgmodel[idg],("dgmodel",idg),pq);
+        mm = model[pq];
+        for i,c in enumerate(corr):
+          if is_null(mm[i]):
+            # cached results must not be modified in place, so copy
+            mm[i] = c if numpy.isscalar(c) else c.copy();
+          else:
+            mm[i] += c;
+    dprint(1,"solved for %d diffgain terms in %.2fs (%.2fs wall time summed over terms)"%(num_diffgains,walltime,
+              sum([ dgtime for dgflagged,dgflags,dgtime,dgniter in results ])));
+    return flagged;
+
   def run_gain_solution (self,gopt,model,data,weight,bitflags,flag_null_gains=False,looptype=0):
     """Runs a single gain solution loop to completion"""
     flagged = False;
@@ -1267,22 +1496,36 @@ class StefCalNode (pynode.PyNode):
     gain_maxdiffs = [];
     # initial chi-sq, and fallback chisq for divergence
     gopt.solver._reset();
-    init_chisq,init_chisq_unnorm,init_chisq_arr,init_chisq_unnorm_arr = \
-      self.compute_chisq(model,data,gopt.solver,weight=weight,bitflags=bitflags);
+    # solvers that keep data around between iterations (Gain2x2v) must not reuse data from a previous solution,
+    # since model and data may have changed in place since
+    release_data = getattr(gopt.solver,'release_data',None);
+    if release_data:
+      release_data();
+    with self._profiler.measure("chisq",gopt.label):
+      init_chisq,init_chisq_unnorm,init_chisq_arr,init_chisq_unnorm_arr = \
+        self.compute_chisq(model,data,gopt.solver,weight=weight,bitflags=bitflags);
     self._set_ds_array('$init_chisq',init_chisq_arr);
     lowest_chisq = (init_chisq,gopt.solver.get_values());
     lowest_chisq_iter = 0;
     num_diverged = 0;
     dprint(2,"solving for %s, initial chisq is %.12g"%(gopt.label,init_chisq));
     t0 = time.time();
+    # if active-set mode and/or parallel solving is enabled, iterate via an ActiveSet or a pool of processes
+    # (these fall back to None if not possible)
+    solve_weight = weight if gopt.weigh else None;
+    solver = ( self.active_set and ActiveSet.create(gopt.solver,model,data,bitflags,weight=solve_weight,
+                                                    nproc=self.solver_processes) ) or \
+             SubtilePool.create(gopt.solver,self.solver_processes,model,data,bitflags,weight=solve_weight) or \
+             gopt.solver;
     chisq0 = init_chisq;
     # iterate
     for niter in range(gopt.max_iter):
       # iterate over normal gains
       # bounds-flagging is enabled after iteration 3
-      converged,maxdiff,deltas,nflag = gopt.solver.iterate(model,data,bitflags,
-                                          niter=niter,weight=weight if gopt.weigh else None,
-                                          bounds=gopt.bounds if niter>2 else None);
+      with self._profiler.measure("iterate",gopt.label):
+        converged,maxdiff,deltas,nflag = solver.iterate(model,data,bitflags,
+                                            niter=niter,weight=weight if gopt.weigh else None,
+                                            bounds=gopt.bounds if niter>2 else None);
       dprint(3,"iter %d: %.2f%% (%d/%d) conv, %d gfs, max update %g"%(
           niter+1,gopt.solver.num_converged*100./gopt.solver.real_slots,gopt.solver.num_converged,gopt.solver.real_slots,nflag,float(gopt.solver.delta_max)));
       gain_maxdiffs.append(float(maxdiff));
@@ -1295,7 +1538,8 @@ class StefCalNode (pynode.PyNode):
         if delta1 == "same":
           delta1 = gopt.delta;
       if delta != 0 or gopt.max_diverge or converged or niter == gopt.max_iter-1:
-        chisq,chisq_unnorm,chisq_arr,chisq_unnorm_arr = self.compute_chisq(model,data,gopt.solver,weight=weight,bitflags=bitflags);
+        with self._profiler.measure("chisq",gopt.label):
+          chisq,chisq_unnorm,chisq_arr,chisq_unnorm_arr = self.compute_chisq(model,data,gopt.solver,weight=weight,bitflags=bitflags);
       if delta != 0:
         dchi = (chisq0-chisq)/chisq;
         gain_dchi.append(dchi);
@@ -1350,6 +1594,11 @@ class StefCalNode (pynode.PyNode):
     else:
       dprint(1,"%s max iterations (%d) reached at chisq %.12g (last gain update %g) after %.2fs"%(
               gopt.label,gopt.max_iter,chisq,float(gopt.solver.delta_max),time.time()-t0));
+    gopt.num_iter += niter+1;
+    if solver is not gopt.solver:
+      solver.close();
+    if release_data:
+      release_data();
     # check if we have a lower chisq to roll back to
     rolled_back = False;
     if self.chisq_rollback:
@@ -1361,7 +1610,8 @@ class StefCalNode (pynode.PyNode):
             chisq,lowest_chisq[0],lowest_chisq_iter));
         if chisq > lowest_chisq[0]*1.01 and gopt.flag_chisq:
           dprint(2,"Recomputing rolled-back chisq for flagging purposes");
-          chisq,chisq_unnorm,chisq_arr,chisq_unnorm_arr = self.compute_chisq(model,data,gopt.solver,weight=weight,bitflags=bitflags);
+          with self._profiler.measure("chisq",gopt.label):
+            chisq,chisq_unnorm,chisq_arr,chisq_unnorm_arr = self.compute_chisq(model,data,gopt.solver,weight=weight,bitflags=bitflags);
         rolled_back = True;
         self._set_ds_array('$high_discarded_chisq',chisq_arr);
         chisq,gainvals = lowest_chisq;
@@ -1452,6 +1702,5 @@ class StefCalNode (pynode.PyNode):
     return flagged;
     
   def _set_ds_array (self,field,array):
-    vv = meq.vells(array.shape);
-    vv[...] = array;
-    self.set_state(field,array); 
+    with self._state_lock:
+      self.set_state(field,array); 
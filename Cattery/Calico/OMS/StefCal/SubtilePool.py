@@ -0,0 +1,266 @@
+import os
+import os.path
+import math
+import tempfile
+import multiprocessing
+import threading
+import numpy
+import Kittens.utils
+
+_verbosity = Kittens.utils.verbosity(name="subtilepool");
+dprint = _verbosity.dprint;
+dprintf = _verbosity.dprintf;
+
+# shared-memory buffers are created here if available, else in the default temp directory
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None;
+
+# alignment of arrays within a shared buffer
+ALIGNMENT = 64;
+
+class _ArrayRef (object):
+  """Describes an array placed in a shared buffer""";
+  __slots__ = ('dtype','shape','offset');
+  def __init__ (self,dtype,shape,offset):
+    self.dtype,self.shape,self.offset = dtype,shape,offset;
+  def __getstate__ (self):
+    return self.dtype,self.shape,self.offset;
+  def __setstate__ (self,state):
+    self.dtype,self.shape,self.offset = state;
+
+
+class SharedArrays (object):
+  """Places a nested structure of dicts, lists and tuples of arrays into a single shared-memory buffer (a file,
+  preferably in /dev/shm). The 'layout' attribute is a picklable copy of the structure, in which every
+  non-trivial array is replaced by an _ArrayRef. Worker processes use attach() to map the buffer back into
+  the same structure of arrays, without copying.
+  """;
+  def __init__ (self,struct):
+    self._size = 0;
+    self._arrays = [];
+    self.layout = self._make_layout(struct);
+    fd,self.filename = tempfile.mkstemp(prefix="stefcal-",suffix=".shm",dir=SHM_DIR);
+    os.close(fd);
+    buf = numpy.memmap(self.filename,dtype=numpy.uint8,mode='w+',shape=(max(self._size,1),));
+    for arr,ref in self._arrays:
+      numpy.ndarray(ref.shape,ref.dtype,buf,ref.offset)[...] = arr;
+    buf.flush();
+    del buf;
+    self._arrays = None;
+    dprintf(2,"placed %.2f Mb of data into %s\n",self._size/float(2**20),self.filename);
+
+  def _make_layout (self,x):
+    if isinstance(x,dict):
+      return dict([ (key,self._make_layout(value)) for key,value in x.iteritems() ]);
+    elif isinstance(x,(list,tuple)):
+      return type(x)(map(self._make_layout,x));
+    elif isinstance(x,numpy.ndarray) and x.size > 1:
+      ref = _ArrayRef(x.dtype.str,x.shape,self._size);
+      self._size += int(math.ceil(x.nbytes/float(ALIGNMENT)))*ALIGNMENT;
+      self._arrays.append((x,ref));
+      return ref;
+    else:
+      return x;
+
+  def close (self):
+    """Removes the shared buffer. Workers that still have it mapped may continue to use it.""";
+    if self.filename:
+      try:
+        os.unlink(self.filename);
+      except OSError:
+        pass;
+      self.filename = None;
+
+  def __del__ (self):
+    self.close();
+
+  @staticmethod
+  def attach (filename,layout):
+    """Maps a shared buffer created by a SharedArrays object, and returns the structure of arrays""";
+    buf = numpy.memmap(filename,dtype=numpy.uint8,mode='c');
+    def unpack (x):
+      if isinstance(x,_ArrayRef):
+        return numpy.ndarray(x.shape,numpy.dtype(x.dtype),buf,x.offset);
+      elif isinstance(x,dict):
+        return dict([ (key,unpack(value)) for key,value in x.iteritems() ]);
+      elif isinstance(x,(list,tuple)):
+        return type(x)(map(unpack,x));
+      else:
+        return x;
+    return unpack(layout);
+
+
+def _slice_values (x,axis,length,i0,i1):
+  """Takes slice i0:i1 along the given axis of every array in a nested structure. Only arrays
+  of the given length along that axis are sliced, others (scalars, or arrays that are to be broadcast,
+  such as weights of shape 1,NF) are returned as is.""";
+  if isinstance(x,dict):
+    return dict([ (key,_slice_values(value,axis,length,i0,i1)) for key,value in x.iteritems() ]);
+  elif isinstance(x,(list,tuple)):
+    return type(x)([ _slice_values(value,axis,length,i0,i1) for value in x ]);
+  elif isinstance(x,numpy.ndarray) and x.ndim > axis and x.shape[axis] == length and length > 1:
+    return x[(slice(None),)*axis+(slice(i0,i1),)];
+  else:
+    return x;
+
+def _merge_values (blocks,values,axis,shape):
+  """Merges per-block values of a nested structure back into arrays of the given shape. This is the inverse
+  of _slice_values(). Dict entries missing from some blocks are taken to be False (as is the case for gain flags).
+  Scalars that are the same in all blocks remain scalars.""";
+  x0 = values[0];
+  if isinstance(x0,dict):
+    keys = set();
+    for x in values:
+      keys.update(x.iterkeys());
+    return dict([ (key,_merge_values(blocks,[ x.get(key,False) for x in values ],axis,shape)) for key in keys ]);
+  elif isinstance(x0,(list,tuple)):
+    return type(x0)([ _merge_values(blocks,list(elems),axis,shape) for elems in zip(*values) ]);
+  if all([ numpy.ndim(x) == 0 for x in values ]) and all([ x == x0 for x in values[1:] ]):
+    return x0;
+  out = numpy.empty(shape,numpy.result_type(*values));
+  for (i0,i1),x in zip(blocks,values):
+    out[(slice(None),)*axis+(slice(i0,i1),)] = x;
+  return out;
+
+
+class BlockOpts (object):
+  """Picklable stand-in for a GainOpts object, as seen by a solver working on a block of subtiles. Carries
+  the plain option values only, and does not save intermediate tables (the parent solver does that)""";
+  def __init__ (self,opts):
+    for attr,value in vars(opts).iteritems():
+      if isinstance(value,(bool,int,long,float,str,list,tuple,type(None))):
+        setattr(self,attr,value);
+
+  def save_intermediate_values (self,niter):
+    pass;
+
+
+# buffer most recently attached by this (worker) process, as filename,structure
+_attached = None,None;
+
+def _iterate_block (args):
+  """Runs one iteration of a solver on one block of subtiles. Called in a worker process""";
+  global _attached;
+  filename,layout,axis,(d0,d1),impl_class,solver_args,gain,gainflags,kw = args;
+  if _attached[0] != filename:
+    _attached = None,None;
+    _attached = filename,SharedArrays.attach(filename,layout);
+  lhs,rhs,bitflags,weight = _slice_values(_attached[1],axis,solver_args['fullshape'][axis],d0,d1);
+  solver = impl_class(solver_args['datashape'],solver_args['datashape'],solver_args['subtiling'],
+                      solver_args['solve_ifrs'],opts=solver_args['opts'],
+                      force_subtiling=solver_args['force_subtiling'],verbose=solver_args['verbose']);
+  solver.set_values(gain);
+  solver.gainflags = gainflags;
+  converged,maxdiff,deltas,nflag = solver.iterate(lhs,rhs,bitflags,weight=weight,**kw);
+  return solver.gain,solver.gainflags,solver.delta_sq,solver.converged_mask,solver.gainnorm,nflag;
+
+
+# pool of worker processes, started on first use, and kept around for subsequent solutions
+_pool = None;
+_pool_size = 0;
+# guards _pool and _pool_size, since solvers may run in several threads (see StefCal.solve_diffgains_parallel())
+_pool_lock = threading.Lock();
+
+def get_pool (nproc):
+  """Returns a pool of nproc worker processes. The pool can be used from several threads at once, but should be
+  started from the main thread (i.e. call get_pool() before starting any solver threads), since forking from
+  other threads is unsafe""";
+  global _pool,_pool_size;
+  with _pool_lock:
+    if _pool is None or _pool_size != nproc:
+      if _pool is not None:
+        _pool.terminate();
+      dprint(1,"starting pool of %d solver processes"%nproc);
+      _pool = multiprocessing.Pool(nproc);
+      _pool_size = nproc;
+    return _pool;
+
+
+class SubtilePool (object):
+  """Solves disjoint blocks of subtiles in parallel, using a pool of worker processes.
+
+  Solutions for different subtiles are independent (unless a smoothing kernel is in use), so the subtile
+  plane of a solver can be split into blocks along one axis, and solver.iterate() can be run on each block
+  separately. The data, model, bitflags and weights are placed into a shared-memory buffer once, when the
+  SubtilePool is created, so that at each iteration only gains and gain flags go to and from the workers.
+  The per-block results are then merged back into the parent solver (gains, gain flags, delta_sq, converged_mask,
+  num_converged, etc.), so that to the rest of StefCal, SubtilePool.iterate() looks exactly like solver.iterate().
+
+  Use the create() method, which returns None if parallel solving is not possible.
+  """;
+
+  @staticmethod
+  def create (solver,nproc,lhs,rhs,bitflags,weight=None):
+    """Returns a SubtilePool for the given solver, or None if the solution cannot be parallelized""";
+    if nproc < 2:
+      return None;
+    if solver.opts.smoothing:
+      dprint(1,"%s: smoothing kernel in use, solving serially"%solver.opts.label);
+      return None;
+    # split along the axis with the most subtiles
+    axis = numpy.argmax(solver.subshape);
+    if solver.subshape[axis] < 2:
+      dprint(1,"%s: single solution interval, solving serially"%solver.opts.label);
+      return None;
+    return SubtilePool(solver,nproc,axis,lhs,rhs,bitflags,weight);
+
+  def __init__ (self,solver,nproc,axis,lhs,rhs,bitflags,weight=None):
+    self.solver = solver;
+    self.axis = axis;
+    nslots = solver.subshape[axis];
+    tilesize = solver.subtiling[axis];
+    # split subtiles into (near-)equal blocks, one per process
+    nblocks = min(nproc,nslots);
+    bounds = [ (i*nslots)//nblocks for i in range(nblocks+1) ];
+    self.blocks = zip(bounds[:-1],bounds[1:]);
+    # corresponding slices along the data axis
+    self.datablocks = [ (i0*tilesize,i1*tilesize) for i0,i1 in self.blocks ];
+    # only the solvable interferometers need to go into the shared buffer
+    keys = set();
+    for p,q in solver._solve_ifrs:
+      keys.update([(p,q),(q,p)]);
+    subset = lambda x:x and dict([ (pq,value) for pq,value in x.iteritems() if pq in keys ]);
+    self._shared = SharedArrays((subset(lhs),subset(rhs),subset(bitflags),subset(weight)));
+    self._pool = get_pool(nproc);
+    self._opts = BlockOpts(solver.opts);
+    force_subtiling = bool(solver.subtiled_axes) and max(solver.subtiling) == 1;
+    self._solver_args = [ dict(fullshape=tuple(solver.datashape),
+                               datashape=tuple([ d1-d0 if i == axis else n
+                                                 for i,n in enumerate(solver.datashape) ]),
+                               subtiling=solver.subtiling,solve_ifrs=solver._solve_ifrs,
+                               opts=self._opts,force_subtiling=force_subtiling,
+                               verbose=_verbosity.verbose)
+                          for d0,d1 in self.datablocks ];
+    dprint(1,"%s: solving %d blocks of subtiles along axis %d with %d processes"%(
+              solver.opts.label,nblocks,axis,nproc));
+
+  def iterate (self,lhs,rhs,bitflags,bounds=None,verbose=0,niter=0,weight=None):
+    """Same as solver.iterate(), but works in parallel. Note that lhs, rhs, bitflags and weight must be the same
+    as the ones given to the constructor (they have already been placed into the shared buffer, so are ignored here).""";
+    solver = self.solver;
+    kw = dict(bounds=bounds,verbose=verbose,niter=niter);
+    subshape = solver.subshape;
+    slicer = lambda x,(i0,i1):_slice_values(x,self.axis,subshape[self.axis],i0,i1);
+    args = [ (self._shared.filename,self._shared.layout,self.axis,datablock,solver.__class__,solver_args,
+              slicer(solver.gain,block),slicer(solver.gainflags,block),kw)
+             for block,datablock,solver_args in zip(self.blocks,self.datablocks,self._solver_args) ];
+    results = self._pool.map(_iterate_block,args,chunksize=1);
+    # merge results back into solver
+    gains,gainflags,delta_sq,converged_mask,gainnorm,nflag = zip(*results);
+    merge = lambda values:_merge_values(self.blocks,values,self.axis,subshape);
+    solver.set_values(merge(gains));
+    solver.gainflags = merge(gainflags);
+    solver.delta_sq = merge(delta_sq);
+    solver.converged_mask = merge(converged_mask);
+    solver.gainnorm = max(gainnorm);
+    solver.num_converged = solver.converged_mask.sum() - solver.padded_slots;
+    solver.delta_max = math.sqrt(solver.delta_sq.max());
+    nflag = sum(nflag);
+    if _verbosity.verbose > 2:
+      for (i0,i1),cmask in zip(self.blocks,converged_mask):
+        dprint(3,"iter %d: block %d:%d %d/%d conv"%(niter+1,i0,i1,cmask.sum(),cmask.size));
+    solver.opts.save_intermediate_values(niter);
+    return (solver.num_converged >= solver.convergence_target),solver.delta_max,solver.delta_sq,nflag;
+
+  def close (self):
+    """Releases the shared buffer""";
+    self._shared.close();
@@ -0,0 +1,147 @@
+import math
+import numpy
+import Kittens.utils
+
+_verbosity = Kittens.utils.verbosity(name="warmstart");
+dprint = _verbosity.dprint;
+dprintf = _verbosity.dprintf;
+
+def slot_times (domain,datashape,subtiling):
+  """Returns the times of the centres of the time slots of the solutions for a tile, given the tile domain
+  (time0,time1,timestep,numtime,...), the (expanded) data shape, and the subtiling""";
+  time0,time1,timestep,numtime = domain[:4];
+  dt = (time1-time0)/float(numtime)*subtiling[0];
+  return time0 + (numpy.arange(datashape[0]/subtiling[0])+.5)*dt;
+
+def _walk (entries,func):
+  """Walks the gain structures in a list of (times,gains) entries (the last entry being the most recent),
+  and calls func([(times,array),...]) for each array of gains, with those entries that have a matching array.
+  Returns a structure like the most recent one, with arrays replaced by the results of func(), and other
+  values (e.g. the scalar null elements of 2x2 gains) kept as they are.""";
+  x = entries[-1][1];
+  if isinstance(x,dict):
+    return dict([ (key,_walk([ (t,y[key]) for t,y in entries if isinstance(y,dict) and key in y ],func))
+                  for key in x ]);
+  elif isinstance(x,(list,tuple)):
+    return type(x)([ _walk([ (t,y[i]) for t,y in entries if isinstance(y,(list,tuple)) and len(y) == len(x) ],func)
+                     for i in range(len(x)) ]);
+  elif isinstance(x,numpy.ndarray) and x.ndim:
+    return func([ (t,y) for t,y in entries if isinstance(y,numpy.ndarray) and y.shape[1:] == x.shape[1:] ]);
+  return x;
+
+def _sum_sq_diff (x,y,nslots):
+  """Returns sum of |x-y|^2 over the first nslots time slots of all arrays in the gain structures x and y""";
+  if isinstance(x,dict) and isinstance(y,dict):
+    return sum([ _sum_sq_diff(value,y[key],nslots) for key,value in x.iteritems() if key in y ]);
+  elif isinstance(x,(list,tuple)) and isinstance(y,(list,tuple)):
+    return sum([ _sum_sq_diff(a,b,nslots) for a,b in zip(x,y) ]);
+  elif isinstance(x,numpy.ndarray) and isinstance(y,numpy.ndarray) and x.ndim and y.ndim:
+    n = min(nslots,x.shape[0],y.shape[0]);
+    d = x[:n] - y[:n];
+    return float((d.real**2+d.imag**2)[numpy.isfinite(d)].sum());
+  return 0.;
+
+
+class WarmStart (object):
+  """Predicts initial gains for the next tile by extrapolating the solutions of the previous tiles.
+
+  The solutions of the last ntiles tiles are kept, together with the times of their solution slots. When a new tile
+  comes in, a polynomial of the given order in time is fitted (by least squares) to the gains of each parameter and
+  frequency slot, and evaluated at the time slots of the new tile (order 0 thus gives the mean of the previous
+  solutions). The history is discarded if time goes backwards, or if the gap between tiles is more than max_gap tile
+  lengths, since extrapolating over e.g. a scan boundary is meaningless.
+
+  Each prediction is scored against the actual solutions: it is a "hit" if it is closer to them than the last time slot
+  of the previous tile (i.e. the plain init_from_previous guess). Hits and the mean number of iterations of predicted
+  and non-predicted tiles are logged per gain term.
+  """;
+
+  # history is discarded if the gap between tiles exceeds this many tile lengths
+  max_gap = 1;
+
+  def __init__ (self,label,ntiles=3,order=1):
+    self.label = label;
+    self.ntiles = max(ntiles,1);
+    self.order = order;
+    self.num_predicted = self.num_hits = self.num_previous = 0;
+    self.iters_predicted = self.iters_previous = 0;
+    self.reset();
+
+  def reset (self):
+    """Discards the history, e.g. at the start of a new dataset""";
+    # list of (slot times,gains) for previous tiles, with gains cut down to the real (unpadded) time slots
+    self._history = [];
+    self._time1 = None;
+    self._prediction = self._previous = None;
+
+  def predict (self,domain,datashape,subtiling):
+    """Returns predicted gains for a tile with the given domain, expanded data shape and subtiling (in the same
+    form as solver.gain, suitable as an init_value), or None if no prediction can be made""";
+    self._prediction = self._previous = None;
+    if not self._history:
+      return None;
+    time0,time1 = domain[:2];
+    gap = time0 - self._time1;
+    if gap < 0 or gap > self.max_gap*(time1-time0):
+      dprint(1,"%s: gap of %gs since previous tile, discarding warm start history"%(self.label,gap));
+      self.reset();
+      return None;
+    times = numpy.concatenate([ t for t,g in self._history ]);
+    tnew = slot_times(domain,datashape,subtiling);
+    # the previous tile's last timeslot, which is what we are trying to beat
+    self._previous = _walk(self._history[-1:],lambda entries:
+                             numpy.resize(entries[-1][1][-1:],(len(tnew),)+entries[-1][1].shape[1:]));
+    if len(times) < 2:
+      return None;
+    # fit in units of the tile length, relative to the start of the new tile, to keep the fit well-conditioned
+    scale = float(time1-time0) or 1.;
+    tnew = (tnew - time0)/scale;
+    def extrapolate (entries):
+      t = numpy.concatenate([ ts for ts,g in entries ]);
+      order = min(self.order,len(t)-1);
+      shape = entries[-1][1].shape[1:];
+      y = numpy.concatenate([ g.reshape((len(g),-1)) for ts,g in entries ]);
+      powers = numpy.arange(order+1);
+      coeff = numpy.linalg.lstsq(((t-time0)/scale)[:,numpy.newaxis]**powers,numpy.where(numpy.isfinite(y),y,0),
+                                 rcond=-1)[0];
+      pred = numpy.dot(tnew[:,numpy.newaxis]**powers,coeff);
+      # parameters with non-finite values in their history keep the last value
+      bad = ~numpy.isfinite(y).all(0);
+      if bad.any():
+        pred[:,bad] = y[-1,bad];
+      return pred.reshape((len(tnew),)+shape).astype(y.dtype);
+    prediction = self._prediction = _walk(self._history,extrapolate);
+    # solvers take a dict of init values, so a list of gains (as in GainDiagCommon) is keyed by index
+    if isinstance(prediction,list):
+      prediction = dict(enumerate(prediction));
+    dprint(2,"%s: warm start from %d previous tile(s), order %d"%(self.label,len(self._history),self.order));
+    return prediction;
+
+  def record (self,gain,domain,datashape,subtiling,original_datashape,niter=None):
+    """Adds the solutions for a tile to the history. If niter is given, scores the prediction for the tile
+    (if one was made) and updates the iteration statistics.""";
+    nreal = int(math.ceil(original_datashape[0]/float(subtiling[0])));
+    times = slot_times(domain,datashape,subtiling)[:nreal];
+    if niter is not None:
+      if self._prediction is not None:
+        err_pred = math.sqrt(_sum_sq_diff(self._prediction,gain,nreal)/nreal);
+        err_prev = math.sqrt(_sum_sq_diff(self._previous,gain,nreal)/nreal);
+        hit = err_pred < err_prev;
+        self.num_predicted += 1;
+        self.num_hits += hit;
+        self.iters_predicted += niter;
+        dprint(1,"%s: warm start %s, error %g (previous tile value %g), %d iterations"%(self.label,
+                  "hit" if hit else "miss",err_pred,err_prev,niter));
+      elif self._previous is not None:
+        self.num_previous += 1;
+        self.iters_previous += niter;
+      if self.num_predicted:
+        mean_pred = self.iters_predicted/float(self.num_predicted);
+        mean_prev = self.iters_previous/float(self.num_previous) if self.num_previous else 0;
+        dprint(1,"%s: warm start hits %d/%d (%.1f%%), %.1f iterations per tile vs. %.1f without (%s saved)"%(
+                  self.label,self.num_hits,self.num_predicted,self.num_hits*100./self.num_predicted,mean_pred,
+                  mean_prev,"%.1f"%(mean_prev-mean_pred) if self.num_previous else "n/a"));
+    self._prediction = self._previous = None;
+    self._history.append((times,_walk([(times,gain)],lambda entries:numpy.array(entries[-1][1][:nreal]))));
+    del self._history[:-self.ntiles];
+    self._time1 = domain[1];
@@ -0,0 +1,314 @@
+"""Offline benchmark of the StefCal gain solvers.
+
+Generates synthetic corrupted visibilities, and drives the iterate() method of the gain solver classes directly, without
+a meqserver. For each combination of solver, number of antennas, tile shape, subtiling and number of diffgain directions,
+one or more tiles are solved, and the following is reported:
+
+    iter:       mean number of iterations per solution
+    conv:       fraction of solution slots converged
+    tile_s:     wall time per tile (all solutions), in seconds
+    iter_s:     iterations per second
+    maxrss_mb:  peak resident memory of the process so far, in Mb
+    resid:      rms of the residuals, relative to the rms of the noise (close to 1 for a good fit, less with
+                small solution intervals, since some of the noise is then absorbed into the gains)
+    float_dev:  in single precision mode (--float), the deviation from the double precision solution of the same
+                problem: the rms of the difference between the corrupted models predicted by the two solutions,
+                relative to the rms of the corrupted model
+
+Synthetic data is generated as D_pq = G_p M_pq G_q^H + noise, with gains that are constant within a solution interval
+and follow the structure of each solver (full 2x2 matrices for Gain2x2*, diagonal for GainDiag, diagonal phases for
+GainDiagPhase, one diagonal gain common to all antennas for GainDiagCommon). Models are diagonal too, except for the
+Gain2x2* solvers, since the diagonal solvers ignore off-diagonal model terms. With N diffgain directions, each tile
+needs N+1 solutions (one direction-independent, and one per direction, each with its own model and gains), which is
+what StefCal does per major loop when the other directions have been subtracted.
+
+Results can be written to a file (as JSON lines), and compared against those of a previous run, in which case the
+exit status is 1 if any configuration has become slower by more than the given tolerance. Run with --help for options.
+""";
+
+import sys
+import time
+import json
+import resource
+import itertools
+import numpy
+
+from MatrixOps import IJ2x2
+
+SOLVERS = [ "Gain2x2","Gain2x2a","Gain2x2v","GainDiag","GainDiagCommon","GainDiagPhase" ];
+
+# structure of synthetic gains for each solver
+GAIN_KIND = dict(Gain2x2="2x2",Gain2x2a="2x2",Gain2x2v="2x2",GainDiag="diag",GainDiagCommon="common",
+                 GainDiagPhase="phase");
+
+# configuration keys used to match results against those of a previous run
+CONFIG_KEYS = [ "solver","antennas","shape","subtiling","diffgains","float" ];
+
+
+class BenchmarkOpts (object):
+  """Stand-in for GainOpts, carrying the options that the solvers look at""";
+  def __init__ (self,label="G",epsilon=1e-4,quota=0.99,use_float=False,**kw):
+    self.label = label;
+    self.epsilon = epsilon;
+    self.convergence_quota = quota;
+    self.use_float = use_float;
+    self.real_only = False;
+    self.smoothing = [];
+    self.omega = 0.5;
+    self.average = 2;
+    self.feed_forward = False;
+    for key,value in kw.iteritems():
+      setattr(self,key,value);
+
+  def save_intermediate_values (self,niter):
+    pass;
+
+
+def get_solver_class (name):
+  """Returns solver class by name. Given X.Y.Z, imports module X.Y and returns symbol Z from that, given just X,
+  uses X.X (as GainOpts does)""";
+  path = name.split('.');
+  modname,classname = '.'.join(path[:-1] or path[-1:]),path[-1];
+  module = __import__(modname,globals(),locals(),[classname]);
+  return getattr(module,classname);
+
+
+def make_gains (kind,nant,subshape,scatter,rs):
+  """Makes synthetic gains of the given kind, as an array of shape (nant,)+subshape+(2,2)""";
+  shape = (nant,)+tuple(subshape);
+  cnoise = lambda shape:(rs.standard_normal(shape)+1j*rs.standard_normal(shape))/numpy.sqrt(2);
+  G = numpy.zeros(shape+(2,2),complex);
+  if kind == "2x2":
+    G[...] = numpy.eye(2);
+    G += scatter*cnoise(G.shape);
+  elif kind == "diag":
+    for i in range(2):
+      G[...,i,i] = 1+scatter*cnoise(shape);
+  elif kind == "phase":
+    for i in range(2):
+      G[...,i,i] = numpy.exp(1j*numpy.pi*scatter*rs.standard_normal(shape));
+  elif kind == "common":
+    for i in range(2):
+      G[...,i,i] = 1+scatter*cnoise(shape[1:]);
+  else:
+    raise ValueError,"unknown gain kind '%s'"%kind;
+  return G;
+
+
+def expand_gains (G,subtiling):
+  """Expands gains of shape (nant,)+subshape+(2,2) to (nant,)+datashape+(2,2), by repeating each
+  solution over its subtile""";
+  for axis,n in enumerate(subtiling):
+    G = G.repeat(n,axis=axis+1);
+  return G;
+
+
+def make_problem (kind,antennas,datashape,subtiling,noise,scatter,dtype,rs):
+  """Makes one synthetic gain problem. Returns model,data dicts of p,q -> 4-list of arrays, as the solvers
+  expect them""";
+  nant = len(antennas);
+  subshape = [ nd//nt for nd,nt in zip(datashape,subtiling) ];
+  G = expand_gains(make_gains(kind,nant,subshape,scatter,rs),subtiling);
+  cnoise = lambda shape:(rs.standard_normal(shape)+1j*rs.standard_normal(shape))/numpy.sqrt(2);
+  model = {};
+  data = {};
+  for ip,iq in itertools.combinations(range(nant),2):
+    # model has unit-ish diagonal, and weak off-diagonal terms for full 2x2 gains only: the diagonal solvers
+    # ignore off-diagonal model terms, so with those the problem would have no good solution
+    M = numpy.zeros(tuple(datashape)+(2,2),complex);
+    if kind == "2x2":
+      M += 0.1*cnoise(M.shape);
+    M[...,0,0] += 1+0.5*cnoise(datashape);
+    M[...,1,1] += 1+0.5*cnoise(datashape);
+    D = numpy.matmul(numpy.matmul(G[ip],M),numpy.conj(numpy.swapaxes(G[iq],-1,-2)));
+    if noise:
+      D += noise*cnoise(D.shape);
+    pq = antennas[ip],antennas[iq];
+    model[pq] = [ M[...,i,j].astype(dtype) for i,j in IJ2x2 ];
+    data[pq]  = [ D[...,i,j].astype(dtype) for i,j in IJ2x2 ];
+  return model,data;
+
+
+def residual_rms (solver,model,data):
+  """Returns rms of residuals over all baselines and correlations""";
+  sum_sq = 0.;
+  count = 0;
+  for pq in data:
+    for r in solver.residual(model,data,pq):
+      if not numpy.isscalar(r):
+        sum_sq += float((r*numpy.conj(r)).real.sum());
+        count += r.size;
+  return numpy.sqrt(sum_sq/max(count,1));
+
+
+def solve (impl_class,datashape,subtiling,solve_ifrs,opts,model,data,max_iter):
+  """Iterates a solver to convergence (or to max_iter). Returns solver,number of iterations""";
+  gains = impl_class(datashape,datashape,subtiling,solve_ifrs,opts=opts,init_value=1);
+  for niter in range(max_iter):
+    converged,maxdiff,deltas,nflag = gains.iterate(model,data,{},niter=niter);
+    if converged:
+      break;
+  return gains,niter+1;
+
+
+def prediction_deviation (solver,model,ref_solver,ref_model):
+  """Returns rms difference between the corrupted models predicted by two solutions, relative to the
+  rms of the reference prediction""";
+  sum_diff = sum_ref = 0.;
+  for pq in ref_model:
+    for a,b in zip(solver.apply(model,pq),ref_solver.apply(ref_model,pq)):
+      if not numpy.isscalar(b):
+        sum_diff += float((abs(numpy.asarray(a,numpy.complex128)-b)**2).sum());
+        sum_ref  += float((abs(b)**2).sum());
+  return numpy.sqrt(sum_diff/sum_ref) if sum_ref else 0.;
+
+
+def maxrss_mb ():
+  """Returns peak resident memory in Mb""";
+  # note that Linux reports ru_maxrss in kb
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.;
+
+
+def run_config (solver,nant,shape,subtiling,diffgains=0,tiles=1,max_iter=50,epsilon=1e-4,
+                noise=0.01,scatter=0.2,use_float=False,seed=0):
+  """Benchmarks one configuration. Returns a dict of results""";
+  impl_class = get_solver_class(solver);
+  kind = GAIN_KIND.get(solver.split('.')[-1],"2x2");
+  rs = numpy.random.RandomState(seed);
+  antennas = [ str(i) for i in range(nant) ];
+  solve_ifrs = list(itertools.combinations(antennas,2));
+  # pad the tile shape out to a whole number of solution intervals
+  datashape = [ ((nd+nt-1)//nt)*nt for nd,nt in zip(shape,subtiling) ];
+  niter_total = nslots = nconv = 0;
+  solve_time = 0.;
+  resid = [];
+  deviation = [];
+  for itile in range(tiles):
+    for idir in range(diffgains+1):
+      # problems are always generated in double precision, and converted to single if needed, so that in
+      # single precision mode the same problem can be solved in double precision for comparison
+      model,data = make_problem(kind,antennas,datashape,subtiling,noise,scatter,numpy.complex128,rs);
+      if use_float:
+        model64,data64 = model,data;
+        to_float = lambda vis:dict([ (pq,[ x.astype(numpy.complex64) for x in xx ]) for pq,xx in vis.iteritems() ]);
+        model,data = to_float(model),to_float(data);
+      label = "G" if not idir else "dE%d"%idir;
+      t0 = time.time();
+      gains,niter = solve(impl_class,datashape,subtiling,solve_ifrs,
+                          BenchmarkOpts(label=label,epsilon=epsilon,use_float=use_float),model,data,max_iter);
+      solve_time += time.time() - t0;
+      niter_total += niter;
+      nconv += gains.num_converged;
+      nslots += gains.real_slots;
+      rms = residual_rms(gains,model,data);
+      resid.append(rms/noise if noise else rms);
+      if use_float:
+        gains64,niter64 = solve(impl_class,datashape,subtiling,solve_ifrs,
+                                BenchmarkOpts(label=label,epsilon=epsilon),model64,data64,max_iter);
+        deviation.append(prediction_deviation(gains,model,gains64,model64));
+        model64 = data64 = gains64 = None;
+      model = data = gains = None;
+  nsolve = tiles*(diffgains+1);
+  return dict(solver=solver,antennas=nant,shape="x".join(map(str,shape)),subtiling="x".join(map(str,subtiling)),
+              diffgains=diffgains,float=bool(use_float),tiles=tiles,
+              iter=niter_total/float(nsolve),conv=nconv/float(max(nslots,1)),
+              tile_s=solve_time/tiles,iter_s=niter_total/solve_time if solve_time else 0.,
+              maxrss_mb=maxrss_mb(),resid=float(numpy.mean(resid)),
+              float_dev=float(numpy.max(deviation)) if deviation else None);
+
+
+def compare_results (results,baseline,tolerance):
+  """Compares results against baseline results. Returns list of (result,baseline result,ratio) for
+  configurations where iterations/s has dropped by more than the given fraction""";
+  key = lambda rec:tuple([ rec.get(k) for k in CONFIG_KEYS ]);
+  base = dict([ (key(rec),rec) for rec in baseline ]);
+  slower = [];
+  for rec in results:
+    ref = base.get(key(rec));
+    if ref and ref['iter_s']:
+      ratio = rec['iter_s']/ref['iter_s'];
+      if ratio < 1-tolerance:
+        slower.append((rec,ref,ratio));
+  return slower;
+
+
+def _parse_list (value,convert=int):
+  return [ convert(x) for x in value.split(",") if x ];
+
+def _parse_shapes (value):
+  return [ [ int(n) for n in x.split("x") ] for x in value.split(",") if x ];
+
+
+if __name__ == "__main__":
+  from optparse import OptionParser
+
+  parser = OptionParser(usage="""%prog: [options]""",
+      description="Benchmarks StefCal gain solvers on synthetic visibilities.");
+  parser.add_option("-s","--solvers",type="string",default=",".join(SOLVERS),
+                    help="comma-separated list of solver classes (default %default)");
+  parser.add_option("-a","--antennas",type="string",default="14,27",
+                    help="comma-separated list of antenna counts (default %default)");
+  parser.add_option("-t","--shape",type="string",default="30x16",
+                    help="comma-separated list of tile shapes, as NTIMExNFREQ (default %default)");
+  parser.add_option("-S","--subtiling",type="string",default="1x1,5x4",
+                    help="comma-separated list of subtilings (solution intervals), as NTxNF (default %default)");
+  parser.add_option("-d","--diffgains",type="string",default="0",
+                    help="comma-separated list of diffgain direction counts (default %default)");
+  parser.add_option("-n","--tiles",type="int",default=1,
+                    help="number of tiles to solve per configuration (default %default)");
+  parser.add_option("-i","--max-iter",type="int",default=50,
+                    help="max number of iterations per solution (default %default)");
+  parser.add_option("-e","--epsilon",type="float",default=1e-4,
+                    help="convergence criterion (default %default)");
+  parser.add_option("--noise",type="float",default=0.01,
+                    help="noise rms (default %default)");
+  parser.add_option("--scatter",type="float",default=0.2,
+                    help="scatter of gains around unity (default %default)");
+  parser.add_option("-f","--float",action="store_true",
+                    help="use single precision");
+  parser.add_option("--seed",type="int",default=0,
+                    help="random seed (default %default)");
+  parser.add_option("-o","--output",type="string",
+                    help="write results to file, as JSON lines");
+  parser.add_option("-c","--compare",type="string",
+                    help="compare against results of a previous run (written with -o)");
+  parser.add_option("--tolerance",type="float",default=0.2,
+                    help="with -c, fail if iterations/s drops by more than this fraction (default %default)");
+  (options,args) = parser.parse_args();
+  if args:
+    parser.error("incorrect number of arguments");
+
+  # columns of the results table, as name,width,format
+  columns = [ ("solver",-14,"s"),("antennas",8,"d"),("shape",7,"s"),("subtiling",9,"s"),("diffgains",9,"d"),
+              ("iter",6,".1f"),("conv",6,".3f"),("tile_s",8,".3f"),("iter_s",8,".2f"),("maxrss_mb",9,".1f"),
+              ("resid",7,".3f") ];
+  if options.float:
+    columns.append(("float_dev",9,".2e"));
+  print " ".join([ "%*s"%(width,name) for name,width,fmt in columns ]);
+  results = [];
+  for solver,nant,shape,subtiling,ndg in itertools.product(_parse_list(options.solvers,str),
+        _parse_list(options.antennas),_parse_shapes(options.shape),_parse_shapes(options.subtiling),
+        _parse_list(options.diffgains)):
+    rec = run_config(solver,nant,shape,subtiling,diffgains=ndg,tiles=options.tiles,max_iter=options.max_iter,
+                     epsilon=options.epsilon,noise=options.noise,scatter=options.scatter,
+                     use_float=options.float,seed=options.seed);
+    results.append(rec);
+    print " ".join([ ("%%%d%s"%(width,fmt))%rec[name] for name,width,fmt in columns ]);
+    sys.stdout.flush();
+
+  if options.output:
+    ff = open(options.output,"w");
+    for rec in results:
+      ff.write(json.dumps(rec,sort_keys=True)+"\n");
+    ff.close();
+    print "Wrote %d result(s) to %s"%(len(results),options.output);
+
+  if options.compare:
+    baseline = [ json.loads(line) for line in open(options.compare) if line.strip() ];
+    slower = compare_results(results,baseline,options.tolerance);
+    for rec,ref,ratio in slower:
+      print "SLOWER: %s: %.2f iter/s vs %.2f (%.0f%%)"%(" ".join([ str(rec[k]) for k in CONFIG_KEYS ]),
+                rec['iter_s'],ref['iter_s'],ratio*100);
+    if slower:
+      sys.exit(1);
+    print "No regressions against %s"%options.compare;
@@ -0,0 +1,112 @@
+"""Tests that Gain2x2v gives the same solutions as Gain2x2.
+
+Run as: python test_gain2x2v.py
+""";
+
+import os
+import os.path
+import sys
+import itertools
+import unittest
+import numpy
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))));
+
+from Gain2x2 import Gain2x2
+from Gain2x2v import Gain2x2v
+from MatrixOps import IJ2x2
+
+class Opts (object):
+  """Stand-in for GainOpts""";
+  def __init__ (self,feed_forward=False):
+    self.label = "G";
+    self.epsilon = 1e-6;
+    self.convergence_quota = 0.99;
+    self.use_float = False;
+    self.real_only = False;
+    self.smoothing = [];
+    self.omega = 0.5;
+    self.average = 2;
+    self.feed_forward = feed_forward;
+
+  def save_intermediate_values (self,niter):
+    pass;
+
+
+def make_problem (nant=6,shape=(10,8),seed=1):
+  """Makes synthetic model,data,bitflags dicts, with gains scattered enough for some to go out of bounds""";
+  rs = numpy.random.RandomState(seed);
+  cnoise = lambda shape:rs.standard_normal(shape)+1j*rs.standard_normal(shape);
+  antennas = [ str(i) for i in range(nant) ];
+  G = numpy.eye(2) + 0.2*cnoise((nant,)+shape+(2,2));
+  model,data,bitflags = {},{},{};
+  for ip,iq in itertools.combinations(range(nant),2):
+    M = 0.1*cnoise(shape+(2,2));
+    M[...,0,0] += 1;
+    M[...,1,1] += 1;
+    D = numpy.matmul(numpy.matmul(G[ip],M),numpy.conj(numpy.swapaxes(G[iq],-1,-2)));
+    D += 0.01*rs.standard_normal(D.shape);
+    pq = antennas[ip],antennas[iq];
+    model[pq] = [ M[...,i,j] for i,j in IJ2x2 ];
+    data[pq]  = [ D[...,i,j] for i,j in IJ2x2 ];
+  bitflags[antennas[0],antennas[2]] = numpy.zeros(shape,int);
+  bitflags[antennas[0],antennas[2]][3,:4] = 1;
+  return antennas,model,data,bitflags;
+
+
+class Gain2x2vTest (unittest.TestCase):
+  def solve (self,solver_class,subtiling,feed_forward,bounds,niter=12):
+    antennas,model,data,bitflags = make_problem();
+    shape = [10,8];
+    solver = solver_class(shape,shape,subtiling,list(itertools.combinations(antennas,2)),
+                          opts=Opts(feed_forward),init_value=1);
+    results = [];
+    for i in range(niter):
+      # as StefCal does, bounds are only enabled after a few iterations
+      converged,delta_max,delta_sq,nflag = solver.iterate(model,data,bitflags,niter=i,
+                                                          bounds=bounds if i>2 else None);
+      results.append((delta_max,nflag));
+    return solver,results;
+
+  def assertSameSolutions (self,subtiling,feed_forward,bounds):
+    ref,ref_results = self.solve(Gain2x2,subtiling,feed_forward,bounds);
+    sol,results = self.solve(Gain2x2v,subtiling,feed_forward,bounds);
+    self.assertEqual([ nflag for delta_max,nflag in results ],[ nflag for delta_max,nflag in ref_results ]);
+    for (delta_max,nflag),(ref_delta_max,ref_nflag) in zip(results,ref_results):
+      self.assertAlmostEqual(delta_max,ref_delta_max,places=10);
+    for p,gains in ref.gain.iteritems():
+      for g,g0 in zip(sol.gain[p],gains):
+        self.assertTrue(abs(g-g0).max() < 1e-10);
+    self.assertEqual(sorted(sol.gainflags.keys()),sorted(ref.gainflags.keys()));
+    for p,gf in ref.gainflags.iteritems():
+      self.assertTrue((sol.gainflags[p] == gf).all());
+    return ref_results;
+
+  def test_no_bounds (self):
+    for subtiling in [1,1],[5,4]:
+      for feed_forward in False,True:
+        self.assertSameSolutions(subtiling,feed_forward,None);
+
+  def test_bounds (self):
+    for feed_forward in False,True:
+      results = self.assertSameSolutions([1,1],feed_forward,(0.8,1.2));
+      # make sure that bounds did come into play
+      self.assertTrue(sum([ nflag for delta_max,nflag in results ]) > 0);
+
+  def test_data_reuse (self):
+    antennas,model,data,bitflags = make_problem();
+    shape = [10,8];
+    solver = Gain2x2v(shape,shape,[1,1],list(itertools.combinations(antennas,2)),opts=Opts(),init_value=1);
+    solver.iterate(model,data,bitflags);
+    dense = solver._dense_cache[1];
+    solver.iterate(model,data,bitflags,niter=1);
+    self.assertTrue(solver._dense_cache[1] is dense);
+    # new dicts, or release_data(), rebuild the arrays
+    solver.iterate(dict(model),data,bitflags,niter=2);
+    self.assertTrue(solver._dense_cache[1] is not dense);
+    solver.release_data();
+    self.assertTrue(solver._dense_cache is None);
+
+
+if __name__ == "__main__":
+  unittest.main();
@@ -0,0 +1,87 @@
+"""Round-trip tests of binary gain tables (see GainTable.py).
+
+Run as: python test_gaintable.py
+""";
+
+import os
+import os.path
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))));
+
+import GainTable
+
+class GainTableTest (unittest.TestCase):
+  def setUp (self):
+    self.dir = tempfile.mkdtemp();
+    self.filename = os.path.join(self.dir,"gains.bin");
+
+  def tearDown (self):
+    shutil.rmtree(self.dir);
+
+  def write (self,records,append=False):
+    writer = GainTable.GainTableWriter(self.filename,append=append);
+    for key,solutions,domain in records:
+      writer.write(key,solutions,"Gain2x2",domain=domain);
+    writer.close();
+
+  def assertRecords (self,records):
+    table = GainTable.GainTable(self.filename);
+    self.assertEqual(sorted(table.domain_index.keys()),sorted([ (key,domain) for key,solutions,domain in records ]));
+    for key,solutions,domain in records:
+      entry = table.get(key,domain);
+      self.assertEqual(entry['implementation'],"Gain2x2");
+      self.assertEqual(sorted(entry['solutions'].keys()),sorted(solutions.keys()));
+      for name,value in solutions.iteritems():
+        if isinstance(value,numpy.ndarray):
+          self.assertEqual(entry['solutions'][name].dtype,value.dtype);
+          self.assertEqual(entry['solutions'][name].shape,value.shape);
+          self.assertTrue((entry['solutions'][name] == value).all());
+        else:
+          self.assertEqual(entry['solutions'][name],value);
+    return table;
+
+  def test_roundtrip (self):
+    records = [ ("G",dict(gains=numpy.arange(12.).reshape(3,4),niter=i),i) for i in range(3) ];
+    self.write(records);
+    self.assertRecords(records);
+
+  def test_empty_last_array (self):
+    # records whose last array is empty, or that have no arrays at all, must still be complete on disk
+    records = [ ("G",dict(gains=numpy.ones(5,complex),flags=numpy.zeros(0,bool)),0),
+                ("G",dict(niter=3),1) ];
+    for key,solutions,domain in records:
+      self.write([(key,solutions,domain)],append=True);
+      self.assertEqual(GainTable.GainTable(self.filename).end_offset,os.path.getsize(self.filename));
+    more = [ ("dE",dict(gains=numpy.arange(3.),flags=numpy.zeros(0,bool)),2) ];
+    self.write(more,append=True);
+    self.assertRecords(records+more);
+
+  def test_torn_record (self):
+    records = [ ("G",dict(gains=numpy.arange(100.)*i),i) for i in range(3) ];
+    self.write(records);
+    size = os.path.getsize(self.filename);
+    # cut into the data of the last record: readers skip it, writers drop it when appending
+    ff = open(self.filename,"r+b");
+    ff.truncate(size-10);
+    ff.close();
+    self.assertRecords(records[:2]);
+    more = [ ("G",dict(gains=numpy.ones(4)),7) ];
+    self.write(more,append=True);
+    self.assertRecords(records[:2]+more);
+
+  def test_streamer_copies (self):
+    streamer = GainTable.TableStreamer();
+    gains = numpy.zeros(3);
+    streamer.write(self.filename,"G",dict(gains=gains),"Gain2x2",domain=0);
+    gains[...] = 5;
+    streamer.close();
+    self.assertRecords([ ("G",dict(gains=numpy.zeros(3)),0) ]);
+
+
+if __name__ == "__main__":
+  unittest.main();
@@ -186,6 +186,60 @@ TDLCompileMenu("Enable visualizers",
   TDLCompileOption("visualize_flag_unity","Flag zero/unity solutions in visualizers",True),
   TDLCompileOption("visualize_norm_offdiag","Normalize off-diagonal terms by diagonals",True),
   toggle="stefcal_visualize");
+TDLCompileOption("stefcal_solver_processes","Number of processes for parallel solving",[0,4,8,16,32],more=int,default=0,
+  doc=
+  """If >1, independent solution intervals are split into blocks and solved in parallel by a pool of this many
+  processes. Set to 0 to solve in the meqserver process itself. Solutions with a smoothing kernel are always
+  solved serially.
+  """
+  );
+TDLCompileOption("stefcal_active_set","Stop iterating on converged solution intervals",False,
+  doc=
+  """If enabled, solution intervals that have converged are frozen, and subsequent iterations only go over the
+  intervals that are still converging. Solutions with a smoothing kernel always iterate over all intervals.
+  """
+  );
+TDLCompileOption("stefcal_diffgain_threads","Solve for differential gains in parallel threads",[0,2,4,8],more=int,default=0,
+  doc=
+  """If >1, all differential gain terms are solved for concurrently in each major loop, by a pool of this many threads.
+  Each direction is then fitted against the models of the other directions from the previous major loop (SAGE-style),
+  rather than against the ones already updated in the current loop, so convergence per major loop may be slightly
+  slower. Set to 0 to solve for the directions one after another.
+  """
+  );
+TDLCompileOption("stefcal_resume","Resume from solutions already in tables",False,
+  doc=
+  """Binary solution tables are written to tile by tile, as solutions become available. If this is enabled,
+  tiles that already have solutions in the tables (e.g. from a previous run that was interrupted) are not solved again,
+  rather their solutions are loaded and applied, and new solutions are appended to the tables.
+  """
+  );
+TDLCompileOption("stefcal_profile_file","Write per-stage profiling records to",[None,"stefcal-profile.jsonl","stefcal-profile.csv"],more=str,
+  doc=
+  """If set, the wall time, CPU time and memory use of each stage of every tile (and of each gain term's
+  iterations and chi-square computations) are appended to this file. Records are written as CSV if the filename ends
+  in .csv, else as JSON lines.
+  """
+  );
+TDLCompileOption("stefcal_apply_cache_mb","Memory for caching applied gain terms, Mb",[0,256,512,1024,2048],more=int,default=512,
+  doc=
+  """Within a tile, the result of applying a gain term to the data or model is cached, and reused in subsequent
+  major loops for as long as that term (and every term applied before it) has not changed, e.g. for terms that are not
+  being solved for. The least recently used results are dropped once the cache exceeds this size. Set to 0 to disable.
+  """
+  );
+TDLCompileOption("stefcal_warm_start_tiles","Extrapolate starting guesses from previous tiles",[0,2,3,5],more=int,default=0,
+  doc=
+  """If >0, the starting guess for each gain term being solved for is extrapolated from its solutions for (up to) this
+  many previous tiles, by fitting a polynomial in time to each parameter and frequency interval. With slowly varying
+  gains, this reduces the number of iterations needed per tile. Set to 0 to disable.
+  """
+  );
+TDLCompileOption("stefcal_warm_start_order","Order of polynomial used to extrapolate starting guesses",[0,1,2],more=int,default=1,
+  doc=
+  """Order 1 extrapolates linearly in time, while order 0 uses the mean of the previous solutions.
+  """
+  );
 TDLCompileOption("stefcal_verbose","Stefcal verbosity level",[0,1,2,3],more=int);
 
 import Purr.Pipe
@@ -275,6 +329,14 @@ def _define_forest(ns,parent=None,**kw):
                            rescale=stefcal_rescale,
                            init_from_previous=False,
                            critical_flag_threshold=critical_flag_threshold,
+                           solver_processes=stefcal_solver_processes,
+                           active_set=stefcal_active_set,
+                           diffgain_threads=stefcal_diffgain_threads,
+                           resume_from_table=stefcal_resume,
+                           profile_file=stefcal_profile_file or '',
+                           apply_cache_mb=stefcal_apply_cache_mb,
+                           warm_start_tiles=stefcal_warm_start_tiles,
+                           warm_start_order=stefcal_warm_start_order,
                            diffgain_labels=diffgain_labels,
                            # flagging options
                            output_flag_bit=Meow.MSUtils.FLAGMASK_OUTPUT,
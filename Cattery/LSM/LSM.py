@@ -32,9 +32,11 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 
-import sys,time
+import sys,time,gc
 import math,struct
+import numpy
 import pickle # for serialization and file io
+import cPickle,cStringIO
 # from Dummy import *
 
 from common_utils import *
@@ -42,6 +44,8 @@ from LSM_inner import *
 from Timba.Meq import meq
 from Timba.TDL import *
 import LSM_Sixpack
+import LSM_format
+import LSM_parsers
 from Timba.Meq import meq
 
 from Timba.Apps import app_nogui
@@ -141,13 +145,13 @@ class PUnit:
 
  # get RA,DEC if possible
  def getRADec(self,ns):
-   mysixpack=self.__sixpack
+   mysixpack=self.getSP()
    [ra,dec,br]=extract_parms(mysixpack,ns)
    return (ra,dec)
 
  # get I,Q,U,V if possible
  def getIQUV(self,ns):
-   mysixpack=self.__sixpack
+   mysixpack=self.getSP()
    [ra,dec,I]=extract_parms(mysixpack,ns)
    [I,Q,U,V,SI,f0,RM]=extract_polarization_parms(mysixpack,ns,absolute=1)
    return (I,Q,U,V,SI,f0,RM)
@@ -222,10 +226,7 @@ class PUnit:
   newp.sp=self.sp.clone()
   # instead of the Sixpack Object, we store the 
   # root node namse of the IQUV,Ra,Dec subtrees
-  if self.__sixpack!=None:
-   newp.__sixpack=self.__sixpack
-  else:
-   newp.__sixpack=None
+  newp.__sixpack=self.getSP()
   newp.FOV_distance=self.FOV_distance
   newp._patch_name=self._patch_name
   return newp
@@ -238,12 +239,15 @@ class PUnit:
  # set the sixpack object
  def setSP(self,sp):
   self.__sixpack=sp
- # return a sixpack object (TDL_Sixpack) for this PUnit
+ # return a sixpack object (TDL_Sixpack) for this PUnit. PUnits read
+ # from a file get it from the LSM when it is first asked for
  def getSP(self):
+  if self.__sixpack==None and self.lsm!=None:
+   self.__sixpack=self.lsm.reconstructSixpack(self.name)
   return self.__sixpack
  # return a sixpack object (TDL_Sixpack) for this PUnit
  def getSixpack(self):
-  return self.__sixpack
+  return self.getSP()
  # set the sixpack object
  def setSixpack(self,sp):
   self.__sixpack=sp
@@ -251,7 +255,7 @@ class PUnit:
  # change RA,Dec of myself, 
  def change_location(self,new_ra,new_dec,ns):
    if self.getType()==POINT_TYPE or self.getType()==GAUSS_TYPE :
-    my_sixpack=self.__sixpack
+    my_sixpack=self.getSP()
     change_radec(my_sixpack,new_ra,new_dec,ns)
    elif self.getType()==PATCH_TYPE:
     change_radec_patch(self.name,new_ra,new_dec,ns)
@@ -260,6 +264,211 @@ class PUnit:
    # change static values
    self.sp.set_staticRA(new_ra)
    self.sp.set_staticDec(new_dec)
+   if self.lsm!=None:
+    self.lsm.updateLocation(self)
+
+###############################################
+class PUnitView(object):
+ """A (point or gaussian) p-Unit stored in a row of the SourceTable of
+ an LSM created with columnar=True. This has the same interface as a
+ PUnit, but keeps no state of its own besides the row, so that
+ large models take little memory. The sixpack is recreated from the
+ table whenever it is asked for, and clone() returns a full PUnit.
+ """
+ __slots__=('name','lsm','_table','_row')
+
+ # Constructor
+ def __init__(self,name,lsm,table,row):
+  self.name=name
+  self.lsm=lsm
+  self._table=table
+  self._row=row
+
+ def setType(self,flag):
+  self._table.set(self._row,'type',flag)
+ def getType(self):
+  return self._table.get(self._row,'type')
+ type=property(getType,setType)
+
+ def addSource(self,s):
+  self._table.set_extra(self._row,'s_list',self.getSources()+[s])
+ def getSources(self):
+  return self._table.get_extra(self._row,'s_list',[self.name])
+ s_list=property(getSources)
+
+ def setCat(self,cat):
+  self._table.set(self._row,'cat',cat)
+ def getCat(self):
+  return self._table.get(self._row,'cat')
+
+ def setBrightness(self,brightness):
+  self._table.set(self._row,'brightness',brightness)
+ def getBrightness(self,type='A',f=0,t=0):
+  if type=='A':
+   return self._table.get(self._row,'brightness')
+  return self._table.get(self._row,type)
+
+ def setFOVDist(self,distance):
+  self._table.set(self._row,'FOV',distance)
+ def getFOVDist(self):
+  return self._table.get(self._row,'FOV')
+
+ def getExtParms(self):
+  row=self._row
+  return (self._table.get(row,'eX'),self._table.get(row,'eY'),self._table.get(row,'eP'))
+
+ def getRADec(self,ns=None):
+  return (self._table.get(self._row,'ra'),self._table.get(self._row,'dec'))
+
+ def getIQUV(self,ns=None):
+  return tuple([ self._table.get(self._row,col) for col in ('I','Q','U','V','SI','f0','RM') ])
+
+ def getEssentialParms(self,ns=None):
+  return self.getRADec()+self.getIQUV()
+
+ def getLimits(self):
+  if self.getType()==GAUSS_TYPE:
+   (ra,dec)=self.getRADec()
+   eX=self._table.get(self._row,'eX')
+   return [ra-eX/2,ra+eX/2,dec-eX/2,dec+eX/2]
+  return [0,0,0,0]
+
+ # patch membership and the beam l,m are rare, so they are
+ # kept out of the table columns
+ def _get_patch_name(self):
+  return self._table.get_extra(self._row,'patch_name')
+ def _set_patch_name(self,name):
+  self._table.set_extra(self._row,'patch_name',name)
+ _patch_name=property(_get_patch_name,_set_patch_name)
+ def _get_lm(self):
+  return self._table.get_extra(self._row,'lm')
+ def _set_lm(self,lm):
+  self._table.set_extra(self._row,'lm',lm)
+ _lm=property(_get_lm,_set_lm)
+
+ # the sixpack helper
+ def _get_sp(self):
+  return SpHView(self._table,self._row)
+ sp=property(_get_sp)
+
+ def __str__(self):
+   temp_str="P-Unit: | Name="+str(self.name)
+   temp_str+=", type="+str(self.getType())
+   temp_str+=",source_list="+str(self.getSources())
+   temp_str+=",cat="+str(self.getCat())
+   temp_str+=",Brightness="+str(self.getBrightness())
+   temp_str+=",sp="+str(self.sp)
+   temp_str+=",FOV="+str(self.getFOVDist())
+   temp_str+=",patch="+str(self._patch_name)
+   temp_str+=" |"
+   return temp_str
+
+ # return a full PUnit with the same values, without a reference
+ # to the LSM, so that it can be saved
+ def clone(self,subscope=None):
+  newp=PUnit(self.name,None)
+  newp.type=self.getType()
+  newp.s_list=self.getSources()
+  newp.cat=self.getCat()
+  newp.app_brightness=self.getBrightness()
+  newp.sp=self.sp.clone()
+  newp.setSixpack(self.getSixpack())
+  newp.FOV_distance=self.getFOVDist()
+  newp._patch_name=self._patch_name
+  newp._lm=self._lm
+  return newp
+
+ def setLSM(self,lsm):
+  self.lsm=lsm
+
+ # the sixpack is made from the table values on demand, and
+ # setting one stores its values back into the table
+ def getSixpack(self):
+  row=self._row
+  get=self._table.get
+  return LSM_Sixpack.Sixpack(label=self.name,RA=get(row,'ra'),Dec=get(row,'dec'),
+     I0=get(row,'I'),stokesQ=get(row,'Q'),stokesU=get(row,'U'),stokesV=get(row,'V'),
+     SI=get(row,'SI'),f0=get(row,'f0'),RM=get(row,'RM'))
+ getSP=getSixpack
+ def setSixpack(self,sp):
+  for col,value in zip(('ra','dec','I','Q','U','V','SI','f0','RM'),sixpack_values(sp)):
+   self._table.set(self._row,col,value)
+ setSP=setSixpack
+
+ # change RA,Dec of myself
+ def change_location(self,new_ra,new_dec,ns=None):
+  self._table.set(self._row,'ra',new_ra)
+  self._table.set(self._row,'dec',new_dec)
+  if self.lsm!=None:
+   self.lsm.updateLocation(self)
+
+# return the (ra,dec,I,Q,U,V,SI,f0,RM) values of a sixpack, as floats.
+# Raises TypeError or ValueError if they are not all numbers (e.g.
+# node stubs)
+def sixpack_values(sp):
+ return tuple([ float(x) for x in (sp.ra(),sp.dec(),sp.stokesI(),sp.stokesQ(),
+                                    sp.stokesU(),sp.stokesV(),sp.SI(),sp.f0(),sp.rm()) ])
+
+# sixpack fields, as stored in LSM files, and the corresponding keyword
+# arguments of LSM_Sixpack.Sixpack
+SIXPACK_FIELDS=('ra','dec','I','Q','U','V','SI','f0','RM')
+SIXPACK_KEYWORDS={'ra':'RA','dec':'Dec','I':'I0','Q':'stokesQ','U':'stokesU','V':'stokesV',
+   'SI':'SI','f0':'f0','RM':'RM','patchroot':'root','pointroot':'root'}
+
+# return the sixpack of a p-Unit in the form stored in LSM files: None
+# if there is no sixpack, ('values',label,sixpack_values(sp)) if it holds
+# numbers, else ('nodes',dict), with the label and the node stub (or
+# number) of each field. LSMs saved by older versions hold a dict of
+# node names rather than a sixpack, which is returned as such
+def sixpack_spec(sp):
+ if sp==None:
+  return None
+ if isinstance(sp,dict):
+  return ('nodes',dict(sp))
+ try:
+  return ('values',sp.label(),sixpack_values(sp))
+ except (TypeError,ValueError,AttributeError):
+  pass
+ spec={'label':sp.label()}
+ for field,value in zip(SIXPACK_FIELDS,(sp.ra(),sp.dec(),sp.stokesI(),sp.stokesQ(),
+                                       sp.stokesU(),sp.stokesV(),sp.SI(),sp.f0(),sp.rm())):
+  spec[field]=value
+ return ('nodes',spec)
+
+# LSMs saved by older versions are pickled LSM objects. The classes in
+# them are looked up by the last component of their module name, since
+# the package path of the LSM has changed over time
+def _find_legacy_class(module,name):
+ for mod in (sys.modules[__name__],sys.modules[Source.__module__],LSM_Sixpack):
+  if module.split('.')[-1]==mod.__name__.split('.')[-1] and hasattr(mod,name):
+   return getattr(mod,name)
+ __import__(module)
+ return getattr(sys.modules[module],name)
+
+def legacy_unpickler(f):
+ unpickler=cPickle.Unpickler(f)
+ unpickler.find_global=_find_legacy_class
+ return unpickler
+
+# call func(*args) with the cyclic garbage collector off: creating many
+# objects at once (as when loading a large LSM) otherwise makes it run
+# over and over again
+def _without_gc(func,*args):
+ enabled=gc.isenabled()
+ gc.disable()
+ try:
+  return func(*args)
+ finally:
+  if enabled:
+   gc.enable()
+
+# return values of a SourceTable column for the given rows, appended
+# to a list of values of other sources
+def _join_column(values,table,col,rows,dtype=float):
+ values=numpy.array(values,dtype)
+ if len(rows):
+  values=numpy.concatenate((values,table[col][rows].astype(dtype)))
+ return values
 
 ###############################################
 class LSM:
@@ -271,15 +480,25 @@ class LSM:
   p_table: p-Unit table
 
   helper attributes:
-  __barr: array of p-Units sorted by brightness - private attribute
+  __barr: p-Unit names sorted by brightness (a BrightnessIndex) - private attribute
+  __spatial: RA,Dec of p-Units (a SpatialIndex) - private attribute
+  __table: SourceTable holding the point and gaussian sources, if the LSM
+          was created with columnar=True, else None. p_table and s_table
+          then hold PUnitViews and SourceViews of its rows
   __mqs: meqserver proxy
   __root: root of all subtrees of the LSM
+  __nodes: definitions of the nodes read from a file (an LSM_format.NodeDefs),
+          which are only created when a p-Unit that needs them is used
+  __pending: sixpacks of p-Units read from a file that have not been
+          asked for yet (see reconstructSixpack())
   __file: currently opend file or recently saved file name
           If not using a file, this will be Empty
  """
  # Constructor
- # Does pretty much nothing so far
- def __init__(self):
+ # if columnar=True, sources are stored in a SourceTable (see above),
+ # which takes much less memory for large models, and allows bulk
+ # operations to be vectorized
+ def __init__(self,columnar=False):
   self.s_table={}
   self.m_table='thislsm.mep'
   self.tmpl_table={}
@@ -295,11 +514,15 @@ class LSM:
   # counter to give unique names to patches
   self.__patch_count=0
  
-  self.__barr=[] 
+  self.__barr=BrightnessIndex()
+  self.__spatial=SpatialIndex()
+  self.__table=SourceTable() if columnar else None
   # root of all subtrees
   self.__root=None
   # name of the root node
   self.__root_name=None
+  self.__nodes=None
+  self.__pending={}
 
   # how to create phase center of patches
   # 'G': geometric center, 'C': centroid  (weighted)
@@ -345,6 +568,8 @@ class LSM:
    # dont stop, just issue a warning
    print "WARNING: Source "+s.name+' is already present'
    return
+  if self.__table!=None and self.__add_to_table(s,kw):
+   return
   self.s_table[s.name]=s
   """ After inserting the source to source table,
       search the  MeqParm table if it has any parms of the source.
@@ -392,6 +617,101 @@ class LSM:
   # finally, insert p-Unit to p-Unit table
   self.insertPUnit(p)
 
+ # columnar version of add_source(): store the source in a row of
+ # the SourceTable. Returns False (and does nothing) if the source
+ # cannot be stored there, e.g. if its sixpack holds node stubs
+ # rather than numbers
+ def __add_to_table(self,s,kw):
+  if s.getType() not in (POINT_TYPE,GAUSS_TYPE):
+   return False
+  values={}
+  if kw.has_key('sixpack'):
+   try:
+    (ra,dec,I,Q,U,V,SI,f0,RM)=sixpack_values(kw['sixpack'])
+   except (TypeError,ValueError,AttributeError):
+    return False
+   values.update(ra=ra,dec=dec,I=I,Q=Q,U=U,V=V,SI=SI,f0=f0,RM=RM)
+  if kw.has_key('ra'):
+   values['ra']=kw['ra']
+  if kw.has_key('dec'):
+   values['dec']=kw['dec']
+  (values['eX'],values['eY'],values['eP'])=s.extParms()
+  row=self.__table.append(s.name,type=s.getType(),brightness=kw.get('brightness',0),**values)
+  self.s_table[s.name]=SourceView(s.name,self.__table,row)
+  p=PUnitView(s.name,self,self.__table,row)
+  if kw.get('lm',None)!=None:
+   p._lm=kw['lm']
+  self.insertPUnit(p)
+  return True
+
+ # Batch version of add_source(), for point sources and gaussians with
+ # sixpacks of plain numbers (as read by the LSM_parsers readers).
+ # sources: NumPy record array with a 'name' field, and any of the fields
+ #  in LSM_parsers.SOURCE_FIELDS (missing ones get their defaults), and
+ #  optionally l,m (the cached l,m of each p-Unit)
+ # Sources with nonzero eX, eY or eP are gaussians. Their sixpacks are
+ # only created when they are first asked for (see reconstructSixpack()).
+ # Sources already present are ignored. Returns the number of sources added
+ def add_sources(self,sources):
+  return _without_gc(self.__add_sources,sources)
+
+ def __add_sources(self,sources):
+  names=[ str(name) for name in sources['name'].tolist() ]
+  keep=[]
+  seen=set()
+  for i,name in enumerate(names):
+   if self.s_table.has_key(name) or self.p_table.has_key(name) or name in seen:
+    print "WARNING: Source "+name+' is already present'
+   else:
+    seen.add(name)
+    keep.append(i)
+  if len(keep)<len(names):
+   sources=sources[numpy.array(keep,int)]
+   names=[ names[i] for i in keep ]
+  if not names:
+   return 0
+
+  column=lambda col:LSM_parsers.source_column(sources,col)
+  (ra,dec)=(column('ra'),column('dec'))
+  brightness=column('brightness').tolist()
+  ext=dict([ (col,column(col)) for col in ('eX','eY','eP') ])
+  types=numpy.where((ext['eX']!=0)|(ext['eY']!=0)|(ext['eP']!=0),GAUSS_TYPE,POINT_TYPE)
+  if 'l' in sources.dtype.names and 'm' in sources.dtype.names:
+   lm=zip(sources['l'].tolist(),sources['m'].tolist())
+  else:
+   lm=[None]*len(names)
+
+  if self.__table!=None:
+   table=self.__table
+   values=dict([ (field,column(field)) for field in SIXPACK_FIELDS ])
+   values.update(ext)
+   rows=table.extend(names,type=types,brightness=column('brightness'),**values)
+   for name,row,plm in zip(names,rows.tolist(),lm):
+    self.s_table[name]=SourceView(name,table,row)
+    p=PUnitView(name,self,table,row)
+    if plm!=None:
+     p._lm=plm
+    self.p_table[name]=p
+  else:
+   spvalues=zip(*[ column(field).tolist() for field in SIXPACK_FIELDS ])
+   ext=zip(ext['eX'].tolist(),ext['eY'].tolist(),ext['eP'].tolist())
+   for i,name in enumerate(names):
+    (eX,eY,eP)=ext[i]
+    self.s_table[name]=Source(name,major=eX,minor=eY,pangle=eP)
+    p=PUnit(name,self)
+    p.setType(self.s_table[name].getType())
+    p.addSource(name)
+    p.setBrightness(brightness[i])
+    p.sp.set_staticRA(spvalues[i][0])
+    p.sp.set_staticDec(spvalues[i][1])
+    p._lm=lm[i]
+    # the sixpack is made when it is first asked for
+    self.__pending[name]=('values',name,spvalues[i])
+    self.p_table[name]=p
+  self.__barr.insert_many(names,brightness)
+  self.__spatial.insert_many(names,ra,dec,types,numpy.ones(len(names),bool))
+  return len(names)
+
  # Helper method 
  # inserts a p-unit into the p-Unit table, and 
  # orders according to the brightness
@@ -399,31 +719,27 @@ class LSM:
   if self.p_table.has_key(p.name):
    #raise NameError, 'PUnit '+p.name+' is already present'
    print "WARNING: PUnit '"+p.name+"' is already present. Ignoring insertion"
-  else:
-   self.p_table[p.name]=p
-  # now do the sorting of the brightness array
-  tmp_brightness=p.getBrightness() 
-  if (len(self.__barr)==0):
-   self.__barr.insert(0,p.name)
-  else: # list is not empty
-   for i in range(len(self.__barr)):
-    if self.p_table[self.__barr[i]].getBrightness() < tmp_brightness:
-     break
-
-
-   # special check for end of list
-   if i==0: 
-    if self.p_table[self.__barr[i]].getBrightness() < tmp_brightness:
-      self.__barr.insert(0,p.name)
-    else:
-      self.__barr.append(p.name)
-   elif i==len(self.__barr)-1:
-    if self.p_table[self.__barr[i]].getBrightness() < tmp_brightness:
-     self.__barr.insert(i,p.name)
-    else:
-     self.__barr.append(p.name)
-   else:
-    self.__barr.insert(i,p.name)
+   return
+  self.p_table[p.name]=p
+  # now insert into the brightness index (a bisection, or an append
+  # during a bulk load)
+  self.__barr.insert(p.name,p.getBrightness())
+  self.__spatial.insert(p.name,p.sp.getRA(),p.sp.getDec(),p.getType(),p._patch_name==None)
+
+ # update the spatial index after p-Unit p has moved
+ def updateLocation(self,p):
+  if p.name in self.__spatial:
+   self.__spatial.move(p.name,p.sp.getRA(),p.sp.getDec())
+
+ # Bulk loading: between beginBulkLoad() and endBulkLoad(), p-units
+ # are not sorted by brightness as they are inserted, but once at the
+ # end (or when the LSM is next queried). The build_from_*() methods use
+ # this, so that loading an N-source model takes O(N log N) time.
+ def beginBulkLoad(self):
+  self.__barr.begin_bulk()
+
+ def endBulkLoad(self):
+  self.__barr.end_bulk()
 
  # method for printing to screen
  def dump(self):
@@ -533,20 +849,14 @@ class LSM:
   max_Dec=-100
   min_Dec=100
 
-  for p in self.p_table.keys():
+  # point sources from the spatial index
+  bounds=self.__spatial.bounds(types=[POINT_TYPE])
+  if bounds!=None:
+   [min_RA,max_RA,min_Dec,max_Dec]=[min(min_RA,bounds[0]),max(max_RA,bounds[1]),\
+                                    min(min_Dec,bounds[2]),max(max_Dec,bounds[3])]
+  for p in self.__spatial.names(types=[GAUSS_TYPE]):
    punit=self.p_table[p]
-   if punit.getType()==POINT_TYPE :
-    tmpval=punit.sp.getRA()
-    if tmpval > max_RA:
-     max_RA=tmpval
-    if tmpval <  min_RA:
-     min_RA=tmpval
-    tmpval=punit.sp.getDec()
-    if tmpval > max_Dec:
-     max_Dec=tmpval
-    if tmpval <  min_Dec:
-     min_Dec=tmpval
-   elif punit.getType()==GAUSS_TYPE :
+   if punit.getType()==GAUSS_TYPE :
     [x0,x1,y0,y1]=punit.getLimits()
     if x1 > max_RA:
      max_RA=x1
@@ -577,51 +887,24 @@ class LSM:
   else:
    # select the max value
    tmp_max=-1e6
-   for pname in self.p_table.keys():
-    mytype=self.p_table[pname].getType()
-    if mytype==POINT_TYPE or mytype==GAUSS_TYPE :
-     tmp_val=self.p_table[pname].sp.getValue(type,f,t)
-     if tmp_max < tmp_val:
-      tmp_max=tmp_val
+   values=self.__brightness_values(type,f,t)
+   if len(values):
+    tmp_max=max(tmp_max,values.max())
    return tmp_max
 
-  # else
-  return 0
-
  # return min value of (brightness)
  # type='I','Q','U','V' or 'A' for app_brightness
  # f=freq_index, t=time_index
  def getMinBrightness(self,type='A',f=0,t=0):
-  if type=='A':
-   #if len(self.__barr)==0:
-   # return 0
-   #pname=self.__barr[len(self.__barr)-1]
-   #return self.p_table[pname].getBrightness()
-   # the Min value of brightness is not necessarily the 
-   # last element in __barr because sources in patches
-   # are removed from the __barr. Hence we need to do a 
-   # scan of all punits
-   tmp_min=1e6 # FIXME: a very large value
-   for pname in self.p_table.keys():
-    mytype=self.p_table[pname].getType()
-    if mytype==POINT_TYPE or mytype==GAUSS_TYPE:
-     tmp_val=self.p_table[pname].getBrightness()
-     if tmp_min > tmp_val:
-      tmp_min=tmp_val
-   return tmp_min
-  else:
-   # select the min value
-   tmp_min=1e6
-   for pname in self.p_table.keys():
-    mytype=self.p_table[pname].getType()
-    if mytype==POINT_TYPE or mytype==GAUSS_TYPE :
-     tmp_val=self.p_table[pname].sp.getValue(type,f,t)
-     if tmp_min > tmp_val:
-      tmp_min=tmp_val
-   return tmp_min
-
-  # else
-  return 0
+  # the Min value of brightness is not necessarily the 
+  # last element in __barr because sources in patches
+  # are removed from the __barr. Hence we need to do a 
+  # scan of all punits
+  tmp_min=1e6 # FIXME: a very large value
+  values=self.__brightness_values(type,f,t)
+  if len(values):
+   tmp_min=min(tmp_min,values.min())
+  return tmp_min
 
  # return max,min and abs(min) values 
  def getBrightnessLims(self,type='A',f=0,t=0):
@@ -630,20 +913,42 @@ class LSM:
    tmp_min=1e6 # FIXME: a very large value
    tmp_max=-1e6
    tmp_abs_min=1e6
-   for pname in self.p_table.keys():
-    mytype=self.p_table[pname].getType()
-    if mytype==POINT_TYPE or mytype==GAUSS_TYPE:
-     tmp_val=self.p_table[pname].getBrightness()
-     if tmp_min > tmp_val:
-      tmp_min=tmp_val
-     if tmp_abs_min > abs(tmp_val):
-      tmp_abs_min=abs(tmp_val)
-     if tmp_max < tmp_val:
-      tmp_max=tmp_val
+   values=self.__brightness_values(type,f,t)
+   if len(values):
+    tmp_min=min(tmp_min,values.min())
+    tmp_abs_min=min(tmp_abs_min,abs(values).min())
+    tmp_max=max(tmp_max,values.max())
    return (tmp_max,tmp_min,tmp_abs_min)
 
   return (0,0,0)
 
+ # return array of brightness values of all point and gaussian
+ # p-units (including those in patches)
+ # type='I','Q','U','V' or 'A' for app_brightness
+ # f=freq_index, t=time_index
+ def __brightness_values(self,type='A',f=0,t=0):
+  values=[]
+  pnames=self.p_table.keys()
+  if self.__table!=None and len(self.__table):
+   # take the values of sources in the table in one go
+   table=self.__table
+   mytype=table['type']
+   values.append(table['brightness' if type=='A' else type][(mytype==POINT_TYPE)|(mytype==GAUSS_TYPE)])
+   if len(table)==len(self.p_table):
+    pnames=[]
+   else:
+    pnames=[ pname for pname in pnames if not table.rows.has_key(pname) ]
+  tmp_values=[]
+  for pname in pnames:
+   mytype=self.p_table[pname].getType()
+   if mytype==POINT_TYPE or mytype==GAUSS_TYPE:
+    if type=='A':
+     tmp_values.append(self.p_table[pname].getBrightness())
+    else:
+     tmp_values.append(self.p_table[pname].sp.getValue(type,f,t))
+  values.append(numpy.array(tmp_values,float))
+  return numpy.concatenate(values)
+
  # return current frequency and time
  def getCurrentFreqTime(self,freq_index,time_index):
   if self.cells==None:
@@ -668,164 +973,326 @@ class LSM:
    punit=self.p_table[sname]
    #if punit.getType()==POINT_TYPE:
    punit.sp.updateValues(sname)
+   # positions may now come from the new vellsets
+   self.updateLocation(punit)
 
- # save to a file
+ # save to a file, in the binary format of LSM_format
  # while saving, discard any existing vellsets because
  # they can be recalculated. 
+ # returns True if the LSM was saved
  def save(self,filename):
   # add safeguard: do not save if the filename has 
   # a 'protected.lsm' term
   ii=string.find(filename,'protected.lsm')
   if ii!=-1:
    print "WARNING: the filename %s is protected. save failed!!!"%filename
-   return
+   return False
   try:
-   f=open(filename,'wb') 
-   p=pickle.Pickler(f)
-   # create a new LSM from this LSM,
-   # without reference to MeqServer or the forests
-   g=LSM()
-   g.s_table=self.s_table
-   g.m_table=self.m_table
-   g.tmpl_table=self.tmpl_table
-   g.__barr=self.__barr
-   g.mqs=None
-   g.cells=None
-   g.__patch_count=self.__patch_count
-   g.default_patch_center=self.default_patch_center
-   g.default_patch_method=self.default_patch_method
-
-
-   # serialize the root
-   gdict={}
-   if self.__root!=None:
-    # serialize the whole subtree
-    traverse(self.__root,gdict,self.__ns._name)
-
-   # if the nodescope has a subscope, strip the subscope 
-   # name from the root name
-   if self.__ns._name:
-     g.__root_name=strip_subscope(self.__root_name)
-   else: 
-     g.__root_name=self.__root_name
-
-   # remove circular references to the old LSM
-   # serialize the PUnit table 
-   g.p_table={}
-
-   extra_node_list=[]
-   for sname in self.p_table.keys(): 
-    punit=self.p_table[sname]
-    # this is just for testing, add a dummy node thats not in the LSM
-    g.p_table[sname]=punit.clone(self.__ns._name)
-    g.p_table[sname].setLSM(g)
-
-   g.__root=pickle.dumps(gdict)
-   g._extra_node_list=extra_node_list
-   #print g._extra_node_list
-
-   p.dump(g)
-   f.close()
-
+   (meta,sources,punits,sixpacks,nodes)=self.__file_data()
+   LSM_format.write(filename,meta,sources,punits,sixpacks,nodes)
    self.__file=filename
-
   except IOError:
    print "file %s cannot be opened, save failed" % filename 
-  
-  # next step: save the MeqTrees
-  if self.mqs != None:
-   pass
-   #forest_filename=filename+'.forest'
-   #self.mqs.meq('Save.Forest',meq.record(file_name=forest_filename));
-
- # load from a file 
+   return False
+  return True
+
+ # return the contents of the LSM in the form stored in LSM files (see
+ # LSM_format): (meta,sources,punits,sixpacks,nodes). Sources and
+ # p-Units in the SourceTable are stored column by column, others one
+ # by one. Node names are stripped of the subscope of the nodescope, if
+ # any
+ def __file_data(self):
+  subscope=None
+  if self.__ns!=None and self.__ns._name:
+   subscope=self.__ns._name
+  nodes=LSM_format.NodeDefs()
+  root_name=self.__root_name
+  if self.__root!=None:
+   nodes.add_tree(self.__root,subscope)
+  if root_name!=None and subscope:
+   root_name=strip_subscope(root_name)
+  if root_name!=None and self.__nodes!=None:
+   nodes.copy_tree(self.__nodes,root_name)
+  meta={'m_table':self.m_table,'patch_count':self.__patch_count,
+        'default_patch_center':self.default_patch_center,
+        'default_patch_method':self.default_patch_method,'root_name':root_name}
+  table=self.__table
+
+  # source table
+  objs=[]
+  rows=[]
+  for s in self.s_table.itervalues():
+   if isinstance(s,SourceView):
+    rows.append(s._row)
+   else:
+    objs.append(s)
+  rows=numpy.array(rows,int)
+  ext=numpy.array([ s.extParms() for s in objs ],float).reshape((len(objs),3))
+  sources=[('name',[ s.name for s in objs ]+[ table.names[i] for i in rows ]),
+           ('type',_join_column([ s.getType() for s in objs ],table,'type',rows,numpy.int16)),
+           ('table',[ s.tableName for s in objs ]+[SourceView.tableName]*len(rows))]
+  for i,col in enumerate(('eX','eY','eP')):
+   sources.append((col,_join_column(ext[:,i],table,col,rows)))
+
+  # p-Unit table
+  objs=[]
+  rows=[]
+  for p in self.p_table.itervalues():
+   if isinstance(p,PUnitView):
+    rows.append(p._row)
+   else:
+    objs.append(p)
+  rows=numpy.array(rows,int)
+  names=[ p.name for p in objs ]+[ table.names[i] for i in rows ]
+  patch=[]
+  lm=[]
+  slist=[]
+  kind=[]
+  labels=[]
+  values=[]
+  sixpacks={}
+  for p in objs:
+   patch.append(p._patch_name or '')
+   lm.append(getattr(p,'_lm',None) or (numpy.nan,numpy.nan))
+   slist.append(list(p.s_list))
+   spec=self.__pending.get(p.name) or sixpack_spec(p.getSP())
+   if spec==None:
+    kind.append(0)
+    labels.append('')
+    values.append((0,)*len(SIXPACK_FIELDS))
+   elif spec[0]=='values':
+    kind.append(1)
+    labels.append(spec[1])
+    values.append(spec[2])
+   else:
+    fields={}
+    for field,value in spec[1].iteritems():
+     if field!='label' and hasattr(value,'name'):
+      # a node stub
+      nodes.add_tree(value,subscope)
+      value=strip_subscope(value.name)
+     elif field!='label' and isinstance(value,str) and self.__nodes!=None:
+      nodes.copy_tree(self.__nodes,value)
+     fields[field]=value
+    sixpacks[p.name]=LSM_format.encode_value(fields)
+    kind.append(2)
+    labels.append(fields.get('label') or p.name)
+    values.append((0,)*len(SIXPACK_FIELDS))
+  # rarely used attributes of the table rows
+  for row in rows:
+   patch.append(table.get_extra(row,'patch_name') or '')
+   lm.append(table.get_extra(row,'lm') or (numpy.nan,numpy.nan))
+   slist.append(table.get_extra(row,'s_list',[table.names[row]]))
+  values=numpy.array(values,float).reshape((len(objs),len(SIXPACK_FIELDS)))
+  punits=[('name',names),
+          ('type',_join_column([ p.getType() for p in objs ],table,'type',rows,numpy.int16)),
+          ('cat',_join_column([ p.getCat() for p in objs ],table,'cat',rows,numpy.int16)),
+          ('brightness',_join_column([ p.getBrightness() for p in objs ],table,'brightness',rows)),
+          ('FOV',_join_column([ p.getFOVDist() for p in objs ],table,'FOV',rows)),
+          ('ra',_join_column([ p.sp.static_RA for p in objs ],table,'ra',rows)),
+          ('dec',_join_column([ p.sp.static_Dec for p in objs ],table,'dec',rows)),
+          ('patch',patch),
+          ('lm',numpy.array(lm,float).reshape((len(lm),2))),
+          ('nsources',numpy.array(map(len,slist),numpy.int32)),
+          ('sources',[ sname for ss in slist for sname in ss ]),
+          ('sixpack',numpy.array(kind+[1]*len(rows),numpy.int8)),
+          ('label',labels+names[len(objs):])]
+  for i,field in enumerate(SIXPACK_FIELDS):
+   punits.append(('sp_'+field,_join_column(values[:,i],table,field,rows)))
+  return (meta,sources,punits,sixpacks,nodes)
+
+ # load from a file, saved in the binary format of LSM_format, or by
+ # older versions of the LSM (as a pickle).
+ # Nodes are not created when the file is loaded, but when a p-Unit that
+ # needs them is used (see reconstructSixpack()).
  # Note if the saved LSM was created using a Subscope
  # the new LSM will ignore that subscope, i.e. will change
  # all node names such that the subscope part is not present
+ # returns True if the LSM was loaded
  def load(self,filename,ns=None):
   try:
-   f=open(filename,'rb') 
-   p=pickle.Unpickler(f)
-   tmpl=LSM()
-   tmpl=p.load()
-   self.s_table=tmpl.s_table
-   self.m_table=tmpl.m_table
-   self.tmpl_table=tmpl.tmpl_table
-   self.__barr=tmpl.__barr
-
-   self.__patch_count=tmpl.__patch_count
-   self.default_patch_center=tmpl.default_patch_center
-   self.default_patch_method=tmpl.default_patch_method
-
-   self.__root_name=tmpl.__root_name
-   #print "Root =",self.__root_name
-   if tmpl.__root!=None:
-    if ns==None:
-     ns=NodeScope()
-    self.__ns=ns
-    my_dict=pickle.loads(tmpl.__root)
-    #print my_dict[self.__root_name]
-    # if there is already a node with the root name, we remove it from our dict
-    # and change root name
-    if ns[self.__root_name].initialized():
-      # create a unique name
-      new_root_name=ns.MakeUniqueName(self.__root_name)
-      oldroot=my_dict.pop(self.__root_name)
-      print "WARNING: changing name from %s to %s"%(self.__root_name,new_root_name)
-      self.__root_name=new_root_name
-      my_dict[self.__root_name]=oldroot
-
-    my_dict=reconstruct(my_dict,ns)
-    #self.__root=my_dict[self.__root_name]
-   else:
-     self.__root=None
-     print "WARNING: cannot find a root node in the LSM. load will fail!"
-
-   # recreate the extra node list, if any
-   if hasattr(tmpl,"_extra_node_list") and len(tmpl._extra_node_list)>0:
-     print "Found extra nodes"
-     extra_root_name=ns.MakeUniqueName(self.__root_name+"_extra")
-     ns[extra_root_name]<<Meq.Composer(children=tmpl._extra_node_list)
-
-   
-   self.p_table=tmpl.p_table
-   # reconstruct PUnits and Sixpacks if possible
-   for sname in self.p_table.keys(): 
-    punit=self.p_table[sname]
-    punit.setLSM(self)
-    # now create the sixpack
-    tmp_dict=punit.getSP()
-    #print tmp_dict
-    if tmp_dict.has_key('patchroot'):
-     my_sp=LSM_Sixpack.Sixpack(label=tmp_dict['label'],\
-      ns=self.__ns, root=self.__ns[tmp_dict['patchroot']])
-    else: 
-     # NOTE: do not give the nodescope because then it tries to
-     # compose, but the tree is already composed
-     my_sp=LSM_Sixpack.Sixpack(label=tmp_dict['label'],\
-       ra=cname_node_stub(self.__ns,tmp_dict['ra']),\
-       dec=cname_node_stub(self.__ns,tmp_dict['dec']),\
-       stokesI=cname_node_stub(self.__ns,tmp_dict['I']),\
-       stokesQ=cname_node_stub(self.__ns,tmp_dict['Q']),\
-       stokesU=cname_node_stub(self.__ns,tmp_dict['U']),\
-      stokesV=cname_node_stub(self.__ns,tmp_dict['V']))
-     # set the root node
-     my_sp=my_sp.clone(sixpack=self.__ns[tmp_dict['pointroot']],ns=self.__ns)
-    punit.setSP(my_sp)
-    # recreate the NodeSet nodes, if any
-
+   data=_without_gc(self.__read_file,filename)
+  except IOError,err:
+   print "file %s cannot be opened, load failed: %s"%(filename,err)
+   return False
+  self.s_table={}
+  self.p_table={}
+  self.__barr=BrightnessIndex()
+  self.__spatial=SpatialIndex()
+  if self.__table!=None:
+   self.__table=SourceTable()
+  self.__root=None
+  self.__nodes=None
+  self.__pending={}
+  if ns!=None:
+   self.__ns=ns
+  _without_gc(self.__add_file_data,data,False)
+  self.setFileName(filename)
+  return True
+
+ # return the contents of an LSM file, as (meta,sources,punits,sixpacks,
+ # nodes), see __file_data()
+ def __read_file(self,filename):
+  if not LSM_format.is_lsm_file(filename):
+   return self.__read_pickle(filename)
+  lf=LSM_format.LSMFile(filename)
+  return (lf.json('META',{}),lf.columns('SRCS'),lf.columns('PUNT'),lf.json('SPND',{}),lf.nodes())
+
+ # read an LSM saved by older versions: a pickled LSM, with the node
+ # forest pickled again into its root. No nodes are created
+ def __read_pickle(self,filename):
+  f=open(filename,'rb')
+  try:
+   tmpl=legacy_unpickler(f).load()
+  finally:
    f.close()
-
-   self.setFileName(filename)
-
-  except IOError:
-   print "file %s cannot be opened, load failed" % filename 
-  # next step: Load the MeqTrees if possible 
-  if self.mqs != None:
-   pass
-   #forest_filename=filename+'.forest'
-   #self.mqs.meq('Load.Forest',meq.record(file_name=forest_filename),wait=True);
-   #self.mqs.meq('Load.Forest',meq.record(file_name=forest_filename));
+  # attributes that older LSMs do not have
+  tmpl.__table=None
+  tmpl.__pending={}
+  tmpl.__ns=None
+  tmpl.__nodes=LSM_format.NodeDefs()
+  if tmpl.__root!=None:
+   tmpl.__nodes.add_dict(legacy_unpickler(cStringIO.StringIO(tmpl.__root)).load())
+   tmpl.__root=None
+  (meta,sources,punits,sixpacks,nodes)=tmpl.__file_data()
+  return (meta,dict(sources),dict(punits),LSM_format.decode_value(sixpacks),nodes)
+
+ # add the contents of an LSM file (see __read_file()) to the LSM.
+ # If merge=True, p-Units and sources that are already present are
+ # ignored, else the LSM attributes are set from the file too
+ def __add_file_data(self,data,merge=False):
+  (meta,sources,punits,sixpacks,nodes)=data
+  if not merge:
+   self.m_table=meta.get('m_table',self.m_table)
+   self.__patch_count=meta.get('patch_count',0)
+   self.default_patch_center=meta.get('default_patch_center',self.default_patch_center)
+   self.default_patch_method=meta.get('default_patch_method',self.default_patch_method)
+   self.__root_name=meta.get('root_name')
+  if self.__nodes==None:
+   self.__nodes=nodes
+  else:
+   for name in nodes.keys():
+    self.__nodes.copy_tree(nodes,name)
+
+  # source table, by name
+  snames=sources.get('name',[])
+  srow=dict([ (sname,i) for i,sname in enumerate(snames) ])
+  stype=sources.get('type',numpy.zeros(0)).tolist()
+
+  # p-Unit table
+  names=punits.get('name',[])
+  cols=dict([ (col,value.tolist()) for col,value in punits.items() if isinstance(value,numpy.ndarray) ])
+  slist=[]
+  i0=0
+  for nsrc in cols.get('nsources',[]):
+   slist.append(punits['sources'][i0:i0+nsrc])
+   i0+=nsrc
+  patch=punits.get('patch',[])
+  lm=cols.get('lm',[])
+  spvalues=zip(*[ cols['sp_'+field] for field in SIXPACK_FIELDS ])
+  # point sources and gaussians with plain numbers go into the SourceTable,
+  # if there is one
+  to_table=[]
+  inserted=[]
+  self.beginBulkLoad()
+  for i,pname in enumerate(names):
+   if self.p_table.has_key(pname):
+    print "WARNING: PUnit %s already found. Ignoring"%pname
+    continue
+   ptype=cols['type'][i]
+   if self.__table!=None and ptype in (POINT_TYPE,GAUSS_TYPE) and cols['sixpack'][i]!=2 and\
+      slist[i]==[pname] and srow.has_key(pname) and stype[srow[pname]]==ptype and\
+      not self.s_table.has_key(pname):
+    to_table.append(i)
+    continue
+   p=PUnit(pname,self)
+   p.setType(ptype)
+   p.s_list=slist[i]
+   p.setCat(cols['cat'][i])
+   p.setBrightness(cols['brightness'][i])
+   p.setFOVDist(cols['FOV'][i])
+   p.sp.set_staticRA(cols['ra'][i])
+   p.sp.set_staticDec(cols['dec'][i])
+   p._patch_name=patch[i] or None
+   if lm[i][0]==lm[i][0]:
+    p._lm=tuple(lm[i])
+   # the sixpack is made when it is first asked for
+   if cols['sixpack'][i]==1:
+    self.__pending[pname]=('values',punits['label'][i],spvalues[i])
+   elif cols['sixpack'][i]==2:
+    self.__pending[pname]=('nodes',sixpacks[pname])
+   self.p_table[pname]=p
+   self.__barr.insert(pname,cols['brightness'][i])
+   inserted.append(i)
+
+  if to_table:
+   table=self.__table
+   idx=numpy.array(to_table,int)
+   sidx=numpy.array([ srow[names[i]] for i in to_table ],int)
+   values=dict([ (field,punits['sp_'+field][idx]) for field in SIXPACK_FIELDS ])
+   for col in 'eX','eY','eP':
+    values[col]=sources[col][sidx]
+   rows=table.extend([ names[i] for i in to_table ],type=punits['type'][idx],cat=punits['cat'][idx],
+                     brightness=punits['brightness'][idx],FOV=punits['FOV'][idx],**values)
+   # the static RA,Dec are the ones that count
+   table['ra'][rows]=punits['ra'][idx]
+   table['dec'][rows]=punits['dec'][idx]
+   for i,row in zip(to_table,rows.tolist()):
+    pname=names[i]
+    self.s_table[pname]=SourceView(pname,table,row)
+    p=PUnitView(pname,self,table,row)
+    if patch[i]:
+     p._patch_name=patch[i]
+    if lm[i][0]==lm[i][0]:
+     p._lm=tuple(lm[i])
+    self.p_table[pname]=p
+    self.__barr.insert(pname,cols['brightness'][i])
+   inserted+=to_table
+
+  # all p-Units go into the spatial index at once
+  if inserted:
+   idx=numpy.array(inserted,int)
+   self.__spatial.insert_many([ names[i] for i in inserted ],punits['ra'][idx],punits['dec'][idx],
+                              punits['type'][idx],[ not patch[i] for i in inserted ])
+  self.endBulkLoad()
+
+  # remaining sources
+  if snames:
+   ext=zip(sources['eX'].tolist(),sources['eY'].tolist(),sources['eP'].tolist())
+   for sname,treeType,tableName,(eX,eY,eP) in zip(snames,stype,sources['table'],ext):
+    if not self.s_table.has_key(sname):
+     s=Source(sname,treeType,tableName,eX,eY,eP)
+     s.setTemplateTree(treeType)
+     self.s_table[sname]=s
+
+ # p-Units read from a file get their sixpacks when these are first
+ # asked for (see PUnit.getSP()). Returns the sixpack of the named
+ # p-Unit, creating the nodes it needs, or None if there is none
+ def reconstructSixpack(self,pname):
+  spec=self.__pending.pop(pname,None)
+  if spec==None:
+   return None
+  if spec[0]=='values':
+   (label,values)=spec[1:]
+   kw=dict(zip([ SIXPACK_KEYWORDS[field] for field in SIXPACK_FIELDS ],values))
+   return LSM_Sixpack.Sixpack(label=label,**kw)
+  if self.__ns==None:
+   self.__ns=NodeScope()
+  # NOTE: do not give the nodescope because then it tries to
+  # compose, but the tree is already composed
+  kw={'label':pname}
+  for field,value in spec[1].iteritems():
+   if field=='label':
+    kw['label']=value
+   elif isinstance(value,str):
+    if self.__nodes!=None and self.__nodes.has_key(value):
+     value=self.__nodes.resolve(value,self.__ns)
+    else:
+     value=cname_node_stub(self.__ns,value)
+    kw[SIXPACK_KEYWORDS.get(field,field)]=value
+   else:
+    kw[SIXPACK_KEYWORDS.get(field,field)]=value
+  return LSM_Sixpack.Sixpack(**kw)
 
 
  # send a request to the LSM to give the p-units
@@ -836,6 +1303,18 @@ class LSM:
  # names='list of names': gives a list of p units matching the names in the  'name_list'
  # name='name': gives the p unit matching the name 'name'
  # cat=1,2,.. : gives p units of given category
+ # min_bright=x, max_bright=y : gives p units with x<=brightness<=y, in
+ #   order of decreasing brightness (either one may be omitted). If count
+ #   is also given, at most count p units are returned
+ # cone=(ra0,dec0,radius) : gives p units within radius of ra0,dec0,
+ #   nearest first (all in radians)
+ # box=(ra_min,ra_max,dec_min,dec_max) : gives p units within the given
+ #   RA,Dec limits. If ra_min>ra_max, the box wraps around RA=2pi
+ # nearest=(ra0,dec0) : gives the p units nearest to ra0,dec0, nearest
+ #   first. Gives just one p unit, unless count is also given
+ # cone, box and nearest give the same set of p units as all=1 (i.e. points
+ # within patches are not included), and may be combined with min_bright
+ # and max_bright, in which case min_bright/max_bright are applied first
  def queryLSM(self,**kw):
   
   outlist=[]
@@ -857,9 +1336,40 @@ class LSM:
       outlist.append(self.p_table[pname])
    return outlist
  
+  if kw.has_key('cone') or kw.has_key('box') or kw.has_key('nearest'):
+   if kw.has_key('cone'):
+    (ra0,dec0,radius)=kw['cone']
+    names=self.__spatial.cone(ra0,dec0,radius,top=True)
+   elif kw.has_key('box'):
+    (ra_min,ra_max,dec_min,dec_max)=kw['box']
+    names=self.__spatial.box(ra_min,ra_max,dec_min,dec_max,top=True)
+   else:
+    (ra0,dec0)=kw['nearest']
+    if kw.has_key('min_bright') or kw.has_key('max_bright'):
+     # search among all, and filter below
+     names=self.__spatial.nearest(ra0,dec0,len(self.__spatial),top=True)
+    else:
+     names=self.__spatial.nearest(ra0,dec0,kw.get('count',1),top=True)
+   if kw.has_key('min_bright') or kw.has_key('max_bright'):
+    bright=set(self.__barr.brightness_range(kw.get('min_bright',None),kw.get('max_bright',None)))
+    names=[ pname for pname in names if pname in bright ]
+   if kw.has_key('count'):
+    names=names[:max(kw['count'],0)]
+   for pname in names:
+    outlist.append(self.p_table[pname])
+   return outlist
+
+  if kw.has_key('min_bright') or kw.has_key('max_bright'):
+   names=self.__barr.brightness_range(kw.get('min_bright',None),kw.get('max_bright',None))
+   if kw.has_key('count'):
+    names=names[:max(kw['count'],0)]
+   for pname in names:
+    outlist.append(self.p_table[pname])
+   return outlist
+
   if kw.has_key('count'):
-   for i in range(min(kw['count'],len(self.__barr))): 
-    outlist.append(self.p_table[self.__barr[i]])
+   for pname in self.__barr.brightest(kw['count']):
+    outlist.append(self.p_table[pname])
    return outlist
 
   if kw.has_key('cat'):
@@ -959,6 +1469,7 @@ class LSM:
 
      child_list.append(my_name)
      self.p_table[sname]._patch_name=patch_name
+     self.__spatial.setTop(sname,False)
    #print child_list
    patch_root=self.__ns['sixpack:q='+patch_name]<<Meq.PatchComposer(method=self.default_patch_method,children=child_list)
 
@@ -1058,70 +1569,20 @@ class LSM:
   # now for each point source in p-unit list
   # if they are not already included in a patch
   # and also if they satisfy the criteria for including
-  # in a patch, do a binary search and find correct grid position
-  
-  # set up bins to collect sorted sources
-  xbins={}
-  for ii in range(len(x_array)-1):
-   xbins[ii]=[]
-  ybins={}
-  for ii in range(len(y_array)-1):
-   ybins[ii]=[]
-
-  #print xbins
-  #print ybins
-
+  # in a patch, find the correct grid position. The brightness
+  # index only holds sources that are not in a patch, and the
+  # spatial index bins them all in one go
+  names=self.__barr.brightness_range(min_bright,max_bright)
+  bins=self.__spatial.grid(x_array,y_array,names=names,types=[POINT_TYPE])
 
-  for sname in self.p_table.keys(): 
-    punit=self.p_table[sname]
-    pb=punit.getBrightness('A')
-    if  punit.getType()==POINT_TYPE and\
-       punit._patch_name==None and\
-       (pb<=max_bright) and (pb>=min_bright):
-      # get RA and Dec
-      xx=punit.sp.getRA()
-      yy=punit.sp.getDec()
-      k=bin_search(x_array,xx,0,len(x_array)-1)
-      xbins[k].append(sname)
-      k=bin_search(y_array,yy,0,len(y_array)-1)
-      ybins[k].append(sname)
-
-  #print xbins
-  #print ybins
-  # now create a reverse mapping hash table
-  # indexed by source name, such that the pair
-  # of indices [x_,y_] for each source (patch index)
-  # is given
-  p_id_x={}
-  p_id_y={}
+  # now create the patches
   # ignore bin indices 0 and the last_index
   # bacause these fall out of the range
-  if len(xbins)>2:
-   for ii in range(len(xbins)-2):
-    ll=xbins[ii+1]
-    # traverse list
-    for sname in ll:
-      p_id_x[sname]=ii+1
-  if len(ybins)>2:
-   for ii in range(len(ybins)-2):
-    ll=ybins[ii+1]
-    # traverse list
-    for sname in ll:
-      p_id_y[sname]=ii+1
-
-  # now create the patches
   patch_bins={}
-  for ii in range(len(xbins)-2):
-   for jj in range(len(ybins)-2):
+  for ii in range(len(x_array)-3):
+   for jj in range(len(y_array)-3):
     patch_name="Patch#"+str(ii+1)+":"+str(jj+1)
-    patch_bins[patch_name]=[]
- 
-  for sname in p_id_x.keys():
-    ii=p_id_x[sname]
-    if p_id_y.has_key(sname):
-     jj=p_id_y[sname]
-     patch_name="Patch#"+str(ii)+":"+str(jj)
-     patch_bins[patch_name].append(sname)
+    patch_bins[patch_name]=bins.get((ii+1,jj+1),[])
 
   # create progree dialog
   if isinstance(qApp,QApplication):
@@ -1225,8 +1686,10 @@ class LSM:
  # sixpack_list: list of sixpacks
  # ns: NodeScope of the sixpack trees
  def build_from_sixpacks(self,sixpack_list,ns):
+		self.beginBulkLoad()
 		for my_sp in sixpack_list:
 		  self.add_sixpack(sixpack=my_sp,ns=ns)
+		self.endBulkLoad()
 
 
  # Add just one sixpack to the LSM
@@ -1272,63 +1735,7 @@ class LSM:
  #NVSS  J163411+624953   16 34 11.868   0.73   62 49 53.72   8.3     1400    0.0030    .0005 J
  #
  def build_from_catalog(self,infile_name,ns):
-
-  infile=open(infile_name,'r')
-  all=infile.readlines()
-  infile.close()
-
-  # regexp pattern
-  pp=re.compile(r"""
-   ^(?P<col1>\S+)  # column 1 'NVSS'
-   \s*             # skip white space
-   (?P<col2>[A-Za-z]\w+\+\w+)  # source name i.e. 'J163002+631308'
-   \s*             # skip white space
-   (?P<col3>\d+)   # RA angle - hr 
-   \s*             # skip white space
-   (?P<col4>\d+)   # RA angle - min 
-   \s*             # skip white space
-   (?P<col5>\d+(\.\d+)?)   # RA angle - sec
-   \s*             # skip white space
-   (?P<col6>[^ ]+) # eRA angle - sec or 'n'
-   \s*             # skip white space
-   (?P<col7>\d+)   # Dec angle - hr 
-   \s*             # skip white space
-   (?P<col8>\d+)   # Dec angle - min 
-   \s*             # skip white space
-   (?P<col9>\d+(\.\d+)?)   # Dec angle - sec
-   \s*             # skip white space
-   (?P<col10>[^ ]+)   # eDec angle - sec
-   \s*             # skip white space
-   (?P<col11>\d+)   # freq
-   \s*             # skip white space
-   (?P<col12>\d+(\.\d+)?)   # brightness - Flux
-   \s*             # skip white space
-   (?P<col13>\d*\.\d+)   # brightness - eFlux
-   \s*""",re.VERBOSE)
-## OMS 10/02/2007: removed this, as some NVSS extracts have extra fields 
-## after eFlux. Also, I've seen "n" for eRA/eDec, so I changed the
-## regex above
-#   \S+
-#   \s*$""",re.VERBOSE)
- 
-  # read each source and insert to LSM
-  for eachline in all:
-   v=pp.search(eachline)
-   if v!=None:
-    s=Source(v.group('col2'))
-    source_RA=float(v.group('col3'))+(float(v.group('col5'))/60.0+float(v.group('col4')))/60.0
-    source_RA*=math.pi/12.0
-    source_Dec=float(v.group('col7'))+(float(v.group('col9'))/60.0+float(v.group('col8')))/60.0
-    source_Dec*=math.pi/180.0
-
-    my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=eval(v.group('col12')), f0=1e6,RA=source_RA, Dec=source_Dec,trace=0)
-   # first compose the sixpack before giving it to the LSM
-    SourceRoot=my_sixpack.sixpack(ns)
-    my_sixpack.display()
-    self.add_source(s,brightness=eval(v.group('col12')),
-     sixpack=my_sixpack,
-     ra=source_RA, dec=source_Dec)
- 
+  self.add_sources(LSM_parsers.read_catalog(infile_name))
   self.setNodeScope(ns)
   self.setFileName(infile_name)
 
@@ -1369,6 +1776,7 @@ class LSM:
  
   # read each source and insert to LSM
   # give source a name and convert coordinates to radians
+  self.beginBulkLoad()
   for eachline in all:
    v=pp.search(eachline)
    if v!=None:
@@ -1386,6 +1794,7 @@ class LSM:
      sixpack=my_sixpack,
      ra=source_RA, dec=source_Dec)
  
+  self.endBulkLoad()
   self.setNodeScope(ns)
   self.setFileName(infile_name)
 
@@ -1420,6 +1829,7 @@ class LSM:
  
   # read each source and insert to LSM
   # give source a name and convert coordinates to radians
+  self.beginBulkLoad()
   for eachline in all:
    v=pp.search(eachline)
    if v!=None:
@@ -1437,6 +1847,7 @@ class LSM:
      sixpack=my_sixpack,
      ra=source_RA, dec=source_Dec)
  
+  self.endBulkLoad()
   self.setNodeScope(ns)
   self.setFileName(infile_name)
 
@@ -1477,7 +1888,18 @@ class LSM:
     lpb.show()
     i=0
 
-   for pname in self.p_table.keys():
+   pnames=self.p_table.keys()
+   if self.__table!=None and len(self.__table):
+    # sources in the table are transformed in one go
+    table=self.__table
+    ra=table['ra'].copy()
+    dec=table['dec'].copy()
+    table['ra'][:]=A[0][0]*ra+A[0][1]*dec+b[0]
+    table['dec'][:]=A[1][0]*ra+A[1][1]*dec+b[1]
+    self.__spatial.move_many(table.names,table['ra'],table['dec'])
+    pnames=[ pname for pname in pnames if not table.rows.has_key(pname) ]
+
+   for pname in pnames:
     pu=self.p_table[pname]
     old_ra=pu.sp.getRA()
     old_dec=pu.sp.getDec()
@@ -1502,61 +1924,13 @@ class LSM:
  # if we find sources with duplicate names, ignore them
  def merge(self,filename,ns=None):
   try:
-   f=open(filename,'rb') 
-   p=pickle.Unpickler(f)
-   tmpl=LSM()
-   tmpl=p.load()
-
-   # recreate the sixpacks
-   if tmpl.__root!=None:
-    if ns==None:
-     ns=self.__ns
-    my_dict=pickle.loads(tmpl.__root)
-    my_dict=reconstruct(my_dict,ns)
-   else:
-     tmpl.__root=self.__root
-   
-   # reconstruct PUnits and Sixpacks if possible
-   for sname in tmpl.p_table.keys(): 
-    if not self.p_table.has_key(sname):
-       punit=tmpl.p_table[sname]
-       punit.setLSM(self)
-       # now create the sixpack
-       tmp_dict=punit.getSixpack()
-       #print tmp_dict
-       if tmp_dict.has_key('patchroot'):
-           my_sp=LSM_Sixpack.Sixpack(label=tmp_dict['label'],\
-            ns=self.__ns, root=self.__ns[tmp_dict['patchroot']])
-       else: 
-       # NOTE: do not give the nodescope because then it tries to
-       # compose, but the tree is already composed
-          my_sp=LSM_Sixpack.Sixpack(label=tmp_dict['label'],\
-            ra=cname_node_stub(self.__ns,tmp_dict['ra']),\
-            dec=cname_node_stub(self.__ns,tmp_dict['dec']),\
-            stokesI=cname_node_stub(self.__ns,tmp_dict['I']),\
-            stokesQ=cname_node_stub(self.__ns,tmp_dict['Q']),\
-            stokesU=cname_node_stub(self.__ns,tmp_dict['U']),\
-            stokesV=cname_node_stub(self.__ns,tmp_dict['V']))
-       # set the root node
-       my_sp=my_sp.clone(sixpack=self.__ns[tmp_dict['pointroot']],ns=self.__ns)
-       punit.setSP(my_sp)
-       # add the new PUnit to self
-       self.insertPUnit(punit)
-    else:
-     print "WARNING: PUnit %s already found. Ignoring"%sname
-
-   # reconstruct source table too...
-   for sname in tmpl.s_table.keys():
-    if not self.s_table.has_key(sname):
-     # add source to source table
-     self.s_table[sname]=Source(sname)
-   f.close()
-
-  except IOError:
-   print "file %s cannot be opened, load failed" % filename 
-  # next step: Load the MeqTrees if possible 
-  if self.mqs != None:
-   pass
+   data=_without_gc(self.__read_file,filename)
+  except IOError,err:
+   print "file %s cannot be opened, load failed: %s"%(filename,err)
+   return
+  if self.__ns==None:
+   self.__ns=ns
+  _without_gc(self.__add_file_data,data,True)
 
 
 
@@ -1567,273 +1941,15 @@ class LSM:
  # dont use the above two together!
  def build_from_newstar(self,infile_name,ns,verbose=1,ignore_pol=False, only_cleancomp=False, no_cleancomp=False):
 
-    # read mdl.dsc and "MDL_O_DEF" on how I did this
-    ff=open(infile_name,mode="rb")
-    #### read header -- 512 bytes
-    gfh=Timba.array.fromfile(ff,dtype=Timba.array.uint8,count=512)
-    ## type
-    ftype=gfh[0:4].tostring()
-    ## length
-    fhlen=struct.unpack('i',gfh[4:8])
-    fhlen=fhlen[0]
-    ### version
-    fver=struct.unpack('i',gfh[5:9])
-    fver=fver[0]
-    ### creation date
-    crdate=gfh[12:23].tostring()
-    ### creation time
-    crtime=gfh[23:28].tostring()
-    ### revision date
-    rrdate=gfh[28:39].tostring()
-    ### revision time
-    rrtime=gfh[39:44].tostring()
-    ### revision count
-    rcount=struct.unpack('i',gfh[44:48])
-    rcount=rcount[0]
-    #### node name
-    nname=gfh[48:128].tostring()
-
-    ### the remaining info is not needed
-
-#    print "%s: read header type=%s, length=%d, version=%d, created=%s@%s, updated=%s@%s x %d, node  name=%s"%(infile_name,ftype,fhlen,fver,crdate,crtime,rrdate,rrtime,rcount,nname)
-
-    ####### Model Header -- 64 bytes 
-    mdh=Timba.array.fromfile(ff,dtype=Timba.array.uint8,count=64)
-
-    ### Max. # of lines in model or disk version
-    maxlin=struct.unpack('i',mdh[12:16])
-    maxlin=maxlin[0]
-
-    ### pointer to model ???
-    modptr=struct.unpack('i',mdh[16:20])
-    modptr=modptr[0]
-
-    #### no of sources in model
-    nsources=struct.unpack('i',mdh[20:24])
-    nsources=nsources[0]
-
-    ### model type(0: no ra,dec, 1=app, 2=epoch)
-    mtype=struct.unpack('i',mdh[24:28])
-    mtype=mtype[0]
-
-    ### Epoch (e.g. 1950) if TYP=2 (float) : 4 bytes
-    mepoch=struct.unpack('f',mdh[28:32])
-    mepoch=mepoch[0]
-
-    ###  Model centre RA (circles) : double
-    ra0=struct.unpack('d',mdh[32:40])
-    ra0=ra0[0]*math.pi*2
-
-    ### Model centre DEC (circles)
-    dec0=struct.unpack('d',mdh[40:48])
-    dec0=dec0[0]*math.pi*2
-
-    ### Model centre FRQ (MHz)
-    freq0=struct.unpack('d',mdh[48:56])
-    freq0=freq0[0]*1e6
-
-    ###### the remaining is not needed
-
-
-#    print "%s: read model header lines=%d, pointer=%d, sources=%d, type=%d, epoch=%f RA=%f, DEC=%f (rad) Freq=%f Hz"%(infile_name,maxlin,modptr,nsources,mtype,mepoch,ra0,dec0,freq0)
-
-#    log = file('lsm.log','wt');
-#    print 'ra0=%.14f dec0=%.14f'%(ra0,dec0);
-#    log.write('ra0=%.14f dec0=%.14f\n'%(ra0,dec0));
-    
-
-    # temp dict to hold unique nodenames
-    unamedict={}
-
-    ########## Models -- 56 bytes
-    for ii in range(0,nsources):
-    #for ii in range(0,4):
-       mdl=Timba.array.fromfile(ff,dtype=Timba.array.uint8,count=56)
-
-       ### Amplitude (Stokes I)
-       sI=struct.unpack('f',mdl[0:4])
-       sI=sI[0]*0.005 # convert from WU to Jy (1WU=5mJy)
-
-       ### L offset (mult by 60*60*180/pi to get arcsecs)
-       ll=struct.unpack('f',mdl[4:8])
-       ll=ll[0]
-
-       ### M offset 
-       mm=struct.unpack('f',mdl[8:12])
-       mm=mm[0]
-       
-       ### Identification
-       id=struct.unpack('i',mdl[12:16])
-       id=id[0]
-       
-       # log.write('%d: l=%.14f m=%.14f r=%.14f\n'%(id,ll,mm,math.sqrt(ll*ll+mm*mm)));
-
-       ### Q fraction
-       ## OMS 25/01/2010: is this a boo-boo? This used to divide by 100, as if the number was a percentage.
-       ## But MDL.DSC says only "Q (fraction of I)".
-       sQ=struct.unpack('f',mdl[16:20]) 
-       sQ=sQ[0]*sI; #/100
-       ### U fraction
-       sU=struct.unpack('f',mdl[20:24])
-       sU=sU[0]*sI; #/100
-       ### V fraction
-       sV=struct.unpack('f',mdl[24:28])
-       sV=sV[0]*sI; #/100
-
-       ### extended source params: in arcsec, so multiply by ???
-       eX=struct.unpack('f',mdl[28:32])
-       eX=eX[0]
-       eY=struct.unpack('f',mdl[32:36])
-       eY=eY[0]
-       eP=struct.unpack('f',mdl[36:40])
-       eP=eP[0]
-
-       ## the procedure is NMOEXT in nscan/nmoext.for
-       if eP==0 and eX==eY:
-         r0=0
-       else:
-         r0=0.5*(360/math.pi)*math.atan2(-eP,eY-eX)
-       r1=math.sqrt(eP*eP+(eX-eY)*(eX-eY))
-       r2=eX+eY
-       
-       # the real stuff
-       # ex,eY (arcsec) (major,minor axes),  eP (deg) position angle
-       #eX=math.sqrt(abs(0.5*(r2+r1)))*3600*360/math.pi
-       #eY=math.sqrt(abs(0.5*(r2-r1)))*3600*360/math.pi
-       #eP=r0/2
-       # use radians directly
-       eX=math.sqrt(abs(0.5*(r2+r1)))
-       eY=math.sqrt(abs(0.5*(r2-r1)))
-       eP=r0/(2*360)*math.pi
-
-       #print id,r0,r1,r2,eX,eY,eP
-
-       ### spectral index
-       SI=struct.unpack('f',mdl[40:44])
-       SI=SI[0]
-       ### rotation measure
-       RM=struct.unpack('f',mdl[44:48])
-       RM=RM[0]
-
-       ### bits
-       ## Bits: bit 0= extended; bit 1= Q|U|V <>0
-       bit1=struct.unpack('B',mdl[52:53])
-       ### Type: bit 0= clean component; bit 3= beamed
-       bit2=struct.unpack('B',mdl[53:54])
-
-       bit1=bit1[0]
-       bit2=bit2[0]
-
-       #print ii,id,ll,mm,sI,sQ,sU,sV,eX,eY,eP,SI,RM
-       ###### the remaining is not needed
-
-       if only_cleancomp==True:
-          # only include extendend source with clean component
-          if bit1==0 and bit2==1:
-            # NEWSTAR MDL lists might have same source twice if they are 
-            # clean components, so make a unique name for them
-            bname='NEWS'+str(id);
-            if unamedict.has_key(bname):
-              uniqname=bname+'_'+str(unamedict[bname])
-              unamedict[bname]=unamedict[bname]+1
-            else:
-              uniqname=bname
-              unamedict[bname]=1
-
-            s=Source(uniqname, major=eX, minor=eY, pangle=eP)
-            (source_RA,source_Dec)=lm_to_radec(ra0,dec0,ll,mm)
-
-            #print ii,id,ll,mm,source_RA,source_Dec
-            if ignore_pol:
-             my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,SI=SI, trace=0)
-            elif SI==0 and sQ==0 and sU==0 and sV==0 and RM==0:
-             my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,trace=0)
-            elif (RM==0):
-             my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,SI=SI,stokesQ=sQ, stokesU=sU, stokesV=sV, trace=0)
-            else:
-             my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,SI=SI,stokesQ=sQ, stokesU=sU, stokesV=sV, RM=RM,trace=0)
-
-            # first compose the sixpack before giving it to the LSM
-            my_sixpack.sixpack(ns)
-            self.add_source(s,brightness=sI,
-                     sixpack=my_sixpack,
-                     ra=source_RA, dec=source_Dec,lm=(ll,mm))
-          else:
-           pass
- 
-       elif no_cleancomp==True:
-          # exclude extendend source with clean component
-          if bit1==0 and bit2==1:
-            pass
-          else:
-            # NEWSTAR MDL lists might have same source twice if they are 
-            # clean components, so make a unique name for them
-            bname='NEWS'+str(id);
-            if unamedict.has_key(bname):
-              uniqname=bname+'_'+str(unamedict[bname])
-              unamedict[bname]=unamedict[bname]+1
-            else:
-              uniqname=bname
-              unamedict[bname]=1
-
-            s=Source(uniqname, major=eX, minor=eY, pangle=eP)
-            (source_RA,source_Dec)=lm_to_radec(ra0,dec0,ll,mm)
-
-            #print ii,id,ll,mm,source_RA,source_Dec
-            if ignore_pol:
-             my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,SI=SI, trace=0)
-            elif SI==0 and sQ==0 and sU==0 and sV==0 and RM==0:
-             my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,trace=0)
-            elif (RM==0):
-             my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,SI=SI,stokesQ=sQ, stokesU=sU, stokesV=sV, trace=0)
-            else:
-             my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,SI=SI,stokesQ=sQ, stokesU=sU, stokesV=sV, RM=RM,trace=0)
-
-            # first compose the sixpack before giving it to the LSM
-            my_sixpack.sixpack(ns)
-            self.add_source(s,brightness=sI,
-                     sixpack=my_sixpack,
-                     ra=source_RA, dec=source_Dec,lm=(ll,mm))
-
- 
-       else:
-          # add all sources
-          # NEWSTAR MDL lists might have same source twice if they are 
-          # clean components, so make a unique name for them
-          bname = ('NEWS' if bit2 else 'NEWS')+str(id);
-          if unamedict.has_key(bname):
-            uniqname=bname+'_'+str(unamedict[bname])
-            unamedict[bname]=unamedict[bname]+1
-          else:
-            uniqname=bname
-            unamedict[bname]=1
-
-          s=Source(uniqname, major=eX, minor=eY, pangle=eP)
-          (source_RA,source_Dec)=lm_to_radec(ra0,dec0,ll,mm)
-
-          #print ii,id,ll,mm,source_RA,source_Dec
-          if ignore_pol:
-           my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,SI=SI, trace=0)
-          elif SI==0 and sQ==0 and sU==0 and sV==0 and RM==0:
-           my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,trace=0)
-          elif (RM==0):
-           my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,SI=SI,stokesQ=sQ, stokesU=sU, stokesV=sV, trace=0)
-          else:
-           my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,SI=SI,stokesQ=sQ, stokesU=sU, stokesV=sV, RM=RM,trace=0)
-
-          # first compose the sixpack before giving it to the LSM
-          my_sixpack.sixpack(ns)
-          self.add_source(s,brightness=sI,
-                   sixpack=my_sixpack,
-                   ra=source_RA, dec=source_Dec,lm=(ll,mm))
- 
-
-    ff.close()
+    # see LSM_parsers.read_newstar() for the file format
+    (hdr,sources)=LSM_parsers.read_newstar(infile_name,ignore_pol=ignore_pol,
+                      only_cleancomp=only_cleancomp,no_cleancomp=no_cleancomp)
+    self.add_sources(sources)
     self.setNodeScope(ns)
     self.setFileName(infile_name+'.lsm')
     
     if verbose==1:
-      print "Read %d sources from NewStar file %s created %s:%s"%(nsources,infile_name,crdate,crtime)
+      print "Read %d sources from NewStar file %s created %s:%s"%(hdr['nsources'],infile_name,hdr['crdate'],hdr['crtime'])
 
 
  ## build from a text file of clean components
@@ -1863,6 +1979,7 @@ class LSM:
  
   # read each source and insert to LSM
   kk=0
+  self.beginBulkLoad()
   for eachline in all:
    v=pp.search(eachline)
    if v!=None:
@@ -1887,6 +2004,7 @@ class LSM:
      sixpack=my_sixpack,
      ra=source_RA, dec=source_Dec)
  
+  self.endBulkLoad()
   self.setNodeScope(ns)
   self.setFileName(infile_name)
 
@@ -1902,6 +2020,7 @@ class LSM:
   infile.close()
 
   kk=0
+  self.beginBulkLoad()
   for eachline in all:
    ff = re.split('\s+',eachline);
    if len(ff) >= 11:
@@ -1932,6 +2051,7 @@ class LSM:
      sixpack=my_sixpack,
      ra=source_RA, dec=source_Dec)
  
+  self.endBulkLoad()
   self.setNodeScope(ns)
   self.setFileName(infile_name)
   
@@ -1985,6 +2105,7 @@ class LSM:
 
 
   kk=0
+  self.beginBulkLoad()
   for eachline in all:
    print 'eachline is ', eachline
    v=pp.search(eachline)
@@ -2046,6 +2167,7 @@ class LSM:
      sixpack=my_sixpack,
      ra=source_RA, dec=source_Dec)
  
+  self.endBulkLoad()
   self.setNodeScope(ns)
   self.setFileName(infile_name)
 
@@ -2053,75 +2175,7 @@ class LSM:
  ## format:
  ## NAME RA(hours, min, sec) DEC(degrees, min, sec) sI sQ sU sV SI RM eX eY eP f0(optional)
  def build_from_extlist(self,infile_name,ns,ignore_pol=False,f0=None):
-  
-
-  from string import split, strip
-  print 'should be reading ',infile_name
-  infile=open(infile_name,'r')
-  all=infile.readlines()
-  infile.close()
-
-  kk=0
-  for eachline in all:
-   if True:
-    info = split(strip(eachline))
-    print 'info is ', info
-    #### if we have negative RA, we have to subtract min,sec!!
-    source_RA=float(info[1])
-    if source_RA<0:
-      source_RA=float(info[1])-(float(info[3])/60.0+float(info[2]))/60.0
-    else:
-      source_RA=float(info[1])+(float(info[3])/60.0+float(info[2]))/60.0
-    source_RA*=math.pi/12.0
-    #### if we have negative dec, we have to subtract min,sec!!
-    source_Dec=float(info[4])
-    if source_Dec<0:
-      source_Dec=float(info[4])-(float(info[6])/60.0+float(info[5]))/60.0
-    else:
-      source_Dec=float(info[4])+(float(info[6])/60.0+float(info[5]))/60.0
-    source_Dec*=math.pi/180.0
-    print 'source pos ', source_RA, source_Dec
-
-    sI=float(info[7])
-    #convert to percentages
-    if (sI > 0):
-     sQ=float(info[8])
-     sU=float(info[9])
-     sV=float(info[10])
-    else:
-     sQ=sU=sV=0
-
-    SI=eval(info[11])
-    RM=eval(info[12])
-    eX=eval(info[13])
-    eY=eval(info[14])
-    eP=eval(info[15])
-
-    if (eX==0 and eY==0 and eP==0):
-     s=Source(info[0])
-    else:
-     s=Source(info[0], major=eX, minor=eY, pangle=eP)
-
-    kk=kk+1
-
-    print 'extlist parms ', sI,sQ,sU,sV,SI,RM;
-    freq0 = info[16];
-    freq0 = (freq0 and eval(freq0)) or f0 or 1e6; 
-    print 'sI, sQ, sU, sV, RM, ref freq', sI, sQ, sU, sV, RM, freq0
-    if (ignore_pol==True or (sQ==0 and sU==0 and sV==0 and RM==0)):
-     my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, SI=SI, f0=freq0, RA=source_RA, Dec=source_Dec,trace=0)
-    elif (SI==0 and RM==0):
-     my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,stokesQ=sQ, stokesU=sU, stokesV=sV,trace=0)
-    elif (SI==0):
-     my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,stokesQ=sQ, stokesU=sU, stokesV=sV, RM=RM, trace=0)
-    else :
-     my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, f0=freq0,RA=source_RA, Dec=source_Dec,stokesQ=sQ, stokesU=sU, stokesV=sV, SI=SI, RM=RM, trace=0)
- 
-   # first compose the sixpack before giving it to the LSM
-    self.add_source(s,brightness=eval(info[7]),
-     sixpack=my_sixpack,
-     ra=source_RA, dec=source_Dec)
- 
+  self.add_sources(LSM_parsers.read_extlist(infile_name,ignore_pol=ignore_pol,f0=f0))
   self.setNodeScope(ns)
   self.setFileName(infile_name)
 
@@ -2274,67 +2328,7 @@ class LSM:
  ## format:
  ## 3CR RA1950 (h min sec)   e_RAs DE1950 (d min sec)  e_DEm S178MHz n_S178MHz l_Diam  Diam  x_Diam
  def build_from_vizier(self,infile_name,ns,f0=None):
-  infile=open(infile_name,'r')
-  all=infile.readlines()
-  infile.close()
-
-  # regexp pattern
-  pp=re.compile(r"""
-   ^\s*(?P<col1>[A-Za-z0-9]*(.)?[A-Za-z0-9]+)  # column 1 name: a string or number
-   \s+             # skip white space
-   (?P<col2>(-)?\d+(\.\d+)?)   # RA angle - hours 
-   \s+             # skip white space
-   (?P<col3>(-)?\d+(\.\d+)?)   # RA angle - min 
-   \s*             # skip white space
-   (?P<col4>(-)?\d+(\.\d+)?)   # RA angle - sec 
-   \s*             # skip white space
-   (?P<col5>(-)?\d+(\.\d+)?)   # eRA arcmin
-   \s*             # skip white space
-   (?P<col6>[+|-]?\d+(\.\d+)?)   # Dec angle - degrees
-   \s*             # skip white space
-   (?P<col7>(-)?\d+(\.\d+)?)   # Dec angle - min
-   \s*             # skip white space
-   (?P<col8>(-)?\d+(\.\d+)?)   # Dec angle - sec 
-   \s*             # skip white space
-   (?P<col9>(-)?\d+(\.\d+)?)   # eDec arcmin
-   \s*             # skip white space
-   (?P<col10>(-)?\d+(\.\d+)?)   # Stokes I - Flux (Jy)
-   \s*             # skip white space
-   (?P<col11>[-+]?(\d+(\.\d*)?|\d*\.\d+)([eE][-+]?\d+)?)  # Spectral index
-   \s*.\s*""",re.VERBOSE) # ignore the rest
-
-
-  kk=0
-  for eachline in all:
-   v=pp.search(eachline)
-   if v!=None:
-     s=Source(v.group('col1'))
-     source_RA=float(v.group('col2'))+(float(v.group('col4'))/60.0+float(v.group('col3')))/60.0
-     source_RA*=math.pi/12.0
-     source_Dec=float(v.group('col6'))+(float(v.group('col8'))/60.0+float(v.group('col7')))/60.0
-     source_Dec*=math.pi/180.0
-
-     sI=eval(v.group('col10'))
-
-     SI=eval(v.group('col11'))
-
-     s=Source(v.group('col1'))
-
-     kk=kk+1
-
-     #print sI,sQ,sU,sV
-     if f0==None:
-      freq0=1e6
-     else:
-      freq0=f0
-     my_sixpack=LSM_Sixpack.newstar_source(ns,punit=s.name,I0=sI, SI=SI, f0=freq0, RA=source_RA, Dec=source_Dec,trace=0)
- 
-     # first compose the sixpack before giving it to the LSM
-     SourceRoot=my_sixpack.sixpack(ns)
-     self.add_source(s,brightness=eval(v.group('col9')),
-       sixpack=my_sixpack,
-       ra=source_RA, dec=source_Dec)
- 
+  self.add_sources(LSM_parsers.read_vizier(infile_name,f0=f0))
   self.setNodeScope(ns)
   self.setFileName(infile_name)
 
@@ -2377,6 +2371,7 @@ class LSM:
    \s+             # skip white space
    (?P<col14>\d+(\.\d+)?)   # F_peak
    \s*.\s*""",re.VERBOSE) # ignore the rest
+  self.beginBulkLoad()
   for eachline in all:
    v=pp.search(eachline)
    if v!=None:
@@ -2402,6 +2397,7 @@ class LSM:
        sixpack=my_sixpack,
        ra=source_RA, dec=source_Dec)
  
+  self.endBulkLoad()
   self.setNodeScope(ns)
   self.setFileName(infile_name)
 
@@ -0,0 +1,397 @@
+#!/usr/bin/python
+#
+# The Local Sky Model (LSM)
+#
+# The binary file format of the LSM, as written by LSM.save() and read
+# by LSM.load() and LSM.merge(). Older versions of the LSM saved pickled
+# LSM objects instead, which LSM.load() still reads (see also
+# lsm_migrate.py to convert them).
+#
+
+
+#% $Id$
+
+#
+# Copyright (C) 2002-2007
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# and The MeqTree Foundation
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands, seg@astron.nl
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+import os
+import struct
+import base64
+import json
+import numpy
+
+from common_utils import *
+
+# A file starts with an 8-byte magic string, followed by the format
+# version and a (reserved) flags word. After that come chunks, each of
+# which is a 4-byte tag, the length of its payload and the payload. The
+# last chunk has the tag END_TAG. All integers are little-endian.
+#
+# Readers skip chunks with tags they do not know, so chunks can be
+# added without changing FORMAT_VERSION; changes that older readers
+# cannot ignore must increment it. An LSM file has these chunks:
+#  META: JSON dict of LSM attributes (see LSM.save())
+#  SRCS: columns of the source table
+#  PUNT: columns of the p-Unit table
+#  SPND: JSON dict of p-Unit name -> sixpack, for sixpacks made of nodes
+#  NODE: columns of node definitions (see NodeDefs)
+MAGIC='\x89LSM\r\n\x1a\n'
+FORMAT_VERSION=1
+END_TAG='END '
+
+_HEADER=struct.Struct('<8sII')
+_CHUNK=struct.Struct('<4sQ')
+
+class LSMFormatError(IOError):
+ pass
+
+# return True if the file is in the binary format (rather than a pickle)
+def is_lsm_file(filename):
+ f=open(filename,'rb')
+ try:
+  return f.read(len(MAGIC))==MAGIC
+ finally:
+  f.close()
+
+###############################################
+# Columns are encoded as a uint32 header length and a JSON header that
+# describes them, followed by the data of each column, 8-byte aligned.
+# A column is either a NumPy array of numbers, or a list of strings,
+# which is stored as n+1 int64 offsets into the concatenated strings.
+# columns: list of (name,array or list of strings)
+def encode_columns(columns):
+ descr=[]
+ data=[]
+ offset=0
+ for name,value in columns:
+  if isinstance(value,numpy.ndarray):
+   value=numpy.ascontiguousarray(value,value.dtype.newbyteorder('<'))
+   buf=value.tostring()
+   descr.append(dict(name=name,dtype=value.dtype.str,shape=value.shape,offset=offset,nbytes=len(buf)))
+  else:
+   strings=[ isinstance(x,unicode) and x.encode('utf-8') or x for x in value ]
+   offsets=numpy.zeros(len(strings)+1,'<i8')
+   numpy.cumsum(map(len,strings),out=offsets[1:])
+   buf=offsets.tostring()+''.join(strings)
+   descr.append(dict(name=name,dtype='str',count=len(strings),offset=offset,nbytes=len(buf)))
+  data.append(buf)
+  data.append('\0'*(-len(buf)%8))
+  offset+=len(buf)+(-len(buf)%8)
+ header=json.dumps(descr)
+ header+=' '*(-(len(header)+4)%8)
+ return struct.pack('<I',len(header))+header+''.join(data)
+
+# decode columns, returns dict of name -> array or list of strings.
+# Arrays are read-only views of the payload
+def decode_columns(payload):
+ try:
+  (hlen,)=struct.unpack_from('<I',payload,0)
+  descr=json.loads(payload[4:4+hlen])
+ except (struct.error,ValueError),err:
+  raise LSMFormatError("bad column header: %s"%err)
+ base=4+hlen
+ columns={}
+ for d in descr:
+  start=base+d['offset']
+  end=start+d['nbytes']
+  if end>len(payload):
+   raise LSMFormatError("column %s is truncated"%d['name'])
+  if d['dtype']=='str':
+   n=d['count']
+   offsets=numpy.frombuffer(payload,'<i8',n+1,start).tolist()
+   blob=payload[start+8*(n+1):end]
+   value=[ blob[i0:i1] for i0,i1 in zip(offsets[:-1],offsets[1:]) ]
+  else:
+   dtype=numpy.dtype(str(d['dtype']))
+   # only plain numbers, never objects
+   if dtype.kind not in 'biufc':
+    raise LSMFormatError("column %s has unsupported type %s"%(d['name'],dtype))
+   shape=tuple(d['shape'])
+   value=numpy.frombuffer(payload,dtype,int(numpy.prod(shape)),start).reshape(shape)
+  columns[str(d['name'])]=value
+ return columns
+
+###############################################
+# Values in node initrecs (numbers, strings, lists, records, funklets
+# and arrays) are stored as JSON. Values that JSON cannot represent are
+# stored as dicts with a single '__<type>__' key. Records are restored by
+# class name from Timba.dmi, and arrays must hold numbers, so reading a
+# file never runs code from it (unlike unpickling).
+def encode_value(x):
+ if x is None or isinstance(x,(bool,int,long,float,str,unicode)):
+  return x
+ if isinstance(x,numpy.ndarray):
+  if x.dtype.kind not in 'biufc':
+   raise TypeError,"cannot save array of %s"%x.dtype
+  x=numpy.ascontiguousarray(x,x.dtype.newbyteorder('<'))
+  return {'__array__':[x.dtype.str,x.shape,base64.b64encode(x.tostring())]}
+ if isinstance(x,numpy.generic):
+  return encode_value(x.item())
+ if isinstance(x,complex):
+  return {'__complex__':[x.real,x.imag]}
+ if isinstance(x,dict):
+  items=dict([ (str(key),encode_value(value)) for key,value in x.iteritems() ])
+  if type(x) is not dict:
+   return {'__record__':[type(x).__name__,items]}
+  if len([ key for key in items if key.startswith('__') ]):
+   return {'__dict__':items}
+  return items
+ if isinstance(x,(list,tuple)):
+  items=map(encode_value,x)
+  if type(x) is list:
+   return items
+  if type(x) is tuple:
+   return {'__tuple__':items}
+  return {'__seq__':[type(x).__name__,items]}
+ raise TypeError,"cannot save value of type %s"%type(x).__name__
+
+def decode_value(x):
+ if isinstance(x,unicode):
+  return x.encode('utf-8')
+ if isinstance(x,list):
+  return map(decode_value,x)
+ if not isinstance(x,dict):
+  return x
+ if len(x)==1:
+  (key,value)=x.items()[0]
+  if key=='__array__':
+   (dtype,shape,data)=value
+   dtype=numpy.dtype(str(dtype))
+   if dtype.kind not in 'biufc':
+    raise LSMFormatError("unsupported array type %s"%dtype)
+   return numpy.fromstring(base64.b64decode(data),dtype).reshape(shape)
+  elif key=='__complex__':
+   return complex(*value)
+  elif key=='__dict__':
+   return dict([ (str(kk),decode_value(vv)) for kk,vv in value.iteritems() ])
+  elif key=='__tuple__':
+   return tuple(map(decode_value,value))
+  elif key=='__record__':
+   rec=_dmi_class(value[0],dict)()
+   for kk,vv in value[1].iteritems():
+    rec[str(kk)]=decode_value(vv)
+   return rec
+  elif key=='__seq__':
+   return _dmi_class(value[0],tuple)(map(decode_value,value[1]))
+ return dict([ (str(key),decode_value(value)) for key,value in x.iteritems() ])
+
+# return the class of the given name from Timba.dmi, if it is derived
+# from base, else base
+def _dmi_class(name,base):
+ try:
+  from Timba import dmi
+ except ImportError:
+  return base
+ cls=getattr(dmi,str(name),None)
+ if isinstance(cls,type) and issubclass(cls,base):
+  return cls
+ return base
+
+###############################################
+class NodeDefs:
+ """Definitions of the nodes of a forest, as stored in LSM files: for
+ each node, its name, class name, children and initrec, as recorded by
+ traverse() in common_utils. NodeDefs[name] returns them as a dict, in
+ the same form as traverse() does, decoding the initrec only then.
+ Nodes are created in a NodeScope by resolve(), which creates just the
+ subtree of the given node, so that loading an LSM creates no nodes
+ until a p-Unit that needs them is used.
+ Attributes are
+  _index: index of each node name
+  _names,_classes,_children: name, class name and list of children
+     of each node
+  _initrecs: initrec of each node, JSON-encoded (see encode_value())
+  _stubs: node stubs created by resolve()
+ """
+
+ # Constructor
+ def __init__(self):
+  self._index={}
+  self._names=[]
+  self._classes=[]
+  self._children=[]
+  self._initrecs=[]
+  self._stubs={}
+
+ def __len__(self):
+  return len(self._names)
+
+ def has_key(self,name):
+  return self._index.has_key(name)
+ __contains__=has_key
+
+ def keys(self):
+  return list(self._names)
+
+ def __getitem__(self,name):
+  i=self._index[name]
+  return {'name':name,'classname':self._classes[i],'children':list(self._children[i]),
+     'initrec':decode_value(json.loads(self._initrecs[i]))}
+
+ # add a node (ignored if already present). initrec is JSON-encoded
+ def _append(self,name,classname,children,initrec):
+  if self._index.has_key(name):
+   return
+  self._index[name]=len(self._names)
+  self._names.append(name)
+  self._classes.append(classname)
+  self._children.append(list(children))
+  self._initrecs.append(initrec)
+
+ # add a dict of node definitions, as made by traverse()
+ def add_dict(self,node_dict):
+  for name,rec in node_dict.iteritems():
+   self._append(name,rec['classname'],rec['children'],json.dumps(encode_value(rec['initrec'])))
+
+ # add the subtree of a node stub. If subscope is given, node names
+ # are stripped of it
+ def add_tree(self,root,subscope=None):
+  node_dict={}
+  traverse(root,node_dict,subscope)
+  self.add_dict(node_dict)
+
+ # add the subtree of the named node from another NodeDefs
+ def copy_tree(self,other,name):
+  stack=[name]
+  while stack:
+   name=stack.pop()
+   if self._index.has_key(name) or not other._index.has_key(name):
+    continue
+   i=other._index[name]
+   self._append(name,other._classes[i],other._children[i],other._initrecs[i])
+   stack+=other._children[i]
+
+ # return the stub of the named node, creating it and its subtree in
+ # the given NodeScope if this has not been done yet
+ def resolve(self,name,ns):
+  if not self._stubs.has_key(name):
+   self._stubs[name]=create_node_stub(self,self._stubs,ns,name)
+  return self._stubs[name]
+
+ # return list of (name,column) for encode_columns()
+ def columns(self):
+  return [('name',self._names),('class',self._classes),
+     ('nchildren',numpy.array(map(len,self._children),numpy.int32)),
+     ('children',[ child for ch in self._children for child in ch ]),('initrec',self._initrecs)]
+
+# make NodeDefs from a dict of columns, as returned by decode_columns()
+def node_defs_from_columns(columns):
+ nodes=NodeDefs()
+ children=columns['children']
+ i0=0
+ for name,classname,nch,initrec in zip(columns['name'],columns['class'],
+                                   columns['nchildren'].tolist(),columns['initrec']):
+  nodes._append(name,classname,children[i0:i0+nch],initrec)
+  i0+=nch
+ return nodes
+
+###############################################
+# write an LSM file. meta and sixpacks are dicts (see above), sources
+# and punits are lists of (name,column), nodes a NodeDefs. The file is
+# written under a temporary name first, so that an existing file is
+# only replaced once the new one is complete
+def write(filename,meta,sources,punits,sixpacks,nodes):
+ tmpname=filename+'.tmp'
+ f=open(tmpname,'wb')
+ try:
+  f.write(_HEADER.pack(MAGIC,FORMAT_VERSION,0))
+  for tag,payload in [('META',json.dumps(meta)),('SRCS',encode_columns(sources)),
+                      ('PUNT',encode_columns(punits)),('SPND',json.dumps(sixpacks)),
+                      ('NODE',encode_columns(nodes.columns())),(END_TAG,'')]:
+   f.write(_CHUNK.pack(tag,len(payload)))
+   f.write(payload)
+  f.close()
+  os.rename(tmpname,filename)
+ except:
+  f.close()
+  if os.path.exists(tmpname):
+   os.remove(tmpname)
+  raise
+
+###############################################
+class LSMFile:
+ """An LSM file opened for reading. The header and the chunk index
+ are read when it is opened, and chunks when they are asked for.
+ Attributes are
+  filename: name of the file
+  version: format version of the file
+  _chunks: dict of tag -> (offset,length) of each chunk
+ """
+
+ # Constructor
+ def __init__(self,filename):
+  self.filename=filename
+  self._chunks={}
+  size=os.path.getsize(filename)
+  f=open(filename,'rb')
+  try:
+   header=f.read(_HEADER.size)
+   if len(header)<_HEADER.size or header[:len(MAGIC)]!=MAGIC:
+    raise LSMFormatError("%s is not an LSM file"%filename)
+   (magic,self.version,flags)=_HEADER.unpack(header)
+   if self.version>FORMAT_VERSION:
+    raise LSMFormatError("%s has format version %d, only versions up to %d are supported"%(filename,self.version,FORMAT_VERSION))
+   while True:
+    head=f.read(_CHUNK.size)
+    if len(head)<_CHUNK.size:
+     raise LSMFormatError("%s is truncated"%filename)
+    (tag,length)=_CHUNK.unpack(head)
+    if tag==END_TAG:
+     break
+    if f.tell()+length>size:
+     raise LSMFormatError("%s is truncated"%filename)
+    self._chunks[tag]=(f.tell(),length)
+    f.seek(length,1)
+  finally:
+   f.close()
+
+ def has_chunk(self,tag):
+  return self._chunks.has_key(tag)
+
+ # return the payload of a chunk, or None if the file has no such chunk
+ def read(self,tag):
+  if not self._chunks.has_key(tag):
+   return None
+  (offset,length)=self._chunks[tag]
+  f=open(self.filename,'rb')
+  try:
+   f.seek(offset)
+   return f.read(length)
+  finally:
+   f.close()
+
+ def json(self,tag,default=None):
+  payload=self.read(tag)
+  if payload is None:
+   return default
+  return decode_value(json.loads(payload))
+
+ # return dict of columns, or an empty dict
+ def columns(self,tag):
+  payload=self.read(tag)
+  if payload is None:
+   return {}
+  return decode_columns(payload)
+
+ def nodes(self):
+  if not self.has_chunk('NODE'):
+   return NodeDefs()
+  return node_defs_from_columns(self.columns('NODE'))
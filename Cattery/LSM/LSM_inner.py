@@ -31,6 +31,9 @@
 #
 
 import sys,time
+import bisect
+import math
+import numpy
 import pickle # for serialization and file io
 # from Dummy import *
 
@@ -43,6 +46,13 @@ from Timba.Meq import meq
 from Timba.Apps import app_nogui
 from Timba.Apps import assayer
 
+# a k-d tree speeds up repeated cone and nearest-neighbour searches
+# in the SpatialIndex, but is not essential
+try:
+ from scipy.spatial import cKDTree
+except ImportError:
+ cKDTree=None
+
 #############################################
 class Source:
  """Source object in source table
@@ -417,3 +427,567 @@ class TemTree:
   self.id=id 
 
 #########################################################################
+
+###############################################
+class BrightnessIndex:
+ """p-Unit names sorted by decreasing brightness, as used by the LSM
+ Attributes are
+  _keys: sort keys (negated brightness), in ascending order
+  _names: p-Unit names, in the same order as _keys
+  _key: sort key of each p-Unit name in the index
+  _pending: list of (key,name) inserted by a bulk load, not yet sorted,
+     or None if not doing a bulk load
+
+ Insertion and removal find their position by bisection. A p-Unit is
+ inserted after any others of the same brightness, so equally bright
+ p-Units stay in the order they were inserted. During a bulk load
+ (begin_bulk()...end_bulk()), insertions are appended to a pending
+ list, and are sorted once, when the bulk load ends or when the index
+ is next queried, whichever comes first.
+ """
+
+ # Constructor
+ # pairs: optional list of (name,brightness) to load
+ def __init__(self,pairs=()):
+  self._keys=[]
+  self._names=[]
+  self._key={}
+  self._pending=None
+  if pairs:
+   self.begin_bulk()
+   for name,brightness in pairs:
+    self.insert(name,brightness)
+   self.end_bulk()
+
+ # insert a p-Unit name with the given brightness
+ # returns False if the name is already present (and ignores it)
+ def insert(self,name,brightness):
+  if self._key.has_key(name):
+   return False
+  key=-brightness
+  self._key[name]=key
+  if self._pending is not None:
+   self._pending.append((key,name))
+  else:
+   i=bisect.bisect_right(self._keys,key)
+   self._keys.insert(i,key)
+   self._names.insert(i,name)
+  return True
+
+ # insert many p-Unit names with the given brightnesses at once (as a
+ # bulk load). Names already present are ignored
+ def insert_many(self,names,brightness):
+  pairs=[ (-b,name) for name,b in zip(names,brightness) if not self._key.has_key(name) ]
+  self._key.update([ (name,key) for key,name in pairs ])
+  if self._pending is not None:
+   self._pending+=pairs
+  else:
+   self._pending=pairs
+   self.end_bulk()
+
+ # remove a p-Unit name, raises ValueError if not present
+ # (as list.remove does)
+ def remove(self,name):
+  if not self._key.has_key(name):
+   raise ValueError,"BrightnessIndex.remove(x): x not in index"
+  self._flush()
+  key=self._key.pop(name)
+  # look for the name among the p-Units of the same brightness
+  i0=bisect.bisect_left(self._keys,key)
+  i1=bisect.bisect_right(self._keys,key)
+  i=i0+self._names[i0:i1].index(name)
+  del self._keys[i]
+  del self._names[i]
+
+ # start a bulk load: insertions are sorted only once, at the end
+ def begin_bulk(self):
+  if self._pending is None:
+   self._pending=[]
+
+ # end a bulk load, sorting any pending insertions into the index
+ def end_bulk(self):
+  self._flush()
+  self._pending=None
+
+ # sort pending insertions into the index. The sort is stable, and
+ # existing entries go first, so ties come out in insertion order
+ def _flush(self):
+  if self._pending:
+   merged=zip(self._keys,self._names)+self._pending
+   merged.sort(key=lambda x:x[0])
+   self._keys=[ x[0] for x in merged ]
+   self._names=[ x[1] for x in merged ]
+   self._pending=[]
+
+ # return the names of the count brightest p-Units
+ def brightest(self,count):
+  self._flush()
+  return self._names[:max(count,0)]
+
+ # return the names of the p-Units with min_bright<=brightness<=max_bright,
+ # brightest first. Either limit may be None
+ def brightness_range(self,min_bright=None,max_bright=None):
+  self._flush()
+  i0=0
+  i1=len(self._keys)
+  if max_bright is not None:
+   i0=bisect.bisect_left(self._keys,-max_bright)
+  if min_bright is not None:
+   i1=bisect.bisect_right(self._keys,-min_bright)
+  return self._names[i0:i1]
+
+ # return the brightness a p-Unit was inserted with
+ def getBrightness(self,name):
+  return -self._key[name]
+
+ def __len__(self):
+  return len(self._key)
+
+ def __contains__(self,name):
+  return self._key.has_key(name)
+
+ def __iter__(self):
+  self._flush()
+  return iter(self._names)
+
+ def __getitem__(self,i):
+  self._flush()
+  return self._names[i]
+
+###############################################
+class SpatialIndex:
+ """RA/Dec positions of p-Units, as used by the LSM
+ Attributes are
+  _names: p-Unit name of each row (None for removed rows)
+  _row: row of each p-Unit name
+  _ra,_dec: positions (radians), one per row
+  _xyz: positions as unit vectors, one row per row
+  _type: p-Unit type (POINT_TYPE, etc.)
+  _top: True if the p-Unit is listed at the top level of the LSM,
+     i.e. it is not a point source that belongs to a patch
+  _valid: False for removed rows
+  _nrows: number of rows in use, including removed rows
+  _tree: k-d tree of _xyz, built when first needed, or None
+
+ Rows are stored in NumPy arrays that grow by doubling, so all queries
+ are vectorized. Removed rows are dropped when they make up more than
+ half of the rows. Cone and nearest-neighbour searches use a k-d tree
+ on the unit vectors if scipy is available, and a vectorized scan over
+ all rows otherwise. Query results can be restricted to the top-level
+ p-Units (top=True), and to a list of p-Unit types (types=[...]).
+ """
+
+ # Constructor
+ def __init__(self):
+  self._names=[]
+  self._row={}
+  self._nrows=0
+  self._ra=numpy.zeros(0)
+  self._dec=numpy.zeros(0)
+  self._xyz=numpy.zeros((0,3))
+  self._type=numpy.zeros(0,int)
+  self._top=numpy.zeros(0,bool)
+  self._valid=numpy.zeros(0,bool)
+  self._tree=None
+
+ # the k-d tree is rebuilt after loading rather than pickled
+ def __getstate__(self):
+  state=self.__dict__.copy()
+  state['_tree']=None
+  return state
+
+ # return unit vector(s) for the given RA,Dec
+ @staticmethod
+ def unit_vector(ra,dec):
+  ra=numpy.asarray(ra,float)
+  dec=numpy.asarray(dec,float)
+  return numpy.array([numpy.cos(dec)*numpy.cos(ra),numpy.cos(dec)*numpy.sin(ra),numpy.sin(dec)]).T
+
+ # insert (or move, if already present) a p-Unit
+ def insert(self,name,ra,dec,type=POINT_TYPE,top=True):
+  row=self._row.get(name)
+  if row is None:
+   if self._nrows==len(self._ra):
+    self._resize(max(2*self._nrows,16))
+   row=self._row[name]=self._nrows
+   self._names.append(name)
+   self._nrows+=1
+  self._ra[row]=ra
+  self._dec[row]=dec
+  self._xyz[row]=self.unit_vector(ra,dec)
+  self._type[row]=type
+  self._top[row]=top
+  self._valid[row]=True
+  self._tree=None
+
+ # insert many p-Units at once, which must not be present yet
+ def insert_many(self,names,ra,dec,types,top):
+  n=len(names)
+  if self._nrows+n>len(self._ra):
+   self._resize(max(2*self._nrows,self._nrows+n,16))
+  rows=numpy.arange(self._nrows,self._nrows+n)
+  self._row.update(zip(names,rows.tolist()))
+  self._names+=names
+  self._nrows+=n
+  self._ra[rows]=ra
+  self._dec[rows]=dec
+  self._xyz[rows]=self.unit_vector(ra,dec)
+  self._type[rows]=types
+  self._top[rows]=top
+  self._valid[rows]=True
+  self._tree=None
+
+ # change the position of a p-Unit
+ def move(self,name,ra,dec):
+  row=self._row[name]
+  if self._ra[row]!=ra or self._dec[row]!=dec:
+   self._ra[row]=ra
+   self._dec[row]=dec
+   self._xyz[row]=self.unit_vector(ra,dec)
+   self._tree=None
+
+ # change the positions of many p-Units at once
+ def move_many(self,names,ra,dec):
+  rows=numpy.array([ self._row[name] for name in names ],int)
+  self._ra[rows]=ra
+  self._dec[rows]=dec
+  self._xyz[rows]=self.unit_vector(ra,dec)
+  self._tree=None
+
+ # mark a p-Unit as top-level or not
+ def setTop(self,name,top):
+  self._top[self._row[name]]=top
+
+ # remove a p-Unit
+ def remove(self,name):
+  row=self._row.pop(name)
+  self._names[row]=None
+  self._valid[row]=False
+  if len(self._row)<self._nrows/2:
+   self._compact()
+  self._tree=None
+
+ def __len__(self):
+  return len(self._row)
+
+ def __contains__(self,name):
+  return self._row.has_key(name)
+
+ def _resize(self,nrows):
+  for attr in '_ra','_dec','_xyz','_type','_top','_valid':
+   old=getattr(self,attr)
+   new=numpy.zeros((nrows,)+old.shape[1:],old.dtype)
+   new[:self._nrows]=old[:self._nrows]
+   setattr(self,attr,new)
+
+ # drop removed rows
+ def _compact(self):
+  rows=numpy.where(self._valid[:self._nrows])[0]
+  for attr in '_ra','_dec','_xyz','_type','_top','_valid':
+   setattr(self,attr,getattr(self,attr)[rows])
+  self._names=[ self._names[i] for i in rows ]
+  self._row=dict([ (name,i) for i,name in enumerate(self._names) ])
+  self._nrows=len(self._names)
+
+ # return boolean mask of rows in use that pass the top/types selection
+ def _mask(self,top=False,types=None):
+  n=self._nrows
+  mask=self._valid[:n].copy()
+  if top:
+   mask&=self._top[:n]
+  if types is not None:
+   mask&=numpy.in1d(self._type[:n],list(types))
+  return mask
+
+ def _get_tree(self):
+  if self._tree is None and cKDTree is not None and self._nrows:
+   self._tree=cKDTree(self._xyz[:self._nrows])
+  return self._tree
+
+ # return the angular distance (radians) of the given rows from unit vector v0
+ def _distance(self,rows,v0):
+  return numpy.arccos(numpy.clip(numpy.dot(self._xyz[rows],v0),-1,1))
+
+ # return the names of the given rows, sorted by the given keys
+ def _sorted_names(self,rows,keys=None):
+  if keys is not None:
+   rows=rows[numpy.argsort(keys,kind='mergesort')]
+  return [ self._names[i] for i in rows ]
+
+ # return names of the p-Units within radius (radians) of ra0,dec0,
+ # nearest first
+ def cone(self,ra0,dec0,radius,top=False,types=None):
+  v0=self.unit_vector(ra0,dec0)
+  mask=self._mask(top,types)
+  tree=self._get_tree()
+  if tree is not None:
+   # chord length corresponding to the radius
+   rows=numpy.array(tree.query_ball_point(v0,2*math.sin(min(radius,math.pi)/2)*(1+1e-12)),int)
+  else:
+   rows=numpy.arange(self._nrows)
+  rows=rows[mask[rows]]
+  dist=self._distance(rows,v0)
+  inside=dist<=radius
+  return self._sorted_names(rows[inside],dist[inside])
+
+ # return names of the count p-Units nearest to ra0,dec0, nearest first
+ def nearest(self,ra0,dec0,count=1,top=False,types=None):
+  v0=self.unit_vector(ra0,dec0)
+  mask=self._mask(top,types)
+  nsel=mask.sum()
+  count=min(count,nsel)
+  if count<=0:
+   return []
+  # the tree only pays off when asking for a few neighbours
+  tree=self._get_tree() if count*4<nsel else None
+  if tree is not None:
+   # ask the tree for more neighbours until enough of them are selected
+   k=count
+   while True:
+    rows=numpy.atleast_1d(tree.query(v0,k)[1])
+    rows=rows[rows<self._nrows]
+    rows=rows[mask[rows]]
+    if len(rows)>=count or k>=self._nrows:
+     break
+    k=min(2*k,self._nrows)
+   rows=rows[:count]
+  else:
+   rows=numpy.arange(self._nrows)[mask]
+   dist=self._distance(rows,v0)
+   if count<len(rows):
+    part=numpy.argpartition(dist,count-1)[:count]
+    rows,dist=rows[part],dist[part]
+   rows=rows[numpy.argsort(dist,kind='mergesort')]
+  return self._sorted_names(rows,self._distance(rows,v0))
+
+ # return names of the p-Units with ra_min<=RA<=ra_max and
+ # dec_min<=Dec<=dec_max. If ra_min>ra_max, the box wraps around
+ # RA=2pi, and RA is compared modulo 2pi
+ def box(self,ra_min,ra_max,dec_min,dec_max,top=False,types=None):
+  n=self._nrows
+  mask=self._mask(top,types)
+  ra=self._ra[:n]
+  dec=self._dec[:n]
+  mask&=(dec>=dec_min)&(dec<=dec_max)
+  if ra_min<=ra_max:
+   mask&=(ra>=ra_min)&(ra<=ra_max)
+  else:
+   ra=numpy.mod(ra,2*math.pi)
+   mask&=(ra>=math.fmod(ra_min,2*math.pi))|(ra<=math.fmod(ra_max,2*math.pi))
+  return self._sorted_names(numpy.where(mask)[0])
+
+ # bin p-Units into the cells of a grid: x_array and y_array are sorted
+ # RA and Dec cell boundaries. Returns a dict of (i,j):[names], for
+ # x_array[i]<=RA<x_array[i+1] and y_array[j]<=Dec<y_array[j+1]. If a list
+ # of names is given, only those p-Units are binned, and names within each
+ # cell are in the same order
+ def grid(self,x_array,y_array,names=None,top=False,types=None):
+  if names is None:
+   rows=numpy.where(self._mask(top,types))[0]
+  else:
+   rows=numpy.array([ self._row[name] for name in names ],int)
+   rows=rows[self._mask(top,types)[rows]]
+  ii=numpy.searchsorted(x_array,self._ra[rows],side='right')-1
+  jj=numpy.searchsorted(y_array,self._dec[rows],side='right')-1
+  inside=(ii>=0)&(ii<len(x_array)-1)&(jj>=0)&(jj<len(y_array)-1)
+  bins={}
+  for i,j,row in zip(ii[inside],jj[inside],rows[inside]):
+   bins.setdefault((int(i),int(j)),[]).append(self._names[row])
+  return bins
+
+ # return names of the selected p-Units
+ def names(self,top=False,types=None):
+  return self._sorted_names(numpy.where(self._mask(top,types))[0])
+
+ # return [min_RA,max_RA,min_Dec,max_Dec] of the selected p-Units,
+ # or None if there are none
+ def bounds(self,top=False,types=None):
+  mask=self._mask(top,types)
+  if not mask.any():
+   return None
+  n=self._nrows
+  ra=self._ra[:n][mask]
+  dec=self._dec[:n][mask]
+  return [ra.min(),ra.max(),dec.min(),dec.max()]
+
+###############################################
+class SourceTable:
+ """Columnar storage of source parameters, as used by an LSM created
+ with columnar=True. Each source is a row, and each parameter a
+ contiguous NumPy array, so that bulk operations (transforms,
+ brightness limits, exports) are vector operations.
+ Attributes are
+  names: source name of each row
+  rows: row of each source name
+  nrows: number of rows in use
+  _columns: dict of column name -> array (grown by doubling)
+  _extra: dict of row -> dict of rarely used attributes (e.g. the
+     patch name, or the beam l,m), to keep rows small
+
+ Columns are
+  ra,dec: position (radians)
+  I,Q,U,V: Stokes parameters
+  SI,f0,RM: spectral index, reference frequency, rotation measure
+  eX,eY,eP: extent and position angle of gaussians
+  brightness: apparent brightness
+  FOV: FOV distance
+  type: POINT_TYPE or GAUSS_TYPE
+  cat: category
+ """
+ FLOAT_COLUMNS=('ra','dec','I','Q','U','V','SI','f0','RM','eX','eY','eP','brightness','FOV')
+ INT_COLUMNS=('type','cat')
+
+ # Constructor
+ def __init__(self):
+  self.names=[]
+  self.rows={}
+  self.nrows=0
+  self._columns={}
+  for col in self.FLOAT_COLUMNS:
+   self._columns[col]=numpy.zeros(0)
+  for col in self.INT_COLUMNS:
+   self._columns[col]=numpy.zeros(0,numpy.int16)
+  self._extra={}
+
+ # append a source, with the given column values (others are 0,
+ # and cat is 1). Returns its row
+ def append(self,name,**values):
+  if self.nrows==len(self._columns['ra']):
+   self._resize(max(2*self.nrows,16))
+  row=self.rows[name]=self.nrows
+  self.names.append(name)
+  self.nrows+=1
+  self._columns['cat'][row]=1
+  for col,value in values.iteritems():
+   self._columns[col][row]=value
+  return row
+
+ # append many sources at once, with the given columns (arrays of
+ # values, or single values). Returns their rows
+ def extend(self,names,**values):
+  n=len(names)
+  if self.nrows+n>len(self._columns['ra']):
+   self._resize(max(2*self.nrows,self.nrows+n,16))
+  rows=numpy.arange(self.nrows,self.nrows+n)
+  self.rows.update(zip(names,rows.tolist()))
+  self.names+=names
+  self.nrows+=n
+  self._columns['cat'][rows]=1
+  for col,value in values.iteritems():
+   self._columns[col][rows]=value
+  return rows
+
+ def _resize(self,nrows):
+  for col,old in self._columns.items():
+   new=numpy.zeros(nrows,old.dtype)
+   new[:self.nrows]=old[:self.nrows]
+   self._columns[col]=new
+
+ def __len__(self):
+  return self.nrows
+
+ # return a column (a view of the rows in use)
+ def __getitem__(self,col):
+  return self._columns[col][:self.nrows]
+
+ # return a value, as a Python scalar
+ def get(self,row,col):
+  return self._columns[col][row].item()
+
+ def set(self,row,col,value):
+  self._columns[col][row]=value
+
+ # rarely used attributes, stored per row in a dict
+ def get_extra(self,row,attr,default=None):
+  return self._extra.get(row,{}).get(attr,default)
+
+ def set_extra(self,row,attr,value):
+  self._extra.setdefault(row,{})[attr]=value
+
+###############################################
+class SourceView(object):
+ """A Source stored in a row of a SourceTable"""
+ __slots__=('name','_table','_row')
+
+ # Constructor
+ def __init__(self,name,table,row):
+  self.name=name
+  self._table=table
+  self._row=row
+
+ tableName='Table1'
+
+ def getType(self):
+  return self._table.get(self._row,'type')
+ treeType=getType
+
+ def extParms(self):
+  row=self._row
+  return (self._table.get(row,'eX'),self._table.get(row,'eY'),self._table.get(row,'eP'))
+
+ # return a plain Source with the same values, e.g. for saving
+ def toSource(self):
+  (eX,eY,eP)=self.extParms()
+  return Source(self.name,self.getType(),self.tableName,eX,eY,eP)
+
+ def __str__(self):
+   temp_str="Source name: "+self.name
+   temp_str+=" Template tree: "+str(self.getType())
+   temp_str+=" MeqParm Table: "+self.tableName
+   temp_str+=" Extended ?: "+str(self.extParms())
+   return temp_str
+
+###############################################
+class SpHView(object):
+ """Stands in for the sixpack helper (SpH) of a p-Unit stored in a
+ SourceTable. Values are static, i.e. they come from the table rather
+ than from the vellsets of a meqserver response.
+ """
+ __slots__=('_table','_row')
+
+ # Constructor
+ def __init__(self,table,row):
+  self._table=table
+  self._row=row
+
+ def getRA(self):
+  return self._table.get(self._row,'ra')
+ def getDec(self):
+  return self._table.get(self._row,'dec')
+ def set_staticRA(self,RA):
+  self._table.set(self._row,'ra',RA)
+ def set_staticDec(self,Dec):
+  self._table.set(self._row,'dec',Dec)
+ def getI(self):
+  return self._table.get(self._row,'I')
+ def getQ(self):
+  return self._table.get(self._row,'Q')
+ def getU(self):
+  return self._table.get(self._row,'U')
+ def getV(self):
+  return self._table.get(self._row,'V')
+
+ # type='A','I','Q','U','V'; f,t are ignored since values are static
+ def getValue(self,type,freq_index=0,time_index=0):
+  if type=='A':
+   type='I'
+  return self._table.get(self._row,type)
+ def getValueSize(self,type,freq_index=0,time_index=0):
+  return [1,1]
+
+ # nothing to update, or to link to
+ def updateValues(self,pname):
+  pass
+ def setRoot(self,root):
+  pass
+ def setLSM(self,lsm):
+  pass
+
+ def clone(self):
+  newsph=SpH(None)
+  newsph.static_RA=self.getRA()
+  newsph.static_Dec=self.getDec()
+  return newsph
+
+ def __str__(self):
+  return "SpH: static RA,Dec="+str((self.getRA(),self.getDec()))
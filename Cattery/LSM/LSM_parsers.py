@@ -0,0 +1,306 @@
+#!/usr/bin/python
+#
+# The Local Sky Model (LSM)
+#
+# Readers of the source lists that the LSM can be built from (see the
+# LSM.build_from_*() methods). Each reads a whole file at once, and
+# returns the sources as a NumPy record array (see make_sources()),
+# which LSM.add_sources() inserts in one go.
+#
+
+
+#% $Id$
+
+#
+# Copyright (C) 2002-2007
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# and The MeqTree Foundation
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands, seg@astron.nl
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+import re
+import math
+import struct
+import numpy
+
+from common_utils import *
+
+# fields of a source record, besides its name:
+#  ra,dec: position (radians)
+#  I,Q,U,V: Stokes parameters
+#  SI,f0,RM: spectral index, reference frequency, rotation measure
+#  eX,eY,eP: extent and position angle (gaussians, else 0)
+#  brightness: apparent brightness
+# and their values when not given (as for a Sixpack)
+SOURCE_FIELDS=('ra','dec','I','Q','U','V','SI','f0','RM','eX','eY','eP','brightness')
+SOURCE_DEFAULTS={'dec':math.pi/2,'I':1.0,'f0':1e6}
+
+# return a record array of sources with the given names, and columns
+# given as keyword arguments (arrays, or single values). Fields not
+# given get their defaults; columns that are not in SOURCE_FIELDS
+# (such as the l,m of NEWSTAR sources) are added as extra fields
+def make_sources(names,**columns):
+ names=numpy.array(names,str)
+ extra=[ col for col in sorted(columns.keys()) if col not in SOURCE_FIELDS ]
+ dtype=[('name',names.dtype)]+[ (col,numpy.float64) for col in SOURCE_FIELDS+tuple(extra) ]
+ sources=numpy.zeros(len(names),dtype).view(numpy.recarray)
+ sources['name']=names
+ for col in SOURCE_FIELDS+tuple(extra):
+  sources[col]=columns.get(col,SOURCE_DEFAULTS.get(col,0))
+ return sources
+
+# return the column of a record array, or an array of its default
+# value if there is no such field
+def source_column(sources,col):
+ if col in sources.dtype.names:
+  return sources[col].astype(numpy.float64)
+ return numpy.repeat(float(SOURCE_DEFAULTS.get(col,0)),len(sources))
+
+# return the lines of a text file
+def _read_lines(filename):
+ infile=open(filename,'r')
+ try:
+  return infile.read().splitlines()
+ finally:
+  infile.close()
+
+# return rows of ncols numbers (strings) as an (nrows,ncols) array. This
+# leaves the parsing to numpy.fromstring(), which is much faster than
+# converting the strings one by one
+def _float_rows(rows,ncols):
+ values=numpy.fromstring(' '.join([ ' '.join(row) for row in rows ]),sep=' ')
+ if len(values)!=len(rows)*ncols:
+  raise ValueError,"invalid number in source list"
+ return values.reshape((len(rows),ncols))
+
+# hours (or degrees),min,sec -> hours (or degrees)
+def _sexagesimal(hms):
+ return hms[:,0]+(hms[:,2]/60.0+hms[:,1])/60.0
+
+###############################################
+# NEWSTAR .MDL files (see mdl.dsc and "MDL_O_DEF"): a 512-byte general
+# file header and a 64-byte model header, followed by a 56-byte record
+# for each source. Integers and floats are in the byte order of the
+# machine that wrote the file
+MDL_RECORD=numpy.dtype({
+ 'names':  ['I','l','m','id','Q','U','V','eX','eY','eP','SI','RM','bits','type'],
+ 'formats':['f4','f4','f4','i4','f4','f4','f4','f4','f4','f4','f4','f4','u1','u1'],
+ 'offsets':[0,4,8,12,16,20,24,28,32,36,40,44,52,53],
+ 'itemsize':56})
+
+# read the headers of a NEWSTAR file, returns a dict
+def read_newstar_header(ff):
+ gfh=ff.read(512)
+ mdh=ff.read(64)
+ if len(gfh)<512 or len(mdh)<64:
+  raise IOError,"%s: truncated NEWSTAR header"%ff.name
+ hdr={}
+ hdr['type']=gfh[0:4]
+ (hdr['length'],)=struct.unpack_from('i',gfh,4)
+ (hdr['version'],)=struct.unpack_from('i',gfh,5)
+ hdr['crdate']=gfh[12:23]
+ hdr['crtime']=gfh[23:28]
+ hdr['rrdate']=gfh[28:39]
+ hdr['rrtime']=gfh[39:44]
+ (hdr['rcount'],)=struct.unpack_from('i',gfh,44)
+ hdr['node']=gfh[48:128]
+ # model header
+ (hdr['maxlin'],hdr['modptr'],hdr['nsources'],hdr['mtype'])=struct.unpack_from('4i',mdh,12)
+ (hdr['epoch'],)=struct.unpack_from('f',mdh,28)
+ # centre RA,Dec (circles) and frequency (MHz)
+ (ra0,dec0,freq0)=struct.unpack_from('3d',mdh,32)
+ hdr['ra0']=ra0*math.pi*2
+ hdr['dec0']=dec0*math.pi*2
+ hdr['freq0']=freq0*1e6
+ return hdr
+
+# read a NEWSTAR .MDL file. Returns (header,sources), with the l,m
+# offsets of the sources as extra fields.
+# ignore_pol: drop polarization (Q,U,V and RM)
+# only_cleancomp: read only the clean components
+# no_cleancomp: read all but the clean components
+def read_newstar(filename,ignore_pol=False,only_cleancomp=False,no_cleancomp=False):
+ ff=open(filename,'rb')
+ try:
+  hdr=read_newstar_header(ff)
+  mdl=numpy.fromfile(ff,dtype=MDL_RECORD,count=hdr['nsources'])
+ finally:
+  ff.close()
+ if len(mdl)<hdr['nsources']:
+  raise IOError,"%s: expected %d sources, found only %d"%(filename,hdr['nsources'],len(mdl))
+
+ # clean components are point sources (bit 0 of bits is "extended")
+ # with bit 0 of type set
+ if only_cleancomp or no_cleancomp:
+  clean=(mdl['bits']==0)&(mdl['type']==1)
+  mdl=mdl[clean if only_cleancomp else ~clean]
+
+ # amplitude is in WU (1WU=5mJy), Q,U,V are fractions of I
+ I=mdl['I'].astype(numpy.float64)*0.005
+ if ignore_pol:
+  Q=U=V=RM=0
+ else:
+  Q=mdl['Q']*I
+  U=mdl['U']*I
+  V=mdl['V']*I
+  RM=mdl['RM']
+ l=mdl['l'].astype(numpy.float64)
+ m=mdl['m'].astype(numpy.float64)
+
+ # extended source parameters, as done by NMOEXT in nscan/nmoext.for,
+ # but in radians
+ eX=mdl['eX'].astype(numpy.float64)
+ eY=mdl['eY'].astype(numpy.float64)
+ eP=mdl['eP'].astype(numpy.float64)
+ r0=numpy.where((eP==0)&(eX==eY),0,0.5*(360/math.pi)*numpy.arctan2(-eP,eY-eX))
+ r1=numpy.sqrt(eP*eP+(eX-eY)*(eX-eY))
+ r2=eX+eY
+
+ # NEWSTAR MDL lists might have same source twice if they are
+ # clean components, so make a unique name for them
+ names=[]
+ count={}
+ for id in mdl['id'].tolist():
+  bname='NEWS'+str(id)
+  if count.has_key(bname):
+   names.append(bname+'_'+str(count[bname]))
+   count[bname]+=1
+  else:
+   names.append(bname)
+   count[bname]=1
+
+ (ra,dec)=lm_to_radec_array(hdr['ra0'],hdr['dec0'],l,m)
+ sources=make_sources(names,ra=ra,dec=dec,I=I,Q=Q,U=U,V=V,
+    SI=mdl['SI'],f0=hdr['freq0'],RM=RM,
+    eX=numpy.sqrt(abs(0.5*(r2+r1))),eY=numpy.sqrt(abs(0.5*(r2-r1))),eP=r0/(2*360)*math.pi,
+    brightness=I,l=l,m=m)
+ return (hdr,sources)
+
+###############################################
+# read a text file with one source per line:
+# NAME RA(hours, min, sec) DEC(degrees, min, sec) sI sQ sU sV SI RM eX eY eP [f0]
+# (as written by LSM.save_as_extlist()). A missing or zero f0 is taken
+# to be the given f0, or 1MHz if that is None
+def read_extlist(filename,ignore_pol=False,f0=None):
+ rows=[ line.split() for line in _read_lines(filename) ]
+ rows=[ row for row in rows if row and not row[0].startswith('#') ]
+ names=[ row[0] for row in rows ]
+ values=_float_rows([ row[1:17] if len(row)>16 else row[1:16]+['0'] for row in rows ],16)
+ freq0=values[:,15]
+
+ # if we have negative RA or Dec, we have to subtract min,sec
+ (hms,dms)=(values[:,0:3].copy(),values[:,3:6].copy())
+ for x in hms,dms:
+  x[:,1:]*=numpy.where(numpy.signbit(x[:,0]),-1,1)[:,numpy.newaxis]
+ ra=_sexagesimal(hms)*math.pi/12.0
+ dec=_sexagesimal(dms)*math.pi/180.0
+
+ I=values[:,6]
+ if ignore_pol:
+  (Q,U,V,RM)=(0,0,0,0)
+ else:
+  (Q,U,V)=(values[:,7:10]*(I>0)[:,numpy.newaxis]).T
+  RM=values[:,11]
+ sources=make_sources(names,ra=ra,dec=dec,I=I,Q=Q,U=U,V=V,SI=values[:,10],RM=RM,
+    f0=numpy.where(freq0!=0,freq0,f0 or 1e6),
+    eX=values[:,12],eY=values[:,13],eP=values[:,14],brightness=I)
+ return sources
+
+###############################################
+# read a catalog text file, like this:
+#
+# cat     name            RA          eRA      Dec        eDec     freq   Flux(Jy)   eFl equi.
+#---------------------------------------------------------------------------------------------
+#NVSS  J163411+624953   16 34 11.868   0.73   62 49 53.72   8.3     1400    0.0030    .0005 J
+#
+CATALOG_LINE=re.compile(r"""
+   ^(?P<col1>\S+)  # column 1 'NVSS'
+   \s*             # skip white space
+   (?P<col2>[A-Za-z]\w+\+\w+)  # source name i.e. 'J163002+631308'
+   \s*             # skip white space
+   (?P<col3>\d+)   # RA angle - hr
+   \s*             # skip white space
+   (?P<col4>\d+)   # RA angle - min
+   \s*             # skip white space
+   (?P<col5>\d+(\.\d+)?)   # RA angle - sec
+   \s*             # skip white space
+   (?P<col6>[^ ]+) # eRA angle - sec or 'n'
+   \s*             # skip white space
+   (?P<col7>\d+)   # Dec angle - hr
+   \s*             # skip white space
+   (?P<col8>\d+)   # Dec angle - min
+   \s*             # skip white space
+   (?P<col9>\d+(\.\d+)?)   # Dec angle - sec
+   \s*             # skip white space
+   (?P<col10>[^ ]+)   # eDec angle - sec
+   \s*             # skip white space
+   (?P<col11>\d+)   # freq
+   \s*             # skip white space
+   (?P<col12>\d+(\.\d+)?)   # brightness - Flux
+   \s*             # skip white space
+   (?P<col13>\d*\.\d+)   # brightness - eFlux
+   \s*""",re.VERBOSE)
+## OMS 10/02/2007: some NVSS extracts have extra fields after eFlux.
+## Also, I've seen "n" for eRA/eDec, so the regex allows for that
+
+# return the names and the values of the given groups of the lines
+# of a file that match the regexp
+def _match_lines(filename,regexp,name,groups):
+ matches=[ v for v in map(regexp.search,_read_lines(filename)) if v!=None ]
+ names=[ v.group(name) for v in matches ]
+ values=_float_rows([ v.group(*groups) for v in matches ],len(groups))
+ return (names,values)
+
+def read_catalog(filename):
+ (names,values)=_match_lines(filename,CATALOG_LINE,'col2',
+    ('col3','col4','col5','col7','col8','col9','col12'))
+ I=values[:,6]
+ return make_sources(names,ra=_sexagesimal(values[:,0:3])*math.pi/12.0,
+    dec=_sexagesimal(values[:,3:6])*math.pi/180.0,I=I,f0=1e6,brightness=I)
+
+###############################################
+# read a source list from VizieR
+VIZIER_LINE=re.compile(r"""
+   ^\s*(?P<col1>[A-Za-z0-9]*(.)?[A-Za-z0-9]+)  # column 1 name: a string or number
+   \s+             # skip white space
+   (?P<col2>(-)?\d+(\.\d+)?)   # RA angle - hours
+   \s+             # skip white space
+   (?P<col3>(-)?\d+(\.\d+)?)   # RA angle - min
+   \s*             # skip white space
+   (?P<col4>(-)?\d+(\.\d+)?)   # RA angle - sec
+   \s*             # skip white space
+   (?P<col5>(-)?\d+(\.\d+)?)   # eRA arcmin
+   \s*             # skip white space
+   (?P<col6>[+|-]?\d+(\.\d+)?)   # Dec angle - degrees
+   \s*             # skip white space
+   (?P<col7>(-)?\d+(\.\d+)?)   # Dec angle - min
+   \s*             # skip white space
+   (?P<col8>(-)?\d+(\.\d+)?)   # Dec angle - sec
+   \s*             # skip white space
+   (?P<col9>(-)?\d+(\.\d+)?)   # eDec arcmin
+   \s*             # skip white space
+   (?P<col10>(-)?\d+(\.\d+)?)   # Stokes I - Flux (Jy)
+   \s*             # skip white space
+   (?P<col11>[-+]?(\d+(\.\d*)?|\d*\.\d+)([eE][-+]?\d+)?)  # Spectral index
+   \s*.\s*""",re.VERBOSE) # ignore the rest
+
+def read_vizier(filename,f0=None):
+ (names,values)=_match_lines(filename,VIZIER_LINE,'col1',
+    ('col2','col3','col4','col6','col7','col8','col9','col10','col11'))
+ return make_sources(names,ra=_sexagesimal(values[:,0:3])*math.pi/12.0,
+    dec=_sexagesimal(values[:,3:6])*math.pi/180.0,I=values[:,7],SI=values[:,8],
+    f0=(f0==None and 1e6 or f0),brightness=values[:,6])
@@ -752,6 +752,24 @@ def lm_to_radec(ra0,dec0,l,m):
 
     return (ra,dec)
 
+## lm_to_radec() of arrays of l,m, giving arrays of ra,dec
+def lm_to_radec_array(ra0,dec0,l,m):
+    A=Timba.array
+    sind0=math.sin(dec0)
+    cosd0=math.cos(dec0)
+    dl=A.asarray(l,A.float64)
+    dm=A.asarray(m,A.float64)
+    d0=dm*dm*sind0*sind0+dl*dl-2*dm*cosd0*sind0
+    sind=A.sqrt(abs(sind0*sind0-d0))
+    cosd=A.sqrt(abs(cosd0*cosd0+d0))
+    if (sind0<=0):
+     sind=-sind
+
+    dec=A.arctan2(sind,cosd)
+    ra=A.arctan2(A.where(dl!=0,-dl,1e-10),(cosd0-dm*sind0))+ra0
+
+    return (ra,dec)
+
 
 ## convert ra,dec to lm (NCP)
 def radec_to_lm(ra0,dec0,ra,dec):
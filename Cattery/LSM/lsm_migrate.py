@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# The Local Sky Model (LSM)
+#
+# Converts LSM files saved by older versions of the LSM (pickled LSM
+# objects) to the binary format of LSM_format. No nodes are created,
+# node definitions are copied across as they are.
+#
+
+
+#% $Id$
+
+#
+# Copyright (C) 2002-2007
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# and The MeqTree Foundation
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands, seg@astron.nl
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+import sys
+import shutil
+
+import LSM_format
+from LSM import LSM
+
+# convert an LSM file to the binary format. If backup is given, infile
+# is copied there once it has been read. Returns True on success
+def migrate(infile,outfile,backup=None):
+ lsm=LSM()
+ if not lsm.load(infile):
+  return False
+ if backup:
+  shutil.copy2(infile,backup)
+ if not lsm.save(outfile):
+  return False
+ return LSM_format.is_lsm_file(outfile)
+
+if __name__=='__main__':
+ from optparse import OptionParser
+
+ parser=OptionParser(usage="""%prog: [options] file.lsm [file.lsm ...]""",
+     description="Converts LSM files saved by older versions (as pickles) to the binary LSM format. "
+     "Files are converted in place, and the originals are kept with a .bak suffix, unless -o is given.")
+ parser.add_option("-o","--output",type="string",
+                   help="write converted LSM to this file (only one input file may then be given)")
+ parser.add_option("--no-backup",action="store_true",
+                   help="do not keep the originals of files converted in place")
+ (options,args)=parser.parse_args()
+ if not args:
+  parser.error("no LSM files given")
+ if options.output and len(args)>1:
+  parser.error("-o can only be used with one input file")
+
+ failed=0
+ for infile in args:
+  if LSM_format.is_lsm_file(infile):
+   print "%s: already in the binary format, skipping"%infile
+   continue
+  outfile=options.output or infile
+  backup=None
+  if outfile==infile and not options.no_backup:
+   backup=infile+'.bak'
+  # a bad file (e.g. one that cannot be unpickled) should not stop the others
+  try:
+   ok=migrate(infile,outfile,backup)
+  except Exception,err:
+   print "%s: %s: %s"%(infile,err.__class__.__name__,err)
+   ok=False
+  if ok:
+   print "%s: converted to %s"%(infile,outfile)
+  else:
+   print "%s: conversion failed"%infile
+   failed+=1
+ sys.exit(failed and 1 or 0)
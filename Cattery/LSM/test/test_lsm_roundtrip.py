@@ -0,0 +1,192 @@
+#!/usr/bin/python
+#
+# Round-trip tests of LSM files: LSMs built from small NEWSTAR and
+# extlist files are saved and loaded again (with and without columnar
+# storage), LSMs saved by older versions (as pickles) are loaded and
+# migrated, and damaged or newer files are rejected.
+#
+# Run as: python test_lsm_roundtrip.py
+#
+
+#% $Id$
+
+#
+# Copyright (C) 2002-2007
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# and The MeqTree Foundation
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands, seg@astron.nl
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+import os
+import sys
+import struct
+import shutil
+import tempfile
+import unittest
+
+TEST_DIR=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(TEST_DIR))
+
+import LSM_format
+import lsm_migrate
+from LSM import LSM,sixpack_values
+
+# write a NEWSTAR model file with the given sources, each a tuple of
+# (I,l,m,Q,U,V,eX,eY,eP,SI,RM,extended,cleancomp)
+def write_newstar(filename,sources,ra0=0.1,dec0=1.2,freq0=1400.):
+ gfh=bytearray(512)
+ gfh[0:4]='.MDL'
+ gfh[12:23]='18-Oct-2026'
+ gfh[23:28]='12:00'
+ mdh=bytearray(64)
+ n=len(sources)
+ struct.pack_into('4i',mdh,12,n,0,n,1)
+ struct.pack_into('3d',mdh,32,ra0,dec0,freq0)
+ f=open(filename,'wb')
+ f.write(gfh)
+ f.write(mdh)
+ for i,(I,l,m,Q,U,V,eX,eY,eP,SI,RM,ext,clean) in enumerate(sources):
+  f.write(struct.pack('fffifffffffff',I,l,m,i,Q,U,V,eX,eY,eP,SI,RM,0))
+  f.write(struct.pack('BBxx',ext and 1 or 0,clean and 1 or 0))
+ f.close()
+
+NEWSTAR_SOURCES=[
+ (12.0,0.01,-0.02,0.5,0.1,0,0,0,0,-0.7,0,False,False),
+ (3.5,-0.03,0.01,0,0,0,2e-7,1e-7,0.3,0,3.0,True,False),
+ (0.8,0.02,0.03,0,0,0.01,0,0,0,-0.5,0,False,True),
+ (7.25,-0.01,-0.04,0,0,0,5e-7,5e-7,0,0,0,True,True)]
+
+# name, RA (h m s), Dec (d m s), I Q U V, SI RM, eX eY eP, f0
+EXTLIST="""# test sources
+A1 16 34 11.868 62 49 53.72 2.5 0.1 0 0 -0.7 0 0 0 0 1.4e9
+A2 16 40 3.2 -62 4 53.1 1.25 0 0 0 0 2 1e-5 5e-6 0.5 0
+A3 -1 20 0 5 30 0 4.0 0 0.2 0 0 0 0 0 0 1.4e9
+"""
+
+# return the state of an LSM that survives saving and loading: the
+# p-Units (with their sixpack values) and sources, by name. If places
+# is given, sixpack values are rounded to that many decimal places
+def lsm_state(lsm,places=None):
+ punits={}
+ for name,p in lsm.p_table.iteritems():
+  sp=p.getSP()
+  values=sixpack_values(sp)
+  if places!=None:
+   values=tuple([ round(x,places) for x in values ])
+  punits[name]=(p.getType(),p.getCat(),p.getBrightness(),p.getFOVDist(),
+                tuple(p.getExtParms()),values,sp.label())
+ sources={}
+ for name,s in lsm.s_table.iteritems():
+  sources[name]=(s.getType(),tuple(s.extParms()))
+ return (punits,sources)
+
+# return names of the p-Units returned by queryLSM(count=...)
+def brightest(lsm,count=10):
+ return [ p.name for p in lsm.queryLSM(count=count) ]
+
+
+class LSMRoundTripTest(unittest.TestCase):
+ def setUp(self):
+  self.dir=tempfile.mkdtemp()
+  self.newstar=os.path.join(self.dir,'model.mdl')
+  write_newstar(self.newstar,NEWSTAR_SOURCES)
+  self.extlist=os.path.join(self.dir,'model.txt')
+  f=open(self.extlist,'w')
+  f.write(EXTLIST)
+  f.close()
+
+ def tearDown(self):
+  shutil.rmtree(self.dir)
+
+ def path(self,name):
+  return os.path.join(self.dir,name)
+
+ def build(self,kind,columnar=False):
+  lsm=LSM(columnar=columnar)
+  if kind=='newstar':
+   lsm.build_from_newstar(self.newstar,None,verbose=0)
+  else:
+   lsm.build_from_extlist(self.extlist,None)
+  return lsm
+
+ def assertSameLSM(self,lsm,ref,places=None):
+  self.assertEqual(lsm_state(lsm,places),lsm_state(ref,places))
+  self.assertEqual(brightest(lsm),brightest(ref))
+
+ def test_build(self):
+  self.assertEqual(len(self.build('newstar').p_table),len(NEWSTAR_SOURCES))
+  self.assertEqual(len(self.build('extlist').p_table),3)
+  # columnar storage gives the same LSM
+  for kind in 'newstar','extlist':
+   self.assertSameLSM(self.build(kind,columnar=True),self.build(kind))
+
+ def test_roundtrip(self):
+  for kind in 'newstar','extlist':
+   for columnar in False,True:
+    ref=self.build(kind,columnar)
+    filename=self.path('%s.lsm'%kind)
+    self.assertTrue(ref.save(filename))
+    self.assertTrue(LSM_format.is_lsm_file(filename))
+    for load_columnar in False,True:
+     lsm=LSM(columnar=load_columnar)
+     self.assertTrue(lsm.load(filename))
+     self.assertSameLSM(lsm,ref)
+     # and once more, from what was loaded
+     lsm.save(self.path('again.lsm'))
+     again=LSM()
+     self.assertTrue(again.load(self.path('again.lsm')))
+     self.assertSameLSM(again,ref)
+
+ def test_legacy(self):
+  legacy=os.path.join(TEST_DIR,'3C343_nvss_legacy.lsm')
+  self.assertFalse(LSM_format.is_lsm_file(legacy))
+  # the legacy file was built from the same catalog, by a version that
+  # converted coordinates one source at a time, so these may differ in
+  # the last bits
+  ref=LSM()
+  ref.build_from_catalog(os.path.join(TEST_DIR,'3C343_nvss.txt'),None)
+  for columnar in False,True:
+   lsm=LSM(columnar=columnar)
+   self.assertTrue(lsm.load(legacy))
+   self.assertSameLSM(lsm,ref,places=12)
+  # migrated files hold the same LSM
+  filename=self.path('migrated.lsm')
+  self.assertTrue(lsm_migrate.migrate(legacy,filename))
+  lsm=LSM()
+  self.assertTrue(lsm.load(filename))
+  self.assertSameLSM(lsm,ref,places=12)
+
+ def test_bad_files(self):
+  filename=self.path('model.lsm')
+  self.build('newstar').save(filename)
+  data=open(filename,'rb').read()
+  # truncated file
+  truncated=self.path('truncated.lsm')
+  open(truncated,'wb').write(data[:len(data)//2])
+  # file written by a newer version of the format
+  newer=self.path('newer.lsm')
+  header=LSM_format._HEADER
+  (magic,version,flags)=header.unpack_from(data)
+  open(newer,'wb').write(header.pack(magic,LSM_format.FORMAT_VERSION+1,flags)+data[header.size:])
+  for bad in truncated,newer:
+   self.assertRaises(LSM_format.LSMFormatError,LSM_format.LSMFile,bad)
+   self.assertFalse(LSM().load(bad))
+   self.assertFalse(lsm_migrate.migrate(bad,self.path('out.lsm')))
+
+
+if __name__=='__main__':
+ unittest.main()
@@ -11,7 +11,7 @@ pyfits = Kittens.utils.import_pyfits();
 
 import Siamese.OMS.InterpolatedBeams
 
-from Siamese.OMS.InterpolatedBeams import _verbosity,dprint,dprintf,DEG,LMVoltageBeam
+from Siamese.OMS.InterpolatedBeams import _verbosity,dprint,dprintf,DEG,LMVoltageBeam,LMVoltageBeamStack,PrefilterCache
 
 from Timba import pynode
 from Timba.Meq import meq
@@ -47,6 +47,10 @@ class FITSCompoundBeamInterpolatorNode (pynode.PyNode):
     mystate('m_0',0.0);
     mystate('verbose',0);
     mystate('missing_is_null',False);
+    # directory of disk cache for prefiltered beams, see InterpolatedBeams.PrefilterCache. Disabled if empty.
+    mystate('prefilter_cache_dir','');
+    # number of threads to interpolate in, see InterpolationThreads. 0 or 1 for no threads.
+    mystate('num_threads',0);
     # Check filename arguments: we must be created with two identical-length lists
     if isinstance(self.filename_real,(list,tuple)) and isinstance(self.filename_imag,(list,tuple)) \
         and len(self.filename_real) == len(self.filename_imag) and not len(self.filename_real)%1:
@@ -61,7 +65,7 @@ class FITSCompoundBeamInterpolatorNode (pynode.PyNode):
 
   def init_voltage_beams (self):
     """initializes VoltageBeams for the given set of FITS files (per each _vb_key, that is).
-    Returns list of 1 or 4 VoltageBeam objects."""
+    Returns an LMVoltageBeamStack of 2N VoltageBeam objects, and the beam maximum."""
     # maintain a global dict of VoltageBeam objects per each filename set, so that we reuse them
     global _voltage_beams;
     if not '_voltage_beams' in globals():
@@ -70,6 +74,7 @@ class FITSCompoundBeamInterpolatorNode (pynode.PyNode):
     vbs,beam_max = _voltage_beams.get(self._vb_key,(None,None));
     if not vbs:
       vbs = [];
+      cache = PrefilterCache(self.prefilter_cache_dir) if self.prefilter_cache_dir else None;
       for filename_real,filename_imag in self._vb_key:
         # if files do not exist, replace with blanks
         if not ( os.path.exists(filename_real) and os.path.exists(filename_imag) ) and self.missing_is_null:
@@ -80,7 +85,7 @@ class FITSCompoundBeamInterpolatorNode (pynode.PyNode):
           vb = LMVoltageBeam(
                   l0=self.l_0,m0=self.m_0,
                   ampl_interpolation=self.ampl_interpolation,spline_order=self.spline_order,
-                  verbose=self.verbose);
+                  prefilter_cache=cache,num_threads=self.num_threads,verbose=self.verbose);
           vb.read(filename_real,filename_imag);
         else:
           vb = None;
@@ -89,11 +94,12 @@ class FITSCompoundBeamInterpolatorNode (pynode.PyNode):
       xx = [ vb.beam() if vb else numpy.array([0]) for vb in vbs[:len(vbs)/2] ];
       yy = [ vb.beam() if vb else numpy.array([0]) for vb in vbs[len(vbs)/2:] ];
       beam_max = math.sqrt(max([ (abs(x)**2+abs(y)**2).max() for x,y in zip(xx,yy)]));
+      vbs = LMVoltageBeamStack(vbs,prefilter_cache=cache);
       _voltage_beams[self._vb_key] = vbs,beam_max;
     return vbs,beam_max;
 
   def get_result (self,request,*children):
-    # get list of VoltageBeams
+    # get stack of VoltageBeams
     vbs,beam_max = self.init_voltage_beams();
     # now, figure out the lm and time/freq grid
     lm = children[0];
@@ -109,13 +115,10 @@ class FITSCompoundBeamInterpolatorNode (pynode.PyNode):
         grid[axis] = values;
     # interpolate
     vellsets = [];
-    hasfreq = False;
-    for vb in vbs:
-      if vb is None:
+    for beam in vbs.interpolate(freqaxis=self._freqaxis,**grid):
+      if beam is None:
         vellsets.append(meq.vellset(meq.sca_vells(0.)));
       else:
-        beam = vb.interpolate(freqaxis=self._freqaxis,**grid);
-        hasfreq = hasfreq or vb.hasFrequencyAxis();
         if self.normalize and beam_max != 0:
           beam /= beam_max;
         vells = meq.complex_vells(beam.shape);
@@ -123,7 +126,7 @@ class FITSCompoundBeamInterpolatorNode (pynode.PyNode):
         # make vells and return result
         vellsets.append(meq.vellset(vells));
     # create result object
-    cells = request.cells if hasfreq else getattr(lm,'cells',None);
+    cells = request.cells if vbs.hasFrequencyAxis() else getattr(lm,'cells',None);
     result = meq.result(vellsets[0],cells=cells);
     result.vellsets[1:] = vellsets[1:];
     result.dims = (2,len(vellsets)/2);
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import os
 import os.path
 import math
+import hashlib
 import numpy
 from scipy.ndimage import interpolation
 from scipy import interpolate
 
 import Kittens.utils
+from Siamese.OMS import InterpolationThreads
 _verbosity = Kittens.utils.verbosity(name="vb");
 #_verbosity.set_verbose(5)
 dprint = _verbosity.dprint;
@@ -60,6 +63,108 @@ def unite_shapes (a,b):
         raise TypeError,"error: trying to unite incompatible shapes %s and %s"%(sa,sb);
   return a,b;
 
+def stack_arrays (arrays):
+  """Stacks a list of arrays along a new first axis. The arrays are promoted to a common shape first,
+  in the same way as by unite_shapes(). Scalars are treated as arrays of shape [1].""";
+  shapes = [ numpy.shape(a) or (1,) for a in arrays ];
+  shape = [1]*max(map(len,shapes));
+  for sh in shapes:
+    for axis,n in enumerate(sh):
+      if n != 1:
+        if shape[axis] not in (1,n):
+          raise TypeError,"error: trying to stack incompatible shapes %s and %s"%(shape,sh);
+        shape[axis] = n;
+  stack = numpy.empty([len(arrays)]+shape,numpy.result_type(*arrays));
+  for x,a,sh in zip(stack,arrays,shapes):
+    x[...] = numpy.reshape(a,list(sh)+[1]*(len(shape)-len(sh)));
+  return stack;
+
+def collapse_constant_axes (*arrays):
+  """Given arrays of the same shape, finds the axes along which all of them are constant, and returns the arrays
+  reduced to length 1 along those axes (as views). This undoes the expansion done by e.g. unite_shapes(), so that
+  duplicate values need only be processed once, and the results broadcast back.""";
+  for axis in range(arrays[0].ndim):
+    if arrays[0].shape[axis] > 1:
+      first = (slice(None),)*axis + (slice(0,1),);
+      if all([ (a[first] == a).all() for a in arrays ]):
+        arrays = [ a[first] for a in arrays ];
+  return arrays;
+
+def _apply_amplitude (output,ampl):
+  """Replaces the amplitude of the complex output array by ampl, keeping its phase""";
+  phase_array = numpy.arctan2(output.imag,output.real)
+  output.real = ampl * numpy.cos(phase_array)
+  output.imag = ampl * numpy.sin(phase_array)
+
+class PrefilterCache (object):
+  """Disk cache of spline-prefiltered beam planes.
+
+  Prefiltering large beam cubes (interpolation.spline_filter) is slow, and would otherwise be redone every time a tree
+  is rebuilt. The prefiltered planes are stored in a directory as .npy files, named by a hash of everything they
+  depend on: the checksums of the FITS files, the spline order, the axis options, etc. Files are loaded memory-mapped
+  (read-only), so loading is nearly free, and processes using the same beams share the same pages. Since the key
+  includes the file contents, entries never go stale; old ones may simply be deleted from the directory.
+  """;
+
+  # bump this to invalidate existing cache entries if the prefiltering changes
+  VERSION = 1;
+
+  # dict of (filename,size,mtime) -> checksum, so that each file is only checksummed once
+  _checksums = {};
+
+  def __init__ (self,dirname):
+    self.dirname = os.path.expanduser(dirname);
+    if not os.path.isdir(self.dirname):
+      os.makedirs(self.dirname);
+
+  @staticmethod
+  def checksum (filename):
+    """Returns checksum of the contents of a file""";
+    st = os.stat(filename);
+    fkey = os.path.abspath(filename),st.st_size,st.st_mtime;
+    cs = PrefilterCache._checksums.get(fkey);
+    if cs is None:
+      sha = hashlib.sha1();
+      ff = open(filename,"rb");
+      while True:
+        buf = ff.read(1<<22);
+        if not buf:
+          break;
+        sha.update(buf);
+      ff.close();
+      cs = PrefilterCache._checksums[fkey] = sha.hexdigest();
+    return cs;
+
+  def key (self,*parts):
+    """Makes a cache key out of the given parts (which must have a well-defined repr())""";
+    return hashlib.sha1(repr((self.VERSION,)+parts)).hexdigest();
+
+  def get (self,key,compute):
+    """Returns array stored under the given key, memory-mapped. If not in the cache, calls compute() to get it,
+    and stores it.""";
+    path = os.path.join(self.dirname,key+".npy");
+    if os.path.exists(path):
+      try:
+        value = numpy.load(path,mmap_mode='r');
+        dprint(1,"loaded prefiltered beam from cache",path);
+        return value;
+      except (IOError,ValueError),exc:
+        dprint(0,"error loading prefiltered beam from cache %s (%s), recomputing"%(path,exc));
+    value = compute();
+    # write to a temporary file and rename it, so that other processes never see a partially written file
+    tmppath = "%s.%d.tmp"%(path,os.getpid());
+    try:
+      ff = open(tmppath,"wb");
+      numpy.save(ff,value);
+      ff.close();
+      os.rename(tmppath,path);
+      dprint(1,"saved prefiltered beam to cache",path);
+    except (IOError,OSError),exc:
+      dprint(0,"error saving prefiltered beam to cache %s (%s)"%(path,exc));
+      if os.path.exists(tmppath):
+        os.remove(tmppath);
+    return value;
+
 class FITSAxes (object):
   """Helper class encapsulating a FITS header."""
   def __init__ (self,hdr):
@@ -145,8 +250,15 @@ class FITSAxes (object):
 class LMVoltageBeam (object):
   """This class implements a complex voltage beam as a function of LM."""
   def __init__ (self,spline_order=2,l0=0,m0=0,l_axis="L",m_axis="M",
-                ampl_interpolation=False,verbose=None):
+                ampl_interpolation=False,prefilter_cache=None,num_threads=0,verbose=None):
+    """Creates beam. If prefilter_cache is given (a PrefilterCache object), prefiltered planes are
+    looked up in and stored in it. If num_threads>1, interpolation is done in a pool of that many threads
+    (see InterpolationThreads).""";
     self._spline_order = spline_order;
+    self.num_threads = num_threads;
+    self._prefilter_cache = prefilter_cache;
+    # cache keys of the real, imaginary and amplitude planes, if the cache was used
+    self.plane_keys = None;
     self.l0, self.m0 = l0, m0;
     # figure out axis names, and whether they should be swapped
     if l_axis[0] == '-':
@@ -228,17 +340,28 @@ class LMVoltageBeam (object):
       dprint(2,"freq grid is",axes.grid(freqaxis));
     # prefilter beam for interpolator
     self._beam = beam;
-    if self._spline_order > 1:
-      self._beam_real = interpolation.spline_filter(beam.real,order=self._spline_order);
-      self._beam_imag = interpolation.spline_filter(beam.imag,order=self._spline_order);
-      if not beam_ampl is None:
-        self._beam_ampl = interpolation.spline_filter(beam_ampl,order=self._spline_order);
-      else:
-        self._beam_ampl = beam_ampl
+    self._prefilter(beam,beam_ampl,[filename_real,filename_imag]);
+
+  def _prefilter (self,beam,beam_ampl,filenames):
+    """Sets up the prefiltered real, imaginary and amplitude (if beam_ampl is not None) planes of the beam,
+    using the prefilter cache if one is set. Filenames are the files the beam was read from.""";
+    planes = [ ("real",beam.real),("imag",beam.imag) ];
+    if beam_ampl is not None:
+      planes.append(("ampl",beam_ampl));
+    if self._spline_order <= 1:
+      values = [ plane for name,plane in planes ];
+    elif self._prefilter_cache is None:
+      values = [ interpolation.spline_filter(plane,order=self._spline_order) for name,plane in planes ];
     else:
-      self._beam_real = beam.real;
-      self._beam_imag = beam.imag;
-      self._beam_ampl = beam_ampl
+      cache = self._prefilter_cache;
+      checksums = [ cache.checksum(filename) for filename in filenames if filename ];
+      self.plane_keys = [ cache.key(self.__class__.__name__,name,checksums,self._spline_order,
+                                    self._l_axis,self._l_axis_sign,self._m_axis,self._m_axis_sign,
+                                    plane.shape,plane.dtype.str) for name,plane in planes ];
+      values = [ cache.get(key,lambda plane=plane:interpolation.spline_filter(plane,order=self._spline_order))
+                 for key,(name,plane) in zip(self.plane_keys,planes) ];
+    self._beam_real,self._beam_imag = values[:2];
+    self._beam_ampl = values[2] if beam_ampl is not None else None;
 
   def hasFrequencyAxis (self):
     return bool(self._freqToPixel);
@@ -276,6 +399,103 @@ class LMVoltageBeam (object):
 
     'time' is currently ignored -- provided for later compatibility (i.e. beams with time planes)
     """
+    planes = [ self._beam_real,self._beam_imag ];
+    if self._beam_ampl is not None:
+      planes.append(self._beam_ampl);
+    values,shape = self.interpolate_planes(planes,l,m,freq=freq,freqaxis=freqaxis);
+    # values are broadcast back to shape of L
+    if output is None:
+      output = numpy.zeros(shape,complex);
+    elif output.shape != shape:
+      output.resize(shape);
+    output.real = values[0];
+    output.imag = values[1];
+    if self._beam_ampl is not None:
+      _apply_amplitude(output,values[2]);
+    dprint(3,"interpolated value [0] is",output.ravel()[0]);
+    dprint(4,"interpolated value is",output);
+    return output;
+
+  def interpolate_planes (self,planes,l,m,freq=None,freqaxis=None):
+    """Interpolates l/m coordinates (and frequencies) in a number of prefiltered real planes of the beam,
+    e.g. the real and imaginary parts. Arguments are as for interpolate().
+
+    Axes along which l/m are constant (e.g. because they have been expanded by unite_shapes) are interpolated
+    once. Where l/m do not depend on frequency but the beam does (case B), the interpolation is done in
+    separable form, see _interpolate_separable().
+
+    Returns a tuple of (values,shape), where shape is the shape of the output array, and values is an array of
+    nplanes x shape, or of a shape that broadcasts to it.""";
+    l,m = unite_shapes(numpy.array(l),numpy.array(m));
+    full_shape = list(l.shape);
+    l,m = collapse_constant_axes(l,m);
+    if self.hasFrequencyAxis() and freq is not None and numpy.size(freq) > 1 and freqaxis is not None and \
+        (l.ndim <= freqaxis or l.shape[freqaxis] == 1):
+      values = self._interpolate_separable(planes,l,m,numpy.array(freq,float).ravel(),freqaxis);
+    else:
+      lm,shape = self.pixel_coordinates(l,m,freq=freq,freqaxis=freqaxis);
+      dprint(3,"interpolating %d lm points"%lm.shape[1]);
+      values = self.interpolate_plane_set(planes,lm);
+      values = values.reshape([len(planes)]+list(shape));
+    # work out the full output shape
+    vshape = list(values.shape[1:]);
+    shape = vshape + [1]*(len(full_shape)-len(vshape));
+    for axis,n in enumerate(full_shape):
+      shape[axis] = max(n,shape[axis]);
+    return values.reshape([len(planes)]+vshape+[1]*(len(shape)-len(vshape))),tuple(shape);
+
+  def _interpolate_separable (self,planes,l,m,freq,freqaxis):
+    """Interpolates l/m coordinates that do not depend on frequency in a beam that does (case B of interpolate()).
+
+    The prefiltered beam is a tensor-product spline, so instead of evaluating it at every l/m/freq point, each
+    frequency plane that is needed is interpolated at the unique l/m points only (in 2D), and the results are
+    combined with the 1D spline weights of each frequency. The weights are found by interpolating unit vectors
+    along the frequency axis, which gives exactly the same boundary treatment as a 3D interpolation.
+    Frequencies outside the beam's span (which use scaled l/m) are treated the same way, one scale factor at a
+    time. Returns array of nplanes x shape, where shape is the shape of l/m with the freq axis expanded.""";
+    # collapse l/m to the unique points
+    shape = list(l.shape) + [1]*(freqaxis-l.ndim+1);
+    lm = (l + self.l0).ravel() + 1j*(m + self.m0).ravel();
+    lm,index = numpy.unique(lm,return_inverse=True);
+    ## catch out-of-bounds frequencies: lm scale factor is 1 for in-bounds channels, <1 for below, >1 for above
+    scale = numpy.ones(len(freq),float);
+    below = freq < self._freqgrid[0];
+    above = freq > self._freqgrid[-1];
+    scale[below] = freq[below]/self._freqgrid[0];
+    scale[above] = freq[above]/self._freqgrid[-1];
+    chan = self._freqToPixel(numpy.clip(freq,self._freqgrid[0],self._freqgrid[-1]));
+    # 1D spline weights of each beam channel, per frequency
+    nchan = planes[0].shape[2];
+    weights = numpy.array([ interpolation.map_coordinates(unit,chan[numpy.newaxis,:],order=self._spline_order,
+                                                          prefilter=False,mode='nearest')
+                            for unit in numpy.eye(nchan) ]).T;
+    dprint(3,"separable interpolation of %d unique lm points (of %d) at %d frequencies"%(len(lm),len(index),len(freq)));
+    values = numpy.empty((len(planes),len(lm),len(freq)),float);
+    for sc in numpy.unique(scale):
+      ifreq = numpy.where(scale == sc)[0];
+      w = weights[ifreq,:];
+      ichan = numpy.where(w.any(0))[0];
+      w = w[:,ichan];
+      xy = numpy.vstack((self._lToPixel(lm.real*sc),self._mToPixel(lm.imag*sc)));
+      planevals = self.interpolate_plane_set([ plane[:,:,ich] for plane in planes for ich in ichan ],xy);
+      planevals = planevals.reshape((len(planes),len(ichan),len(lm)));
+      for pv,output in zip(planevals,values):
+        output[:,ifreq] = numpy.dot(pv.T,w.T);
+    # expand back to the l/m points, and put the frequency axis in place
+    values = values[:,index,:].reshape([len(planes)]+shape[:freqaxis]+shape[freqaxis+1:]+[len(freq)]);
+    return numpy.rollaxis(values,values.ndim-1,freqaxis+1);
+
+  def interpolate_plane_set (self,planes,lm):
+    """Interpolates a number of (prefiltered) real planes of the beam at the 2xN or 3xN pixel coordinates
+    returned by pixel_coordinates(), using num_threads threads. Returns array of nplanes x N values""";
+    values = numpy.empty((len(planes),lm.shape[1]),float);
+    return InterpolationThreads.map_coordinates(planes,lm,values,num_threads=self.num_threads,
+                  order=self._spline_order,prefilter=(self._spline_order==1),mode='nearest');
+
+  def pixel_coordinates (self,l,m,freq=None,freqaxis=None):
+    """Converts l/m coordinates (and frequencies, if the beam has a frequency axis) into pixel coordinates,
+    as per the interpolate() method. Returns a tuple of (lm,shape), where lm is a 2xN or 3xN array of
+    coordinates suitable for map_coordinates(), and shape is the shape of the output array.""";
     # make sure inputs are arrays
     l = numpy.array(l) + self.l0;
     m = numpy.array(m) + self.m0;
@@ -303,14 +523,17 @@ class LMVoltageBeam (object):
       scale[above] = freq[above]/self._freqgrid[-1]
       freq[below] = self._freqgrid[0]
       freq[above] = self._freqgrid[-1]
+      freq_scale = scale
       # convert frequency to fractional channel index
       chan = self._freqToPixel(freq)
       dprint(3,"in frequency plane coordinates we have",chan)
       # case (A): reuse same frequency for every l/m point
       if len(chan) == 1:
-        chan = numpy.array([chan[0]]*l.size)
+        lm = numpy.empty((3,l.size),float);
+        lm[0,:] = l.ravel();
+        lm[1,:] = m.ravel();
+        lm[2,:] = chan[0];
         scale = scale[0]  # single lm scale factor 
-        lm = numpy.vstack((l.ravel(),m.ravel(),chan));
       # case B/C:
       else:
         # first turn chan vector into an array of the proper shape
@@ -332,7 +555,7 @@ class LMVoltageBeam (object):
         lm[0,:] *= scale
         lm[1,:] *= scale
         dprint(3,"some points were extrapolated for OOB frequencies using scale factors",
-          scale if numpy.isscalar(scale) else scale[above|below])
+          freq_scale[above|below])
     # case (D): no frequency dependence in the beam
     else:
       lm = numpy.vstack((l.ravel(),m.ravel()));
@@ -340,25 +563,15 @@ class LMVoltageBeam (object):
     lm[0,:] = self._lToPixel(lm[0,:])
     lm[1,:] = self._mToPixel(lm[1,:])
     dprint(3,"xy pixel coordinates are [0]",lm[0,0],lm[1,0]);
-    # interpolate and reshape back to shape of L
-    if output is None:
-      output = numpy.zeros(l.shape,complex);
-    elif output.shape != l.shape:
-      output.resize(l.shape);
-    dprint(3,"interpolating %d lm points"%lm.shape[1]);
-    output.real = interpolation.map_coordinates(self._beam_real,lm,order=self._spline_order,
-                  prefilter=(self._spline_order==1),mode='nearest').reshape(l.shape);
-    output.imag = interpolation.map_coordinates(self._beam_imag,lm,order=self._spline_order,
-                  prefilter=(self._spline_order==1),mode='nearest').reshape(l.shape);
-    if not self._beam_ampl is None:
-      output_ampl = interpolation.map_coordinates(self._beam_ampl,lm,order=self._spline_order,
-                  prefilter=(self._spline_order==1),mode='nearest').reshape(l.shape);
-      phase_array = numpy.arctan2(output.imag,output.real)
-      output.real = output_ampl * numpy.cos(phase_array)
-      output.imag = output_ampl * numpy.sin(phase_array)
-    dprint(3,"interpolated value [0] is",output.ravel()[0]);
-    dprint(4,"interpolated value is",output);
-    return output;
+    return lm,l.shape;
+
+  def grid_key (self):
+    """Returns a key describing the grid and coordinate conversion of the beam. Beams with equal keys
+    map the same l/m/freq coordinates to the same pixels.""";
+    axes = self._axes;
+    return (self._beam.shape,self.hasFrequencyAxis(),self.l0,self.m0,self._spline_order,
+            self._l_axis,self._l_axis_sign,self._m_axis,self._m_axis_sign,
+            tuple([ tuple(axes.grid(i)) for i in range(axes.ndim()) ]));
 
 class LMVoltageMultifreqBeam (LMVoltageBeam):
   """This class implements an LMVoltageBeam where the
@@ -423,18 +636,12 @@ class LMVoltageMultifreqBeam (LMVoltageBeam):
     dprint(2,"m grid is",self._axes.grid(maxis));
     dprint(2,"freq grid is",freqs);
     self._freqaxis = freqs;
+    self._freqgrid = numpy.array(freqs);
     self._freq_interpolator = interpolate.interp1d(freqs,range(len(freqs)),'linear');
     # prefilter beam for interpolator
     self._beam = beamcube;
-    self._beam_ampl = numpy.abs(beamcube) if self.ampl_interpolation else None;
-    if self._spline_order > 1:
-      self._beam_real = interpolation.spline_filter(beamcube.real,order=self._spline_order);
-      self._beam_imag = interpolation.spline_filter(beamcube.imag,order=self._spline_order);
-      if self._beam_ampl:
-        self._beam_ampl = interpolation.spline_filter(self._beam_ampl,order=self._spline_order);
-    else:
-      self._beam_real = beamcube.real;
-      self._beam_imag = beamcube.imag;
+    self._prefilter(beamcube,numpy.abs(beamcube) if self.ampl_interpolation else None,
+                    [ filename for pair in filenames for filename in pair ]);
 
   def hasFrequencyAxis (self):
     return True;
@@ -442,6 +649,81 @@ class LMVoltageMultifreqBeam (LMVoltageBeam):
   def _freqToPixel (self,freq):
     return self._freq_interpolator(freq);
 
+  def grid_key (self):
+    return LMVoltageBeam.grid_key(self) + (tuple(self._freqaxis),);
+
+
+class LMVoltageBeamStack (object):
+  """This class interpolates a set of LMVoltageBeams (e.g. the XX/XY/YX/YY elements of a Jones matrix) in one go.
+  The prefiltered real/imaginary (and amplitude) planes of all the beams are stacked into one cube, so pixel
+  coordinates are computed only once per set of l/m/freq points, and are then reused for every plane.
+  Beams that are None are treated as null. Beams that are not on the same grid as the first one are
+  interpolated separately. If a PrefilterCache is given, and the beams' planes came from that cache,
+  the cube is cached as well, so that it too is memory-mapped and shared between processes.""";
+  def __init__ (self,beams,prefilter_cache=None):
+    self.beams = list(beams);
+    live = [ vb for vb in self.beams if vb is not None ];
+    self._ref = live[0] if live else None;
+    key = live and self._ref.grid_key();
+    stacked = [ vb for vb in live if vb.grid_key() == key ];
+    # list of plane indices (real,imag,ampl) in the cube, per stacked beam
+    self._planes = {};
+    planes = [];
+    for vb in stacked:
+      index = [ len(planes),len(planes)+1 ];
+      planes += [ vb._beam_real,vb._beam_imag ];
+      if vb._beam_ampl is not None:
+        index.append(len(planes));
+        planes.append(vb._beam_ampl);
+      self._planes[id(vb)] = index;
+    def make_cube ():
+      cube = numpy.empty((len(planes),)+(planes[0].shape if planes else ()),float);
+      for i,plane in enumerate(planes):
+        cube[i] = plane;
+      return cube;
+    if prefilter_cache is not None and stacked and all([ vb.plane_keys for vb in stacked ]):
+      key = prefilter_cache.key(self.__class__.__name__,[ vb.plane_keys for vb in stacked ]);
+      self._cube = prefilter_cache.get(key,make_cube);
+    else:
+      self._cube = make_cube();
+    # make the beams refer to their planes in the cube, so that we don't keep two copies around
+    for vb in stacked:
+      index = self._planes[id(vb)];
+      vb._beam_real,vb._beam_imag = self._cube[index[0]],self._cube[index[1]];
+      if len(index) > 2:
+        vb._beam_ampl = self._cube[index[2]];
+    dprint(1,"stacked %d beam planes into a cube of shape"%len(planes),self._cube.shape);
+    if len(stacked) < len(live):
+      dprint(0,"warning: %d beam(s) are on a different grid, and will be interpolated separately"%(len(live)-len(stacked)));
+
+  def __len__ (self):
+    return len(self.beams);
+
+  def hasFrequencyAxis (self):
+    return any([ vb.hasFrequencyAxis() for vb in self.beams if vb is not None ]);
+
+  def interpolate (self,l,m,time=None,freq=None,freqaxis=None):
+    """Interpolates l/m coordinates in all the beams. Arguments are as for LMVoltageBeam.interpolate().
+    Returns a list of complex arrays, one per beam (None for null beams).""";
+    if self._ref is None:
+      return [None]*len(self.beams);
+    values,shape = self._ref.interpolate_planes(self._cube,l,m,freq=freq,freqaxis=freqaxis);
+    results = [];
+    for vb in self.beams:
+      if vb is None:
+        results.append(None);
+      elif id(vb) in self._planes:
+        index = self._planes[id(vb)];
+        output = numpy.empty(shape,complex);
+        output.real = values[index[0]];
+        output.imag = values[index[1]];
+        if len(index) > 2:
+          _apply_amplitude(output,values[index[2]]);
+        results.append(output);
+      else:
+        results.append(vb.interpolate(l,m,time=time,freq=freq,freqaxis=freqaxis));
+    return results;
+
 try:
   from Timba import pynode
   from Timba.Meq import meq
@@ -481,6 +763,10 @@ if not standalone:
         mystate('l_beam_offset',0.0);
         mystate('m_beam_offset',0.0);
         mystate('missing_is_null',False);
+        # directory of disk cache for prefiltered beams, see PrefilterCache. Disabled if empty.
+        mystate('prefilter_cache_dir','');
+        # number of threads to interpolate in, see InterpolationThreads. 0 or 1 for no threads.
+        mystate('num_threads',0);
         # Check filename arguments, and init _vb_key for init_voltage_beams() below
         # We may be created with a single filename pair (scalar Jones term), or 4 filenames (full 2x2 matrix)
         if isinstance(self.filename_real,str) and isinstance(self.filename_imag,str):
@@ -497,7 +783,7 @@ if not standalone:
 
     def init_voltage_beams (self):
         """initializes VoltageBeams for the given set of FITS files (per each _vb_key, that is).
-        Returns list of 1 or 4 VoltageBeam objects."""
+        Returns an LMVoltageBeamStack of 1 or 4 VoltageBeam objects, and the beam maximum."""
         # maintain a global dict of VoltageBeam objects per each filename set, so that we reuse them
         global _voltage_beams;
         if not '_voltage_beams' in globals():
@@ -506,6 +792,7 @@ if not standalone:
         vbs,beam_max = _voltage_beams.get(self._vb_key,(None,None));
         if not vbs:
           vbs = [];
+          cache = PrefilterCache(self.prefilter_cache_dir) if self.prefilter_cache_dir else None;
           for filename_real,filename_imag in self._vb_key:
             # if files do not exist, replace with blanks
             dprint(0,"loading beam files",filename_real,filename_imag)
@@ -521,7 +808,7 @@ if not standalone:
                     l0=self.l_beam_offset,m0=self.m_beam_offset,
                     l_axis=self.l_axis,m_axis=self.m_axis,
                     ampl_interpolation=self.ampl_interpolation,spline_order=self.spline_order,
-                    verbose=self.verbose);
+                    prefilter_cache=cache,num_threads=self.num_threads,verbose=self.verbose);
               vb.read(filename_real,filename_imag);
             else:
               vb = None;
@@ -535,11 +822,12 @@ if not standalone:
             xx,xy,yx,yy = [ vb.beam() if vb else 0 for vb in vbs ];
             beam_max = math.sqrt((abs(xx)**2+abs(xy)**2+abs(yx)**2+abs(yy)**2).max()/2);
           dprint(1,"beam max is",beam_max);
+          vbs = LMVoltageBeamStack(vbs,prefilter_cache=cache);
           _voltage_beams[self._vb_key] = vbs,beam_max;
         return vbs,beam_max;
 
     def get_result (self,request,*children):
-      # get list of VoltageBeams
+      # get stack of VoltageBeams
       vbs,beam_max = self.init_voltage_beams();
       # now, figure out the lm and time/freq grid
       # lm may be a 2/3-vector or an Nx2/3 tensor
@@ -570,29 +858,35 @@ if not standalone:
           values = _cells_grid(request,axis);
         if values is not None:
           grid[axis] = values;
-      vellsets = [];
-      # now loop over sources and interpolte
+      # put l,m of all sources into grid, stacked along a new first axis, so that the beams are interpolated
+      # for all sources in one go. The freq axis is then shifted by one.
+      ls,ms = [],[];
       for isrc in range(nsrc):
-        # put l,m into grid
         l,m = lm.vellsets[isrc*nlm].value,lm.vellsets[isrc*nlm+1].value;
-        l,dl = unite_shapes(l,dl);
-        m,dm = unite_shapes(m,dm);
-        grid['l'] = l - dl;
-        grid['m'] = m - dm;
-        # interpolate
-        for vb in vbs:
-          if vb is None:
+        l,dl1 = unite_shapes(l,dl);
+        m,dm1 = unite_shapes(m,dm);
+        ls.append(l - dl1);
+        ms.append(m - dm1);
+      grid['l'] = stack_arrays(ls);
+      grid['m'] = stack_arrays(ms);
+      # interpolate
+      beams = vbs.interpolate(freqaxis=self._freqaxis+1,**grid);
+      if self.normalize and beam_max != 0:
+        for beam in beams:
+          if beam is not None:
+            beam /= beam_max;
+      vellsets = [];
+      for isrc in range(nsrc):
+        for beam in beams:
+          if beam is None:
             vellsets.append(meq.vellset(meq.sca_vells(0.)));
           else:
-            beam = vb.interpolate(freqaxis=self._freqaxis,**grid);
-            if self.normalize and beam_max != 0:
-              beam /= beam_max;
-            vells = meq.complex_vells(beam.shape);
-            vells[...] = beam[...];
+            vells = meq.complex_vells(beam.shape[1:]);
+            vells[...] = beam[isrc,...];
             # make vells and return result
             vellsets.append(meq.vellset(vells));
       # create result object
-      cells = request.cells if vb.hasFrequencyAxis() else getattr(lm,'cells',None);
+      cells = request.cells if vbs.hasFrequencyAxis() else getattr(lm,'cells',None);
       result = meq.result(vellsets[0],cells=cells);
       if len(vellsets) > 1:
         result.vellsets[1:] = vellsets[1:];
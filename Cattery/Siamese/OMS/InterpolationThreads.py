@@ -0,0 +1,62 @@
+"""Thread pool support for the beam interpolators.
+
+scipy.ndimage.map_coordinates() releases the GIL while it interpolates, so interpolating different beam planes
+(real/imaginary parts, elements, frequency planes), or different chunks of points, in several threads runs in
+parallel. The interpolators build a list of jobs that each fill their own part of a preallocated output array, and
+run them with run_jobs(). With num_threads<=1 everything is done serially in the calling thread, as before.
+""";
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from scipy.ndimage import interpolation
+
+# points are not split into chunks smaller than this, since the per-job overhead would dominate
+MIN_CHUNK = 8192;
+
+# thread pools, per number of threads. These are created on first use, and shared by all interpolators.
+_pools = {};
+_pools_lock = threading.Lock();
+
+def get_pool (num_threads):
+  """Returns a pool of num_threads threads""";
+  with _pools_lock:
+    pool = _pools.get(num_threads);
+    if pool is None:
+      pool = _pools[num_threads] = ThreadPool(num_threads);
+    return pool;
+
+def _call (job):
+  return job();
+
+def run_jobs (jobs,num_threads=0):
+  """Calls each of the given callables (which take no arguments), in a pool of num_threads threads if num_threads>1,
+  else serially. Returns list of results.""";
+  if num_threads > 1 and len(jobs) > 1:
+    return get_pool(num_threads).map(_call,jobs,chunksize=1);
+  return [ job() for job in jobs ];
+
+def chunks (npoints,njobs,num_threads=0):
+  """Splits npoints points into chunks, so that a total of about num_threads jobs results when each of njobs jobs
+  is split up (plus some slack to even out the load). Returns list of slices.""";
+  nchunks = 1;
+  if num_threads > 1 and njobs < num_threads*2:
+    nchunks = max(min((num_threads*2+njobs-1)//njobs,npoints//MIN_CHUNK),1);
+  step = max((npoints+nchunks-1)//nchunks,1);
+  return [ slice(i0,min(i0+step,npoints)) for i0 in range(0,npoints,step) ] or [ slice(0,0) ];
+
+def interpolation_jobs (planes,coords,output,num_threads=0,**kw):
+  """Returns a list of jobs (for run_jobs()) that interpolate each of the given planes (N-dimensional real arrays)
+  at the (N,npoints) coordinates, into the corresponding row of the (nplanes,npoints) output array. Keyword arguments
+  are passed to map_coordinates(). The work is split across planes and chunks of points.""";
+  jobs = [];
+  for plane,out in zip(planes,output):
+    for sl in chunks(coords.shape[1],len(planes),num_threads):
+      jobs.append(lambda plane=plane,out=out[sl],sl=sl:interpolation.map_coordinates(plane,coords[:,sl],output=out,**kw));
+  return jobs;
+
+def map_coordinates (planes,coords,output,num_threads=0,**kw):
+  """Interpolates planes at the given coordinates into the output array, as described in interpolation_jobs(),
+  and returns the output array.""";
+  run_jobs(interpolation_jobs(planes,coords,output,num_threads,**kw),num_threads);
+  return output;
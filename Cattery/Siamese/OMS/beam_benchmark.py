@@ -0,0 +1,224 @@
+"""Offline benchmark of the interpolated beam models.
+
+Generates synthetic beam patterns, and interpolates them at random l/m points over a range of frequencies, without
+a meqserver, using different numbers of interpolation threads (see InterpolationThreads). Two models are benchmarked:
+
+    fits:   a stack of four LMVoltageBeams (the XX/XY/YX/YY elements of a Jones matrix), read from FITS cubes with a
+            frequency axis, as used by pybeams_fits
+    emss:   an EMSSVoltageBeamPS read from a set of EMSS pattern files (one per frequency), as used by emss_polar_beams
+
+For each model and number of threads, the following is reported:
+
+    points:     number of l/m points (sources x times) interpolated per call
+    nfreq:      number of frequencies per call
+    wall_s:     wall time per call, in seconds (best of --repeat calls)
+    speedup:    speedup relative to the first (usually single-threaded) entry for the same model
+    mpoints_s:  interpolated values (points x frequencies x beams) per second, in millions
+
+Results can be written to a file (as JSON lines). Run with --help for options.
+""";
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import multiprocessing
+import numpy
+
+import Kittens.utils
+pyfits = Kittens.utils.import_pyfits();
+
+from Siamese.OMS import InterpolatedBeams
+from Siamese.OMS.emss_beams import EMSSVoltageBeam
+
+MODELS = [ "fits","emss" ];
+
+DEG = InterpolatedBeams.DEG;
+
+
+def smooth_pattern (shape,rs):
+  """Makes a smooth random complex pattern of the given shape, peaked at the centre of the first two axes""";
+  x = numpy.linspace(-1,1,shape[0])[:,numpy.newaxis];
+  y = numpy.linspace(-1,1,shape[1])[numpy.newaxis,:];
+  envelope = numpy.cos(numpy.clip(numpy.sqrt(x**2+y**2),0,1)*numpy.pi/2);
+  pattern = numpy.empty(shape,complex);
+  for i in range(shape[2]):
+    phase = rs.uniform(0,2*numpy.pi)+rs.uniform(-1,1)*x+rs.uniform(-1,1)*y;
+    pattern[:,:,i] = envelope*(1+.01*i)*numpy.exp(1j*phase);
+  return pattern;
+
+
+def make_fits_beams (dirname,npix,freqs,rs):
+  """Writes synthetic FITS beams (real and imaginary part for each of four Jones elements), of npix x npix pixels
+  of 0.1 deg, with the given frequency axis. Returns list of (filename_real,filename_imag)""";
+  filenames = [];
+  for elem in "xx","xy","yx","yy":
+    cube = smooth_pattern((npix,npix,len(freqs)),rs);
+    if elem in ("xy","yx"):
+      cube *= .01;
+    names = [];
+    for part,data in ("re",cube.real),("im",cube.imag):
+      hdu = pyfits.PrimaryHDU(data.transpose().copy());
+      hdr = hdu.header;
+      for iaxis,(ctype,crpix,crval,cdelt) in enumerate([("L",npix//2+1,0.,.1),("M",npix//2+1,0.,.1),
+          ("FREQ",1,freqs[0],(freqs[-1]-freqs[0])/max(len(freqs)-1,1) or 1.)]):
+        hdr.update("CTYPE%d"%(iaxis+1),ctype);
+        hdr.update("CRPIX%d"%(iaxis+1),crpix);
+        hdr.update("CRVAL%d"%(iaxis+1),crval);
+        hdr.update("CDELT%d"%(iaxis+1),cdelt);
+      names.append(os.path.join(dirname,"beam_%s_%s.fits"%(elem,part)));
+      hdu.writeto(names[-1]);
+    filenames.append(tuple(names));
+  return filenames;
+
+
+def make_emss_patterns (dirname,ntheta,nphi,freqs,rs):
+  """Writes synthetic EMSS pattern files, one per frequency, on a grid of ntheta x nphi points over 0...90 deg
+  in theta and 0...360 deg in phi. Returns list of filenames""";
+  theta = numpy.linspace(0,90,ntheta);
+  phi = numpy.linspace(0,360,nphi);
+  filenames = [];
+  for freq in freqs:
+    pattern = smooth_pattern((nphi,ntheta,2),rs);
+    # the phi=360 row must match phi=0
+    pattern[-1,...] = pattern[0,...];
+    name = os.path.join(dirname,"pattern_%d.pat"%(freq*1e-6));
+    ff = open(name,"w");
+    ff.write("frequency = %g MHz\n"%(freq*1e-6));
+    for iphi,ph in enumerate(phi):
+      for ith,th in enumerate(theta):
+        eth,eph = pattern[iphi,ith,:];
+        ff.write("%g %g (%.8e, %.8e) (%.8e, %.8e)\n"%(th,ph,eth.real,eth.imag,eph.real,eph.imag));
+    ff.close();
+    filenames.append(name);
+  return filenames;
+
+
+def beam_freqs (freqs,nmax=8):
+  """Returns the frequency grid of the synthetic beams: up to nmax frequencies spanning the same range as freqs""";
+  return numpy.linspace(freqs[0],freqs[-1],min(len(freqs),nmax));
+
+
+def best_time (func,repeat):
+  """Calls func repeat times, returns the fastest wall time""";
+  times = [];
+  for i in range(max(repeat,1)):
+    t0 = time.time();
+    func();
+    times.append(time.time()-t0);
+  return min(times);
+
+
+def run_fits (dirname,threads,nsrc,ntime,freqs,npix,spline_order,repeat,rs):
+  """Benchmarks a stack of FITS beams for each number of threads. Returns list of dicts of results""";
+  filenames = make_fits_beams(dirname,npix,beam_freqs(freqs),rs);
+  radius = npix*.1/3;
+  l = InterpolatedBeams.stack_arrays([ rs.uniform(-radius,radius,(ntime,1))*DEG for i in range(nsrc) ]);
+  m = InterpolatedBeams.stack_arrays([ rs.uniform(-radius,radius,(ntime,1))*DEG for i in range(nsrc) ]);
+  results = [];
+  for num_threads in threads:
+    beams = [];
+    for filename_real,filename_imag in filenames:
+      vb = InterpolatedBeams.LMVoltageBeam(spline_order=spline_order,num_threads=num_threads);
+      vb.read(filename_real,filename_imag);
+      beams.append(vb);
+    stack = InterpolatedBeams.LMVoltageBeamStack(beams);
+    wall = best_time(lambda:stack.interpolate(l=l,m=m,freq=freqs,freqaxis=2),repeat);
+    results.append(dict(model="fits",threads=num_threads,points=nsrc*ntime,nfreq=len(freqs),wall_s=wall,
+                        mpoints_s=nsrc*ntime*len(freqs)*len(beams)/wall*1e-6));
+  return results;
+
+
+def run_emss (dirname,threads,nsrc,ntime,freqs,ntheta,nphi,spline_order,repeat,rs):
+  """Benchmarks an EMSS beam for each number of threads. Returns list of dicts of results""";
+  filenames = make_emss_patterns(dirname,ntheta,nphi,beam_freqs(freqs),rs);
+  npoints = nsrc*ntime;
+  l = rs.uniform(-.5,.5,npoints);
+  m = rs.uniform(-.5,.5,npoints);
+  results = [];
+  for num_threads in threads:
+    vb = EMSSVoltageBeam.EMSSVoltageBeamPS(filenames,spline_order=spline_order,num_threads=num_threads);
+    wall = best_time(lambda:vb.interpolate(l,m,freq=freqs,freqaxis=1,extra_axes=1),repeat);
+    results.append(dict(model="emss",threads=num_threads,points=npoints,nfreq=len(freqs),wall_s=wall,
+                        mpoints_s=npoints*len(freqs)/wall*1e-6));
+  return results;
+
+
+def _parse_list (value,convert=int):
+  return [ convert(x) for x in value.split(",") if x ];
+
+
+if __name__ == "__main__":
+  from optparse import OptionParser
+
+  ncpu = multiprocessing.cpu_count();
+  default_threads = [ 1 ];
+  while default_threads[-1]*2 <= ncpu:
+    default_threads.append(default_threads[-1]*2);
+
+  parser = OptionParser(usage="""%prog: [options]""",
+      description="Benchmarks interpolated beam models on synthetic beam patterns.");
+  parser.add_option("-m","--models",type="string",default=",".join(MODELS),
+                    help="comma-separated list of beam models (default %default)");
+  parser.add_option("-j","--threads",type="string",default=",".join(map(str,default_threads)),
+                    help="comma-separated list of thread counts (default %default)");
+  parser.add_option("-s","--sources",type="int",default=200,
+                    help="number of sources (default %default)");
+  parser.add_option("-t","--times",type="int",default=10,
+                    help="number of timeslots per source (default %default)");
+  parser.add_option("-f","--freqs",type="int",default=64,
+                    help="number of frequencies (default %default)");
+  parser.add_option("--npix",type="int",default=256,
+                    help="size of synthetic FITS beams, in pixels (default %default)");
+  parser.add_option("--theta",type="int",default=91,
+                    help="number of theta points of synthetic EMSS patterns (default %default)");
+  parser.add_option("--phi",type="int",default=181,
+                    help="number of phi points of synthetic EMSS patterns (default %default)");
+  parser.add_option("--spline-order",type="int",default=3,
+                    help="spline order (default %default)");
+  parser.add_option("-r","--repeat",type="int",default=3,
+                    help="number of calls per configuration, the fastest is reported (default %default)");
+  parser.add_option("--seed",type="int",default=0,
+                    help="random seed (default %default)");
+  parser.add_option("-o","--output",type="string",
+                    help="write results to file, as JSON lines");
+  (options,args) = parser.parse_args();
+  if args:
+    parser.error("incorrect number of arguments");
+
+  threads = _parse_list(options.threads);
+  freqs = numpy.linspace(1e9,1.4e9,options.freqs);
+  rs = numpy.random.RandomState(options.seed);
+  dirname = tempfile.mkdtemp(prefix="beam_benchmark");
+
+  # columns of the results table, as name,width,format
+  columns = [ ("model",-6,"s"),("threads",7,"d"),("points",8,"d"),("nfreq",5,"d"),("wall_s",8,".3f"),
+              ("speedup",7,".2f"),("mpoints_s",9,".2f") ];
+  print " ".join([ "%*s"%(width,name) for name,width,fmt in columns ]);
+  results = [];
+  try:
+    for model in _parse_list(options.models,str):
+      if model == "fits":
+        recs = run_fits(dirname,threads,options.sources,options.times,freqs,options.npix,options.spline_order,
+                        options.repeat,rs);
+      elif model == "emss":
+        recs = run_emss(dirname,threads,options.sources,options.times,freqs,options.theta,options.phi,
+                        options.spline_order,options.repeat,rs);
+      else:
+        parser.error("unknown beam model '%s'"%model);
+      for rec in recs:
+        rec['speedup'] = recs[0]['wall_s']/rec['wall_s'] if rec['wall_s'] else 0.;
+        results.append(rec);
+        print " ".join([ ("%%%d%s"%(width,fmt))%rec[name] for name,width,fmt in columns ]);
+        sys.stdout.flush();
+  finally:
+    shutil.rmtree(dirname,ignore_errors=True);
+
+  if options.output:
+    ff = open(options.output,"w");
+    for rec in results:
+      ff.write(json.dumps(rec,sort_keys=True)+"\n");
+    ff.close();
+    print "Wrote %d result(s) to %s"%(len(results),options.output);
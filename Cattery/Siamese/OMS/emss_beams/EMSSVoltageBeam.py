@@ -165,8 +165,8 @@ class EMSSVoltageBeamPS (InterpolatedVoltageBeam):
   This uses map_coordinates to interpolate values in polar coordinates (i.e. l/m inputs
   are converted to phi/theta, and interpolated in that grid)."""
   def __init__ (self,filenames,y=True,hier_interpol=True,spline_order=3,theta_step=1,phi_step=1,rotate=0,
-      rotate_xy=True,proj_theta=False,normalization_factor=1,verbose=0):
-    InterpolatedVoltageBeam.__init__(self,spline_order=spline_order,hier_interpol=hier_interpol);
+      rotate_xy=True,proj_theta=False,normalization_factor=1,num_threads=0,verbose=0):
+    InterpolatedVoltageBeam.__init__(self,spline_order=spline_order,hier_interpol=hier_interpol,num_threads=num_threads);
     self._theta_step = theta_step;
     self._phi_step = phi_step;
     self._rotate = rotate*DEG;
@@ -214,8 +214,9 @@ class EMSSVoltageBeamPS (InterpolatedVoltageBeam):
           (",".join(["%f"%(x*1e-6) for x in freq[oob]]),freqgrid[0]*1e-6,freqgrid[-1]*1e-6));
         dprint(0,"Doing frequency extrapolation instead");
         self._freq_warning = True;
-      freqcoord[freq<=freqgrid[0]]  = - freq/freqgrid[0]     # lm multiplied by negative of this 
-      freqcoord[freq>=freqgrid[-1]] = - freq/freqgrid[-1]   
+      below,above = freq<=freqgrid[0],freq>=freqgrid[-1];
+      freqcoord[below] = - freq[below]/freqgrid[0]     # lm multiplied by negative of this 
+      freqcoord[above] = - freq[above]/freqgrid[-1]   
     return freqcoord;
 
   @staticmethod
@@ -4,6 +4,7 @@ import math
 import numpy
 from scipy.ndimage import interpolation
 import Kittens.utils
+from Siamese.OMS import InterpolationThreads
 
 _verbosity = Kittens.utils.verbosity(name="vb");
 #_verbosity.set_verbose(3)
@@ -85,10 +86,26 @@ def unite_multiple_shapes (*arr0):
                 [ "[%s]"%(",".join(map(str,x.shape))) if x is not None else "[]" for x in arr0 ]);
   return arr;
 
+def unique_points (*coords):
+  """Finds the unique points in a set of coordinate vectors (all of the same length N).
+  Returns a tuple of (coords,index), where coords is a list of vectors giving the coordinates of the unique points,
+  and index is an N-vector such that coords[i][index] gives back the original coordinates. If all points are
+  unique, the original coords are returned, and index is None.
+  """
+  pts = numpy.ascontiguousarray(numpy.vstack(coords).T,dtype=float);
+  # view each point as a single opaque value, so that numpy.unique() compares points as a whole
+  view = pts.view(numpy.dtype((numpy.void,pts.dtype.itemsize*pts.shape[1]))).ravel();
+  _,first,index = numpy.unique(view,return_index=True,return_inverse=True);
+  if len(first) == len(view):
+    return coords,None;
+  return [ numpy.asarray(x)[first] for x in coords ],index;
+
 class InterpolatedVoltageBeam (object):
   """This class implements a complex (interpolated) voltage beam as a function of LM."""
-  def __init__ (self,hier_interpol=True,spline_order=2,l0=0,m0=0):
+  def __init__ (self,hier_interpol=True,spline_order=2,l0=0,m0=0,num_threads=0):
     self._spline_order = spline_order;
+    # if >1, interpolation is done in a pool of this many threads (see InterpolationThreads)
+    self.num_threads = num_threads;
     self.l0,self.m0 = l0,m0;
     self._hier_interpol = hier_interpol;
     self.interpolate = self.interpolate_linfreq if hier_interpol else self.interpolate_3d;
@@ -264,16 +281,17 @@ class InterpolatedVoltageBeam (object):
           dprint(1,l,m,"phases",numpy.angle(self._beam[l,m,:])/DEG);
     
     dprint(3,"interpolating %s coordinate points to output shape %s"%(coords.shape,output_shape));
-    # interpolate real and imag parts separately
-    output.real = interpolation.map_coordinates(self._beam_real,coords,order=self._spline_order,mode='nearest',
-                    prefilter=(self._spline_order==1)).reshape(output_shape);
-    output.imag = interpolation.map_coordinates(self._beam_imag,coords,order=self._spline_order,mode='nearest',
-                    prefilter=(self._spline_order==1)).reshape(output_shape);
+    # interpolate real, imag and amplitude planes separately
+    values = numpy.empty((3,coords.shape[1]),float);
+    InterpolationThreads.map_coordinates((self._beam_real,self._beam_imag,self._beam_ampl),coords,values,
+                    num_threads=self.num_threads,order=self._spline_order,mode='nearest',
+                    prefilter=(self._spline_order==1));
+    output.real = values[0].reshape(output_shape);
+    output.imag = values[1].reshape(output_shape);
     output[~(numpy.isfinite(output))] = 0;
     if mask is not None:
       output[mask] = 0;
-    output_ampl = interpolation.map_coordinates(self._beam_ampl,coords,order=self._spline_order,mode='nearest',
-                    prefilter=(self._spline_order==1)).reshape(output_shape);
+    output_ampl = values[2].reshape(output_shape);
     output_ampl[~(numpy.isfinite(output_ampl))] = 0;
     phase_array = numpy.angle(output);
     output.real = output_ampl * numpy.cos(phase_array);
@@ -289,31 +307,44 @@ class InterpolatedVoltageBeam (object):
     
     return output;
     
-  def _interpolate_freqplane (self,ifreq,coords,verbose=False):
-    val = self._freqplanes.get(ifreq);
-    if val is None:
+  def _interpolate_freqplanes (self,keys,coords,verbose=False):
+    """Interpolates frequency planes of the beam at the given coordinates (only the l/m rows of coords are used).
+    keys is a list of (ifreq,scale) pairs, where ifreq is the number of the plane, and scale is a factor applied to
+    the coordinates (for frequencies outside the beam's range, which are extrapolated). All the planes are
+    interpolated at once, using num_threads threads.
+    Returns dict of (ifreq,scale) -> (complex value,amplitude) arrays of shape self._freqplane_shape.""";
+    keys = sorted(set(keys));
+    npoints = coords.shape[1];
+    # set up one job per (plane,part,chunk of points) for the pool, with a preallocated output array per scale
+    jobs = [];
+    outputs = [];
+    for scale in sorted(set([ sc for ifreq,sc in keys ])):
+      ifreqs = [ ifreq for ifreq,sc in keys if sc == scale ];
+      planes = [ beam[...,ifreq] for ifreq in ifreqs for beam in (self._beam_real,self._beam_imag,self._beam_ampl) ];
+      values = numpy.empty((len(planes),npoints),float);
+      jobs += InterpolationThreads.interpolation_jobs(planes,coords[:2,...]*scale,values,num_threads=self.num_threads,
+                    order=self._spline_order,mode='nearest',prefilter=(self._spline_order==1));
+      outputs += [ ((ifreq,scale),values[3*i:3*i+3]) for i,ifreq in enumerate(ifreqs) ];
+    InterpolationThreads.run_jobs(jobs,self.num_threads);
+    freqplanes = {};
+    for key,(re,im,ampl) in outputs:
       output = numpy.zeros(self._freqplane_shape,complex);
-      # interpolate real and imag parts separately
-      output.real = interpolation.map_coordinates(self._beam_real[...,ifreq],coords[:2,...],mode='nearest',
-                      order=self._spline_order,prefilter=(self._spline_order==1)).reshape(self._freqplane_shape);
-      output.imag = interpolation.map_coordinates(self._beam_imag[...,ifreq],coords[:2,...],mode='nearest',
-                      order=self._spline_order,prefilter=(self._spline_order==1)).reshape(self._freqplane_shape);
-      output_ampl = interpolation.map_coordinates(self._beam_ampl[...,ifreq],coords[:2,...],mode='nearest',
-                      order=self._spline_order,prefilter=(self._spline_order==1)).reshape(self._freqplane_shape);
+      output.real = re.reshape(self._freqplane_shape);
+      output.imag = im.reshape(self._freqplane_shape);
+      output_ampl = ampl.reshape(self._freqplane_shape);
       output[~(numpy.isfinite(output))] = 0;
       output_ampl[~(numpy.isfinite(output_ampl))] = 0;
       if verbose:
         l0,m0,freq = coords[:,0];
         for l in int(l0),int(l0)+1:
           for m in int(m0),int(m0)+1:
-            dprint(0,l,m,freq,"beam plane amplitude",abs(self._beam[l,m,ifreq]),self._beam_ampl[l,m,ifreq]);
+            dprint(0,l,m,freq,"beam plane amplitude",abs(self._beam[l,m,key[0]]),self._beam_ampl[l,m,key[0]]);
         dprint(0,"interpolated amplitude",output_ampl[0]);
       phase_array = numpy.angle(output);
       output.real = output_ampl * numpy.cos(phase_array);
       output.imag = output_ampl * numpy.sin(phase_array);
-      val = self._freqplanes[ifreq] = output,output_ampl;
-    return val;
-    
+      freqplanes[key] = output,output_ampl;
+    return freqplanes;
 
   def interpolate_linfreq (self,l,m,freq,thetaphi=False,rotate=None,time=None,freqaxis=1,output=None,mask=None,extra_axes=0):
     """Interpolates beam into the given l/m (default) or theta/phi (thetaphi=True) coordinates,
@@ -365,34 +396,46 @@ class InterpolatedVoltageBeam (object):
     freqslice = [slice(None)]*len(output_shape);
     reduced_slice = [slice(None)]*len(output_shape);
     reduced_slice[freqaxis] = 0; 
-    for ifreq,freq in enumerate(freqcoord):
-      freqslice[freqaxis] = ifreq;
+    reduced_slice = tuple(reduced_slice);
+    # work out which frequency planes each frequency needs, as a list of (ifreq,scale,weight). Frequencies below
+    # or above the beam's range use the first or last plane, with lm scaled by -freq.
+    nplanes = len(self._freq_grid);
+    plane_weights = [];
+    for freq in freqcoord:
       if freq < -1:
-        coords *= - freq
-        output[freqslice] = self._interpolate_freqplane(len(self._freq_grid)-1,coords)[0][reduced_slice]
+        plane_weights.append([(nplanes-1,-freq,1)]);
       elif freq < 0:
-        coords *= - freq
-        output[freqslice] = self._interpolate_freqplane(0,coords)[0][reduced_slice]
+        plane_weights.append([(0,-freq,1)]);
       elif freq == 0:
-        output[freqslice] = self._interpolate_freqplane(0,coords)[0][reduced_slice]
-      elif freq >= len(self._freq_grid)-1:
-        output[freqslice] = self._interpolate_freqplane(len(self._freq_grid)-1,coords)[0][reduced_slice]
+        plane_weights.append([(0,1,1)]);
+      elif freq >= nplanes-1:
+        plane_weights.append([(nplanes-1,1,1)]);
       else:
         f0,f1 = int(freq),int(freq)+1;
-        (c0,abs0),(c1,abs1) = self._interpolate_freqplane(f0,coords,
-                  verbose and not ifreq),self._interpolate_freqplane(f1,coords,verbose and not ifreq)
+        plane_weights.append([(f0,1,f1-freq),(f1,1,freq-f0)]);
+    # interpolate all the planes needed in one go
+    self._freqplanes = self._interpolate_freqplanes([ (ifreq,scale) for pw in plane_weights for ifreq,scale,w in pw ],
+                                                    coords,verbose=verbose);
+    for ifreq,pw in enumerate(plane_weights):
+      freqslice[freqaxis] = ifreq;
+      fslice = tuple(freqslice);
+      if len(pw) == 1:
+        output[fslice] = self._freqplanes[pw[0][:2]][0][reduced_slice];
+      else:
+        (f0,sc0,w0),(f1,sc1,w1) = pw;
+        (c0,abs0),(c1,abs1) = self._freqplanes[f0,sc0],self._freqplanes[f1,sc1];
         if verbose>1 and not ifreq:
           dprint(0,"per-plane weights",f0,f1);
           dprint(0,"per-plane amplitudes",abs0[0],abs1[0]);
           dprint(0,"per-plane phases",numpy.angle(c0)/DEG,numpy.angle(c1)/DEG);
-        ax = abs0*(f1-freq) + abs1*(freq-f0);
-        cx = c0*(f1-freq) + c1*(freq-f0);
+        ax = abs0*w0 + abs1*w1;
+        cx = c0*w0 + c1*w1;
         px = numpy.angle(cx);
-        output[freqslice].real = (ax*numpy.cos(px))[reduced_slice];
-        output[freqslice].imag = (ax*numpy.sin(px))[reduced_slice];
+        output[fslice].real = (ax*numpy.cos(px))[reduced_slice];
+        output[fslice].imag = (ax*numpy.sin(px))[reduced_slice];
       # apply mask, if any
       if mask is not None:
-        output[freqslice][mask] = 0;
+        output[fslice][mask] = 0;
     
     dprint(3,"interpolated value [0] is",output.ravel()[0]);
     # dprint(4,"interpolated value is",output);
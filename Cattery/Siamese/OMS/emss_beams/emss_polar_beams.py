@@ -54,7 +54,7 @@ DEG = math.pi/180;
 
 import EMSSVoltageBeam
 import InterpolatedVoltageBeam
-from InterpolatedVoltageBeam import unite_shapes,unite_multiple_shapes
+from InterpolatedVoltageBeam import unite_shapes,unite_multiple_shapes,unique_points
 
 SYM_SEPARATE = None;
 SYM_X = "X";
@@ -116,6 +116,9 @@ TDLCompileOption("horizon_masking","Include horizon masking",False,doc="""<P>
   If True, then horizon masking will be included. This may slow things down.</P>""");
 TDLCompileOption("randomize_rotation","Include random rotational offsets",False,doc="""<P>
   If True, then each station's beam will be rotated by an arbitrary amount. This can help randomize the sidelobes.</P>""");
+TDLCompileOption("num_threads","Number of interpolation threads",[0,2,4,8,16],more=int,
+  doc="""<P>If >1, beam interpolation is split across this many threads. Use 0 for single-threaded
+  interpolation.</P>""");
 TDLCompileOption("verbose_level","Debugging message level",[None,1,2,3],more=int);
 
 def _cells_grid (obj,axis):
@@ -149,6 +152,8 @@ class EMSSPolarBeamInterpolatorNode (pynode.PyNode):
     mystate('beam_symmetry',None);
     mystate('normalization_factor',1);
     mystate('rotate_xy',True);
+    # number of threads to interpolate in, see InterpolationThreads. 0 or 1 for no threads.
+    mystate('num_threads',0);
     # other init
     mequtils.add_axis('l');
     mequtils.add_axis('m');
@@ -189,7 +194,7 @@ class EMSSPolarBeamInterpolatorNode (pynode.PyNode):
             vb = _voltage_beams[vbkey] = EMSSVoltageBeam.EMSSVoltageBeamPS(files_per_xy,y=yarg,rotate=rotate,
                         spline_order=self.spline_order,hier_interpol=self.hier_interpol,
                         rotate_xy=self.rotate_xy,normalization_factor=self.normalization_factor,
-                        proj_theta=False,verbose=self.verbose);
+                        proj_theta=False,num_threads=self.num_threads,verbose=self.verbose);
           vbmat.append(vb);
       self._vbs.append(vbmat);
     return self._vbs;
@@ -264,8 +269,13 @@ class EMSSPolarBeamInterpolatorNode (pynode.PyNode):
       lcube,mcube,maskcube,rotate = unite_multiple_shapes(lcube,mcube,maskcube,rotate.reshape([1]+list(rotate.shape)));
       cubeshape = list(lcube.shape);
       rotate = rotate.ravel();
-    # ok, we've stacked things into lm cubes, interpolate
-    grid['l'],grid['m'] = lcube.ravel(),mcube.ravel();
+    # ok, we've stacked things into lm cubes. Many sources/timeslots may share the same l/m (and rotation),
+    # so only interpolate the unique points, and expand the results afterwards
+    points,index = unique_points(*([lcube.ravel(),mcube.ravel()] + ([rotate] if rotate is not None else [])));
+    dprint(2,"interpolating %d unique points out of %d"%(len(points[0]),lcube.size));
+    grid['l'],grid['m'] = points[:2];
+    if rotate is not None:
+      rotate = points[2];
     # loop over all 2x2 matrices (we may have several, they all need to be added)
     E = [None]*4;
     for vbmat in vbs:
@@ -275,6 +285,8 @@ class EMSSPolarBeamInterpolatorNode (pynode.PyNode):
           E[i] = beam;
         else:
           E[i] += beam;
+    if index is not None:
+      E = [ ej[index,...] for ej in E ];
     # The l/m cubes have a shape of [nsrcs,lm_shape].
     # These are raveled for interpolation, so the resulting Es have a shape of [nsrcs*num_lm_points,num_freq]
     # Reshape them properly. Note that there's an extra "source" axis at the front, so the frequency axis
@@ -481,6 +493,7 @@ def make_beam_node (beam,pattern,lm,radec0=None,dlm=None,azel=None,pa=None):
                      l_beam_offset=l_beam_offset*DEG,m_beam_offset=m_beam_offset*DEG,
                      beam_symmetry=beam_symmetry,
                      normalization_factor=normalization_factor,rotate_xy=rotate_xy,
+                     num_threads=num_threads,
                      children=children);
 
 
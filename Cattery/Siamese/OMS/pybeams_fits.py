@@ -82,6 +82,14 @@ at the phase centre. You can use this option to offset the beam pattern.</P>""")
 TDLCompileOption("sky_rotation","Include sky rotation",True,doc="""<P>
   If True, then the beam will rotate on the sky with parallactic angle. Use for e.g. alt-az mounts.)
   </P>""");
+TDLCompileOption("prefilter_cache_dir","Cache directory for prefiltered beams",[None,"~/.cache/meqtrees/beams"],more=str,
+    doc="""<P>Prefiltering the beam patterns for spline interpolation can take a long time for large beam cubes.
+    If a directory is given here, the prefiltered beams are saved there, and loaded from there (nearly instantly)
+    the next time the same beam files are used with the same spline order and axis options.
+    </P>""");
+TDLCompileOption("num_threads","Number of interpolation threads",[0,2,4,8,16],more=int,
+    doc="""<P>If >1, beam interpolation is split across this many threads. Use 0 for single-threaded
+    interpolation.</P>""");
 TDLCompileOption("verbose_level","Debugging message level",[None,1,2,3],more=int);
 
 REIM = "re","im";
@@ -130,6 +138,7 @@ def make_beam_node (beam,pattern,*children):
                      l_beam_offset=l_beam_offset*DEG,m_beam_offset=m_beam_offset*DEG, 
                      l_axis=l_axis,m_axis=m_axis,
                      ampl_interpolation=ampl_interpolation,
+                     prefilter_cache_dir=prefilter_cache_dir or '',num_threads=num_threads,
                      children=children);
 
 def compute_jones (Jones,sources,stations=None,pointing_offsets=None,inspectors=[],label='E',**kw):